@@ -38,7 +38,12 @@ from torch.nn.utils import clip_grad_norm_
 from torch.utils.tensorboard import SummaryWriter
 from transformer import Noam
 
-from icefall.ali import convert_alignments_to_tensor, load_alignments, lookup_alignments
+from icefall.ali import (
+    AlignmentStore,
+    convert_alignments_to_tensor,
+    load_alignments,
+    lookup_alignments,
+)
 from icefall.checkpoint import load_checkpoint
 from icefall.checkpoint import save_checkpoint as save_checkpoint_impl
 from icefall.dist import cleanup_dist, setup_dist
@@ -750,7 +755,20 @@ def run(rank, world_size, args):
         optimizer.load_state_dict(checkpoints["optimizer"])
 
     train_960_ali_filename = Path(params.ali_dir) / "train-960.pt"
+    # Converted by ./local/convert_alignments_to_store.py
+    train_960_ali_dir = Path(params.ali_dir) / "train-960"
     if (
+        params.batch_idx_train < params.use_ali_until
+        and (train_960_ali_dir / "info.json").is_file()
+    ):
+        logging.info(f"Use pre-computed alignments from {train_960_ali_dir}")
+        train_ali = AlignmentStore(train_960_ali_dir)
+        assert train_ali.subsampling_factor == params.subsampling_factor
+        assert len(train_ali) == 843723, f"{len(train_ali)} vs 843723"
+
+        valid_ali = AlignmentStore(Path(params.ali_dir) / "valid")
+        assert valid_ali.subsampling_factor == params.subsampling_factor
+    elif (
         params.batch_idx_train < params.use_ali_until
         and train_960_ali_filename.is_file()
     ):
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+# Copyright    2023  Xiaomi Corp.
+#
+# See ../../../../LICENSE for clarification regarding multiple authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+This file converts alignments saved by `icefall.ali.save_alignments()`,
+e.g., data/ali_500/train-960.pt, to a directory that can be memory-mapped
+by `icefall.ali.AlignmentStore`, e.g., data/ali_500/train-960.
+
+Usage:
+
+./local/convert_alignments_to_store.py \
+  data/ali_500/train-960.pt \
+  data/ali_500/valid.pt
+
+conformer_mmi/train.py uses the converted alignments if they exist.
+"""
+
+import argparse
+import logging
+from pathlib import Path
+
+from icefall.ali import convert_alignments_to_store
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "filenames",
+        type=str,
+        nargs="+",
+        help="""Files saved by icefall.ali.save_alignments(). The output
+        directory of foo.pt is foo in the same directory.""",
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = get_args()
+    for filename in args.filenames:
+        filename = Path(filename)
+        out_dir = filename.with_suffix("")
+        if (out_dir / "info.json").is_file():
+            logging.info(f"{out_dir} exists - skipping")
+            continue
+        convert_alignments_to_store(filename, out_dir)
+
+
+if __name__ == "__main__":
+    formatter = "%(asctime)s %(levelname)s [%(filename)s:%(lineno)d] %(message)s"
+
+    logging.basicConfig(format=formatter, level=logging.INFO)
+    main()
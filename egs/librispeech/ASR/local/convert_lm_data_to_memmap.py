@@ -0,0 +1 @@
+../../../ptb/LM/local/convert_lm_data_to_memmap.py
\ No newline at end of file
@@ -11,6 +11,7 @@ set -eou pipefail
 # 1) Split long audios into chunks with overlaps.
 # 2) Perform speech recognition on chunks, getting tokens and timestamps.
 # 3) Merge the overlapped chunks into utterances acording to the timestamps.
+# Stage 5 runs stages 2-4 as a single pipelined and resumable job instead.
 
 # Each chunk (except the first and the last) is padded with extra left side and right side.
 # The chunk length is: left_side + chunk_size + right_side.
@@ -91,4 +92,24 @@ if [ $stage -le 4 ] && [ $stop_stage -ge 4 ]; then
     --extra $extra
 fi
 
-
+if [ $stage -le 5 ] && [ $stop_stage -ge 5 ]; then
+  # It is an alternative to stages 2-4, which does not save the chunk manifests.
+  # Run it with stage=5 and stop_stage=5 after stage 1.
+  # Final results are saved in $output_dir/manifests/librilight_cuts_{subset}.jsonl.gz
+  # If it is interrupted, run it again to resume.
+  log "Stage 5: Split, recognize and merge chunks in a pipeline."
+  for subset in small medium large; do
+    ./long_file_recog/recognize_pipelined.py \
+      --world-size $world_size \
+      --num-workers 8 \
+      --subset $subset \
+      --manifest-in-dir $output_dir/manifests \
+      --manifest-out-dir $output_dir/manifests \
+      --nn-model-filename long_file_recog/exp/jit_model.pt \
+      --bpe-model data/lang_bpe_500/bpe.model \
+      --chunk $chunk \
+      --extra $extra \
+      --max-duration 2400 \
+      --decoding-method greedy_search
+  done
+fi
@@ -73,6 +73,71 @@ def get_parser():
     return parser.parse_args()
 
 
+def merge_chunk_cuts(
+    cut_list: List[Cut], supervision: SupervisionSegment, extra: float
+) -> MonoCut:
+    """Merge the chunks of a recording into a cut of the whole recording.
+
+    Args:
+      cut_list:
+        The chunk-wise cuts of the recording, with recognition results.
+      supervision:
+        The supervision of the recording, containing the text file path.
+      extra:
+        Extra duration (in seconds) to drop at both sides of each chunk.
+    Returns:
+      Return a cut with the merged alignment.
+    """
+    rec_id = supervision.recording_id
+    for cut in cut_list:
+        assert cut.recording.id == rec_id, (cut.recording.id, rec_id)
+
+    # For each group with a same recording, sort it accroding to the start time
+    cut_list = sorted(cut_list, key=(lambda cut: cut.start))
+
+    rec = cut_list[0].recording
+    alignments = []
+    cur_end = 0
+    for cut in cut_list:
+        # Get left and right borders
+        left = cut.start + extra if cut.start > 0 else 0
+        chunk_end = cut.start + cut.duration
+        right = chunk_end - extra if chunk_end < rec.duration else rec.duration
+
+        # Assert the chunks are continuous
+        assert left == cur_end, (left, cur_end)
+        cur_end = right
+
+        assert len(cut.supervisions) == 1, len(cut.supervisions)
+        for ali in cut.supervisions[0].alignment["symbol"]:
+            t = ali.start + cut.start
+            if left <= t < right:
+                alignments.append(ali.with_offset(cut.start))
+
+    new_sup = SupervisionSegment(
+        id=rec_id,
+        recording_id=rec_id,
+        start=0,
+        duration=rec.duration,
+        alignment={"symbol": alignments},
+        language=supervision.language,
+        speaker=supervision.speaker,
+    )
+
+    utt_cut = MonoCut(
+        id=rec_id,
+        start=0,
+        duration=rec.duration,
+        channel=0,
+        recording=rec,
+        supervisions=[new_sup],
+    )
+    # Set a custom attribute to the cut
+    utt_cut.text_path = supervision.book
+
+    return utt_cut
+
+
 def merge_chunks(
     cuts_chunk: CutSet,
     supervisions: SupervisionSet,
@@ -101,60 +166,12 @@ def merge_chunks(
 
     def _merge(cut_list: List[Cut], rec_id: str, utt_idx: int):
         """Merge chunks with same recording_id."""
-        for cut in cut_list:
-            assert cut.recording.id == rec_id, (cut.recording.id, rec_id)
-
-        # For each group with a same recording, sort it accroding to the start time
-        # In fact, we don't need to do this since the cuts have been sorted
-        # according to the start time
-        cut_list = sorted(cut_list, key=(lambda cut: cut.start))
-
-        rec = cut_list[0].recording
-        alignments = []
-        cur_end = 0
-        for cut in cut_list:
-            # Get left and right borders
-            left = cut.start + extra if cut.start > 0 else 0
-            chunk_end = cut.start + cut.duration
-            right = chunk_end - extra if chunk_end < rec.duration else rec.duration
-
-            # Assert the chunks are continuous
-            assert left == cur_end, (left, cur_end)
-            cur_end = right
-
-            assert len(cut.supervisions) == 1, len(cut.supervisions)
-            for ali in cut.supervisions[0].alignment["symbol"]:
-                t = ali.start + cut.start
-                if left <= t < right:
-                    alignments.append(ali.with_offset(cut.start))
-
         old_sup = supervisions[rec_id]
         # Assuming the supervisions are sorted with the same recoding order as in cuts_chunk
         # old_sup = supervisions[utt_idx]
         assert old_sup.recording_id == rec_id, (old_sup.recording_id, rec_id)
 
-        new_sup = SupervisionSegment(
-            id=rec_id,
-            recording_id=rec_id,
-            start=0,
-            duration=rec.duration,
-            alignment={"symbol": alignments},
-            language=old_sup.language,
-            speaker=old_sup.speaker,
-        )
-
-        utt_cut = MonoCut(
-            id=rec_id,
-            start=0,
-            duration=rec.duration,
-            channel=0,
-            recording=rec,
-            supervisions=[new_sup],
-        )
-        # Set a custom attribute to the cut
-        utt_cut.text_path = old_sup.book
-
-        return utt_cut
+        return merge_chunk_cuts(cut_list, old_sup, extra)
 
     last_rec_id = None
     cut_list = []
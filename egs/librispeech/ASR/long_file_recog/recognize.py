@@ -229,6 +229,24 @@ def decode_one_batch(
     return hyps, timestamps, scores
 
 
+def set_alignment(
+    cut: Cut,
+    sp: spm.SentencePieceProcessor,
+    symbol_list: List[int],
+    time_list: List[float],
+    score_list: List[float],
+) -> None:
+    """Store the recognition result of a chunk as the alignment of its
+    supervision."""
+    symbol_list = sp.id_to_piece(symbol_list)
+    ali = [
+        AlignmentItem(symbol=symbol, start=start, duration=None, score=score)
+        for symbol, start, score in zip(symbol_list, time_list, score_list)
+    ]
+    assert len(cut.supervisions) == 1, len(cut.supervisions)
+    cut.supervisions[0].alignment = {"symbol": ali}
+
+
 def decode_dataset(
     dl: torch.utils.data.DataLoader,
     params: AttributeDict,
@@ -275,13 +293,7 @@ def decode_dataset(
         for cut, symbol_list, time_list, score_list in zip(
             cuts, hyps, timestamps, scores
         ):
-            symbol_list = sp.id_to_piece(symbol_list)
-            ali = [
-                AlignmentItem(symbol=symbol, start=start, duration=None, score=score)
-                for symbol, start, score in zip(symbol_list, time_list, score_list)
-            ]
-            assert len(cut.supervisions) == 1, len(cut.supervisions)
-            cut.supervisions[0].alignment = {"symbol": ali}
+            set_alignment(cut, sp, symbol_list, time_list, score_list)
             cuts_writer.write(cut, flush=True)
 
     num_cuts = 0
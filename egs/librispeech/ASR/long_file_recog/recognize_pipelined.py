@@ -0,0 +1,540 @@
+#!/usr/bin/env python3
+# Copyright 2023 Xiaomi Corporation (Author: Fangjun Kuang, Zengwei Yao)
+#
+# See ../../../../LICENSE for clarification regarding multiple authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+This script runs split_into_chunks.py, recognize.py and merge_chunks.py
+as a single pipeline, without writing the intermediate chunk manifests:
+
+  - The DataLoader workers read the recordings lazily, split each of them
+    into overlapping chunks and compute the features of a batch of chunks.
+  - The main process of each job decodes the batches. Once all chunks of a
+    recording are decoded, they are merged into a cut of the whole recording,
+    which is appended to the output manifest right away. Only the recordings
+    that are being decoded are kept in memory.
+
+Each job writes to {manifest-out-dir}/librilight_cuts_{subset}_job_{rank}.jsonl.
+If the script is interrupted, running it again skips the recordings that
+have been written. After all recordings are done, the results are combined
+into {manifest-out-dir}/librilight_cuts_{subset}.jsonl.gz, which is the same
+as the output of merge_chunks.py.
+
+Usage:
+
+./long_file_recog/recognize_pipelined.py \
+  --world-size 4 \
+  --num-workers 8 \
+  --subset small \
+  --manifest-in-dir data/librilight/manifests \
+  --manifest-out-dir data/librilight/manifests \
+  --nn-model-filename long_file_recog/exp/jit_model.pt \
+  --bpe-model data/lang_bpe_500/bpe.model \
+  --chunk 30.0 \
+  --extra 2.0 \
+  --max-duration 2400 \
+  --decoding-method greedy_search
+
+You can use the following command to get the exported models:
+
+./pruned_transducer_stateless7/export.py \
+  --exp-dir ./pruned_transducer_stateless7/exp \
+  --bpe-model data/lang_bpe_500/bpe.model \
+  --epoch 20 \
+  --avg 10 \
+  --jit 1
+"""
+
+import argparse
+import logging
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Set
+
+import k2
+import sentencepiece as spm
+import torch
+import torch.multiprocessing as mp
+import torch.nn as nn
+from asr_datamodule import SpeechRecognitionDataset
+from lhotse import CutSet, Fbank, FbankConfig, load_manifest, load_manifest_lazy
+from lhotse.audio import Recording
+from lhotse.cut import Cut, MonoCut
+from lhotse.dataset import OnTheFlyFeatures
+from lhotse.serialization import SequentialJsonlWriter
+from lhotse.supervision import SupervisionSet
+from merge_chunks import merge_chunk_cuts
+from recognize import decode_one_batch, get_params, set_alignment
+from torch.utils.data import DataLoader
+
+from icefall.utils import AttributeDict, setup_logger
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+
+    parser.add_argument(
+        "--world-size",
+        type=int,
+        default=1,
+        help="Number of decoding jobs. Each job uses one GPU if available, "
+        "otherwise one CPU process.",
+    )
+
+    parser.add_argument(
+        "--num-workers",
+        type=int,
+        default=2,
+        help="The number of DataLoader workers of each job, "
+        "which split the recordings and compute the features.",
+    )
+
+    parser.add_argument(
+        "--max-duration",
+        type=float,
+        default=600.0,
+        help="Maximum pooled chunk duration (in seconds) of a batch.",
+    )
+
+    parser.add_argument(
+        "--subset",
+        type=str,
+        default="small",
+        help="Subset to process. Possible values are 'small', 'medium', 'large'",
+    )
+
+    parser.add_argument(
+        "--manifest-in-dir",
+        type=Path,
+        default=Path("data/librilight/manifests"),
+        help="Path to directory of full utterances.",
+    )
+
+    parser.add_argument(
+        "--manifest-out-dir",
+        type=Path,
+        default=Path("data/librilight/manifests"),
+        help="Path to directory to save the cuts with recognition results.",
+    )
+
+    parser.add_argument(
+        "--log-dir",
+        type=Path,
+        default=Path("long_file_recog/log"),
+        help="Path to directory to save logs.",
+    )
+
+    parser.add_argument(
+        "--chunk",
+        type=float,
+        default=30.0,
+        help="""Duration (in seconds) of each chunk.""",
+    )
+
+    parser.add_argument(
+        "--extra",
+        type=float,
+        default=2.0,
+        help="""Extra duration (in seconds) at both sides.""",
+    )
+
+    parser.add_argument(
+        "--nn-model-filename",
+        type=str,
+        required=True,
+        help="Path to the torchscript model cpu_jit.pt",
+    )
+
+    parser.add_argument(
+        "--bpe-model",
+        type=str,
+        default="data/lang_bpe_500/bpe.model",
+        help="Path to the BPE model",
+    )
+
+    parser.add_argument(
+        "--decoding-method",
+        type=str,
+        default="greedy_search",
+        help="""Possible values are:
+          - greedy_search
+          - modified_beam_search
+          - fast_beam_search
+        """,
+    )
+
+    return parser
+
+
+class LongFileChunkDataset(torch.utils.data.IterableDataset):
+    """Split the recordings into overlapping chunks and yield batches of
+    chunks with their features.
+
+    The recordings are read lazily and sharded over the jobs and the
+    DataLoader workers of each job, so all chunks of a recording are
+    produced by the same worker, in order.
+
+    Each chunk has a custom attribute `num_chunks`, which is the number of
+    chunks of its recording.
+    """
+
+    def __init__(
+        self,
+        recordings_filename: Path,
+        chunk: float,
+        extra: float,
+        max_duration: float,
+        rank: int = 0,
+        world_size: int = 1,
+        done_ids: Optional[Set[str]] = None,
+    ):
+        """
+        Args:
+          recordings_filename:
+            Path to the recording manifest.
+          chunk:
+            Duration (in seconds) of each chunk.
+          extra:
+            Extra duration (in seconds) at both sides of each chunk.
+          max_duration:
+            Maximum pooled chunk duration (in seconds) of a batch.
+          rank:
+            Index of the current job.
+          world_size:
+            Number of jobs.
+          done_ids:
+            IDs of the recordings that have been recognized. They are skipped.
+        """
+        super().__init__()
+        assert chunk > 2 * extra, (chunk, extra)
+        self.recordings_filename = recordings_filename
+        self.chunk = chunk
+        self.extra = extra
+        self.max_duration = max_duration
+        self.rank = rank
+        self.world_size = world_size
+        self.done_ids = done_ids if done_ids is not None else set()
+        self.dataset = SpeechRecognitionDataset(
+            input_strategy=OnTheFlyFeatures(Fbank(FbankConfig(num_mel_bins=80))),
+            return_cuts=True,
+        )
+
+    def recordings(self) -> Iterator[Recording]:
+        """Yield the recordings of the current DataLoader worker."""
+        worker_info = torch.utils.data.get_worker_info()
+        num_workers = worker_info.num_workers if worker_info is not None else 1
+        worker_id = worker_info.id if worker_info is not None else 0
+
+        num_shards = self.world_size * num_workers
+        shard = self.rank * num_workers + worker_id
+
+        recordings = load_manifest_lazy(self.recordings_filename)
+        for i, rec in enumerate(recordings):
+            if i % num_shards == shard and rec.id not in self.done_ids:
+                yield rec
+
+    def chunks(self) -> Iterator[Cut]:
+        """Yield the chunks of the recordings, see split_into_chunks.py"""
+        for rec in self.recordings():
+            cut = MonoCut(
+                id=rec.id,
+                start=0,
+                duration=rec.duration,
+                channel=0,
+                recording=rec,
+            )
+            chunks = cut.cut_into_windows(
+                duration=self.chunk, hop=self.chunk - 2 * self.extra
+            ).fill_supervisions()
+            chunks = list(chunks)
+            for c in chunks:
+                # Used to find out when a recording is completely decoded
+                c.num_chunks = len(chunks)
+                yield c
+
+    def __iter__(self) -> Iterator[Dict]:
+        cuts = []
+        duration = 0
+        for c in self.chunks():
+            if cuts and duration + c.duration > self.max_duration:
+                yield self.dataset[CutSet.from_cuts(cuts)]
+                cuts = []
+                duration = 0
+            cuts.append(c)
+            duration += c.duration
+        if cuts:
+            yield self.dataset[CutSet.from_cuts(cuts)]
+
+
+def decode_and_merge(
+    dl: torch.utils.data.DataLoader,
+    params: AttributeDict,
+    model: nn.Module,
+    sp: spm.SentencePieceProcessor,
+    supervisions: SupervisionSet,
+    cuts_writer: SequentialJsonlWriter,
+    decoding_graph: Optional[k2.Fsa] = None,
+) -> None:
+    """Decode the chunks and save the merged recognition results of each
+    recording as soon as all its chunks are decoded.
+
+    Args:
+      dl:
+        PyTorch's dataloader containing :class:`LongFileChunkDataset`.
+      params:
+        It is returned by :func:`get_params`.
+      model:
+        The neural model.
+      sp:
+        The BPE model.
+      supervisions:
+        The supervision manifest containing text file path.
+      cuts_writer:
+        Writer to save the cuts with recognition results.
+      decoding_graph:
+        The decoding graph. Can be either a `k2.trivial_graph` or LG, Used
+        only when --decoding_method is fast_beam_search.
+    """
+    # Decoded chunks of the recordings in flight, indexed by recording id
+    pending: Dict[str, List[Cut]] = {}
+
+    num_cuts = 0
+    num_recordings = 0
+    log_interval = 10
+    for batch_idx, batch in enumerate(dl):
+        cuts = batch["supervisions"]["cut"]
+
+        hyps, timestamps, scores = decode_one_batch(
+            params=params,
+            model=model,
+            decoding_graph=decoding_graph,
+            batch=batch,
+        )
+
+        for cut, symbol_list, time_list, score_list in zip(
+            cuts, hyps, timestamps, scores
+        ):
+            set_alignment(cut, sp, symbol_list, time_list, score_list)
+
+            rec_id = cut.recording.id
+            cut_list = pending.setdefault(rec_id, [])
+            cut_list.append(cut)
+            if len(cut_list) < cut.num_chunks:
+                continue
+
+            del pending[rec_id]
+            old_sup = supervisions[rec_id]
+            assert old_sup.recording_id == rec_id, (old_sup.recording_id, rec_id)
+            utt_cut = merge_chunk_cuts(cut_list, old_sup, params.extra)
+            cuts_writer.write(utt_cut, flush=True)
+            num_recordings += 1
+
+        num_cuts += len(cuts)
+        if batch_idx % log_interval == 0:
+            logging.info(
+                f"cuts processed until now is {num_cuts}, "
+                f"recordings saved until now is {num_recordings}, "
+                f"recordings in flight is {len(pending)}"
+            )
+
+    for rec_id, cut_list in pending.items():
+        # It happens when the audio of some chunks cannot be read.
+        logging.warning(
+            f"Recording {rec_id} is not saved: "
+            f"only {len(cut_list)}/{cut_list[0].num_chunks} chunks are decoded"
+        )
+
+
+def drop_incomplete_line(filename: Path) -> None:
+    """Remove the last line of a jsonl file if it is incomplete, e.g.,
+    when the writing process is killed."""
+    block_size = 1 << 20
+    with open(filename, "rb+") as f:
+        end = f.seek(0, 2)
+        if end == 0:
+            return
+        f.seek(end - 1)
+        if f.read(1) == b"\n":
+            return
+
+        # Search backwards for the end of the last complete line
+        logging.warning(f"Dropping an incomplete line at the end of {filename}")
+        pos = end
+        while pos > 0:
+            start = max(pos - block_size, 0)
+            f.seek(start)
+            i = f.read(pos - start).rfind(b"\n")
+            if i != -1:
+                f.truncate(start + i + 1)
+                return
+            pos = start
+        f.truncate(0)
+
+
+@torch.no_grad()
+def run(rank, world_size, args, done_ids):
+    """
+    Args:
+      rank:
+        It is a value between 0 and `world_size-1`.
+      world_size:
+        Number of decoding jobs.
+      args:
+        The return value of get_parser().parse_args()
+      done_ids:
+        IDs of the recordings that have been recognized.
+    """
+    params = get_params()
+    params.update(vars(args))
+
+    setup_logger(f"{params.log_dir}/log-decode-pipelined")
+    logging.info("Decoding started")
+
+    assert params.decoding_method in (
+        "greedy_search",
+        "fast_beam_search",
+        "modified_beam_search",
+    ), params.decoding_method
+
+    sp = spm.SentencePieceProcessor()
+    sp.load(params.bpe_model)
+
+    # <blk> is defined in local/train_bpe_model.py
+    params.blank_id = sp.piece_to_id("<blk>")
+    params.unk_id = sp.piece_to_id("<unk>")
+    params.vocab_size = sp.get_piece_size()
+
+    logging.info(f"{params}")
+
+    device = torch.device("cpu")
+    if torch.cuda.is_available():
+        device = torch.device("cuda", rank)
+    logging.info(f"device: {device}")
+
+    logging.info("Loading jit model")
+    model = torch.jit.load(params.nn_model_filename)
+    model.to(device)
+    model.eval()
+
+    if params.decoding_method == "fast_beam_search":
+        decoding_graph = k2.trivial_graph(params.vocab_size - 1, device=device)
+    else:
+        decoding_graph = None
+
+    supervisions = load_manifest(
+        params.manifest_in_dir / f"librilight_supervisions_{params.subset}.jsonl.gz"
+    )
+
+    dataset = LongFileChunkDataset(
+        recordings_filename=params.manifest_in_dir
+        / f"librilight_recordings_{params.subset}.jsonl.gz",
+        chunk=params.chunk,
+        extra=params.extra,
+        max_duration=params.max_duration,
+        rank=rank,
+        world_size=world_size,
+        done_ids=done_ids,
+    )
+    dl = DataLoader(
+        dataset,
+        batch_size=None,
+        num_workers=params.num_workers,
+        persistent_workers=False,
+    )
+
+    out_cuts_filename = params.manifest_out_dir / (
+        f"{params.cuts_filename}_job_{rank}.jsonl"
+    )
+    # Append to the results of the previous run, if any
+    cuts_writer = CutSet.open_writer(out_cuts_filename, overwrite=False)
+    decode_and_merge(
+        dl=dl,
+        params=params,
+        model=model,
+        sp=sp,
+        supervisions=supervisions,
+        decoding_graph=decoding_graph,
+        cuts_writer=cuts_writer,
+    )
+    cuts_writer.close()
+    logging.info(f"Cuts saved to {out_cuts_filename}")
+
+    logging.info("Done!")
+
+
+def main():
+    parser = get_parser()
+    args = parser.parse_args()
+
+    subset = args.subset
+    assert subset in ["small", "medium", "large"], subset
+
+    manifest_out_dir = args.manifest_out_dir
+    manifest_out_dir.mkdir(parents=True, exist_ok=True)
+
+    args.cuts_filename = f"librilight_cuts_{args.subset}"
+
+    out_cuts_filename = manifest_out_dir / (args.cuts_filename + ".jsonl.gz")
+    if out_cuts_filename.is_file():
+        logging.info(f"{out_cuts_filename} already exists - skipping.")
+        return
+
+    # Results of the previous runs. We don't compress them, so that a file
+    # that was being written when the job was killed can still be appended.
+    job_filenames = sorted(manifest_out_dir.glob(f"{args.cuts_filename}_job_*.jsonl"))
+    done_ids = set()
+    for filename in job_filenames:
+        drop_incomplete_line(filename)
+        done_ids.update(cut.id for cut in load_manifest_lazy(filename))
+    if done_ids:
+        logging.info(f"Resuming: {len(done_ids)} recordings have been recognized")
+
+    world_size = args.world_size
+    assert world_size >= 1
+    if world_size > 1:
+        mp.spawn(run, args=(world_size, args, done_ids), nprocs=world_size, join=True)
+    else:
+        run(rank=0, world_size=world_size, args=args, done_ids=done_ids)
+
+    recordings = load_manifest_lazy(
+        args.manifest_in_dir / f"librilight_recordings_{args.subset}.jsonl.gz"
+    )
+    job_filenames = sorted(manifest_out_dir.glob(f"{args.cuts_filename}_job_*.jsonl"))
+    num_done = sum(
+        sum(1 for _ in load_manifest_lazy(filename)) for filename in job_filenames
+    )
+    num_recordings = sum(1 for _ in recordings)
+    if num_done < num_recordings:
+        logging.warning(
+            f"Only {num_done}/{num_recordings} recordings are recognized. "
+            "Run this script again to resume."
+        )
+        return
+
+    # Combine the results of all jobs
+    with CutSet.open_writer(out_cuts_filename) as cuts_writer:
+        for filename in job_filenames:
+            for cut in load_manifest_lazy(filename):
+                cuts_writer.write(cut)
+    logging.info(f"Cuts saved to {out_cuts_filename}")
+
+
+# Note: torch.set_num_threads(1) is called when importing recognize.py
+
+if __name__ == "__main__":
+    formatter = "%(asctime)s %(levelname)s [%(filename)s:%(lineno)d] %(message)s"
+
+    logging.basicConfig(format=formatter, level=logging.INFO)
+    main()
@@ -15,17 +15,24 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import heapq
 import math
 import warnings
 from dataclasses import dataclass, field
-from typing import Dict, List, Optional, Tuple, Union
+from typing import Dict, List, Optional, Set, Tuple, Union
 
 import k2
 import sentencepiece as spm
 import torch
 from torch import nn
 
-from icefall import ContextGraph, ContextState, NgramLm, NgramLmStateCost
+from icefall import (
+    CompiledContextGraph,
+    ContextGraph,
+    ContextState,
+    NgramLm,
+    NgramLmStateCost,
+)
 from icefall.decode import Nbest, one_best_decoding
 from icefall.lm_wrapper import LmScorer
 from icefall.rnn_lm.model import RnnLmModel
@@ -781,6 +788,31 @@ def greedy_search_batch(
         )
 
 
+# Constants of the polynomial rolling hash used to identify the token
+# sequence of a hypothesis, i.e., hash(ys + [y]) = (hash(ys) * BASE + y + 1) % MOD
+# The hash has 40 bits instead of 64 so that MOD * BASE < 2**63, i.e., the
+# update never overflows the int64 tensors in modified_beam_search_tensorized().
+# HypothesisList falls back to keying a hypothesis by tuple(ys) when its hash
+# collides with that of a different token sequence, so merging stays exact.
+_PREFIX_HASH_BASE = 1000003
+_PREFIX_HASH_MOD = 1099511627689  # the largest prime below 2**40
+
+
+def extend_ys_hash(ys_hash: int, token: int) -> int:
+    """Return the hash of `ys + [token]` given the hash of `ys` in O(1)."""
+    return (ys_hash * _PREFIX_HASH_BASE + token + 1) % _PREFIX_HASH_MOD
+
+
+def compute_ys_hash(ys: List[int]) -> int:
+    """Return the hash of the token sequence `ys`. It takes O(len(ys)) time,
+    so use :func:`extend_ys_hash` when a token is appended to a hypothesis.
+    """
+    ans = 0
+    for token in ys:
+        ans = extend_ys_hash(ans, token)
+    return ans
+
+
 @dataclass
 class Hypothesis:
     # The predicted tokens so far.
@@ -800,39 +832,78 @@ class Hypothesis:
     # the lm score for next token given the current ys
     lm_score: Optional[torch.Tensor] = None
 
-    # the RNNLM states (h and c in LSTM)
-    state: Optional[Tuple[torch.Tensor, torch.Tensor]] = None
+    # the NN LM state. It is a row of RnnLmStateArena for an RNN LM and
+    # the cached keys and values of TransformerLM.score_token() for a
+    # transformer LM.
+    state: Optional[Union[int, Tuple[torch.Tensor, ...]]] = None
 
     # N-gram LM state
     state_cost: Optional[NgramLmStateCost] = None
 
-    # Context graph state
-    context_state: Optional[ContextState] = None
+    # Context graph state. It is a node id if the graph is a CompiledContextGraph
+    context_state: Optional[Union[ContextState, int]] = None
 
     num_tailing_blanks: int = 0
 
+    # Rolling hash of ys, see extend_ys_hash(). It is computed from ys
+    # if not given. Pass it explicitly when extending a hypothesis to avoid
+    # the O(len(ys)) computation.
+    ys_hash: Optional[int] = None
+
+    def __post_init__(self):
+        if self.ys_hash is None:
+            self.ys_hash = compute_ys_hash(self.ys)
+
     @property
-    def key(self) -> str:
-        """Return a string representation of self.ys"""
-        return "_".join(map(str, self.ys))
+    def key(self) -> int:
+        """Return the hash of self.ys. Note: Different ys may have the same
+        key, though it is very unlikely, so compare ys if you need to be sure.
+        """
+        return self.ys_hash
 
 
 class HypothesisList(object):
-    def __init__(self, data: Optional[Dict[str, Hypothesis]] = None) -> None:
+    def __init__(
+        self, data: Optional[Dict[Union[int, Tuple[int, ...]], Hypothesis]] = None
+    ) -> None:
         """
         Args:
           data:
-            A dict of Hypotheses. Its key is its `value.key`.
+            A dict of Hypotheses. Its key is its `value.key`, or `tuple(value.ys)`
+            if `value.key` collides with that of another hypothesis.
         """
         if data is None:
             self._data = {}
         else:
             self._data = data
 
+        # True if some hypothesis is keyed by tuple(ys) since its hash
+        # collides with that of another one.
+        self._has_collision = any(isinstance(k, tuple) for k in self._data)
+
     @property
-    def data(self) -> Dict[str, Hypothesis]:
+    def data(self) -> Dict[Union[int, Tuple[int, ...]], Hypothesis]:
         return self._data
 
+    def _find_key(self, hyp: Hypothesis) -> Union[int, Tuple[int, ...]]:
+        """Return the key under which `hyp` is (or would be) stored in `self`.
+
+        Lookup by `hyp.key` is O(1). Only when the hash collides with a
+        hypothesis having different `ys`, `tuple(hyp.ys)` is used instead.
+        """
+        key = hyp.key
+        old_hyp = self._data.get(key)
+        if old_hyp is None:
+            if not self._has_collision:
+                return key
+            # hyp may have been stored under tuple(ys) while the
+            # colliding hypothesis was later removed
+            exact_key = tuple(hyp.ys)
+            return exact_key if exact_key in self._data else key
+        if old_hyp.ys == hyp.ys:
+            return key
+        return tuple(hyp.ys)
+
     def add(self, hyp: Hypothesis) -> None:
         """Add a Hypothesis to `self`.
 
@@ -843,11 +914,13 @@ class HypothesisList(object):
           hyp:
             The hypothesis to be added.
         """
-        key = hyp.key
+        key = self._find_key(hyp)
         if key in self:
             old_hyp = self._data[key]  # shallow copy
             torch.logaddexp(old_hyp.log_prob, hyp.log_prob, out=old_hyp.log_prob)
         else:
+            if isinstance(key, tuple):
+                self._has_collision = True
             self._data[key] = hyp
 
     def get_most_probable(self, length_norm: bool = False) -> Hypothesis:
@@ -878,7 +951,7 @@ class HypothesisList(object):
             Note: It must be contained in `self`. Otherwise,
             an exception is raised.
         """
-        key = hyp.key
+        key = self._find_key(hyp)
         assert key in self, f"{key} does not exist"
         del self._data[key]
 
@@ -918,7 +991,7 @@ class HypothesisList(object):
         ans = HypothesisList(dict(hyps))
         return ans
 
-    def __contains__(self, key: str):
+    def __contains__(self, key: Union[int, Tuple[int, ...]]):
         return key in self._data
 
     def __iter__(self):
@@ -929,11 +1002,128 @@ class HypothesisList(object):
 
     def __str__(self) -> str:
         s = []
-        for key in self:
-            s.append(key)
+        for hyp in self:
+            s.append("_".join(map(str, hyp.ys)))
         return ", ".join(s)
 
 
+class RnnLmStateArena(object):
+    """Keep the LSTM states (h, c) and the scores of an RNN LM for the
+    hypotheses of a beam search in preallocated tensors.
+
+    Each LM context, i.e., the sequence of tokens seen by the LM, owns a
+    row of the tensors and a hypothesis keeps the row of its context as
+    its `state`. The context of a row extended by a token is scored only
+    once: the row of the result is remembered, so that other hypotheses
+    extending the same row by the same token, in the same or in a later
+    frame, reuse it.
+
+    Call :meth:`extend` to score the new tokens of a frame and
+    :meth:`sweep` after each frame to free the rows that are no longer used.
+    """
+
+    def __init__(
+        self,
+        LM: LmScorer,
+        init_score: torch.Tensor,
+        init_state: Tuple[torch.Tensor, torch.Tensor],
+        max_rows: int,
+    ) -> None:
+        """
+        Args:
+          LM:
+            The RNN LM.
+          init_score:
+            The LM scores after seeing the "sos" token, of shape (1, vocab_size).
+          init_state:
+            The LSTM states after seeing the "sos" token, each of shape
+            (num_layers, 1, hidden_dim).
+          max_rows:
+            The maximum number of rows in use at a time. As the rows of the
+            previous frame and the new rows of the current frame are used
+            at the same time, it should be 2 * num_utterances * beam.
+        """
+        h, c = init_state
+        assert h.size(1) == 1, h.shape
+        self.LM = LM
+        self.max_rows = max_rows
+        self.h = h.new_zeros(h.size(0), max_rows, h.size(2))
+        self.c = c.new_zeros(c.size(0), max_rows, c.size(2))
+        self.scores = init_score.new_zeros(max_rows, init_score.size(-1))
+
+        self._free_rows = list(range(max_rows))
+        self._used_rows = set()
+
+        # Map (row, token) to the row of the context extended by the token
+        self._children: Dict[Tuple[int, int], int] = {}
+
+        self.root = self._allocate()
+        self.h[:, self.root] = h[:, 0]
+        self.c[:, self.root] = c[:, 0]
+        self.scores[self.root] = init_score.reshape(-1)
+
+    def _allocate(self) -> int:
+        if not self._free_rows:
+            raise RuntimeError(f"All {self.max_rows} rows are in use")
+        row = heapq.heappop(self._free_rows)
+        self._used_rows.add(row)
+        return row
+
+    def extend(self, rows: List[int], tokens: List[int]) -> List[int]:
+        """Extend the contexts of the given rows by the given tokens.
+
+        Args:
+          rows:
+            The rows of the contexts.
+          tokens:
+            The new tokens, one for each row.
+        Returns:
+          Return the rows of the extended contexts. The LM scores of the
+          next token given an extended context are in `self.scores[row]`.
+        """
+        new_keys: Dict[Tuple[int, int], int] = {}
+        for key in zip(rows, tokens):
+            if key not in self._children and key not in new_keys:
+                new_keys[key] = len(new_keys)
+
+        if new_keys:
+            device = self.h.device
+            parents = torch.tensor(
+                [r for r, _ in new_keys], dtype=torch.int64, device=device
+            )
+            x = torch.tensor(
+                [[t] for _, t in new_keys], dtype=torch.int64, device=device
+            )
+            x_lens = torch.ones(len(new_keys), dtype=torch.int64, device=device)
+            state = (
+                self.h.index_select(1, parents),
+                self.c.index_select(1, parents),
+            )
+            scores, (h, c) = self.LM.score_token(x, x_lens, state)
+
+            children = [self._allocate() for _ in range(len(new_keys))]
+            index = torch.tensor(children, dtype=torch.int64, device=device)
+            self.h.index_copy_(1, index, h)
+            self.c.index_copy_(1, index, c)
+            self.scores.index_copy_(0, index, scores)
+            for key, child in zip(new_keys, children):
+                self._children[key] = child
+
+        return [self._children[key] for key in zip(rows, tokens)]
+
+    def sweep(self, live_rows: Set[int]) -> None:
+        """Free all the rows that are not in `live_rows`, e.g., the rows of
+        the hypotheses that are pruned away."""
+        for row in self._used_rows - live_rows:
+            heapq.heappush(self._free_rows, row)
+        self._used_rows &= live_rows
+        self._children = {
+            key: child
+            for key, child in self._children.items()
+            if key[0] in live_rows and child in live_rows
+        }
+
+
 def get_hyps_shape(hyps: List[HypothesisList]) -> k2.RaggedShape:
     """Return a ragged shape with axes [utt][num_hyps].
 
@@ -963,7 +1153,7 @@ def keywords_search(
     model: nn.Module,
     encoder_out: torch.Tensor,
     encoder_out_lens: torch.Tensor,
-    keywords_graph: ContextGraph,
+    keywords_graph: Union[ContextGraph, CompiledContextGraph],
     beam: int = 4,
     num_tailing_blanks: int = 0,
     blank_penalty: float = 0,
@@ -1098,19 +1288,45 @@ def keywords_search(
         ragged_log_probs = k2.RaggedTensor(shape=log_probs_shape, value=log_probs)
         ragged_probs = k2.RaggedTensor(shape=log_probs_shape, value=probs)
 
+        topk = []
+        context_states = []
+        context_tokens = []
         for i in range(batch_size):
             topk_log_probs, topk_indexes = ragged_log_probs[i].topk(beam)
-            hyp_probs = ragged_probs[i].tolist()
 
             with warnings.catch_warnings():
                 warnings.simplefilter("ignore")
                 topk_hyp_indexes = (topk_indexes // vocab_size).tolist()
                 topk_token_indexes = (topk_indexes % vocab_size).tolist()
 
+            topk.append(
+                (topk_log_probs, topk_indexes, topk_hyp_indexes, topk_token_indexes)
+            )
+            for hyp_idx, token in zip(topk_hyp_indexes, topk_token_indexes):
+                if token not in (blank_id, unk_id):
+                    context_states.append(A[i][hyp_idx].context_state)
+                    context_tokens.append(token)
+
+        # Search the keywords graph once for all the hypotheses of this frame
+        context_scores, next_context_states, _ = keywords_graph.forward_batch(
+            context_states, context_tokens
+        )
+        context_index = 0
+
+        for i in range(batch_size):
+            (
+                topk_log_probs,
+                topk_indexes,
+                topk_hyp_indexes,
+                topk_token_indexes,
+            ) = topk[i]
+            hyp_probs = ragged_probs[i].tolist()
+
             for k in range(len(topk_hyp_indexes)):
                 hyp_idx = topk_hyp_indexes[k]
                 hyp = A[i][hyp_idx]
                 new_ys = hyp.ys[:]
+                new_ys_hash = hyp.ys_hash
                 new_token = topk_token_indexes[k]
                 new_timestamp = hyp.timestamp[:]
                 new_ac_probs = hyp.ac_probs[:]
@@ -1119,21 +1335,22 @@ def keywords_search(
                 new_num_tailing_blanks = hyp.num_tailing_blanks + 1
                 if new_token not in (blank_id, unk_id):
                     new_ys.append(new_token)
+                    new_ys_hash = extend_ys_hash(new_ys_hash, new_token)
                     new_timestamp.append(t)
                     new_ac_probs.append(hyp_probs[topk_indexes[k]])
-                    (
-                        context_score,
-                        new_context_state,
-                        _,
-                    ) = keywords_graph.forward_one_step(hyp.context_state, new_token)
+                    context_score = context_scores[context_index]
+                    new_context_state = next_context_states[context_index]
+                    context_index += 1
                     new_num_tailing_blanks = 0
-                    if new_context_state.token == -1:  # root
+                    if new_context_state == keywords_graph.root:
                         new_ys[-context_size:] = [-1] * (context_size - 1) + [blank_id]
+                        new_ys_hash = compute_ys_hash(new_ys)
 
                 new_log_prob = topk_log_probs[k] + context_score
 
                 new_hyp = Hypothesis(
                     ys=new_ys,
+                    ys_hash=new_ys_hash,
                     log_prob=new_log_prob,
                     timestamp=new_timestamp,
                     ac_probs=new_ac_probs,
@@ -1198,7 +1415,7 @@ def modified_beam_search(
     model: nn.Module,
     encoder_out: torch.Tensor,
     encoder_out_lens: torch.Tensor,
-    context_graph: Optional[ContextGraph] = None,
+    context_graph: Optional[Union[ContextGraph, CompiledContextGraph]] = None,
     beam: int = 4,
     temperature: float = 1.0,
     blank_penalty: float = 0.0,
@@ -1214,6 +1431,8 @@ def modified_beam_search(
       encoder_out_lens:
         A 1-D tensor of shape (N,), containing number of valid frames in
         encoder_out before padding.
+      context_graph:
+        An optional ContextGraph or CompiledContextGraph for context biasing.
       beam:
         Number of active paths during the beam search.
       temperature:
@@ -1324,6 +1543,9 @@ def modified_beam_search(
         )
         ragged_log_probs = k2.RaggedTensor(shape=log_probs_shape, value=log_probs)
 
+        topk = []
+        context_states = []
+        context_tokens = []
         for i in range(batch_size):
             topk_log_probs, topk_indexes = ragged_log_probs[i].topk(beam)
 
@@ -1332,27 +1554,46 @@ def modified_beam_search(
                 topk_hyp_indexes = (topk_indexes // vocab_size).tolist()
                 topk_token_indexes = (topk_indexes % vocab_size).tolist()
 
+            topk.append((topk_log_probs, topk_hyp_indexes, topk_token_indexes))
+            if context_graph is not None:
+                for hyp_idx, token in zip(topk_hyp_indexes, topk_token_indexes):
+                    if token not in (blank_id, unk_id):
+                        context_states.append(A[i][hyp_idx].context_state)
+                        context_tokens.append(token)
+
+        if context_graph is not None:
+            # Search the context graph once for all the hypotheses of this frame
+            context_scores, next_context_states, _ = context_graph.forward_batch(
+                context_states, context_tokens
+            )
+            context_index = 0
+
+        for i in range(batch_size):
+            topk_log_probs, topk_hyp_indexes, topk_token_indexes = topk[i]
+
             for k in range(len(topk_hyp_indexes)):
                 hyp_idx = topk_hyp_indexes[k]
                 hyp = A[i][hyp_idx]
                 new_ys = hyp.ys[:]
+                new_ys_hash = hyp.ys_hash
                 new_token = topk_token_indexes[k]
                 new_timestamp = hyp.timestamp[:]
                 context_score = 0
                 new_context_state = None if context_graph is None else hyp.context_state
                 if new_token not in (blank_id, unk_id):
                     new_ys.append(new_token)
+                    new_ys_hash = extend_ys_hash(new_ys_hash, new_token)
                     new_timestamp.append(t)
                     if context_graph is not None:
-                        (
-                            context_score,
-                            new_context_state,
-                        ) = context_graph.forward_one_step(hyp.context_state, new_token)
+                        context_score = context_scores[context_index]
+                        new_context_state = next_context_states[context_index]
+                        context_index += 1
 
                 new_log_prob = topk_log_probs[k] + context_score
 
                 new_hyp = Hypothesis(
                     ys=new_ys,
+                    ys_hash=new_ys_hash,
                     log_prob=new_log_prob,
                     timestamp=new_timestamp,
                     context_state=new_context_state,
@@ -1373,6 +1614,7 @@ def modified_beam_search(
                 finalized_B[i].add(
                     Hypothesis(
                         ys=hyp.ys,
+                        ys_hash=hyp.ys_hash,
                         log_prob=hyp.log_prob + context_score,
                         timestamp=hyp.timestamp,
                         context_state=new_context_state,
@@ -1400,6 +1642,256 @@ def modified_beam_search(
         )
 
 
+def modified_beam_search_tensorized(
+    model: nn.Module,
+    encoder_out: torch.Tensor,
+    encoder_out_lens: torch.Tensor,
+    beam: int = 4,
+    temperature: float = 1.0,
+    blank_penalty: float = 0.0,
+    return_timestamps: bool = False,
+) -> Union[List[List[int]], DecodingResults]:
+    """Same as :func:`modified_beam_search`, but all hypotheses are kept in
+    preallocated tensors of shape (N, beam) instead of Python `Hypothesis`
+    objects.
+
+    For each frame, the top-k selection, the merging of hypotheses with the
+    same token sequence and the update of the decoder output are done with
+    tensor operations for the whole batch. Token sequences are identified by
+    a rolling hash of the prefix together with the number of tokens and the
+    last `context_size` tokens, so no per-hypothesis Python lists or string
+    keys are built. The token sequences are recovered at the end by following
+    back-pointers.
+
+    It does not support context biasing; use :func:`modified_beam_search`
+    if a context graph is needed.
+
+    Args:
+      model:
+        The transducer model.
+      encoder_out:
+        Output from the encoder. Its shape is (N, T, C).
+      encoder_out_lens:
+        A 1-D tensor of shape (N,), containing number of valid frames in
+        encoder_out before padding.
+      beam:
+        Number of active paths during the beam search.
+      temperature:
+        Softmax temperature.
+      blank_penalty:
+        The score used to penalize blank probability.
+      return_timestamps:
+        Whether to return timestamps.
+    Returns:
+      If return_timestamps is False, return the decoded result.
+      Else, return a DecodingResults object containing
+      decoded result and corresponding timestamps.
+    """
+    assert encoder_out.ndim == 3, encoder_out.shape
+    assert encoder_out.size(0) >= 1, encoder_out.size(0)
+
+    packed_encoder_out = torch.nn.utils.rnn.pack_padded_sequence(
+        input=encoder_out,
+        lengths=encoder_out_lens.cpu(),
+        batch_first=True,
+        enforce_sorted=False,
+    )
+
+    blank_id = model.decoder.blank_id
+    unk_id = getattr(model, "unk_id", blank_id)
+    context_size = model.decoder.context_size
+    device = next(model.parameters()).device
+
+    batch_size_list = packed_encoder_out.batch_sizes.tolist()
+    N = encoder_out.size(0)
+    assert torch.all(encoder_out_lens > 0), encoder_out_lens
+    assert N == batch_size_list[0], (N, batch_size_list)
+
+    # Row n of the following tensors contains the hypotheses of the n-th
+    # utterance (in sorted order). Unused slots have a log_prob of -inf.
+    hyp_log_probs = torch.full(
+        (N, beam), float("-inf"), dtype=torch.float32, device=device
+    )
+    hyp_log_probs[:, 0] = 0.0
+
+    # The last context_size tokens of each hypothesis, i.e., the decoder input
+    hyp_contexts = (
+        torch.tensor(
+            [-1] * (context_size - 1) + [blank_id], device=device, dtype=torch.int64
+        )
+        .expand(N, beam, context_size)
+        .contiguous()
+    )
+
+    # Rolling hash of the tokens of each hypothesis, see _PREFIX_HASH_BASE
+    hyp_hashes = torch.zeros(N, beam, dtype=torch.int64, device=device)
+
+    # len(hyp.ys) in modified_beam_search, used for length normalization
+    hyp_num_tokens = torch.full(
+        (N, beam), context_size, dtype=torch.int64, device=device
+    )
+
+    decoder_out = model.decoder(hyp_contexts.reshape(-1, context_size), need_pad=False)
+    decoder_out = model.joiner.decoder_proj(decoder_out)
+    decoder_out = decoder_out.reshape(N, beam, -1)
+    # decoder_out is of shape (N, beam, joiner_dim)
+
+    # frame_tokens[t][n, k] is the token emitted on frame t by the k-th
+    # hypothesis of the n-th utterance, or -1 if no token is emitted.
+    # frame_parents[t][n, k] is the index of the hypothesis on frame t - 1
+    # it is extended from.
+    frame_tokens = []
+    frame_parents = []
+
+    encoder_out = model.joiner.encoder_proj(packed_encoder_out.data)
+
+    beam_range = torch.arange(beam, device=device)
+
+    offset = 0
+    for t, batch_size in enumerate(batch_size_list):
+        start = offset
+        end = offset + batch_size
+        current_encoder_out = encoder_out.data[start:end]
+        current_encoder_out = current_encoder_out.unsqueeze(1).unsqueeze(1)
+        # current_encoder_out's shape is (batch_size, 1, 1, encoder_out_dim)
+        offset = end
+
+        # Utterances are sorted by length in descending order, so the
+        # finished ones are at the end and keep their final states.
+        log_probs_t = hyp_log_probs[:batch_size]
+        contexts_t = hyp_contexts[:batch_size]
+        hashes_t = hyp_hashes[:batch_size]
+        num_tokens_t = hyp_num_tokens[:batch_size]
+        decoder_out_t = decoder_out[:batch_size]
+
+        logits = model.joiner(
+            current_encoder_out,
+            decoder_out_t.unsqueeze(2),
+            project_input=False,
+        )  # (batch_size, beam, 1, vocab_size)
+
+        logits = logits.squeeze(2)  # (batch_size, beam, vocab_size)
+
+        if blank_penalty != 0:
+            logits[:, :, 0] -= blank_penalty
+
+        log_probs = (logits / temperature).log_softmax(dim=-1)
+        log_probs.add_(log_probs_t.unsqueeze(-1))
+
+        vocab_size = log_probs.size(-1)
+
+        log_probs = log_probs.reshape(batch_size, -1)
+
+        topk_log_probs, topk_indexes = log_probs.topk(beam, dim=1)
+        # (batch_size, beam)
+
+        parents = torch.div(topk_indexes, vocab_size, rounding_mode="floor")
+        tokens = topk_indexes % vocab_size
+        emitted = (tokens != blank_id) & (tokens != unk_id)
+
+        new_hashes = hashes_t.gather(1, parents)
+        new_hashes = torch.where(
+            emitted,
+            (new_hashes * _PREFIX_HASH_BASE + tokens + 1) % _PREFIX_HASH_MOD,
+            new_hashes,
+        )
+
+        new_num_tokens = num_tokens_t.gather(1, parents) + emitted
+
+        new_contexts = contexts_t.gather(
+            1, parents.unsqueeze(-1).expand(batch_size, beam, context_size)
+        )
+        new_contexts = torch.where(
+            emitted.unsqueeze(-1),
+            torch.cat([new_contexts[:, :, 1:], tokens.unsqueeze(-1)], dim=-1),
+            new_contexts,
+        )
+
+        # same[n, i, j] is True if the i-th and j-th candidates of the n-th
+        # utterance have the same token sequence. The number of tokens and
+        # the context are compared to guard against hash collisions.
+        same = (
+            (new_hashes.unsqueeze(2) == new_hashes.unsqueeze(1))
+            & (new_num_tokens.unsqueeze(2) == new_num_tokens.unsqueeze(1))
+            & (new_contexts.unsqueeze(2) == new_contexts.unsqueeze(1)).all(dim=-1)
+        )
+
+        # As in HypothesisList.add(), duplicates are merged into the first
+        # (i.e., the best) one using log-sum-exp.
+        is_first = same.to(torch.int8).argmax(dim=2) == beam_range
+        merged_log_probs = torch.logsumexp(
+            topk_log_probs.unsqueeze(1)
+            .expand(batch_size, beam, beam)
+            .masked_fill(~same, float("-inf")),
+            dim=2,
+        )
+        new_log_probs = torch.where(
+            is_first, merged_log_probs, torch.full_like(merged_log_probs, float("-inf"))
+        )
+
+        # Hypotheses ending with a blank reuse the decoder output of their
+        # parents; only the ones that emitted a new token need the decoder.
+        new_decoder_out = decoder_out_t.gather(
+            1, parents.unsqueeze(-1).expand(batch_size, beam, decoder_out.size(-1))
+        )
+        need_update = (emitted & is_first).reshape(-1).nonzero().squeeze(1)
+        if need_update.numel() > 0:
+            decoder_input = new_contexts.reshape(-1, context_size).index_select(
+                0, need_update
+            )
+            updated_decoder_out = model.decoder(decoder_input, need_pad=False)
+            updated_decoder_out = model.joiner.decoder_proj(updated_decoder_out)
+            new_decoder_out = new_decoder_out.reshape(-1, decoder_out.size(-1))
+            new_decoder_out.index_copy_(0, need_update, updated_decoder_out.squeeze(1))
+            new_decoder_out = new_decoder_out.reshape(batch_size, beam, -1)
+
+        hyp_log_probs[:batch_size] = new_log_probs
+        hyp_contexts[:batch_size] = new_contexts
+        hyp_hashes[:batch_size] = new_hashes
+        hyp_num_tokens[:batch_size] = new_num_tokens
+        decoder_out[:batch_size] = new_decoder_out
+
+        frame_tokens.append(torch.where(emitted, tokens, torch.full_like(tokens, -1)))
+        frame_parents.append(parents)
+
+    # Select the best hypothesis of each utterance with length normalization,
+    # as HypothesisList.get_most_probable(length_norm=True) does
+    best_index = (hyp_log_probs / hyp_num_tokens).argmax(dim=1)
+
+    # Follow the back-pointers from the last frame of each utterance
+    T = len(batch_size_list)
+    traced_tokens = torch.full((N, T), -1, dtype=torch.int64, device=device)
+    for t in range(T - 1, -1, -1):
+        batch_size = batch_size_list[t]
+        rows = torch.arange(batch_size, device=device)
+        k = best_index[:batch_size]
+        traced_tokens[:batch_size, t] = frame_tokens[t][rows, k]
+        best_index[:batch_size] = frame_parents[t][rows, k]
+
+    traced_tokens = traced_tokens.tolist()
+
+    sorted_ans = []
+    sorted_timestamps = []
+    for row in traced_tokens:
+        sorted_ans.append([token for token in row if token != -1])
+        sorted_timestamps.append([t for t, token in enumerate(row) if token != -1])
+
+    ans = []
+    ans_timestamps = []
+    unsorted_indices = packed_encoder_out.unsorted_indices.tolist()
+    for i in range(N):
+        ans.append(sorted_ans[unsorted_indices[i]])
+        ans_timestamps.append(sorted_timestamps[unsorted_indices[i]])
+
+    if not return_timestamps:
+        return ans
+    else:
+        return DecodingResults(
+            hyps=ans,
+            timestamps=ans_timestamps,
+        )
+
+
 def modified_beam_search_lm_rescore(
     model: nn.Module,
     encoder_out: torch.Tensor,
@@ -1541,15 +2033,20 @@ def modified_beam_search_lm_rescore(
                 hyp = A[i][hyp_idx]
 
                 new_ys = hyp.ys[:]
+                new_ys_hash = hyp.ys_hash
                 new_token = topk_token_indexes[k]
                 new_timestamp = hyp.timestamp[:]
                 if new_token not in (blank_id, unk_id):
                     new_ys.append(new_token)
+                    new_ys_hash = extend_ys_hash(new_ys_hash, new_token)
                     new_timestamp.append(t)
 
                 new_log_prob = topk_log_probs[k]
                 new_hyp = Hypothesis(
-                    ys=new_ys, log_prob=new_log_prob, timestamp=new_timestamp
+                    ys=new_ys,
+                    log_prob=new_log_prob,
+                    timestamp=new_timestamp,
+                    ys_hash=new_ys_hash,
                 )
                 B[i].add(new_hyp)
 
@@ -1741,15 +2238,20 @@ def modified_beam_search_lm_rescore_LODR(
                 hyp = A[i][hyp_idx]
 
                 new_ys = hyp.ys[:]
+                new_ys_hash = hyp.ys_hash
                 new_token = topk_token_indexes[k]
                 new_timestamp = hyp.timestamp[:]
                 if new_token not in (blank_id, unk_id):
                     new_ys.append(new_token)
+                    new_ys_hash = extend_ys_hash(new_ys_hash, new_token)
                     new_timestamp.append(t)
 
                 new_log_prob = topk_log_probs[k]
                 new_hyp = Hypothesis(
-                    ys=new_ys, log_prob=new_log_prob, timestamp=new_timestamp
+                    ys=new_ys,
+                    log_prob=new_log_prob,
+                    timestamp=new_timestamp,
+                    ys_hash=new_ys_hash,
                 )
                 B[i].add(new_hyp)
 
@@ -1919,14 +2421,19 @@ def _deprecated_modified_beam_search(
         for i in range(len(topk_hyp_indexes)):
             hyp = A[topk_hyp_indexes[i]]
             new_ys = hyp.ys[:]
+            new_ys_hash = hyp.ys_hash
             new_timestamp = hyp.timestamp[:]
             new_token = topk_token_indexes[i]
             if new_token not in (blank_id, unk_id):
                 new_ys.append(new_token)
+                new_ys_hash = extend_ys_hash(new_ys_hash, new_token)
                 new_timestamp.append(t)
             new_log_prob = topk_log_probs[i]
             new_hyp = Hypothesis(
-                ys=new_ys, log_prob=new_log_prob, timestamp=new_timestamp
+                ys=new_ys,
+                log_prob=new_log_prob,
+                timestamp=new_timestamp,
+                ys_hash=new_ys_hash,
             )
             B.add(new_hyp)
 
@@ -2004,7 +2511,8 @@ def beam_search(
 
     sym_per_utt = 0
 
-    decoder_cache: Dict[str, torch.Tensor] = {}
+    # The decoder output depends only on the last context_size tokens
+    decoder_cache: Dict[Tuple[int, ...], torch.Tensor] = {}
 
     while t < T and sym_per_utt < max_sym_per_utt:
         # fmt: off
@@ -2013,7 +2521,7 @@ def beam_search(
         A = B
         B = HypothesisList()
 
-        joint_cache: Dict[str, torch.Tensor] = {}
+        joint_cache: Dict[Tuple[int, ...], torch.Tensor] = {}
 
         # TODO(fangjun): Implement prefix search to update the `log_prob`
         # of hypotheses in A
@@ -2022,11 +2530,11 @@ def beam_search(
             y_star = A.get_most_probable()
             A.remove(y_star)
 
-            cached_key = y_star.key
+            cached_key = tuple(y_star.ys[-context_size:])
 
             if cached_key not in decoder_cache:
                 decoder_input = torch.tensor(
-                    [y_star.ys[-context_size:]],
+                    [cached_key],
                     device=device,
                     dtype=torch.int64,
                 ).reshape(1, context_size)
@@ -2037,7 +2545,6 @@ def beam_search(
             else:
                 decoder_out = decoder_cache[cached_key]
 
-            cached_key += f"-t-{t}"
             if cached_key not in joint_cache:
                 logits = model.joiner(
                     current_encoder_out,
@@ -2065,6 +2572,7 @@ def beam_search(
             B.add(
                 Hypothesis(
                     ys=y_star.ys[:],
+                    ys_hash=y_star.ys_hash,
                     log_prob=new_y_star_log_prob,
                     timestamp=y_star.timestamp[:],
                 )
@@ -2076,11 +2584,13 @@ def beam_search(
                 if i in (blank_id, unk_id):
                     continue
                 new_ys = y_star.ys + [i]
+                new_ys_hash = extend_ys_hash(y_star.ys_hash, i)
                 new_log_prob = y_star.log_prob + v
                 new_timestamp = y_star.timestamp + [t]
                 A.add(
                     Hypothesis(
                         ys=new_ys,
+                        ys_hash=new_ys_hash,
                         log_prob=new_log_prob,
                         timestamp=new_timestamp,
                     )
@@ -2595,9 +3105,11 @@ def modified_beam_search_ngram_rescoring(
                 hyp = A[i][hyp_idx]
 
                 new_ys = hyp.ys[:]
+                new_ys_hash = hyp.ys_hash
                 new_token = topk_token_indexes[k]
                 if new_token not in (blank_id, unk_id):
                     new_ys.append(new_token)
+                    new_ys_hash = extend_ys_hash(new_ys_hash, new_token)
                     state_cost = hyp.state_cost.forward_one_step(new_token)
                 else:
                     state_cost = hyp.state_cost
@@ -2606,7 +3118,10 @@ def modified_beam_search_ngram_rescoring(
                 new_log_prob = topk_log_probs[k] - hyp.state_cost.lm_score * lm_scale
 
                 new_hyp = Hypothesis(
-                    ys=new_ys, log_prob=new_log_prob, state_cost=state_cost
+                    ys=new_ys,
+                    log_prob=new_log_prob,
+                    state_cost=state_cost,
+                    ys_hash=new_ys_hash,
                 )
                 B[i].add(new_hyp)
 
@@ -2630,7 +3145,7 @@ def modified_beam_search_LODR(
     LODR_lm_scale: float,
     LM: LmScorer,
     beam: int = 4,
-    context_graph: Optional[ContextGraph] = None,
+    context_graph: Optional[Union[ContextGraph, CompiledContextGraph]] = None,
 ) -> List[List[int]]:
     """This function implements LODR (https://arxiv.org/abs/2203.16776) with
     `modified_beam_search`. It uses a bi-gram language model as the estimate
@@ -2687,6 +3202,11 @@ def modified_beam_search_LODR(
     sos_token = torch.tensor([[sos_id]]).to(torch.int64).to(device)
     lens = torch.tensor([1]).to(device)
     init_score, init_states = LM.score_token(sos_token, lens)
+    if LM.lm_type == "rnn":
+        lm_arena = RnnLmStateArena(
+            LM, init_score, init_states, max_rows=max(1, 2 * N * beam)
+        )
+        init_states = lm_arena.root
 
     B = [HypothesisList() for _ in range(N)]
     for i in range(N):
@@ -2773,8 +3293,7 @@ def modified_beam_search_LODR(
         non-blank token.
         """
         token_list = []
-        hs = []
-        cs = []
+        lm_state_list = []
         for i in range(batch_size):
             topk_log_probs, topk_indexes = ragged_log_probs[i].topk(beam)
 
@@ -2788,41 +3307,28 @@ def modified_beam_search_LODR(
 
                 new_token = topk_token_indexes[k]
                 if new_token not in (blank_id, unk_id):
-                    if LM.lm_type == "rnn":
-                        token_list.append([new_token])
-                        # store the LSTM states
-                        hs.append(hyp.state[0])
-                        cs.append(hyp.state[1])
-                    else:
-                        # for transformer LM
-                        token_list.append(
-                            [sos_id] + hyp.ys[context_size:] + [new_token]
-                        )
+                    token_list.append([new_token])
+                    # the arena row of the LSTM states for RNN LM, or the
+                    # cached keys and values for transformer LM
+                    lm_state_list.append(hyp.state)
 
         # forward NN LM to get new states and scores
-        if len(token_list) != 0:
+        if len(token_list) != 0 and LM.lm_type == "rnn":
+            # Contexts that are already scored are looked up in the arena
+            lm_states = lm_arena.extend(
+                lm_state_list, [tokens[0] for tokens in token_list]
+            )
+        elif len(token_list) != 0:
             x_lens = torch.tensor([len(tokens) for tokens in token_list]).to(device)
-            if LM.lm_type == "rnn":
-                tokens_to_score = (
-                    torch.tensor(token_list).to(torch.int64).to(device).reshape(-1, 1)
-                )
-                hs = torch.cat(hs, dim=1).to(device)
-                cs = torch.cat(cs, dim=1).to(device)
-                state = (hs, cs)
-            else:
-                # for transformer LM
-                tokens_list = [torch.tensor(tokens) for tokens in token_list]
-                tokens_to_score = (
-                    torch.nn.utils.rnn.pad_sequence(
-                        tokens_list, batch_first=True, padding_value=0.0
-                    )
-                    .to(device)
-                    .to(torch.int64)
-                )
-
-                state = None
+            tokens_to_score = (
+                torch.tensor(token_list).to(torch.int64).to(device).reshape(-1, 1)
+            )
+            # for transformer LM, only the new tokens are scored,
+            # attending to the cached keys and values of the history
+            state = TransformerLM.stack_states(lm_state_list)
 
             scores, lm_states = LM.score_token(tokens_to_score, x_lens, state)
+            lm_states = TransformerLM.unstack_states(lm_states)
 
         count = 0  # index, used to locate score and lm states
         for i in range(batch_size):
@@ -2838,6 +3344,7 @@ def modified_beam_search_LODR(
                 hyp = A[i][hyp_idx]
 
                 ys = hyp.ys[:]
+                ys_hash = hyp.ys_hash
 
                 # current score of hyp
                 lm_score = hyp.lm_score
@@ -2853,9 +3360,11 @@ def modified_beam_search_LODR(
                         (
                             context_score,
                             new_context_state,
+                            _,
                         ) = context_graph.forward_one_step(hyp.context_state, new_token)
 
                     ys.append(new_token)
+                    ys_hash = extend_ys_hash(ys_hash, new_token)
                     state_cost = hyp.state_cost.forward_one_step(new_token)
 
                     # calculate the score of the latest token
@@ -2873,18 +3382,18 @@ def modified_beam_search_LODR(
                         + context_score
                     )  # add the lm score
 
-                    lm_score = scores[count]
+                    state = lm_states[count]
                     if LM.lm_type == "rnn":
-                        state = (
-                            lm_states[0][:, count, :].unsqueeze(1),
-                            lm_states[1][:, count, :].unsqueeze(1),
-                        )
+                        lm_score = lm_arena.scores[state]
+                    else:
+                        lm_score = scores[count]
                     count += 1
                 else:
                     state_cost = hyp.state_cost
 
                 new_hyp = Hypothesis(
                     ys=ys,
+                    ys_hash=ys_hash,
                     log_prob=hyp_log_prob,
                     state=state,
                     lm_score=lm_score,
@@ -2893,6 +3402,10 @@ def modified_beam_search_LODR(
                 )
                 B[i].add(new_hyp)
 
+        if LM.lm_type == "rnn":
+            # free the LM states of the pruned hypotheses
+            lm_arena.sweep({hyp.state for b in B for hyp in b})
+
     B = B + finalized_B
 
     # finalize context_state, if the matched contexts do not reach final state
@@ -2907,6 +3420,7 @@ def modified_beam_search_LODR(
                 finalized_B[i].add(
                     Hypothesis(
                         ys=hyp.ys,
+                        ys_hash=hyp.ys_hash,
                         log_prob=hyp.log_prob + context_score,
                         timestamp=hyp.timestamp,
                         context_state=new_context_state,
@@ -2981,6 +3495,11 @@ def modified_beam_search_lm_shallow_fusion(
     sos_token = torch.tensor([[sos_id]]).to(torch.int64).to(device)
     lens = torch.tensor([1]).to(device)
     init_score, init_states = LM.score_token(sos_token, lens)
+    if LM.lm_type == "rnn":
+        lm_arena = RnnLmStateArena(
+            LM, init_score, init_states, max_rows=max(1, 2 * N * beam)
+        )
+        init_states = lm_arena.root
 
     B = [HypothesisList() for _ in range(N)]
     for i in range(N):
@@ -3018,10 +3537,6 @@ def modified_beam_search_lm_shallow_fusion(
             [hyp.log_prob.reshape(1, 1) for hyps in A for hyp in hyps]
         )
 
-        lm_scores = torch.cat(
-            [hyp.lm_score.reshape(1, -1) for hyps in A for hyp in hyps]
-        )
-
         decoder_input = torch.tensor(
             [hyp.ys[-context_size:] for hyps in A for hyp in hyps],
             device=device,
@@ -3068,8 +3583,7 @@ def modified_beam_search_lm_shallow_fusion(
         non-blank token.
         """
         token_list = []  # a list of list
-        hs = []
-        cs = []
+        lm_state_list = []
         for i in range(batch_size):
             topk_log_probs, topk_indexes = ragged_log_probs[i].topk(beam)
 
@@ -3083,40 +3597,27 @@ def modified_beam_search_lm_shallow_fusion(
 
                 new_token = topk_token_indexes[k]
                 if new_token not in (blank_id, unk_id):
-                    if LM.lm_type == "rnn":
-                        token_list.append([new_token])
-                        # store the LSTM states
-                        hs.append(hyp.state[0])
-                        cs.append(hyp.state[1])
-                    else:
-                        # for transformer LM
-                        token_list.append(
-                            [sos_id] + hyp.ys[context_size:] + [new_token]
-                        )
-
-        if len(token_list) != 0:
+                    token_list.append([new_token])
+                    # the arena row of the LSTM states for RNN LM, or the
+                    # cached keys and values for transformer LM
+                    lm_state_list.append(hyp.state)
+
+        if len(token_list) != 0 and LM.lm_type == "rnn":
+            # Contexts that are already scored are looked up in the arena
+            lm_states = lm_arena.extend(
+                lm_state_list, [tokens[0] for tokens in token_list]
+            )
+        elif len(token_list) != 0:
             x_lens = torch.tensor([len(tokens) for tokens in token_list]).to(device)
-            if LM.lm_type == "rnn":
-                tokens_to_score = (
-                    torch.tensor(token_list).to(torch.int64).to(device).reshape(-1, 1)
-                )
-                hs = torch.cat(hs, dim=1).to(device)
-                cs = torch.cat(cs, dim=1).to(device)
-                state = (hs, cs)
-            else:
-                # for transformer LM
-                tokens_list = [torch.tensor(tokens) for tokens in token_list]
-                tokens_to_score = (
-                    torch.nn.utils.rnn.pad_sequence(
-                        tokens_list, batch_first=True, padding_value=0.0
-                    )
-                    .to(device)
-                    .to(torch.int64)
-                )
-
-                state = None
+            tokens_to_score = (
+                torch.tensor(token_list).to(torch.int64).to(device).reshape(-1, 1)
+            )
+            # for transformer LM, only the new tokens are scored,
+            # attending to the cached keys and values of the history
+            state = TransformerLM.stack_states(lm_state_list)
 
             scores, lm_states = LM.score_token(tokens_to_score, x_lens, state)
+            lm_states = TransformerLM.unstack_states(lm_states)
 
         count = 0  # index, used to locate score and lm states
         for i in range(batch_size):
@@ -3132,6 +3633,7 @@ def modified_beam_search_lm_shallow_fusion(
                 hyp = A[i][hyp_idx]
 
                 ys = hyp.ys[:]
+                ys_hash = hyp.ys_hash
 
                 lm_score = hyp.lm_score
                 state = hyp.state
@@ -3141,20 +3643,21 @@ def modified_beam_search_lm_shallow_fusion(
                 new_timestamp = hyp.timestamp[:]
                 if new_token not in (blank_id, unk_id):
                     ys.append(new_token)
+                    ys_hash = extend_ys_hash(ys_hash, new_token)
                     new_timestamp.append(t)
 
                     hyp_log_prob += lm_score[new_token] * lm_scale  # add the lm score
 
-                    lm_score = scores[count]
+                    state = lm_states[count]
                     if LM.lm_type == "rnn":
-                        state = (
-                            lm_states[0][:, count, :].unsqueeze(1),
-                            lm_states[1][:, count, :].unsqueeze(1),
-                        )
+                        lm_score = lm_arena.scores[state]
+                    else:
+                        lm_score = scores[count]
                     count += 1
 
                 new_hyp = Hypothesis(
                     ys=ys,
+                    ys_hash=ys_hash,
                     log_prob=hyp_log_prob,
                     state=state,
                     lm_score=lm_score,
@@ -3162,6 +3665,10 @@ def modified_beam_search_lm_shallow_fusion(
                 )
                 B[i].add(new_hyp)
 
+        if LM.lm_type == "rnn":
+            # free the LM states of the pruned hypotheses
+            lm_arena.sweep({hyp.state for b in B for hyp in b})
+
     B = B + finalized_B
     best_hyps = [b.get_most_probable(length_norm=True) for b in B]
 
@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+#
+# Copyright    2023  Xiaomi Corp.
+#
+# See ../../../../LICENSE for clarification regarding multiple authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+This script compares the real-time factor (RTF) of modified_beam_search
+and modified_beam_search_tensorized on CPU. Only the search is timed;
+the encoder is run once beforehand.
+
+Usage:
+
+(1) With a randomly initialized model
+./zipformer/benchmark_beam_search.py \
+  --batch-size 16 \
+  --num-frames 1600 \
+  --beam-size 4
+
+(2) With a trained model
+./zipformer/benchmark_beam_search.py \
+  --checkpoint ./zipformer/exp/pretrained.pt \
+  --tokens data/lang_bpe_500/tokens.txt \
+  --batch-size 16 \
+  --num-frames 1600 \
+  --beam-size 4
+
+The RTF is computed as the decoding time divided by the duration of the
+input audio, assuming a frame shift of 10 ms.
+"""
+
+import argparse
+import logging
+import time
+from typing import Callable
+
+import k2
+import torch
+from beam_search import modified_beam_search, modified_beam_search_tensorized
+from train import add_model_arguments, get_model, get_params
+
+from icefall.utils import num_tokens
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+
+    parser.add_argument(
+        "--checkpoint",
+        type=str,
+        default="",
+        help="""Path to the checkpoint. It should contain a key "model".
+        If empty, a randomly initialized model is used.""",
+    )
+
+    parser.add_argument(
+        "--tokens",
+        type=str,
+        default="",
+        help="""Path to tokens.txt. If empty, --vocab-size is used and
+        the blank ID is 0.""",
+    )
+
+    parser.add_argument(
+        "--vocab-size",
+        type=int,
+        default=500,
+        help="Vocabulary size. Used only when --tokens is empty.",
+    )
+
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=16,
+        help="Number of utterances in a batch.",
+    )
+
+    parser.add_argument(
+        "--num-frames",
+        type=int,
+        default=1600,
+        help="Number of feature frames of the longest utterance.",
+    )
+
+    parser.add_argument(
+        "--beam-size",
+        type=int,
+        default=4,
+        help="Beam size for modified beam search.",
+    )
+
+    parser.add_argument(
+        "--context-size",
+        type=int,
+        default=2,
+        help="The context size in the decoder. 1 means bigram; 2 means tri-gram",
+    )
+
+    parser.add_argument(
+        "--num-iters",
+        type=int,
+        default=3,
+        help="Number of runs for each method. The average time is reported.",
+    )
+
+    parser.add_argument(
+        "--num-threads",
+        type=int,
+        default=1,
+        help="Number of threads used by torch.",
+    )
+
+    add_model_arguments(parser)
+
+    return parser
+
+
+def benchmark(
+    name: str,
+    search: Callable,
+    num_iters: int,
+    audio_duration: float,
+    **kwargs,
+):
+    # warm up
+    ans = search(**kwargs)
+
+    start = time.time()
+    for _ in range(num_iters):
+        ans = search(**kwargs)
+    elapsed = (time.time() - start) / num_iters
+
+    rtf = elapsed / audio_duration
+    logging.info(
+        f"{name}: {elapsed:.3f} s per batch, "
+        f"audio duration: {audio_duration:.3f} s, RTF: {rtf:.4f}"
+    )
+    return ans, elapsed
+
+
+@torch.no_grad()
+def main():
+    parser = get_parser()
+    args = parser.parse_args()
+
+    params = get_params()
+    params.update(vars(args))
+
+    if params.tokens:
+        token_table = k2.SymbolTable.from_file(params.tokens)
+        params.blank_id = token_table["<blk>"]
+        params.unk_id = token_table["<unk>"]
+        params.vocab_size = num_tokens(token_table) + 1
+    else:
+        params.blank_id = 0
+
+    torch.set_num_threads(params.num_threads)
+    torch.manual_seed(20231015)
+
+    logging.info(f"{params}")
+
+    device = torch.device("cpu")
+
+    logging.info("Creating model")
+    model = get_model(params)
+    if params.checkpoint:
+        checkpoint = torch.load(params.checkpoint, map_location="cpu")
+        model.load_state_dict(checkpoint["model"])
+    model.to(device)
+    model.eval()
+
+    N = params.batch_size
+    features = torch.rand(N, params.num_frames, params.feature_dim, device=device)
+    feature_lens = torch.randint(
+        low=params.num_frames // 2,
+        high=params.num_frames + 1,
+        size=(N,),
+        device=device,
+    )
+    feature_lens[0] = params.num_frames
+
+    encoder_out, encoder_out_lens = model.forward_encoder(features, feature_lens)
+
+    # 10 ms frame shift
+    audio_duration = feature_lens.sum().item() * 0.01
+
+    kwargs = dict(
+        model=model,
+        encoder_out=encoder_out,
+        encoder_out_lens=encoder_out_lens,
+        beam=params.beam_size,
+    )
+
+    ref, ref_elapsed = benchmark(
+        name="modified_beam_search",
+        search=modified_beam_search,
+        num_iters=params.num_iters,
+        audio_duration=audio_duration,
+        **kwargs,
+    )
+
+    hyp, hyp_elapsed = benchmark(
+        name="modified_beam_search_tensorized",
+        search=modified_beam_search_tensorized,
+        num_iters=params.num_iters,
+        audio_duration=audio_duration,
+        **kwargs,
+    )
+
+    num_diff = sum(r != h for r, h in zip(ref, hyp))
+    logging.info(f"Speedup: {ref_elapsed / hyp_elapsed:.2f}x")
+    logging.info(f"Number of utterances with different results: {num_diff}/{N}")
+
+
+if __name__ == "__main__":
+    formatter = "%(asctime)s %(levelname)s [%(filename)s:%(lineno)d] %(message)s"
+
+    logging.basicConfig(format=formatter, level=logging.INFO)
+    main()
@@ -105,15 +105,29 @@ Usage:
     --nbest-scale 1.0 \
     --lm-dir data/lm \
     --decoding-method attention-decoder-rescoring-with-ngram
+
+(9) ctc-prefix-beam-search
+./zipformer/ctc_decode.py \
+    --epoch 30 \
+    --avg 15 \
+    --exp-dir ./zipformer/exp \
+    --use-ctc 1 \
+    --max-duration 600 \
+    --beam-size 4 \
+    --decoding-method ctc-prefix-beam-search
+
+It can optionally boost hotwords with --context-file and add the scores
+of a token-level n-gram LM (lang_dir/2gram.fst.txt) with --ngram-lm-scale.
 """
 
 
 import argparse
 import logging
 import math
+import os
 from collections import defaultdict
 from pathlib import Path
-from typing import Dict, List, Optional, Tuple
+from typing import Dict, List, Optional, Tuple, Union
 
 import k2
 import sentencepiece as spm
@@ -122,6 +136,7 @@ import torch.nn as nn
 from asr_datamodule import LibriSpeechAsrDataModule
 from train import add_model_arguments, get_model, get_params
 
+from icefall import CompiledContextGraph, CompiledNgramLm, ContextGraph, NgramLm
 from icefall.checkpoint import (
     average_checkpoints,
     average_checkpoints_with_averaged_model,
@@ -130,6 +145,7 @@ from icefall.checkpoint import (
 )
 from icefall.decode import (
     ctc_greedy_search,
+    ctc_prefix_beam_search,
     get_lattice,
     nbest_decoding,
     nbest_oracle,
@@ -254,6 +270,65 @@ def get_parser():
           lattice, rescore them with the attention decoder.
         - (9) attention-decoder-rescoring-with-ngram. Extract n paths from the LM
           rescored lattice, rescore them with the attention decoder.
+        - (10) ctc-prefix-beam-search. Use CTC prefix beam search. Like
+          ctc-greedy-search, it needs neither a lexicon nor a decoding graph.
+          It supports hotwords (--context-file) and a token-level
+          n-gram LM (--ngram-lm-scale).
+        """,
+    )
+
+    parser.add_argument(
+        "--beam-size",
+        type=int,
+        default=4,
+        help="""Number of prefixes kept for each utterance.
+        Used only when --decoding-method is ctc-prefix-beam-search.
+        """,
+    )
+
+    parser.add_argument(
+        "--context-score",
+        type=float,
+        default=2,
+        help="""
+        The bonus score of each token for the context biasing words/phrases.
+        Used only when --decoding-method is ctc-prefix-beam-search.
+        """,
+    )
+
+    parser.add_argument(
+        "--context-file",
+        type=str,
+        default="",
+        help="""
+        The path of the context biasing lists, one word/phrase each line
+        Used only when --decoding-method is ctc-prefix-beam-search.
+        """,
+    )
+
+    parser.add_argument(
+        "--tokens-ngram",
+        type=int,
+        default=2,
+        help="""The order of the token-level n-gram LM, which is loaded from
+        lang_dir/{tokens_ngram}gram.fst.txt.
+        """,
+    )
+
+    parser.add_argument(
+        "--backoff-id",
+        type=int,
+        default=500,
+        help="ID of the backoff symbol in the ngram LM",
+    )
+
+    parser.add_argument(
+        "--ngram-lm-scale",
+        type=float,
+        default=0.0,
+        help="""The scale of the token-level n-gram LM scores. If positive,
+        the n-gram LM is used. Used only when --decoding-method is
+        ctc-prefix-beam-search.
         """,
     )
 
@@ -325,6 +400,8 @@ def decode_one_batch(
     batch: dict,
     word_table: k2.SymbolTable,
     G: Optional[k2.Fsa] = None,
+    context_graph: Optional[Union[ContextGraph, CompiledContextGraph]] = None,
+    ngram_lm: Optional[Union[NgramLm, CompiledNgramLm]] = None,
 ) -> Dict[str, List[List[str]]]:
     """Decode one batch and return the result in a dict. The dict has the
     following format:
@@ -365,6 +442,12 @@ def decode_one_batch(
         An LM. It is not None when params.decoding_method is "nbest-rescoring"
         or "whole-lattice-rescoring". In general, the G in HLG
         is a 3-gram LM, while this G is a 4-gram LM.
+      context_graph:
+        The context graph for hotwords. Used only when
+        params.decoding_method is ctc-prefix-beam-search.
+      ngram_lm:
+        A token-level n-gram LM. Used only when params.decoding_method
+        is ctc-prefix-beam-search.
     Returns:
       Return the decoding result. See above description for the format of
       the returned dict. Note: If it decodes to nothing, then return None.
@@ -403,6 +486,20 @@ def decode_one_batch(
         key = "ctc-greedy-search"
         return {key: hyps}
 
+    if params.decoding_method == "ctc-prefix-beam-search":
+        hyps = ctc_prefix_beam_search(
+            ctc_output,
+            encoder_out_lens,
+            beam=params.beam_size,
+            context_graph=context_graph,
+            ngram_lm=ngram_lm,
+            ngram_lm_scale=params.ngram_lm_scale,
+        )
+        hyps = bpe_model.decode(hyps)
+        hyps = [s.split() for s in hyps]
+        key = f"ctc-prefix-beam-search-beam-size-{params.beam_size}"
+        return {key: hyps}
+
     supervision_segments = torch.stack(
         (
             supervisions["sequence_idx"],
@@ -576,6 +673,8 @@ def decode_dataset(
     bpe_model: Optional[spm.SentencePieceProcessor],
     word_table: k2.SymbolTable,
     G: Optional[k2.Fsa] = None,
+    context_graph: Optional[Union[ContextGraph, CompiledContextGraph]] = None,
+    ngram_lm: Optional[Union[NgramLm, CompiledNgramLm]] = None,
 ) -> Dict[str, List[Tuple[str, List[str], List[str]]]]:
     """Decode dataset.
 
@@ -598,6 +697,10 @@ def decode_dataset(
         An LM. It is not None when params.decoding_method is "nbest-rescoring"
         or "whole-lattice-rescoring". In general, the G in HLG
         is a 3-gram LM, while this G is a 4-gram LM.
+      context_graph:
+        The context graph for hotwords, see :func:`decode_one_batch`.
+      ngram_lm:
+        A token-level n-gram LM, see :func:`decode_one_batch`.
     Returns:
       Return a dict, whose key may be "no-rescore" if no LM rescoring
       is used, or it may be "lm_scale_0.7" if LM rescoring is used.
@@ -626,6 +729,8 @@ def decode_dataset(
             batch=batch,
             word_table=word_table,
             G=G,
+            context_graph=context_graph,
+            ngram_lm=ngram_lm,
         )
 
         for name, hyps in hyps_dict.items():
@@ -707,6 +812,7 @@ def main():
 
     assert params.decoding_method in (
         "ctc-greedy-search",
+        "ctc-prefix-beam-search",
         "ctc-decoding",
         "1best",
         "nbest",
@@ -736,6 +842,13 @@ def main():
     if params.use_averaged_model:
         params.suffix += "-use-averaged-model"
 
+    if params.decoding_method == "ctc-prefix-beam-search":
+        params.suffix += f"-beam-size-{params.beam_size}"
+        if os.path.exists(params.context_file):
+            params.suffix += f"-context-score-{params.context_score}"
+        if params.ngram_lm_scale > 0:
+            params.suffix += f"-ngram-lm-scale-{params.ngram_lm_scale}"
+
     setup_logger(f"{params.res_dir}/log-decode-{params.suffix}")
     logging.info("Decoding started")
 
@@ -757,7 +870,10 @@ def main():
     params.sos_id = 1
 
     if params.decoding_method in [
-        "ctc-greedy-search", "ctc-decoding", "attention-decoder-rescoring-no-ngram"
+        "ctc-greedy-search",
+        "ctc-prefix-beam-search",
+        "ctc-decoding",
+        "attention-decoder-rescoring-no-ngram",
     ]:
         HLG = None
         H = k2.ctc_topo(
@@ -829,6 +945,28 @@ def main():
     else:
         G = None
 
+    context_graph = None
+    ngram_lm = None
+    if params.decoding_method == "ctc-prefix-beam-search":
+        if os.path.exists(params.context_file):
+            contexts = []
+            for line in open(params.context_file).readlines():
+                contexts.append(bpe_model.encode(line.strip()))
+            context_graph = ContextGraph(params.context_score)
+            context_graph.build(contexts)
+            context_graph = context_graph.compile()
+
+        if params.ngram_lm_scale > 0:
+            lm_filename = f"{params.tokens_ngram}gram.fst.txt"
+            logging.info(f"Loading token level lm: {lm_filename}")
+            ngram_lm = NgramLm(
+                str(params.lang_dir / lm_filename),
+                backoff_id=params.backoff_id,
+                is_binary=False,
+            )
+            ngram_lm = CompiledNgramLm.from_ngram_lm(ngram_lm)
+            logging.info(f"num states: {ngram_lm.num_states}")
+
     logging.info("About to create model")
     model = get_model(params)
 
@@ -938,6 +1076,8 @@ def main():
             bpe_model=bpe_model,
             word_table=lexicon.word_table,
             G=G,
+            context_graph=context_graph,
+            ngram_lm=ngram_lm,
         )
 
         save_results(
@@ -44,7 +44,16 @@ Usage:
     --decoding-method modified_beam_search \
     --beam-size 4
 
-(4) fast beam search (one best)
+(4) modified beam search (tensorized, faster on CPU)
+./zipformer/decode.py \
+    --epoch 28 \
+    --avg 15 \
+    --exp-dir ./zipformer/exp \
+    --max-duration 600 \
+    --decoding-method modified_beam_search_tensorized \
+    --beam-size 4
+
+(5) fast beam search (one best)
 ./zipformer/decode.py \
     --epoch 28 \
     --avg 15 \
@@ -55,7 +64,7 @@ Usage:
     --max-contexts 8 \
     --max-states 64
 
-(5) fast beam search (nbest)
+(6) fast beam search (nbest)
 ./zipformer/decode.py \
     --epoch 28 \
     --avg 15 \
@@ -68,7 +77,7 @@ Usage:
     --num-paths 200 \
     --nbest-scale 0.5
 
-(6) fast beam search (nbest oracle WER)
+(7) fast beam search (nbest oracle WER)
 ./zipformer/decode.py \
     --epoch 28 \
     --avg 15 \
@@ -81,7 +90,7 @@ Usage:
     --num-paths 200 \
     --nbest-scale 0.5
 
-(7) fast beam search (with LG)
+(8) fast beam search (with LG)
 ./zipformer/decode.py \
     --epoch 28 \
     --avg 15 \
@@ -120,10 +129,12 @@ from beam_search import (
     modified_beam_search_lm_rescore_LODR,
     modified_beam_search_lm_shallow_fusion,
     modified_beam_search_LODR,
+    modified_beam_search_tensorized,
 )
+from scaling_converter import convert_for_inference
 from train import add_model_arguments, get_model, get_params
 
-from icefall import ContextGraph, LmScorer, NgramLm
+from icefall import CompiledNgramLm, ContextGraph, LmScorer, NgramLm
 from icefall.checkpoint import (
     average_checkpoints,
     average_checkpoints_with_averaged_model,
@@ -133,6 +144,7 @@ from icefall.checkpoint import (
 from icefall.lexicon import Lexicon
 from icefall.utils import (
     AttributeDict,
+    align_results_dict,
     setup_logger,
     store_transcripts,
     str2bool,
@@ -215,6 +227,7 @@ def get_parser():
           - greedy_search
           - beam_search
           - modified_beam_search
+          - modified_beam_search_tensorized
           - modified_beam_search_LODR
           - fast_beam_search
           - fast_beam_search_nbest
@@ -348,6 +361,16 @@ def get_parser():
         help="ID of the backoff symbol in the ngram LM",
     )
 
+    parser.add_argument(
+        "--compile-ngram-lm",
+        type=str2bool,
+        default=True,
+        help="""If True, flatten the token level ngram LM into arrays
+        (see icefall.ngram_lm.CompiledNgramLm) for faster lookup.
+        Used only when --decoding-method is modified_beam_search_LODR.
+        """,
+    )
+
     parser.add_argument(
         "--context-score",
         type=float,
@@ -369,6 +392,37 @@ def get_parser():
         modified_beam_search_LODR.
         """,
     )
+
+    parser.add_argument(
+        "--compile-context-graph",
+        type=str2bool,
+        default=True,
+        help="""If True, convert the context graph built from --context-file
+        to an icefall.context_graph.CompiledContextGraph, which searches all
+        hypotheses of a frame in one vectorized call.
+        """,
+    )
+
+    parser.add_argument(
+        "--num-scoring-jobs",
+        type=int,
+        default=1,
+        help="""Number of processes used to align the hypotheses with the
+        references when computing the WERs.
+        """,
+    )
+
+    parser.add_argument(
+        "--convert-for-inference",
+        type=str2bool,
+        default=False,
+        help="""If True, convert the model with
+        scaling_converter.convert_for_inference() before decoding. It removes
+        the modules that are only used in training and uses fused activations,
+        which is faster, especially on CPU. The results are not changed.
+        See ./zipformer/benchmark_inference.py
+        """,
+    )
     add_model_arguments(parser)
 
     return parser
@@ -520,6 +574,15 @@ def decode_one_batch(
         )
         for hyp in sp.decode(hyp_tokens):
             hyps.append(hyp.split())
+    elif params.decoding_method == "modified_beam_search_tensorized":
+        hyp_tokens = modified_beam_search_tensorized(
+            model=model,
+            encoder_out=encoder_out,
+            encoder_out_lens=encoder_out_lens,
+            beam=params.beam_size,
+        )
+        for hyp in sp.decode(hyp_tokens):
+            hyps.append(hyp.split())
     elif params.decoding_method == "modified_beam_search_lm_shallow_fusion":
         hyp_tokens = modified_beam_search_lm_shallow_fusion(
             model=model,
@@ -713,11 +776,12 @@ def save_results(
     results_dict: Dict[str, List[Tuple[str, List[str], List[str]]]],
 ):
     test_set_wers = dict()
+    # Align the results of all keys at a time. It also sorts them.
+    alignments = align_results_dict(results_dict, num_jobs=params.num_scoring_jobs)
     for key, results in results_dict.items():
         recog_path = (
             params.res_dir / f"recogs-{test_set_name}-{key}-{params.suffix}.txt"
         )
-        results = sorted(results)
         store_transcripts(filename=recog_path, texts=results)
         logging.info(f"The transcripts are stored in {recog_path}")
 
@@ -726,9 +790,16 @@ def save_results(
         errs_filename = (
             params.res_dir / f"errs-{test_set_name}-{key}-{params.suffix}.txt"
         )
+        # The alignment of each utterance in JSON lines
+        jsonl_filename = errs_filename.with_suffix(".jsonl")
         with open(errs_filename, "w") as f:
             wer = write_error_stats(
-                f, f"{test_set_name}-{key}", results, enable_log=True
+                f,
+                f"{test_set_name}-{key}",
+                results,
+                enable_log=True,
+                alignments=alignments[key],
+                jsonl_filename=jsonl_filename,
             )
             test_set_wers[key] = wer
 
@@ -770,6 +841,7 @@ def main():
         "fast_beam_search_nbest_LG",
         "fast_beam_search_nbest_oracle",
         "modified_beam_search",
+        "modified_beam_search_tensorized",
         "modified_beam_search_LODR",
         "modified_beam_search_lm_shallow_fusion",
         "modified_beam_search_lm_rescore",
@@ -931,6 +1003,9 @@ def main():
     model.to(device)
     model.eval()
 
+    if params.convert_for_inference:
+        convert_for_inference(model, inplace=True)
+
     # only load the neural network LM if required
     if params.use_shallow_fusion or params.decoding_method in (
         "modified_beam_search_lm_rescore",
@@ -973,7 +1048,9 @@ def main():
             backoff_id=params.backoff_id,
             is_binary=False,
         )
-        logging.info(f"num states: {ngram_lm.lm.num_states}")
+        if params.compile_ngram_lm:
+            ngram_lm = CompiledNgramLm.from_ngram_lm(ngram_lm)
+        logging.info(f"num states: {ngram_lm.num_states}")
         ngram_lm_scale = params.ngram_lm_scale
     else:
         ngram_lm = None
@@ -1003,6 +1080,8 @@ def main():
                 contexts.append((sp.encode(line.strip()), 0.0))
             context_graph = ContextGraph(params.context_score)
             context_graph.build(contexts)
+            if params.compile_context_graph:
+                context_graph = context_graph.compile()
         else:
             context_graph = None
     else:
@@ -16,34 +16,88 @@
 # limitations under the License.
 
 import math
+from dataclasses import dataclass
 from typing import List, Optional, Tuple
 
 import k2
 import torch
 from beam_search import Hypothesis, HypothesisList
+from kaldifeat import FbankOptions, OnlineFbank
 
 from icefall.utils import AttributeDict
 
+# The maximum number of frames kept by the online fbank extractor of
+# a DecodeStream, i.e., 10 seconds. See `DecodeStream.accept_waveform`.
+MAX_FEATURE_VECTORS = 1000
+
+
+def create_streaming_feature_extractor(
+    sample_rate: int, max_feature_vectors: int = -1
+) -> OnlineFbank:
+    """Create a CPU streaming feature extractor.
+
+    Args:
+      sample_rate:
+        The sample rate of the input audio.
+      max_feature_vectors:
+        The maximum number of recent frames kept by the extractor, so that
+        its memory does not grow with the audio length. -1 means no limit.
+    Returns:
+      Return a CPU streaming fbank extractor.
+    """
+    opts = FbankOptions()
+    opts.device = "cpu"
+    opts.frame_opts.dither = 0
+    opts.frame_opts.snip_edges = False
+    opts.frame_opts.samp_freq = sample_rate
+    opts.mel_opts.num_bins = 80
+    opts.mel_opts.high_freq = -400
+    opts.frame_opts.max_feature_vectors = max_feature_vectors
+    return OnlineFbank(opts)
+
+
+@dataclass
+class Segment:
+    """A segment of a stream that ends at an endpoint, see
+    :meth:`DecodeStream.endpoint_detected`."""
+
+    # The decoded tokens
+    tokens: List[int]
+
+    # Start and end time of the segment in seconds, relative to the start
+    # of the stream
+    start_time: float
+    end_time: float
+
+    # timestamps[i] is the time in seconds, relative to the start of the
+    # stream, at which tokens[i] is decoded. Empty for fast_beam_search.
+    timestamps: List[float]
+
 
 class DecodeStream(object):
     def __init__(
         self,
         params: AttributeDict,
         cut_id: str,
-        initial_states: List[torch.Tensor],
+        initial_states: Optional[List[torch.Tensor]],
         decoding_graph: Optional[k2.Fsa] = None,
         device: torch.device = torch.device("cpu"),
+        state_slot: Optional[int] = None,
     ) -> None:
         """
         Args:
           initial_states:
             Initial decode states of the model, e.g. the return value of
-            `get_init_state` in conformer.py
+            `get_init_state` in conformer.py. It can be None if the states
+            are kept in a `StreamingStatePool`, see `state_slot`.
           decoding_graph:
             Decoding graph used for decoding, may be a TrivialGraph or a HLG.
             Used only when decoding_method is fast_beam_search.
           device:
             The device to run this stream.
+          state_slot:
+            If not None, the index of the slot in a `StreamingStatePool`
+            that holds the states of this stream.
         """
         if params.decoding_method == "fast_beam_search":
             assert decoding_graph is not None
@@ -51,13 +105,25 @@ class DecodeStream(object):
 
         self.params = params
         self.cut_id = cut_id
+        self.decoding_graph = decoding_graph
+        self.device = device
         self.LOG_EPS = math.log(1e-10)
 
         self.states = initial_states
+        self.state_slot = state_slot
+        assert (initial_states is None) != (state_slot is None)
 
         # It contains a 2-D tensors representing the feature frames.
+        # When the audio is given by `accept_waveform`, it contains only
+        # the frames from `frame_offset` on, which are not consumed yet.
         self.features: torch.Tensor = None
+        self.frame_offset: int = 0
+
+        # Used only by `accept_waveform`
+        self.online_fbank: Optional[OnlineFbank] = None
+        self._input_finished: bool = False
 
+        # The total number of frames, including the ones that are dropped
         self.num_frames: int = 0
         # how many frames have been processed. (before subsampling).
         # we only modify this value in `func:get_feature_frames`.
@@ -68,6 +134,13 @@ class DecodeStream(object):
         # The transcript of current utterance.
         self.ground_truth: str = ""
 
+        # Used by the schedulers in streaming_scheduler.py. Streams with
+        # smaller priority are decoded first; if deadline (as returned by
+        # time.time()) is not None and has passed, the stream is decoded
+        # in the next chunk.
+        self.priority: int = 0
+        self.deadline: Optional[float] = None
+
         # The decoding result (partial or final) of current utterance.
         self.hyp: List = []
 
@@ -78,20 +151,35 @@ class DecodeStream(object):
         # The ConvNeXt module needs (7 - 1) // 2 = 3 frames of right padding after subsampling
         self.pad_length = 7 + 2 * 3
 
+        # Segments finished at endpoints, see `finish_segment`
+        self.segments: List[Segment] = []
+        # The encoder output frame where the current segment starts
+        self.segment_start_frame: int = 0
+
+        self._init_hyp()
+
+    def _init_hyp(self) -> None:
+        """Initialize the decoding result of a new segment."""
+        params = self.params
         if params.decoding_method == "greedy_search":
             self.hyp = [-1] * (params.context_size - 1) + [params.blank_id]
+            # timestamp[i] is the encoder output frame on which
+            # hyp[context_size + i] is decoded
+            self.timestamp: List[int] = []
+            self.num_trailing_blanks: int = 0
         elif params.decoding_method == "modified_beam_search":
             self.hyps = HypothesisList()
             self.hyps.add(
                 Hypothesis(
                     ys=[-1] * (params.context_size - 1) + [params.blank_id],
-                    log_prob=torch.zeros(1, dtype=torch.float32, device=device),
+                    log_prob=torch.zeros(1, dtype=torch.float32, device=self.device),
                 )
             )
         elif params.decoding_method == "fast_beam_search":
             # The rnnt_decoding_stream for fast_beam_search.
+            self.hyp = []
             self.rnnt_decoding_stream: k2.RnntDecodingStream = k2.RnntDecodingStream(
-                decoding_graph
+                self.decoding_graph
             )
         else:
             raise ValueError(f"Unsupported decoding method: {params.decoding_method}")
@@ -105,6 +193,11 @@ class DecodeStream(object):
     def id(self) -> str:
         return self.cut_id
 
+    @property
+    def num_remaining_frames(self) -> int:
+        """Number of feature frames (including padding) not consumed yet."""
+        return max(self.num_frames - self.num_processed_frames, 0)
+
     def set_features(
         self,
         features: torch.Tensor,
@@ -120,20 +213,108 @@ class DecodeStream(object):
         )
         self.num_frames = self.features.size(0)
 
+    def accept_waveform(self, sample_rate: int, waveform: torch.Tensor) -> None:
+        """Append audio samples of current utterance and compute their
+        features with an online fbank extractor.
+
+        It is an alternative to :meth:`set_features` for live audio.
+        Call :meth:`input_finished` after the last samples.
+
+        Args:
+          sample_rate:
+            The sample rate of the audio.
+          waveform:
+            A 1-D float32 tensor containing the samples, normalized to
+            the range [-1, 1].
+        """
+        assert not self._input_finished
+        assert waveform.dim() == 1, waveform.dim()
+        if self.online_fbank is None:
+            assert self.features is None, "set_features() has been called"
+            self.online_fbank = create_streaming_feature_extractor(
+                sample_rate, max_feature_vectors=MAX_FEATURE_VECTORS
+            )
+        # The extractor keeps only the last MAX_FEATURE_VECTORS frames, so we
+        # give it at most half of that at a time and fetch the new frames
+        # right away, before they are dropped.
+        piece_size = MAX_FEATURE_VECTORS // 2 * sample_rate // 100
+        waveform = waveform.cpu()
+        for start in range(0, waveform.numel(), piece_size):
+            self.online_fbank.accept_waveform(
+                sampling_rate=sample_rate,
+                waveform=waveform[start : start + piece_size],
+            )
+            self._fetch_frames()
+
+    def input_finished(self, tail_pad_len: int = 0) -> None:
+        """Signal that no more audio will be given by :meth:`accept_waveform`.
+        The remaining features are computed and padded as in
+        :meth:`set_features`."""
+        assert not self._input_finished
+        self._input_finished = True
+        if self.online_fbank is not None:
+            self.online_fbank.input_finished()
+            self._fetch_frames()
+        else:
+            assert self.features is None, "set_features() has been called"
+        if self.features is None:
+            # No audio at all
+            self.features = torch.empty(0, 80)
+        self.features = torch.nn.functional.pad(
+            self.features,
+            (0, 0, 0, self.pad_length + tail_pad_len),
+            mode="constant",
+            value=self.LOG_EPS,
+        )
+        self.num_frames = self.frame_offset + self.features.size(0)
+
+    def _fetch_frames(self) -> None:
+        """Move the frames ready in the online fbank extractor to
+        `self.features`."""
+        num_frames_ready = self.online_fbank.num_frames_ready
+        if num_frames_ready == self.num_frames:
+            return
+
+        frames = self.online_fbank.get_frames(
+            list(range(self.num_frames, num_frames_ready))
+        )
+        if self.features is not None:
+            frames.insert(0, self.features)
+        self.features = torch.cat(frames, dim=0)
+        self.num_frames = num_frames_ready
+
+    def is_ready(self, chunk_size: int) -> bool:
+        """Return True if :meth:`get_feature_frames` can be called with
+        the given chunk_size, i.e., there are enough features for a chunk
+        or no more features will be given."""
+        if self.done or self.features is None:
+            return False
+        if self.online_fbank is None or self._input_finished:
+            return True
+        return self.num_remaining_frames >= chunk_size + self.pad_length
+
     def get_feature_frames(self, chunk_size: int) -> Tuple[torch.Tensor, int]:
-        """Consume chunk_size frames of features"""
+        """Consume chunk_size frames of features. If the audio is given by
+        :meth:`accept_waveform`, call it only if :meth:`is_ready` is True."""
         chunk_length = chunk_size + self.pad_length
 
         ret_length = min(self.num_frames - self.num_processed_frames, chunk_length)
 
-        ret_features = self.features[
-            self.num_processed_frames : self.num_processed_frames + ret_length  # noqa
-        ]
+        start = self.num_processed_frames - self.frame_offset
+        ret_features = self.features[start : start + ret_length]
 
         self.num_processed_frames += chunk_size
         if self.num_processed_frames >= self.num_frames:
             self._done = True
 
+        if self.online_fbank is not None:
+            # Drop the frames that are not needed by later chunks
+            num_dropped = (
+                min(self.num_processed_frames, self.num_frames) - self.frame_offset
+            )
+            self.features = self.features[num_dropped:]
+            self.frame_offset += num_dropped
+
         return ret_features, ret_length
 
     def decoding_result(self) -> List[int]:
@@ -146,3 +327,79 @@ class DecodeStream(object):
         else:
             assert self.params.decoding_method == "fast_beam_search"
             return self.hyp
+
+    @property
+    def frame_shift(self) -> float:
+        """Duration in seconds of an encoder output frame."""
+        return self.params.subsampling_factor * 0.01
+
+    def endpoint_detected(self) -> bool:
+        """Return True if the current segment should end here.
+
+        An endpoint is detected if either of the following rules holds,
+        with the rule thresholds given by `params`:
+
+          - The segment has at least `endpoint_min_num_tokens` tokens and
+            is followed by at least `endpoint_min_trailing_silence` seconds
+            of blanks.
+          - The segment is at least `endpoint_max_utterance_length`
+            seconds long.
+
+        It is not supported for fast_beam_search.
+        """
+        params = self.params
+        assert params.decoding_method in (
+            "greedy_search",
+            "modified_beam_search",
+        ), params.decoding_method
+
+        num_frames = self.done_frames - self.segment_start_frame
+        utterance_length = num_frames * self.frame_shift
+        if utterance_length >= params.endpoint_max_utterance_length:
+            return True
+
+        if params.decoding_method == "greedy_search":
+            num_tokens = len(self.hyp) - params.context_size
+            num_trailing_blanks = self.num_trailing_blanks
+        else:
+            best_hyp = self.hyps.get_most_probable(length_norm=True)
+            num_tokens = len(best_hyp.ys) - params.context_size
+            num_trailing_blanks = best_hyp.num_tailing_blanks
+
+        trailing_silence = min(num_trailing_blanks, num_frames) * self.frame_shift
+        return (
+            num_tokens >= params.endpoint_min_num_tokens
+            and trailing_silence >= params.endpoint_min_trailing_silence
+        )
+
+    def finish_segment(self) -> Segment:
+        """End the current segment, append it to `self.segments` and reset
+        the decoding result for the next segment. The encoder states are
+        not changed; it is up to the caller to reset them."""
+        tokens = self.decoding_result()
+        if self.params.decoding_method == "greedy_search":
+            timestamp = self.timestamp
+        elif self.params.decoding_method == "modified_beam_search":
+            timestamp = self.hyps.get_most_probable(length_norm=True).timestamp
+        else:
+            timestamp = []
+
+        segment = Segment(
+            tokens=tokens,
+            start_time=self.segment_start_frame * self.frame_shift,
+            end_time=self.done_frames * self.frame_shift,
+            timestamps=[t * self.frame_shift for t in timestamp],
+        )
+        self.segments.append(segment)
+
+        self.segment_start_frame = self.done_frames
+        self._init_hyp()
+        return segment
+
+    def full_result(self) -> List[int]:
+        """Obtain the decoding result of all segments, including the
+        current one."""
+        ans = []
+        for segment in self.segments:
+            ans += segment.tokens
+        return ans + self.decoding_result()
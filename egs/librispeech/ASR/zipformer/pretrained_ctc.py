@@ -90,6 +90,16 @@ Usage of this script:
   --sample-rate 16000 \
   /path/to/foo.wav \
   /path/to/bar.wav
+
+(6) ctc-prefix-beam-search
+./zipformer/pretrained_ctc.py \
+  --checkpoint ./zipformer/exp/pretrained.pt \
+  --tokens data/lang_bpe_500/tokens.txt \
+  --method ctc-prefix-beam-search \
+  --beam-size 4 \
+  --sample-rate 16000 \
+  /path/to/foo.wav \
+  /path/to/bar.wav
 """
 
 import argparse
@@ -107,6 +117,7 @@ from torch.nn.utils.rnn import pad_sequence
 from train import add_model_arguments, get_model, get_params
 
 from icefall.decode import (
+    ctc_prefix_beam_search,
     get_lattice,
     one_best_decoding,
     rescore_with_attention_decoder_no_ngram,
@@ -157,7 +168,7 @@ def get_parser():
         "--tokens",
         type=str,
         help="""Path to tokens.txt.
-        Used only when method is ctc-decoding.
+        Used only when method is ctc-decoding or ctc-prefix-beam-search.
         """,
     )
 
@@ -184,9 +195,20 @@ def get_parser():
             We call it HLG decoding + whole-lattice n-gram LM rescoring.
         (4) attention-decoder-rescoring-no-ngram. Extract n paths from the decoding
           lattice, rescore them with the attention decoder.
+        (5) ctc-prefix-beam-search - Use CTC prefix beam search. Like
+            ctc-decoding, it needs neither a lexicon nor an n-gram LM.
         """,
     )
 
+    parser.add_argument(
+        "--beam-size",
+        type=int,
+        default=4,
+        help="""
+        Used only when method is ctc-prefix-beam-search.
+        It specifies the number of prefixes kept for each utterance.""",
+    )
+
     parser.add_argument(
         "--G",
         type=str,
@@ -346,7 +368,13 @@ def main():
         dtype=torch.int32,
     )
 
-    if params.method in ["ctc-decoding", "attention-decoder-rescoring-no-ngram"]:
+    if params.method == "ctc-prefix-beam-search":
+        logging.info("Use CTC prefix beam search")
+        token_ids = ctc_prefix_beam_search(
+            ctc_output, encoder_out_lens, beam=params.beam_size
+        )
+        hyps = [[token_table[i] for i in ids] for ids in token_ids]
+    elif params.method in ["ctc-decoding", "attention-decoder-rescoring-no-ngram"]:
         max_token_id = params.vocab_size - 1
         H = k2.ctc_topo(
             max_token=max_token_id,
@@ -454,7 +482,11 @@ def main():
         raise ValueError(f"Unsupported decoding method: {params.method}")
 
     s = "\n"
-    if params.method in ["ctc-decoding", "attention-decoder-rescoring-no-ngram"]:
+    if params.method in [
+        "ctc-decoding",
+        "ctc-prefix-beam-search",
+        "attention-decoder-rescoring-no-ngram",
+    ]:
         for filename, hyp in zip(params.sound_files, hyps):
             words = "".join(hyp)
             words = words.replace("▁", " ").strip()
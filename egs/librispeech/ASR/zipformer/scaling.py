@@ -496,6 +496,33 @@ class BiasNorm(torch.nn.Module):
         )
 
 
+class BiasNormInference(torch.nn.Module):
+    """
+    Inference-only version of BiasNorm. It shares the parameters of the given
+    BiasNorm and computes the output directly, without the autograd function
+    and the limits on log_scale that are used in training.
+    """
+
+    def __init__(self, m: BiasNorm) -> None:
+        super().__init__()
+        self.num_channels = m.num_channels
+        self.channel_dim = m.channel_dim
+        self.log_scale = m.log_scale
+        self.bias = m.bias
+
+    def forward(self, x: Tensor) -> Tensor:
+        channel_dim = self.channel_dim
+        if channel_dim < 0:
+            channel_dim += x.ndim
+        bias = self.bias
+        for _ in range(channel_dim + 1, x.ndim):
+            bias = bias.unsqueeze(-1)
+        scales = (
+            torch.mean((x - bias) ** 2, dim=channel_dim, keepdim=True) ** -0.5
+        ) * self.log_scale.exp()
+        return x * scales
+
+
 def ScaledLinear(*args, initial_scale: float = 1.0, **kwargs) -> nn.Linear:
     """
     Behaves like a constructor of a modified version of nn.Linear
@@ -1488,6 +1515,20 @@ class SwooshROnnx(torch.nn.Module):
         return logaddexp_onnx(zero, x - 1.0) - 0.08 * x - 0.313261687
 
 
+class SwooshLInference(torch.nn.Module):
+    def forward(self, x: Tensor) -> Tensor:
+        """Return Swoosh-L activation, computed by a fused kernel.
+        It does not support backprop."""
+        return k2.swoosh_l_forward(x)
+
+
+class SwooshRInference(torch.nn.Module):
+    def forward(self, x: Tensor) -> Tensor:
+        """Return Swoosh-R activation, computed by a fused kernel.
+        It does not support backprop."""
+        return k2.swoosh_r_forward(x)
+
+
 # simple version of SwooshL that does not redefine the backprop, used in
 # ActivationDropoutAndLinearFunction.
 def SwooshLForward(x: Tensor):
@@ -1654,6 +1695,31 @@ class ActivationDropoutAndLinear(torch.nn.Module):
         )
 
 
+class ActivationAndLinearInference(torch.nn.Module):
+    """
+    Inference-only version of ActivationDropoutAndLinear. It shares the
+    parameters of the given ActivationDropoutAndLinear and computes
+    the activation with a fused kernel followed by nn.functional.linear,
+    without the autograd function and dropout.
+    """
+
+    def __init__(self, m: ActivationDropoutAndLinear) -> None:
+        super().__init__()
+        self.weight = m.weight
+        self.register_parameter("bias", m.bias)
+        self.activation = m.activation
+        if m.activation == "SwooshL":
+            self.activation_func = k2.swoosh_l_forward
+        elif m.activation == "SwooshR":
+            self.activation_func = k2.swoosh_r_forward
+        else:
+            assert False, m.activation
+
+    def forward(self, x: Tensor) -> Tensor:
+        x = self.activation_func(x)
+        return torch.nn.functional.linear(x, self.weight, self.bias)
+
+
 def convert_num_channels(x: Tensor, num_channels: int) -> Tensor:
     if num_channels <= x.shape[-1]:
         return x[..., :num_channels]
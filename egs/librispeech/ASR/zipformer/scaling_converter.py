@@ -20,20 +20,32 @@ This file replaces various modules in a model.
 Specifically, ActivationBalancer is replaced with an identity operator;
 Whiten is also replaced with an identity operator;
 BasicNorm is replaced by a module with `exp` removed.
+
+It also converts a model for inference in eager mode, see
+:func:`convert_for_inference`.
 """
 
 import copy
-from typing import List
+from typing import Any, Dict, List
 
 import torch
 import torch.nn as nn
 from scaling import (
+    ActivationAndLinearInference,
+    ActivationDropoutAndLinear,
     Balancer,
+    BiasNorm,
+    BiasNormInference,
+    Dropout2,
     Dropout3,
+    Identity,
     ScaleGrad,
+    ScheduledFloat,
     SwooshL,
+    SwooshLInference,
     SwooshLOnnx,
     SwooshR,
+    SwooshRInference,
     SwooshROnnx,
     Whiten,
 )
@@ -95,11 +107,82 @@ def convert_scaled_to_non_scaled(
             # to replace torch.jit.trace()
             d[name] = torch.jit.script(m)
 
+    _replace_modules(model, d)
+
+    return model
+
+
+def convert_for_inference(model: nn.Module, inplace: bool = False):
+    """
+    Convert a model for inference in eager mode, e.g., in ./decode.py.
+    On top of :func:`convert_scaled_to_non_scaled`, it
+
+      - replaces Dropout2 and the Identity modules used for diagnostics
+        with nn.Identity;
+      - replaces SwooshL, SwooshR, BiasNorm and ActivationDropoutAndLinear
+        with versions that don't support backprop, so no autograd function
+        is invoked;
+      - replaces each ScheduledFloat with its default value, which it
+        always returns when not in training mode.
+
+    The outputs are the same as those of the original model in eval mode.
+    The parameter names are kept, so the converted model can load the state
+    dict of the original one. It cannot be trained, and it cannot be
+    exported with torch.jit.script().
+
+    Args:
+      model:
+        The model to be converted.
+      inplace:
+        If True, the input model is modified inplace.
+        If False, the input model is copied and we modify the copied version.
+    Return:
+      Return the converted model in eval mode.
+    """
+    model = convert_scaled_to_non_scaled(model, inplace=inplace)
+
+    d = {}
+    # Modules like ScheduledFloat may be shared by several parents
+    for name, m in model.named_modules(remove_duplicate=False):
+        if isinstance(m, (Dropout2, Identity)):
+            d[name] = nn.Identity()
+        elif isinstance(m, SwooshL):
+            d[name] = SwooshLInference()
+        elif isinstance(m, SwooshR):
+            d[name] = SwooshRInference()
+        elif isinstance(m, BiasNorm):
+            d[name] = BiasNormInference(m)
+        elif isinstance(m, ActivationDropoutAndLinear):
+            d[name] = ActivationAndLinearInference(m)
+        elif isinstance(m, ScheduledFloat):
+            d[name] = float(m.default)
+
+    # Skip the submodules of replaced modules, e.g., the dropout_p of
+    # ActivationDropoutAndLinear
+    d = {k: v for k, v in d.items() if not any(k.startswith(p + ".") for p in d)}
+
+    _replace_modules(model, d)
+
+    return model.eval()
+
+
+def _replace_modules(model: nn.Module, d: Dict[str, Any]) -> None:
+    """Replace the submodules of a model.
+
+    Args:
+      model:
+        The model to be modified inplace.
+      d:
+        A dict mapping the name of a submodule to its replacement, which
+        may also be a non-module value, e.g., a float.
+    """
     for k, v in d.items():
         if "." in k:
             parent, child = k.rsplit(".", maxsplit=1)
-            setattr(get_submodule(model, parent), child, v)
+            parent = get_submodule(model, parent)
         else:
-            setattr(model, k, v)
-
-    return model
+            parent, child = model, k
+        if not isinstance(v, nn.Module):
+            # nn.Module does not allow replacing a submodule with a non-module
+            delattr(parent, child)
+        setattr(parent, child, v)
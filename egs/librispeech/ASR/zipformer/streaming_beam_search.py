@@ -20,7 +20,7 @@ from typing import List
 import k2
 import torch
 import torch.nn as nn
-from beam_search import Hypothesis, HypothesisList, get_hyps_shape
+from beam_search import Hypothesis, HypothesisList, extend_ys_hash, get_hyps_shape
 from decode_stream import DecodeStream
 
 from icefall.decode import one_best_decoding
@@ -81,7 +81,11 @@ def greedy_search(
         for i, v in enumerate(y):
             if v != blank_id:
                 streams[i].hyp.append(v)
+                streams[i].timestamp.append(streams[i].done_frames + t)
+                streams[i].num_trailing_blanks = 0
                 emitted = True
+            else:
+                streams[i].num_trailing_blanks += 1
         if emitted:
             # update decoder output
             decoder_input = torch.tensor(
@@ -193,12 +197,24 @@ def modified_beam_search(
                 hyp = A[i][hyp_idx]
 
                 new_ys = hyp.ys[:]
+                new_ys_hash = hyp.ys_hash
+                new_timestamp = hyp.timestamp[:]
+                new_num_tailing_blanks = hyp.num_tailing_blanks + 1
                 new_token = topk_token_indexes[k]
                 if new_token != blank_id:
                     new_ys.append(new_token)
+                    new_ys_hash = extend_ys_hash(new_ys_hash, new_token)
+                    new_timestamp.append(streams[i].done_frames + t)
+                    new_num_tailing_blanks = 0
 
                 new_log_prob = topk_log_probs[k]
-                new_hyp = Hypothesis(ys=new_ys, log_prob=new_log_prob)
+                new_hyp = Hypothesis(
+                    ys=new_ys,
+                    log_prob=new_log_prob,
+                    timestamp=new_timestamp,
+                    num_tailing_blanks=new_num_tailing_blanks,
+                    ys_hash=new_ys_hash,
+                )
                 B[i].add(new_hyp)
 
     for i in range(batch_size):
@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+#
+# Copyright    2023  Xiaomi Corp.
+#
+# See ../../../../LICENSE for clarification regarding multiple authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+A client for ./zipformer/streaming_server.py. It sends each sound file
+over its own connection, all connections at the same time, and prints the
+partial and final results.
+
+Usage:
+
+./zipformer/streaming_client.py \
+  --server-addr 127.0.0.1 \
+  --server-port 6006 \
+  /path/to/foo.wav \
+  /path/to/bar.wav
+
+Use `--num-connections` to send each file multiple times, e.g., to test the
+batching of the server.
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import time
+
+import numpy as np
+import torchaudio
+import websockets
+
+from icefall.utils import str2bool
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+
+    parser.add_argument(
+        "--server-addr",
+        type=str,
+        default="127.0.0.1",
+        help="Address of the server",
+    )
+
+    parser.add_argument(
+        "--server-port",
+        type=int,
+        default=6006,
+        help="Port of the server",
+    )
+
+    parser.add_argument(
+        "--sample-rate",
+        type=int,
+        default=16000,
+        help="The sample rate expected by the server.",
+    )
+
+    parser.add_argument(
+        "--chunk-seconds",
+        type=float,
+        default=0.1,
+        help="Duration of the audio in each message.",
+    )
+
+    parser.add_argument(
+        "--real-time",
+        type=str2bool,
+        default=True,
+        help="""If True, send the audio at the speed it is played.
+        Otherwise, send it as fast as possible.""",
+    )
+
+    parser.add_argument(
+        "--num-connections",
+        type=int,
+        default=1,
+        help="Number of connections for each sound file.",
+    )
+
+    parser.add_argument(
+        "sound_files",
+        type=str,
+        nargs="+",
+        help="The input sound file(s) to transcribe. "
+        "Supported formats are those supported by torchaudio.load(). "
+        "For example, wav and flac are supported.",
+    )
+
+    return parser
+
+
+async def run(args: argparse.Namespace, filename: str, index: int) -> None:
+    wave, sample_rate = torchaudio.load(filename)
+    assert (
+        sample_rate == args.sample_rate
+    ), f"expected sample rate: {args.sample_rate}. Given: {sample_rate}"
+    # We use only the first channel
+    samples = wave[0].numpy().astype(np.float32)
+
+    name = f"{filename}:{index}"
+    chunk = int(args.chunk_seconds * sample_rate)
+    uri = f"ws://{args.server_addr}:{args.server_port}"
+
+    async with websockets.connect(uri) as socket:
+
+        async def send():
+            start_time = time.time()
+            for start in range(0, samples.shape[0], chunk):
+                if args.real_time:
+                    # Wait until the audio of this chunk is available
+                    delay = start / sample_rate - (time.time() - start_time)
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                await socket.send(samples[start : start + chunk].tobytes())
+            await socket.send("Done")
+
+        sender = asyncio.create_task(send())
+        async for message in socket:
+            result = json.loads(message)
+            if result["final"]:
+                logging.info(f"{name} final: {result['text']}")
+                logging.info(f"{name} latency (ms): {result['latency_ms']}")
+                break
+            if result.get("endpoint"):
+                logging.info(
+                    f"{name} segment {result['segment']} "
+                    f"({result['start']:.2f}-{result['end']:.2f} s): {result['text']}"
+                )
+            else:
+                logging.info(f"{name} partial: {result['text']}")
+        await sender
+
+
+async def main():
+    args = get_parser().parse_args()
+    logging.info(vars(args))
+
+    start = time.time()
+    await asyncio.gather(
+        *[
+            run(args, f, i)
+            for f in args.sound_files
+            for i in range(args.num_connections)
+        ]
+    )
+    logging.info(f"Elapsed: {time.time() - start:.3f} s")
+
+
+if __name__ == "__main__":
+    formatter = "%(asctime)s %(levelname)s [%(filename)s:%(lineno)d] %(message)s"
+
+    logging.basicConfig(format=formatter, level=logging.INFO)
+    asyncio.run(main())
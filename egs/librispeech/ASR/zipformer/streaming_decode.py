@@ -33,8 +33,11 @@ Usage:
 import argparse
 import logging
 import math
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Dict, List, Optional, Tuple
+from typing import Dict, Iterator, List, Optional, Tuple
 
 import k2
 import numpy as np
@@ -44,11 +47,14 @@ from asr_datamodule import LibriSpeechAsrDataModule
 from decode_stream import DecodeStream
 from kaldifeat import Fbank, FbankOptions
 from lhotse import CutSet
+from lhotse.cut import Cut
 from streaming_beam_search import (
     fast_beam_search_one_best,
     greedy_search,
     modified_beam_search,
 )
+from streaming_scheduler import get_min_active_streams, get_scheduler
+from streaming_state_pool import StreamingStatePool
 from torch import Tensor, nn
 from torch.nn.utils.rnn import pad_sequence
 from train import add_model_arguments, get_model, get_params
@@ -188,11 +194,104 @@ def get_parser():
         help="The number of streams that can be decoded parallel.",
     )
 
+    parser.add_argument(
+        "--max-batch-size",
+        type=int,
+        default=0,
+        help="""The maximum number of streams decoded in a chunk. If not
+        positive, it is set to --num-decode-streams, i.e., all running streams
+        are decoded in each chunk. If smaller than --num-decode-streams,
+        --scheduler decides which streams to decode.""",
+    )
+
+    parser.add_argument(
+        "--scheduler",
+        type=str,
+        default="fifo",
+        choices=["fifo", "remaining_length"],
+        help="""How to select the streams decoded in a chunk when there are
+        more than --max-batch-size running streams. fifo: in the order they
+        are admitted. remaining_length: group streams with similar number of
+        remaining frames. See streaming_scheduler.py""",
+    )
+
+    parser.add_argument(
+        "--target-occupancy",
+        type=float,
+        default=1.0,
+        help="""A chunk is decoded once the number of running streams
+        reaches target-occupancy * num-decode-streams; new streams are
+        admitted after each chunk until all --num-decode-streams slots are
+        used. Values smaller than 1 start decoding earlier, which lowers
+        the latency of the first results.""",
+    )
+
+    parser.add_argument(
+        "--num-prefetch-workers",
+        type=int,
+        default=4,
+        help="""Number of threads that load audio and compute features
+        ahead of decoding. If 0, features are computed in the main thread.""",
+    )
+
+    parser.add_argument(
+        "--prefetch-size",
+        type=int,
+        default=100,
+        help="""Maximum number of cuts whose features are computed ahead of
+        decoding. Used only when --num-prefetch-workers > 0.""",
+    )
+
     add_model_arguments(parser)
+    add_endpoint_arguments(parser)
 
     return parser
 
 
+def add_endpoint_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument(
+        "--enable-endpoint",
+        type=str2bool,
+        default=False,
+        help="""If True, split streams into segments at endpoints, see
+        DecodeStream.endpoint_detected() in decode_stream.py. The decoding
+        result is reset after each segment. Not supported for
+        fast_beam_search.""",
+    )
+
+    parser.add_argument(
+        "--endpoint-min-trailing-silence",
+        type=float,
+        default=1.2,
+        help="""An endpoint is detected if there are at least this many
+        seconds of trailing blanks after --endpoint-min-num-tokens tokens.
+        Used only when --enable-endpoint is True.""",
+    )
+
+    parser.add_argument(
+        "--endpoint-min-num-tokens",
+        type=int,
+        default=1,
+        help="See --endpoint-min-trailing-silence.",
+    )
+
+    parser.add_argument(
+        "--endpoint-max-utterance-length",
+        type=float,
+        default=20.0,
+        help="""An endpoint is detected if the segment is at least this many
+        seconds long. Used only when --enable-endpoint is True.""",
+    )
+
+    parser.add_argument(
+        "--endpoint-reset-encoder-states",
+        type=str2bool,
+        default=False,
+        help="""If True, the encoder states are reset at each endpoint.
+        Otherwise, the encoder keeps its left context across segments.""",
+    )
+
+
 def get_init_states(
     model: nn.Module,
     batch_size: int = 1,
@@ -421,6 +520,7 @@ def decode_one_chunk(
     params: AttributeDict,
     model: nn.Module,
     decode_streams: List[DecodeStream],
+    state_pool: Optional[StreamingStatePool] = None,
 ) -> List[int]:
     """Decode one chunk frames of features for each decode_streams and
     return the indexes of finished streams in a List.
@@ -432,6 +532,10 @@ def decode_one_chunk(
         The neural model.
       decode_streams:
         A List of DecodeStream, each belonging to a utterance.
+      state_pool:
+        If not None, the states of the streams are kept in it and are
+        updated in place; each stream should have a `state_slot`.
+        Otherwise, `stream.states` is used.
     Returns:
       Return a List containing which DecodeStreams are finished.
     """
@@ -448,7 +552,8 @@ def decode_one_chunk(
         feat, feat_len = stream.get_feature_frames(chunk_size * 2)
         features.append(feat)
         feature_lens.append(feat_len)
-        states.append(stream.states)
+        if state_pool is None:
+            states.append(stream.states)
         processed_lens.append(stream.done_frames)
 
     feature_lens = torch.tensor(feature_lens, device=device)
@@ -468,7 +573,11 @@ def decode_one_chunk(
             value=LOG_EPS,
         )
 
-    states = stack_states(states)
+    if state_pool is None:
+        states = stack_states(states)
+    else:
+        slots = [stream.state_slot for stream in decode_streams]
+        states = state_pool.gather(slots)
 
     encoder_out, encoder_out_lens, new_states = streaming_forward(
         features=features,
@@ -505,18 +614,122 @@ def decode_one_chunk(
     else:
         raise ValueError(f"Unsupported decoding method: {params.decoding_method}")
 
-    states = unstack_states(new_states)
+    if state_pool is None:
+        states = unstack_states(new_states)
+        for i in range(len(decode_streams)):
+            decode_streams[i].states = states[i]
+    else:
+        state_pool.scatter(slots, new_states)
 
     finished_streams = []
     for i in range(len(decode_streams)):
-        decode_streams[i].states = states[i]
-        decode_streams[i].done_frames += encoder_out_lens[i]
+        decode_streams[i].done_frames += int(encoder_out_lens[i])
         if decode_streams[i].done:
             finished_streams.append(i)
+        elif params.enable_endpoint and decode_streams[i].endpoint_detected():
+            decode_streams[i].finish_segment()
+            if params.endpoint_reset_encoder_states:
+                if state_pool is None:
+                    decode_streams[i].states = get_init_states(
+                        model=model, batch_size=1, device=device
+                    )
+                else:
+                    state_pool.reset(decode_streams[i].state_slot)
 
     return finished_streams
 
 
+def compute_features(cut: Cut, fbank: Fbank, device: torch.device) -> Tensor:
+    """Load the audio of a cut and compute its fbank features.
+
+    Args:
+      cut:
+        The cut to process. It should be single channel.
+      fbank:
+        The feature extractor.
+      device:
+        The device of the feature extractor.
+    Returns:
+      Return a 2-D tensor of shape (num_frames, num_bins).
+    """
+    audio: np.ndarray = cut.load_audio()
+    # audio.shape: (1, num_samples)
+    assert len(audio.shape) == 2
+    assert audio.shape[0] == 1, "Should be single channel"
+    assert audio.dtype == np.float32, audio.dtype
+
+    # The trained model is using normalized samples
+    # - this is to avoid sending [-32k,+32k] signal in...
+    # - some lhotse AudioTransform classes can make the signal
+    #   be out of range [-1, 1], hence the tolerance 10
+    assert (
+        np.abs(audio).max() <= 10
+    ), "Should be normalized to [-1, 1], 10 for tolerance..."
+
+    samples = torch.from_numpy(audio).squeeze(0)
+
+    return fbank(samples.to(device))
+
+
+def prefetch_features(
+    cuts: CutSet,
+    opts: FbankOptions,
+    num_workers: int = 4,
+    prefetch_size: int = 100,
+) -> Iterator[Tuple[Cut, Tensor]]:
+    """Load audio and compute features of cuts in background threads.
+
+    At most `prefetch_size` cuts are submitted ahead of the one being
+    consumed, so the memory used by the pending features is bounded.
+    Each worker thread creates its own `Fbank` once and reuses it for
+    all the cuts it processes.
+
+    Args:
+      cuts:
+        The cuts to process.
+      opts:
+        Options for the fbank extractor.
+      num_workers:
+        Number of worker threads. If 0, features are computed in the
+        calling thread.
+      prefetch_size:
+        Maximum number of cuts being processed or waiting to be consumed.
+    Returns:
+      Yield tuples (cut, features) in the order of `cuts`.
+    """
+    if num_workers <= 0:
+        fbank = Fbank(opts)
+        for cut in cuts:
+            yield cut, compute_features(cut, fbank, opts.device)
+        return
+
+    local = threading.local()
+
+    def _compute(cut: Cut) -> Tensor:
+        if not hasattr(local, "fbank"):
+            local.fbank = Fbank(opts)
+        return compute_features(cut, local.fbank, opts.device)
+
+    prefetch_size = max(prefetch_size, 1)
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        try:
+            for cut in cuts:
+                if len(pending) >= prefetch_size:
+                    done_cut, future = pending.popleft()
+                    yield done_cut, future.result()
+                pending.append((cut, executor.submit(_compute, cut)))
+
+            while pending:
+                done_cut, future = pending.popleft()
+                yield done_cut, future.result()
+        finally:
+            # Don't compute features that will never be consumed,
+            # e.g., if the consumer raises an exception.
+            for _, future in pending:
+                future.cancel()
+
+
 def decode_dataset(
     cuts: CutSet,
     params: AttributeDict,
@@ -556,74 +769,88 @@ def decode_dataset(
 
     log_interval = 100
 
+    # The states of the running streams are kept in preallocated tensors.
+    state_pool = StreamingStatePool(
+        init_states=get_init_states(model=model, batch_size=1, device=device),
+        num_slots=params.num_decode_streams,
+    )
+
+    max_batch_size = params.max_batch_size
+    if max_batch_size <= 0:
+        max_batch_size = params.num_decode_streams
+    scheduler = get_scheduler(
+        params.scheduler,
+        max_batch_size=max_batch_size,
+        chunk_length=int(params.chunk_size) * 2 + 7 + 2 * 3,
+    )
+    min_active_streams = get_min_active_streams(
+        params.num_decode_streams, params.target_occupancy
+    )
+
     decode_results = []
     # Contain decode streams currently running.
     decode_streams = []
-    for num, cut in enumerate(cuts):
+
+    def decode_next_chunk():
+        selected = scheduler.select(decode_streams)
+        finished_streams = decode_one_chunk(
+            params=params,
+            model=model,
+            decode_streams=[decode_streams[i] for i in selected],
+            state_pool=state_pool,
+        )
+        for i in sorted([selected[k] for k in finished_streams], reverse=True):
+            decode_results.append(
+                (
+                    decode_streams[i].id,
+                    decode_streams[i].ground_truth.split(),
+                    sp.decode(decode_streams[i].full_result()).split(),
+                )
+            )
+            state_pool.free(decode_streams[i].state_slot)
+            scheduler.remove(decode_streams[i])
+            del decode_streams[i]
+
+    for num, (cut, feature) in enumerate(
+        prefetch_features(
+            cuts,
+            opts=opts,
+            num_workers=params.num_prefetch_workers,
+            prefetch_size=params.prefetch_size,
+        )
+    ):
         # each utterance has a DecodeStream.
-        initial_states = get_init_states(model=model, batch_size=1, device=device)
         decode_stream = DecodeStream(
             params=params,
             cut_id=cut.id,
-            initial_states=initial_states,
+            initial_states=None,
             decoding_graph=decoding_graph,
             device=device,
+            state_slot=state_pool.allocate(),
         )
 
-        audio: np.ndarray = cut.load_audio()
-        # audio.shape: (1, num_samples)
-        assert len(audio.shape) == 2
-        assert audio.shape[0] == 1, "Should be single channel"
-        assert audio.dtype == np.float32, audio.dtype
-
-        # The trained model is using normalized samples
-        # - this is to avoid sending [-32k,+32k] signal in...
-        # - some lhotse AudioTransform classes can make the signal
-        #   be out of range [-1, 1], hence the tolerance 10
-        assert (
-            np.abs(audio).max() <= 10
-        ), "Should be normalized to [-1, 1], 10 for tolerance..."
-
-        samples = torch.from_numpy(audio).squeeze(0)
-
-        fbank = Fbank(opts)
-        feature = fbank(samples.to(device))
         decode_stream.set_features(feature, tail_pad_len=30)
         decode_stream.ground_truth = cut.supervisions[0].text
 
         decode_streams.append(decode_stream)
 
+        # Start decoding once there are enough running streams, and keep
+        # admitting new streams after each chunk until all slots are used.
+        if len(decode_streams) >= min_active_streams:
+            decode_next_chunk()
+
         while len(decode_streams) >= params.num_decode_streams:
-            finished_streams = decode_one_chunk(
-                params=params, model=model, decode_streams=decode_streams
-            )
-            for i in sorted(finished_streams, reverse=True):
-                decode_results.append(
-                    (
-                        decode_streams[i].id,
-                        decode_streams[i].ground_truth.split(),
-                        sp.decode(decode_streams[i].decoding_result()).split(),
-                    )
-                )
-                del decode_streams[i]
+            decode_next_chunk()
 
         if num % log_interval == 0:
             logging.info(f"Cuts processed until now is {num}.")
+            logging.info(f"Scheduler: {scheduler.stats()}")
 
     # decode final chunks of last sequences
     while len(decode_streams):
-        finished_streams = decode_one_chunk(
-            params=params, model=model, decode_streams=decode_streams
-        )
-        for i in sorted(finished_streams, reverse=True):
-            decode_results.append(
-                (
-                    decode_streams[i].id,
-                    decode_streams[i].ground_truth.split(),
-                    sp.decode(decode_streams[i].decoding_result()).split(),
-                )
-            )
-            del decode_streams[i]
+        decode_next_chunk()
+
+    logging.info(f"Scheduler: {scheduler.stats()}")
 
     if params.decoding_method == "greedy_search":
         key = "greedy_search"
@@ -709,6 +936,12 @@ def main():
     params.suffix += f"-chunk-{params.chunk_size}"
     params.suffix += f"-left-context-{params.left_context_frames}"
 
+    if params.enable_endpoint:
+        assert (
+            params.decoding_method != "fast_beam_search"
+        ), "Endpointing is not supported for fast_beam_search"
+        params.suffix += "-endpoint"
+
     # for fast_beam_search
     if params.decoding_method == "fast_beam_search":
         params.suffix += f"-beam-{params.beam}"
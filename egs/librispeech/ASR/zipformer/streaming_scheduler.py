@@ -0,0 +1,207 @@
+# Copyright    2023  Xiaomi Corp.
+#
+# See ../../../../LICENSE for clarification regarding multiple authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Schedulers that choose which of the running streams are decoded in the
+next chunk. See `decode_dataset` in streaming_decode.py for how they are
+used.
+"""
+
+import logging
+import math
+import time
+from typing import Dict, List
+
+from decode_stream import DecodeStream
+
+
+class StreamScheduler(object):
+    """Base class of the schedulers.
+
+    A scheduler selects at most `max_batch_size` of the running streams
+    for each chunk. Streams with a smaller `priority` are selected first,
+    and streams whose `deadline` (in seconds, as returned by `time.time()`)
+    has passed are always selected before the others.
+
+    It also keeps statistics about the chunks it scheduled: the batch
+    occupancy, i.e., the batch size divided by `max_batch_size`, and the
+    padding ratio, i.e., the ratio of padded frames in the feature batch.
+    """
+
+    def __init__(self, max_batch_size: int, chunk_length: int) -> None:
+        """
+        Args:
+          max_batch_size:
+            The maximum number of streams decoded in a chunk.
+          chunk_length:
+            Number of feature frames of the batch in each chunk, including
+            the right padding needed by the encoder_embed. Used to compute
+            the padding ratio.
+        """
+        assert max_batch_size > 0, max_batch_size
+        assert chunk_length > 0, chunk_length
+        self.max_batch_size = max_batch_size
+        self.chunk_length = chunk_length
+
+        # Number of the chunk in which each stream was last selected,
+        # indexed by stream ID.
+        self.last_selected: Dict[str, int] = {}
+
+        self.num_chunks = 0
+        self.tot_occupancy = 0.0
+        self.tot_frames = 0
+        self.tot_padded_frames = 0
+        self.start_time = time.time()
+
+    def _order(self, streams: List[DecodeStream], indexes: List[int]) -> List[int]:
+        """Sort the streams by the policy of the scheduler. Subclasses
+        should override it."""
+        raise NotImplementedError
+
+    def select(self, streams: List[DecodeStream]) -> List[int]:
+        """Return the indexes of the streams to decode in the next chunk,
+        in ascending order."""
+        now = time.time()
+        urgent = [
+            i
+            for i, s in enumerate(streams)
+            if s.deadline is not None and s.deadline <= now
+        ]
+        urgent.sort(key=lambda i: streams[i].deadline)
+
+        if len(streams) <= self.max_batch_size:
+            ans = list(range(len(streams)))
+        else:
+            urgent = urgent[: self.max_batch_size]
+            urgent_set = set(urgent)
+            others = [i for i in range(len(streams)) if i not in urgent_set]
+            others = self._order(streams, others)
+            ans = urgent + others[: self.max_batch_size - len(urgent)]
+            ans.sort()
+
+        for i in ans:
+            self.last_selected[streams[i].id] = self.num_chunks
+        self._record(streams, ans)
+        return ans
+
+    def remove(self, stream: DecodeStream) -> None:
+        """Forget a finished stream."""
+        self.last_selected.pop(stream.id, None)
+
+    def _record(self, streams: List[DecodeStream], indexes: List[int]) -> None:
+        num_frames = 0
+        for i in indexes:
+            num_frames += min(streams[i].num_remaining_frames, self.chunk_length)
+        num_padded_frames = len(indexes) * self.chunk_length - num_frames
+
+        occupancy = len(indexes) / self.max_batch_size
+        padding_ratio = num_padded_frames / (len(indexes) * self.chunk_length)
+        logging.debug(
+            f"Chunk {self.num_chunks}: batch size {len(indexes)}, "
+            f"occupancy {occupancy:.3f}, padding ratio {padding_ratio:.3f}"
+        )
+
+        self.num_chunks += 1
+        self.tot_occupancy += occupancy
+        self.tot_frames += num_frames
+        self.tot_padded_frames += num_padded_frames
+
+    def stats(self) -> str:
+        """Return a summary of the statistics of the scheduled chunks."""
+        if self.num_chunks == 0:
+            return "No chunks are scheduled"
+        elapsed = time.time() - self.start_time
+        tot = self.tot_frames + self.tot_padded_frames
+        return (
+            f"{self.num_chunks} chunks in {elapsed:.2f} seconds "
+            f"({self.num_chunks / elapsed:.2f} chunks/s), "
+            f"average batch occupancy {self.tot_occupancy / self.num_chunks:.3f}, "
+            f"padding ratio {self.tot_padded_frames / tot:.3f}"
+        )
+
+
+class FifoScheduler(StreamScheduler):
+    """Select streams in the order they are admitted.
+
+    With `max_batch_size` equal to the number of decode streams, all
+    running streams are decoded in each chunk.
+    """
+
+    def _order(self, streams: List[DecodeStream], indexes: List[int]) -> List[int]:
+        # The list of streams is in the order of admission
+        return sorted(indexes, key=lambda i: streams[i].priority)
+
+
+class RemainingLengthScheduler(StreamScheduler):
+    """Group streams with similar remaining lengths into the same chunk.
+
+    The stream that has waited longest (among the ones with the smallest
+    priority) is selected first, and the batch is filled with the streams
+    whose number of remaining frames is closest to it. Streams in the same
+    batch therefore tend to finish in the same chunk, so there are fewer
+    short, padded final chunks and their slots are freed together for new
+    streams. Selecting the longest-waiting stream first ensures no stream
+    is starved.
+    """
+
+    def _order(self, streams: List[DecodeStream], indexes: List[int]) -> List[int]:
+        if not indexes:
+            return indexes
+
+        def waited(i: int) -> int:
+            return self.last_selected.get(streams[i].id, -1)
+
+        anchor = min(indexes, key=lambda i: (streams[i].priority, waited(i)))
+        anchor_len = streams[anchor].num_remaining_frames
+        return sorted(
+            indexes,
+            key=lambda i: (
+                i != anchor,
+                streams[i].priority,
+                abs(streams[i].num_remaining_frames - anchor_len),
+                waited(i),
+            ),
+        )
+
+
+def get_scheduler(
+    name: str,
+    max_batch_size: int,
+    chunk_length: int,
+) -> StreamScheduler:
+    """Create a scheduler by its name.
+
+    Args:
+      name:
+        Either "fifo" or "remaining_length".
+      max_batch_size:
+        The maximum number of streams decoded in a chunk.
+      chunk_length:
+        Number of feature frames of the batch in each chunk.
+    """
+    if name == "fifo":
+        return FifoScheduler(max_batch_size, chunk_length)
+    elif name == "remaining_length":
+        return RemainingLengthScheduler(max_batch_size, chunk_length)
+    else:
+        raise ValueError(f"Unsupported scheduler: {name}")
+
+
+def get_min_active_streams(num_decode_streams: int, target_occupancy: float) -> int:
+    """Return the number of running streams needed before a chunk is
+    decoded, see --target-occupancy in streaming_decode.py."""
+    assert 0 < target_occupancy <= 1, target_occupancy
+    return max(1, math.ceil(target_occupancy * num_decode_streams))
@@ -0,0 +1,617 @@
+#!/usr/bin/env python3
+#
+# Copyright    2023  Xiaomi Corp.
+#
+# See ../../../../LICENSE for clarification regarding multiple authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+A websocket server for real-time recognition with a streaming zipformer.
+
+Each connection is decoded by a `DecodeStream`. Chunks of all connections
+that have enough features are batched and decoded by `decode_one_chunk`
+from streaming_decode.py in a single background thread, so the server
+works on CPU.
+
+Protocol:
+
+  - The client sends audio as binary messages. Each message contains
+    float32 samples (little endian) in the range [-1, 1] with the sample
+    rate given by --sample-rate.
+  - The client sends the text message "Done" after the last audio message.
+  - The server sends text messages containing a JSON object
+    {"text": str, "segment": int, "endpoint": bool, "final": bool}.
+    "text" is the result of the current segment. With --enable-endpoint,
+    a message with "endpoint" set to true and the "start" and "end" time
+    of the segment in seconds is sent when a segment ends; the following
+    results belong to the next segment. The final message contains the
+    result of all segments and the latency statistics of the connection
+    in milliseconds, i.e., the time from receiving the audio that
+    completes a chunk to sending the result of that chunk.
+
+Usage:
+
+./zipformer/streaming_server.py \
+  --checkpoint ./zipformer/exp/pretrained.pt \
+  --tokens data/lang_bpe_500/tokens.txt \
+  --causal 1 \
+  --chunk-size 16 \
+  --left-context-frames 128 \
+  --decoding-method greedy_search \
+  --port 6006
+
+Then use ./zipformer/streaming_client.py to send sound files to it.
+
+It requires `pip install websockets`.
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Set
+
+import k2
+import numpy as np
+import torch
+import websockets
+from decode_stream import DecodeStream
+from export import num_tokens
+from streaming_decode import (
+    add_endpoint_arguments,
+    decode_one_chunk,
+    get_init_states,
+)
+from streaming_state_pool import StreamingStatePool
+from train import add_model_arguments, get_model, get_params
+
+from icefall.utils import AttributeDict
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+
+    parser.add_argument(
+        "--checkpoint",
+        type=str,
+        required=True,
+        help="Path to the checkpoint. "
+        "The checkpoint is assumed to be saved by "
+        "icefall.checkpoint.save_checkpoint().",
+    )
+
+    parser.add_argument(
+        "--tokens",
+        type=str,
+        required=True,
+        help="""Path to tokens.txt.""",
+    )
+
+    parser.add_argument(
+        "--host",
+        type=str,
+        default="127.0.0.1",
+        help="The address the server listens on.",
+    )
+
+    parser.add_argument(
+        "--port",
+        type=int,
+        default=6006,
+        help="The port the server listens on.",
+    )
+
+    parser.add_argument(
+        "--sample-rate",
+        type=int,
+        default=16000,
+        help="The sample rate of the audio sent by clients.",
+    )
+
+    parser.add_argument(
+        "--decoding-method",
+        type=str,
+        default="greedy_search",
+        help="""Supported decoding methods are:
+        greedy_search
+        modified_beam_search
+        fast_beam_search
+        """,
+    )
+
+    parser.add_argument(
+        "--num_active_paths",
+        type=int,
+        default=4,
+        help="""An interger indicating how many candidates we will keep for each
+        frame. Used only when --decoding-method is modified_beam_search.""",
+    )
+
+    parser.add_argument(
+        "--beam",
+        type=float,
+        default=4,
+        help="""A floating point value to calculate the cutoff score during beam
+        search (i.e., `cutoff = max-score - beam`), which is the same as the
+        `beam` in Kaldi.
+        Used only when --decoding-method is fast_beam_search""",
+    )
+
+    parser.add_argument(
+        "--max-contexts",
+        type=int,
+        default=4,
+        help="""Used only when --decoding-method is
+        fast_beam_search""",
+    )
+
+    parser.add_argument(
+        "--max-states",
+        type=int,
+        default=32,
+        help="""Used only when --decoding-method is
+        fast_beam_search""",
+    )
+
+    parser.add_argument(
+        "--context-size",
+        type=int,
+        default=2,
+        help="The context size in the decoder. 1 means bigram; 2 means tri-gram",
+    )
+
+    parser.add_argument(
+        "--max-connections",
+        type=int,
+        default=100,
+        help="""Maximum number of connections decoded at the same time.
+        Further connections wait until a running one is closed.""",
+    )
+
+    parser.add_argument(
+        "--max-batch-size",
+        type=int,
+        default=32,
+        help="Maximum number of connections decoded in a chunk.",
+    )
+
+    parser.add_argument(
+        "--max-wait-ms",
+        type=float,
+        default=10,
+        help="""Once a connection has a chunk ready, wait at most this many
+        milliseconds for other connections to fill the batch.""",
+    )
+
+    parser.add_argument(
+        "--max-buffered-seconds",
+        type=float,
+        default=5,
+        help="""Stop reading audio from a connection while it has more than
+        this many seconds of audio that have not been decoded.""",
+    )
+
+    parser.add_argument(
+        "--num-threads",
+        type=int,
+        default=4,
+        help="Number of threads used by torch.",
+    )
+
+    add_model_arguments(parser)
+    add_endpoint_arguments(parser)
+
+    return parser
+
+
+class Connection(object):
+    """The state of a client connection."""
+
+    def __init__(
+        self,
+        stream: DecodeStream,
+        sample_rate: int,
+        max_buffered_frames: int,
+    ) -> None:
+        self.stream = stream
+        self.sample_rate = sample_rate
+        self.max_buffered_frames = max_buffered_frames
+
+        # Audio received but not given to the stream yet. The stream is
+        # used by the decoding thread, so only the decoding loop
+        # gives it audio, between two batches; see `flush`.
+        self.pending_samples: List[torch.Tensor] = []
+        self.num_pending_samples = 0
+        self.input_finished = False
+        self.flushed_input_finished = False
+        # Set when the client is gone. The state slot of the stream is freed
+        # by the decoding loop, see `StreamingServer._free_closed`.
+        self.closed = False
+
+        # Set when the number of frames not decoded yet is below
+        # max_buffered_frames, see `StreamingServer.receive_audio`.
+        self.drained = asyncio.Event()
+        self.drained.set()
+
+        # Results to be sent to the client
+        self.results: asyncio.Queue = asyncio.Queue()
+        self.text = ""
+        self.num_sent_segments = 0
+
+        # (num_samples_received, time) after each audio message, used to
+        # compute the latency of each chunk.
+        self.arrivals = deque()
+        self.num_samples = 0
+        self.last_arrival_time = time.time()
+        self.latencies: List[float] = []
+
+    def accept_waveform(self, samples: torch.Tensor) -> None:
+        self.pending_samples.append(samples)
+        self.num_pending_samples += samples.numel()
+        self.num_samples += samples.numel()
+        self.last_arrival_time = time.time()
+        self.arrivals.append((self.num_samples, self.last_arrival_time))
+        if self.num_buffered_frames > self.max_buffered_frames:
+            self.drained.clear()
+
+    def finish_input(self) -> None:
+        self.input_finished = True
+        self.last_arrival_time = time.time()
+
+    @property
+    def num_buffered_frames(self) -> int:
+        """Number of feature frames (approximately) that have not been
+        decoded."""
+        # 10 ms frame shift
+        return self.stream.num_remaining_frames + (
+            self.num_pending_samples * 100 // self.sample_rate
+        )
+
+    def flush(self) -> None:
+        """Give the pending audio to the stream. Call it only when the
+        stream is not being decoded."""
+        if self.pending_samples:
+            self.stream.accept_waveform(
+                sample_rate=self.sample_rate,
+                waveform=torch.cat(self.pending_samples),
+            )
+            self.pending_samples = []
+            self.num_pending_samples = 0
+        if self.input_finished and not self.flushed_input_finished:
+            # See `tail_pad_len` in `decode_dataset` of streaming_decode.py
+            self.stream.input_finished(tail_pad_len=30)
+            self.flushed_input_finished = True
+
+    def chunk_arrival_time(self, chunk_length: int) -> float:
+        """Return the time when the audio completing the next chunk arrived."""
+        # 10 ms frame shift
+        needed = (
+            (self.stream.num_processed_frames + chunk_length) * self.sample_rate // 100
+        )
+        while self.arrivals and self.arrivals[0][0] < needed:
+            self.arrivals.popleft()
+        if self.arrivals and not self.input_finished:
+            return self.arrivals[0][1]
+        return self.last_arrival_time
+
+    def latency_stats(self) -> Dict[str, float]:
+        if not self.latencies:
+            return {}
+        latencies = np.array(self.latencies) * 1000
+        return {
+            "num_chunks": len(latencies),
+            "mean": float(latencies.mean()),
+            "p50": float(np.percentile(latencies, 50)),
+            "p90": float(np.percentile(latencies, 90)),
+            "max": float(latencies.max()),
+        }
+
+
+class StreamingServer(object):
+    def __init__(
+        self,
+        params: AttributeDict,
+        model: torch.nn.Module,
+        token_table: k2.SymbolTable,
+        decoding_graph: Optional[k2.Fsa] = None,
+    ) -> None:
+        self.params = params
+        self.model = model
+        self.token_table = token_table
+        self.decoding_graph = decoding_graph
+
+        # Number of feature frames consumed by a chunk and the number of
+        # frames needed to decode it, see `decode_one_chunk`
+        self.feature_chunk_size = int(params.chunk_size) * 2
+        self.chunk_length = self.feature_chunk_size + 7 + 2 * 3
+        self.max_buffered_frames = max(
+            int(params.max_buffered_seconds * 100), self.chunk_length
+        )
+
+        self.state_pool = StreamingStatePool(
+            init_states=get_init_states(model=model, batch_size=1, device=model.device),
+            num_slots=params.max_connections,
+        )
+
+        self.connections: Set[Connection] = set()
+        # They are created in `run`, inside the event loop.
+        self.slots: Optional[asyncio.Semaphore] = None
+        # Set when new audio arrives, to wake up the decoding loop
+        self.new_data: Optional[asyncio.Event] = None
+
+        # The neural network runs in this thread, so that the event loop
+        # keeps receiving audio while a batch is decoded.
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+        self.num_batches = 0
+        self.tot_batch_size = 0
+
+    def token_ids_to_words(self, token_ids: List[int]) -> str:
+        text = ""
+        for i in token_ids:
+            text += self.token_table[i]
+        return text.replace("▁", " ").strip()
+
+    def _get_ready(self) -> List[Connection]:
+        ready = []
+        for c in self.connections:
+            if c.closed:
+                continue
+            c.flush()
+            if c.stream.is_ready(self.feature_chunk_size):
+                ready.append(c)
+        return ready
+
+    def _free_closed(self) -> None:
+        """Free the state slots of the closed connections. Call it only when
+        no batch is being decoded, otherwise a new connection could get the
+        slot of a stream in the batch, which is then overwritten after
+        the batch."""
+        for c in [c for c in self.connections if c.closed]:
+            self.connections.discard(c)
+            self.state_pool.free(c.stream.state_slot)
+            self.slots.release()
+
+    @torch.no_grad()
+    def _decode_batch(self, streams: List[DecodeStream]) -> List[List[int]]:
+        decode_one_chunk(
+            params=self.params,
+            model=self.model,
+            decode_streams=streams,
+            state_pool=self.state_pool,
+        )
+        return [s.full_result() if s.done else s.decoding_result() for s in streams]
+
+    async def decode_loop(self) -> None:
+        """Decode chunks of the connections that have enough features."""
+        loop = asyncio.get_running_loop()
+        max_wait = self.params.max_wait_ms / 1000
+        while True:
+            await self.new_data.wait()
+            self.new_data.clear()
+            self._free_closed()
+
+            ready = self._get_ready()
+            if not ready:
+                continue
+
+            # Wait a bit for other connections to fill the batch
+            deadline = loop.time() + max_wait
+            while len(ready) < self.params.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    await asyncio.wait_for(self.new_data.wait(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                self.new_data.clear()
+                ready = self._get_ready()
+
+            # Connections waiting longest go first
+            arrival_times = {c: c.chunk_arrival_time(self.chunk_length) for c in ready}
+            ready.sort(key=lambda c: arrival_times[c])
+            batch = ready[: self.params.max_batch_size]
+
+            hyps = await loop.run_in_executor(
+                self.executor, self._decode_batch, [c.stream for c in batch]
+            )
+
+            now = time.time()
+            for c, hyp in zip(batch, hyps):
+                c.latencies.append(now - arrival_times[c])
+                segments = c.stream.segments
+                while c.num_sent_segments < len(segments):
+                    segment = segments[c.num_sent_segments]
+                    c.results.put_nowait(
+                        {
+                            "text": self.token_ids_to_words(segment.tokens),
+                            "segment": c.num_sent_segments,
+                            "endpoint": True,
+                            "start": segment.start_time,
+                            "end": segment.end_time,
+                            "final": False,
+                        }
+                    )
+                    c.num_sent_segments += 1
+                    c.text = ""
+
+                text = self.token_ids_to_words(hyp)
+                result = {
+                    "text": text,
+                    "segment": c.num_sent_segments,
+                    "endpoint": False,
+                    "final": c.stream.done,
+                }
+                if c.stream.done or text != c.text:
+                    c.results.put_nowait(result)
+                c.text = text
+                if c.num_buffered_frames <= c.max_buffered_frames:
+                    c.drained.set()
+
+            self.num_batches += 1
+            self.tot_batch_size += len(batch)
+            if self.num_batches % 1000 == 0:
+                logging.info(
+                    f"Decoded {self.num_batches} batches, average batch size "
+                    f"{self.tot_batch_size / self.num_batches:.2f}, "
+                    f"{len(self.connections)} active connections"
+                )
+
+            self._free_closed()
+            if self._get_ready():
+                # There is still work to do without new audio, e.g., a
+                # connection has buffered more than one chunk. Its client
+                # may be waiting in `receive_audio` for the buffer to drain.
+                self.new_data.set()
+
+    async def send_results(self, socket, connection: Connection) -> None:
+        while True:
+            result = await connection.results.get()
+            if result["final"]:
+                result["latency_ms"] = connection.latency_stats()
+            await socket.send(json.dumps(result))
+            if result["final"]:
+                return
+
+    async def receive_audio(self, socket, connection: Connection) -> None:
+        async for message in socket:
+            if isinstance(message, str):
+                if message == "Done":
+                    break
+                raise ValueError(f"Unexpected message: {message}")
+
+            samples = torch.from_numpy(np.frombuffer(message, dtype="<f4").copy())
+            connection.accept_waveform(samples)
+            self.new_data.set()
+
+            # Backpressure: Don't read more audio from the socket until
+            # the decoding catches up.
+            await connection.drained.wait()
+
+        connection.finish_input()
+        self.new_data.set()
+
+    async def handle_connection(self, socket) -> None:
+        # It is released in `_free_closed`, when the state slot is freed
+        await self.slots.acquire()
+        params = self.params
+        stream = DecodeStream(
+            params=params,
+            cut_id=str(id(socket)),
+            initial_states=None,
+            decoding_graph=self.decoding_graph,
+            device=self.model.device,
+            state_slot=self.state_pool.allocate(),
+        )
+        connection = Connection(
+            stream=stream,
+            sample_rate=params.sample_rate,
+            max_buffered_frames=self.max_buffered_frames,
+        )
+        self.connections.add(connection)
+        logging.info(
+            f"Connected: {socket.remote_address}. "
+            f"Number of connections: {len(self.connections)}"
+        )
+
+        sender = asyncio.create_task(self.send_results(socket, connection))
+        try:
+            await self.receive_audio(socket, connection)
+            await sender
+            logging.info(
+                f"Finished: {socket.remote_address}. "
+                f"Latency (ms): {connection.latency_stats()}"
+            )
+        except websockets.ConnectionClosed:
+            logging.info(f"Disconnected: {socket.remote_address}")
+        finally:
+            sender.cancel()
+            # The stream may be in a batch being decoded, so we don't free
+            # its state slot here
+            connection.closed = True
+            self.new_data.set()
+
+    async def run(self) -> None:
+        self.slots = asyncio.Semaphore(self.params.max_connections)
+        self.new_data = asyncio.Event()
+
+        decoder = asyncio.create_task(self.decode_loop())
+        async with websockets.serve(
+            self.handle_connection, self.params.host, self.params.port
+        ):
+            logging.info(f"Listening on ws://{self.params.host}:{self.params.port}")
+            await decoder
+
+
+@torch.no_grad()
+def main():
+    parser = get_parser()
+    args = parser.parse_args()
+
+    params = get_params()
+    params.update(vars(args))
+
+    token_table = k2.SymbolTable.from_file(params.tokens)
+    params.blank_id = token_table["<blk>"]
+    params.unk_id = token_table["<unk>"]
+    params.vocab_size = num_tokens(token_table) + 1
+
+    assert params.causal, params.causal
+    if params.enable_endpoint:
+        assert (
+            params.decoding_method != "fast_beam_search"
+        ), "Endpointing is not supported for fast_beam_search"
+    assert "," not in params.chunk_size, "chunk_size should be one value in decoding."
+    assert (
+        "," not in params.left_context_frames
+    ), "left_context_frames should be one value in decoding."
+
+    logging.info(f"{params}")
+
+    torch.set_num_threads(params.num_threads)
+    device = torch.device("cpu")
+
+    logging.info("Creating model")
+    model = get_model(params)
+
+    checkpoint = torch.load(params.checkpoint, map_location="cpu")
+    model.load_state_dict(checkpoint["model"], strict=False)
+    model.to(device)
+    model.eval()
+    model.device = device
+
+    decoding_graph = None
+    if params.decoding_method == "fast_beam_search":
+        decoding_graph = k2.trivial_graph(params.vocab_size - 1, device=device)
+
+    server = StreamingServer(
+        params=params,
+        model=model,
+        token_table=token_table,
+        decoding_graph=decoding_graph,
+    )
+    asyncio.run(server.run())
+
+
+if __name__ == "__main__":
+    formatter = "%(asctime)s %(levelname)s [%(filename)s:%(lineno)d] %(message)s"
+
+    logging.basicConfig(format=formatter, level=logging.INFO)
+    main()
@@ -0,0 +1,137 @@
+# Copyright    2023  Xiaomi Corp.
+#
+# See ../../../../LICENSE for clarification regarding multiple authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import heapq
+from typing import List
+
+import torch
+from torch import Tensor
+
+
+def get_state_batch_dims(num_states: int) -> List[int]:
+    """Return the batch dimension of each tensor in the zipformer states.
+
+    For layer-i, states[i*6:(i+1)*6] is (cached_key, cached_nonlin_attn,
+    cached_val1, cached_val2, cached_conv1, cached_conv2). The first four
+    have the batch in dim 1 and the convolution caches in dim 0.
+    states[-2] (cached left padding of ConvNeXt) and states[-1]
+    (processed_lens) have the batch in dim 0.
+    """
+    assert (num_states - 2) % 6 == 0, num_states
+    tot_num_layers = (num_states - 2) // 6
+    return [1, 1, 1, 1, 0, 0] * tot_num_layers + [0, 0]
+
+
+class StreamingStatePool(object):
+    """Keep the zipformer states of a fixed number of streams in
+    preallocated batched tensors.
+
+    Each stream owns a slot, i.e., an index along the batch dimension of
+    every state tensor. The states of the streams in a batch are gathered
+    with one `index_select` per tensor and written back in place with one
+    `index_copy_`, instead of concatenating and splitting the states of
+    every stream with :func:`stack_states` and :func:`unstack_states`.
+    Slots are reused once their streams are finished.
+    """
+
+    def __init__(self, init_states: List[Tensor], num_slots: int) -> None:
+        """
+        Args:
+          init_states:
+            The initial states of a single stream, e.g., the return value of
+            `get_init_states(model, batch_size=1)` in streaming_decode.py.
+          num_slots:
+            The maximum number of streams that can own a slot at a time.
+        """
+        assert num_slots > 0, num_slots
+        self.batch_dims = get_state_batch_dims(len(init_states))
+        for s, dim in zip(init_states, self.batch_dims):
+            assert s.size(dim) == 1, (s.shape, dim)
+
+        self.init_states = init_states
+        self.num_slots = num_slots
+        self.states = [
+            s.repeat_interleave(num_slots, dim=dim).contiguous()
+            for s, dim in zip(init_states, self.batch_dims)
+        ]
+
+        # A min-heap, so that smaller slots are allocated first and the
+        # active slots tend to be a contiguous range starting from 0.
+        self._free_slots = list(range(num_slots))
+
+    @property
+    def num_free_slots(self) -> int:
+        return len(self._free_slots)
+
+    def allocate(self) -> int:
+        """Get a free slot and reset its states to the initial states."""
+        if not self._free_slots:
+            raise RuntimeError(f"All {self.num_slots} slots are in use")
+        slot = heapq.heappop(self._free_slots)
+        self.reset(slot)
+        return slot
+
+    def free(self, slot: int) -> None:
+        """Return a slot to the pool. Its states are left as they are."""
+        assert 0 <= slot < self.num_slots, slot
+        heapq.heappush(self._free_slots, slot)
+
+    def reset(self, slot: int) -> None:
+        """Set the states of the given slot to the initial states."""
+        for s, init, dim in zip(self.states, self.init_states, self.batch_dims):
+            s.narrow(dim, slot, 1).copy_(init)
+
+    def _is_range(self, slots: List[int]) -> bool:
+        return slots == list(range(slots[0], slots[0] + len(slots)))
+
+    def gather(self, slots: List[int]) -> List[Tensor]:
+        """Return the batched states of the given slots, in that order.
+
+        If the slots are consecutive, the returned tensors are views into
+        the pool; otherwise, they are copies. In both cases, use
+        :meth:`scatter` to write updated states back.
+        """
+        assert len(slots) > 0
+        if self._is_range(slots):
+            return [
+                s.narrow(dim, slots[0], len(slots))
+                for s, dim in zip(self.states, self.batch_dims)
+            ]
+
+        index = torch.tensor(slots, dtype=torch.int64, device=self.states[0].device)
+        return [
+            s.index_select(dim, index) for s, dim in zip(self.states, self.batch_dims)
+        ]
+
+    def scatter(self, slots: List[int], states: List[Tensor]) -> None:
+        """Write the batched states of the given slots back to the pool.
+
+        Args:
+          slots:
+            The slots, in the same order as the batch of `states`.
+          states:
+            The batched states, e.g., the updated states returned by
+            `streaming_forward` in streaming_decode.py.
+        """
+        assert len(states) == len(self.states), (len(states), len(self.states))
+        if self._is_range(slots):
+            for s, new_s, dim in zip(self.states, states, self.batch_dims):
+                s.narrow(dim, slots[0], len(slots)).copy_(new_s)
+            return
+
+        index = torch.tensor(slots, dtype=torch.int64, device=self.states[0].device)
+        for s, new_s, dim in zip(self.states, states, self.batch_dims):
+            s.index_copy_(dim, index, new_s.to(s.dtype))
@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+
+import random
+from typing import List, Tuple
+
+import torch
+from beam_search import (
+    HypothesisList,
+    RnnLmStateArena,
+    modified_beam_search,
+    modified_beam_search_lm_shallow_fusion,
+    modified_beam_search_tensorized,
+)
+from decoder import Decoder
+from joiner import Joiner
+
+from icefall.rnn_lm.model import RnnLmModel
+
+
+def get_model(vocab_size: int = 10, context_size: int = 2):
+    torch.manual_seed(20231015)
+    model = torch.nn.Module()
+    model.decoder = Decoder(
+        vocab_size=vocab_size,
+        decoder_dim=16,
+        blank_id=0,
+        context_size=context_size,
+    )
+    model.joiner = Joiner(
+        encoder_dim=16,
+        decoder_dim=16,
+        joiner_dim=16,
+        vocab_size=vocab_size,
+    )
+    # Make the outputs less uniform, so that hypotheses contain
+    # non-blank tokens
+    for p in model.parameters():
+        p.data.mul_(4.0)
+    return model.eval()
+
+
+@torch.no_grad()
+def test_modified_beam_search_tensorized():
+    for context_size in [1, 2]:
+        model = get_model(context_size=context_size)
+        encoder_out = torch.randn(4, 30, 16)
+        encoder_out_lens = torch.tensor([30, 25, 17, 1])
+
+        for beam in [1, 4, 8]:
+            expected = modified_beam_search(
+                model=model,
+                encoder_out=encoder_out,
+                encoder_out_lens=encoder_out_lens,
+                beam=beam,
+            )
+            hyps = modified_beam_search_tensorized(
+                model=model,
+                encoder_out=encoder_out,
+                encoder_out_lens=encoder_out_lens,
+                beam=beam,
+            )
+            assert hyps == expected, (context_size, beam, hyps, expected)
+            assert any(len(h) > 0 for h in hyps)
+
+
+class RnnLm(torch.nn.Module):
+    """A tiny randomly initialized RNN LM with the interface of LmScorer.
+    It counts the number of tokens it has scored."""
+
+    lm_type = "rnn"
+
+    def __init__(self, vocab_size: int = 10, lm_scale: float = 0.5):
+        super().__init__()
+        torch.manual_seed(20231016)
+        self.lm = RnnLmModel(
+            vocab_size=vocab_size,
+            embedding_dim=8,
+            hidden_dim=8,
+            num_layers=2,
+        ).eval()
+        self.lm_scale = lm_scale
+        self.num_scored = 0
+
+    def score_token(self, x: torch.Tensor, x_lens: torch.Tensor, state=None):
+        self.num_scored += x.size(0)
+        return self.lm.score_token(x, x_lens, state)
+
+    def score_tokens(
+        self, tokens: List[int]
+    ) -> Tuple[torch.Tensor, Tuple[torch.Tensor, torch.Tensor]]:
+        """Score sos + tokens from scratch, one token at a time.
+        Return the scores of the next token and the LSTM states."""
+        state = None
+        for token in [1] + tokens:
+            score, state = self.lm.score_token(
+                torch.tensor([[token]]), torch.tensor([1]), state
+            )
+        return score.reshape(-1), state
+
+
+def check_row(arena: RnnLmStateArena, LM: RnnLm, row: int, tokens: List[int]):
+    score, (h, c) = LM.score_tokens(tokens)
+    assert torch.allclose(arena.scores[row], score, atol=1e-5), (row, tokens)
+    assert torch.allclose(arena.h[:, row], h[:, 0], atol=1e-5), (row, tokens)
+    assert torch.allclose(arena.c[:, row], c[:, 0], atol=1e-5), (row, tokens)
+
+
+@torch.no_grad()
+def test_rnn_lm_state_arena():
+    LM = RnnLm()
+    init_score, init_state = LM.score_tokens([])
+    arena = RnnLmStateArena(LM, init_score.unsqueeze(0), init_state, max_rows=8)
+    root = arena.root
+    check_row(arena, LM, root, [])
+
+    # Identical extensions share a row and are scored only once
+    LM.num_scored = 0
+    rows = arena.extend([root, root, root], [3, 3, 4])
+    assert rows[0] == rows[1] != rows[2], rows
+    assert LM.num_scored == 2, LM.num_scored
+    check_row(arena, LM, rows[0], [3])
+    check_row(arena, LM, rows[2], [4])
+
+    # ... also in a later frame, as long as both rows are in use
+    assert arena.extend([root], [3]) == [rows[0]]
+    assert LM.num_scored == 2, LM.num_scored
+
+    # Freed rows are recycled
+    arena.sweep({rows[0]})
+    new_rows = arena.extend([rows[0], rows[0]], [5, 6])
+    assert sorted(new_rows) == sorted([root, rows[2]]), (new_rows, root, rows)
+    check_row(arena, LM, rows[0], [3])
+    check_row(arena, LM, new_rows[0], [3, 5])
+    check_row(arena, LM, new_rows[1], [3, 6])
+
+    # The extension of a freed row is scored again
+    arena.sweep({new_rows[0]})
+    LM.num_scored = 0
+    (row,) = arena.extend([new_rows[0]], [7])
+    assert LM.num_scored == 1, LM.num_scored
+    check_row(arena, LM, row, [3, 5, 7])
+
+    # Simulate a beam search with beam 4: no row that a hypothesis
+    # still uses is ever freed or overwritten
+    random.seed(20231016)
+    arena = RnnLmStateArena(LM, init_score.unsqueeze(0), init_state, max_rows=8)
+    hyps = [([], arena.root)]
+    for _ in range(50):
+        parents = [random.choice(hyps) for _ in range(4)]
+        tokens = [random.randint(1, 3) for _ in range(4)]
+        rows = arena.extend([row for _, row in parents], tokens)
+        candidates = hyps + [
+            (ys + [token], row) for (ys, _), token, row in zip(parents, tokens, rows)
+        ]
+        hyps = random.sample(candidates, random.randint(1, 4))
+        live_rows = {row for _, row in hyps}
+        arena.sweep(live_rows)
+        assert len(arena._free_rows) + len(live_rows) == arena.max_rows
+        for ys, row in hyps:
+            check_row(arena, LM, row, ys)
+
+    # All rows are in use
+    arena = RnnLmStateArena(LM, init_score.unsqueeze(0), init_state, max_rows=2)
+    arena.extend([arena.root], [3])
+    try:
+        arena.extend([arena.root], [4])
+    except RuntimeError:
+        pass
+    else:
+        assert False, "Expect a RuntimeError"
+
+
+def reference_shallow_fusion(
+    model: torch.nn.Module,
+    encoder_out: torch.Tensor,
+    LM: RnnLm,
+    beam: int,
+) -> Tuple[List[int], torch.Tensor]:
+    """modified_beam_search_lm_shallow_fusion() for a single utterance,
+    which scores the tokens of each hypothesis from scratch with the LM.
+    Return the tokens and the score of the best hypothesis."""
+    blank_id = model.decoder.blank_id
+    context_size = model.decoder.context_size
+    hyps = {tuple([-1] * (context_size - 1) + [blank_id]): torch.zeros(1)}
+    for t in range(encoder_out.size(0)):
+        A = list(hyps.items())
+        decoder_input = torch.tensor([ys[-context_size:] for ys, _ in A])
+        decoder_out = model.decoder(decoder_input, need_pad=False)
+        decoder_out = model.joiner.decoder_proj(decoder_out)
+        current_encoder_out = model.joiner.encoder_proj(encoder_out[t])
+        logits = model.joiner(
+            current_encoder_out.reshape(1, 1, -1), decoder_out, project_input=False
+        )
+        log_probs = logits.squeeze(1).log_softmax(dim=-1)
+        log_probs += torch.cat([log_prob for _, log_prob in A]).unsqueeze(1)
+        vocab_size = log_probs.size(-1)
+
+        topk_log_probs, topk_indexes = log_probs.reshape(-1).topk(beam)
+        hyps = {}
+        for log_prob, index in zip(topk_log_probs, topk_indexes.tolist()):
+            ys, _ = A[index // vocab_size]
+            token = index % vocab_size
+            log_prob = log_prob.reshape(1)
+            if token != blank_id:
+                lm_score, _ = LM.score_tokens(list(ys[context_size:]))
+                log_prob = log_prob + lm_score[token] * LM.lm_scale
+                ys = ys + (token,)
+            if ys in hyps:
+                log_prob = torch.logaddexp(hyps[ys], log_prob)
+            hyps[ys] = log_prob
+
+    ys, log_prob = max(hyps.items(), key=lambda x: x[1] / len(x[0]))
+    return list(ys[context_size:]), log_prob
+
+
+@torch.no_grad()
+def test_modified_beam_search_lm_shallow_fusion():
+    # Record the best hypotheses, which are not returned
+    best_hyps = []
+    get_most_probable = HypothesisList.get_most_probable
+
+    def get_and_record_most_probable(self, length_norm: bool = False):
+        hyp = get_most_probable(self, length_norm)
+        best_hyps.append(hyp)
+        return hyp
+
+    LM = RnnLm()
+    HypothesisList.get_most_probable = get_and_record_most_probable
+    try:
+        for context_size in [1, 2]:
+            model = get_model(context_size=context_size)
+            encoder_out = torch.randn(3, 20, 16)
+            encoder_out_lens = torch.tensor([20, 13, 1])
+            for beam in [1, 4]:
+                best_hyps.clear()
+                hyps = modified_beam_search_lm_shallow_fusion(
+                    model=model,
+                    encoder_out=encoder_out,
+                    encoder_out_lens=encoder_out_lens,
+                    LM=LM,
+                    beam=beam,
+                )
+                assert any(len(h) > 0 for h in hyps)
+
+                # best_hyps is sorted by the number of frames, as is encoder_out
+                for i, hyp in enumerate(best_hyps):
+                    ys, log_prob = reference_shallow_fusion(
+                        model=model,
+                        encoder_out=encoder_out[i, : encoder_out_lens[i]],
+                        LM=LM,
+                        beam=beam,
+                    )
+                    assert hyps[i] == ys, (context_size, beam, i, hyps[i], ys)
+                    assert hyp.ys[context_size:] == ys
+                    assert torch.allclose(hyp.log_prob, log_prob, atol=1e-4), (
+                        hyp.log_prob,
+                        log_prob,
+                    )
+    finally:
+        HypothesisList.get_most_probable = get_most_probable
+
+
+def main():
+    test_modified_beam_search_tensorized()
+    test_rnn_lm_state_arena()
+    test_modified_beam_search_lm_shallow_fusion()
+
+
+if __name__ == "__main__":
+    main()
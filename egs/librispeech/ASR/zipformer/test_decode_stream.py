@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+
+import math
+import random
+from typing import List, Optional
+
+import torch
+from beam_search import Hypothesis, HypothesisList
+from decode_stream import (
+    MAX_FEATURE_VECTORS,
+    DecodeStream,
+    Segment,
+    create_streaming_feature_extractor,
+)
+
+from icefall.utils import AttributeDict
+
+SAMPLE_RATE = 16000
+
+
+def get_params() -> AttributeDict:
+    return AttributeDict(
+        {
+            "decoding_method": "greedy_search",
+            "context_size": 2,
+            "blank_id": 0,
+            "subsampling_factor": 4,
+            # 30 and 500 encoder output frames, respectively
+            "endpoint_min_trailing_silence": 1.2,
+            "endpoint_min_num_tokens": 1,
+            "endpoint_max_utterance_length": 20.0,
+        }
+    )
+
+
+def get_stream(params: AttributeDict) -> DecodeStream:
+    return DecodeStream(
+        params=params,
+        cut_id="test",
+        initial_states=None,
+        state_slot=0,
+    )
+
+
+def compute_features(waveform: torch.Tensor) -> torch.Tensor:
+    """Compute the features of the whole waveform at once."""
+    fbank = create_streaming_feature_extractor(SAMPLE_RATE)
+    fbank.accept_waveform(sampling_rate=SAMPLE_RATE, waveform=waveform)
+    fbank.input_finished()
+    return torch.cat(fbank.get_frames(list(range(fbank.num_frames_ready))))
+
+
+def split_waveform(waveform: torch.Tensor):
+    """Split the waveform into pieces of random sizes. The second one is
+    longer than MAX_FEATURE_VECTORS frames."""
+    long_piece = (MAX_FEATURE_VECTORS + 200) * SAMPLE_RATE // 100
+    start = 0
+    i = 0
+    while start < waveform.numel():
+        if i == 1:
+            n = long_piece
+        else:
+            n = random.randint(1, 3 * SAMPLE_RATE)
+        yield waveform[start : start + n]
+        start += n
+        i += 1
+
+
+@torch.no_grad()
+def test_accept_waveform():
+    random.seed(20231015)
+    torch.manual_seed(20231015)
+    params = get_params()
+    waveform = torch.rand(25 * SAMPLE_RATE) * 0.2 - 0.1
+    pieces = list(split_waveform(waveform))
+    assert pieces[1].numel() * 100 // SAMPLE_RATE > MAX_FEATURE_VECTORS
+    tail_pad_len = 30
+
+    features = compute_features(waveform)
+    assert features.size(0) > 2 * MAX_FEATURE_VECTORS, features.shape
+    stream = get_stream(params)
+    expected = torch.nn.functional.pad(
+        features,
+        (0, 0, 0, stream.pad_length + tail_pad_len),
+        mode="constant",
+        value=stream.LOG_EPS,
+    )
+
+    # All the features are kept if no chunk is consumed
+    for piece in pieces:
+        stream.accept_waveform(sample_rate=SAMPLE_RATE, waveform=piece)
+    stream.input_finished(tail_pad_len=tail_pad_len)
+    assert stream.num_frames == expected.size(0), (stream.num_frames, expected.shape)
+    assert torch.allclose(stream.features, expected, atol=1e-5)
+
+    # Consume the chunks as soon as they are ready
+    chunk_size = 32
+    stream = get_stream(params)
+    consumed = []
+    for piece in pieces:
+        stream.accept_waveform(sample_rate=SAMPLE_RATE, waveform=piece)
+        while stream.is_ready(chunk_size):
+            frames, _ = stream.get_feature_frames(chunk_size)
+            consumed.append(frames[:chunk_size])
+    stream.input_finished(tail_pad_len=tail_pad_len)
+    while not stream.done:
+        frames, _ = stream.get_feature_frames(chunk_size)
+        consumed.append(frames[:chunk_size])
+
+    consumed = torch.cat(consumed)
+    assert consumed.shape == expected.shape, (consumed.shape, expected.shape)
+    assert torch.allclose(consumed, expected, atol=1e-5)
+
+
+def set_result(
+    stream: DecodeStream,
+    tokens: List[int],
+    num_trailing_blanks: int,
+    num_frames: int,
+    timestamp: Optional[List[int]] = None,
+) -> None:
+    """Set the decoding result of the current segment, which has
+    `num_frames` encoder output frames."""
+    if timestamp is None:
+        timestamp = []
+    params = stream.params
+    ys = [-1] * (params.context_size - 1) + [params.blank_id] + tokens
+    if params.decoding_method == "greedy_search":
+        stream.hyp = ys
+        stream.timestamp = timestamp
+        stream.num_trailing_blanks = num_trailing_blanks
+    else:
+        stream.hyps = HypothesisList()
+        stream.hyps.add(
+            Hypothesis(
+                ys=ys,
+                log_prob=torch.zeros(1),
+                timestamp=timestamp,
+                num_tailing_blanks=num_trailing_blanks,
+            )
+        )
+    stream.done_frames = stream.segment_start_frame + num_frames
+
+
+def test_endpoint_detected():
+    for decoding_method in ["greedy_search", "modified_beam_search"]:
+        params = get_params()
+        params.decoding_method = decoding_method
+        stream = get_stream(params)
+        # The segment does not start at the beginning of the stream
+        stream.segment_start_frame = 1000
+
+        # Trailing silence after speech
+        for num_frames in [30, 100]:
+            set_result(stream, [5, 6], num_trailing_blanks=29, num_frames=num_frames)
+            assert not stream.endpoint_detected()
+            set_result(stream, [5, 6], num_trailing_blanks=30, num_frames=num_frames)
+            assert stream.endpoint_detected()
+
+        # Trailing silence with no speech, which is an endpoint only
+        # with --endpoint-min-num-tokens 0
+        set_result(stream, [], num_trailing_blanks=30, num_frames=30)
+        assert not stream.endpoint_detected()
+        params.endpoint_min_num_tokens = 0
+        set_result(stream, [], num_trailing_blanks=29, num_frames=29)
+        assert not stream.endpoint_detected()
+        set_result(stream, [], num_trailing_blanks=30, num_frames=30)
+        assert stream.endpoint_detected()
+        params.endpoint_min_num_tokens = 1
+
+        # Maximum utterance length
+        for tokens in [[], [5, 6]]:
+            set_result(stream, tokens, num_trailing_blanks=0, num_frames=499)
+            assert not stream.endpoint_detected()
+            set_result(stream, tokens, num_trailing_blanks=0, num_frames=500)
+            assert stream.endpoint_detected()
+
+
+def test_finish_segment():
+    for decoding_method in ["greedy_search", "modified_beam_search"]:
+        params = get_params()
+        params.decoding_method = decoding_method
+        stream = get_stream(params)
+        stream.segment_start_frame = 100
+        set_result(
+            stream, [5, 6], num_trailing_blanks=30, num_frames=50, timestamp=[3, 10]
+        )
+
+        segment = stream.finish_segment()
+        assert isinstance(segment, Segment)
+        assert segment.tokens == [5, 6], segment
+        assert math.isclose(segment.start_time, 4.0), segment
+        assert math.isclose(segment.end_time, 6.0), segment
+        assert len(segment.timestamps) == 2, segment
+        assert math.isclose(segment.timestamps[0], 0.12), segment
+        assert math.isclose(segment.timestamps[1], 0.4), segment
+        assert stream.segments == [segment]
+
+        # The next segment starts from scratch
+        assert stream.segment_start_frame == 150, stream.segment_start_frame
+        assert stream.decoding_result() == []
+        assert stream.full_result() == [5, 6]
+        assert not stream.endpoint_detected()
+        if decoding_method == "greedy_search":
+            assert stream.hyp == [-1, 0], stream.hyp
+            assert stream.timestamp == []
+            assert stream.num_trailing_blanks == 0
+        else:
+            (hyp,) = list(stream.hyps)
+            assert hyp.ys == [-1, 0], hyp.ys
+            assert hyp.timestamp == []
+            assert hyp.num_tailing_blanks == 0
+
+        set_result(stream, [7], num_trailing_blanks=0, num_frames=20, timestamp=[160])
+        segment = stream.finish_segment()
+        assert segment.tokens == [7], segment
+        assert math.isclose(segment.start_time, 6.0), segment
+        assert math.isclose(segment.end_time, 6.8), segment
+        assert stream.full_result() == [5, 6, 7]
+
+
+def main():
+    test_accept_waveform()
+    test_endpoint_detected()
+    test_finish_segment()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+
+import torch
+from scaling import (
+    ActivationDropoutAndLinear,
+    Balancer,
+    BiasNorm,
+    ScheduledFloat,
+    SwooshL,
+    SwooshR,
+    Whiten,
+)
+from scaling_converter import convert_for_inference
+from subsampling import Conv2dSubsampling
+from zipformer import Zipformer2
+
+
+def get_models(causal: bool = False):
+    torch.manual_seed(20231015)
+    encoder_embed = Conv2dSubsampling(
+        in_channels=80,
+        out_channels=64,
+        dropout=ScheduledFloat((0.0, 0.3), (20000.0, 0.1)),
+    )
+    encoder = Zipformer2(
+        encoder_dim=(64, 96),
+        encoder_unmasked_dim=(48, 64),
+        num_heads=(4, 4),
+        causal=causal,
+        chunk_size=(4,) if causal else (-1,),
+        left_context_frames=(64,),
+    )
+    model = torch.nn.ModuleDict({"encoder_embed": encoder_embed, "encoder": encoder})
+    model.eval()
+
+    converted = convert_for_inference(model)
+    return model, converted
+
+
+def run(model, x, x_lens):
+    x, x_lens = model["encoder_embed"](x, x_lens)
+    x = x.permute(1, 0, 2)  # (N, T, C) -> (T, N, C)
+    return model["encoder"](x, x_lens)
+
+
+@torch.no_grad()
+def test_convert_for_inference():
+    for causal in [False, True]:
+        model, converted = get_models(causal)
+        for m in converted.modules():
+            assert not isinstance(
+                m,
+                (
+                    ActivationDropoutAndLinear,
+                    Balancer,
+                    BiasNorm,
+                    ScheduledFloat,
+                    SwooshL,
+                    SwooshR,
+                    Whiten,
+                ),
+            ), type(m)
+
+        # The parameter names are kept
+        converted.load_state_dict(model.state_dict())
+
+        x = torch.rand(3, 100, 80)
+        x_lens = torch.tensor([100, 80, 57])
+        y, y_lens = run(model, x, x_lens)
+        y2, y2_lens = run(converted, x, x_lens)
+        assert torch.equal(y_lens, y2_lens)
+        assert torch.allclose(y, y2, atol=1e-5), (y - y2).abs().max()
+
+
+def main():
+    test_convert_for_inference()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+
+import random
+import time
+from typing import List, Optional
+
+from streaming_scheduler import (
+    FifoScheduler,
+    RemainingLengthScheduler,
+    get_min_active_streams,
+    get_scheduler,
+)
+
+
+class Stream(object):
+    """The attributes of a DecodeStream used by the schedulers."""
+
+    def __init__(
+        self,
+        cut_id: str,
+        num_remaining_frames: int = 100,
+        priority: int = 0,
+        deadline: Optional[float] = None,
+    ):
+        self.id = cut_id
+        self.num_remaining_frames = num_remaining_frames
+        self.priority = priority
+        self.deadline = deadline
+
+
+def get_streams(num_remaining_frames: List[int]) -> List[Stream]:
+    return [Stream(str(i), n) for i, n in enumerate(num_remaining_frames)]
+
+
+def test_select_batch_size():
+    random.seed(20231015)
+    now = time.time()
+    for name in ["fifo", "remaining_length"]:
+        scheduler = get_scheduler(name, max_batch_size=4, chunk_length=45)
+        for _ in range(100):
+            streams = [
+                Stream(
+                    str(random.randint(0, 20)),
+                    num_remaining_frames=random.randint(1, 500),
+                    priority=random.randint(0, 2),
+                    deadline=random.choice([None, now - 1, now + 100]),
+                )
+                for _ in range(random.randint(1, 10))
+            ]
+            ans = scheduler.select(streams)
+            assert 0 < len(ans) <= 4, ans
+            assert len(ans) == min(len(streams), 4), ans
+            assert ans == sorted(set(ans)), ans
+            assert all(0 <= i < len(streams) for i in ans), ans
+
+    # All the streams are selected if there are not too many
+    scheduler = FifoScheduler(max_batch_size=4, chunk_length=45)
+    assert scheduler.select(get_streams([1, 2, 3])) == [0, 1, 2]
+
+
+def test_fifo_scheduler():
+    scheduler = FifoScheduler(max_batch_size=2, chunk_length=45)
+    streams = get_streams([100, 200, 300, 400, 500])
+
+    # In the order of admission, every time
+    for _ in range(3):
+        assert scheduler.select(streams) == [0, 1]
+
+    # Smaller priority first
+    for s, p in zip(streams, [1, 0, 1, 0, 0]):
+        s.priority = p
+    assert scheduler.select(streams) == [1, 3]
+
+
+def test_remaining_length_scheduler():
+    scheduler = RemainingLengthScheduler(max_batch_size=3, chunk_length=45)
+    streams = get_streams([100, 500, 110, 490, 105, 300])
+
+    # The anchor is stream 0, which has never been selected, and the
+    # streams with the closest remaining lengths are selected with it
+    assert scheduler.select(streams) == [0, 2, 4]
+
+    # Then streams 1, 3 and 5 have waited longest. Stream 1 is the anchor.
+    assert scheduler.select(streams) == [1, 3, 5]
+
+    # Smaller priority first, even for the anchor
+    streams[4].priority = -1
+    streams[5].priority = -1
+    assert scheduler.select(streams) == [0, 4, 5]
+
+
+def test_starvation():
+    # A stream whose remaining length is far from the others is always
+    # the last one to join a batch, but it becomes the anchor once it has
+    # waited longest.
+    scheduler = RemainingLengthScheduler(max_batch_size=2, chunk_length=45)
+    streams = get_streams([100, 101, 102, 103, 104, 1000])
+    for num_chunks in range(len(streams)):
+        if 5 in scheduler.select(streams):
+            break
+    assert num_chunks < len(streams) - 1, num_chunks
+
+    # With the fifo scheduler, a stream with a larger priority is not
+    # selected until its deadline has passed
+    scheduler = FifoScheduler(max_batch_size=2, chunk_length=45)
+    streams = get_streams([100, 100, 100, 100])
+    streams[3].priority = 1
+    streams[3].deadline = time.time() + 100
+    for _ in range(10):
+        assert scheduler.select(streams) == [0, 1]
+    streams[3].deadline = time.time() - 0.001
+    assert scheduler.select(streams) == [0, 3]
+
+    # Streams with earlier deadlines first
+    now = time.time()
+    for s, deadline in zip(streams, [now - 1, now - 3, now - 2, now - 4]):
+        s.deadline = deadline
+    assert scheduler.select(streams) == [1, 3]
+
+
+def test_remove():
+    scheduler = RemainingLengthScheduler(max_batch_size=1, chunk_length=45)
+    streams = get_streams([100, 100])
+    assert scheduler.select(streams) == [0]
+    assert scheduler.select(streams) == [1]
+    assert scheduler.select(streams) == [0]
+    assert set(scheduler.last_selected) == {"0", "1"}
+
+    # A removed stream is treated as a new one, i.e., as if it has
+    # waited longest
+    scheduler.remove(streams[1])
+    assert set(scheduler.last_selected) == {"0"}
+    scheduler.select(streams)
+    scheduler.remove(streams[0])
+    scheduler.remove(streams[0])
+    assert set(scheduler.last_selected) == {"1"}
+    assert scheduler.select(streams) == [0]
+
+
+def test_get_min_active_streams():
+    assert get_min_active_streams(100, 0.5) == 50
+    assert get_min_active_streams(3, 0.5) == 2
+    assert get_min_active_streams(1, 0.01) == 1
+
+
+def main():
+    test_select_batch_size()
+    test_fifo_scheduler()
+    test_remaining_length_scheduler()
+    test_starvation()
+    test_remove()
+    test_get_min_active_streams()
+
+
+if __name__ == "__main__":
+    main()
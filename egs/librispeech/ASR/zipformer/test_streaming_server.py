@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+
+import asyncio
+import json
+from typing import AsyncIterator, Dict, List, Optional, Union
+
+import torch
+import websockets
+from streaming_server import StreamingServer, get_parser
+from train import get_model, get_params
+
+SAMPLE_RATE = 16000
+
+
+def get_server(
+    max_connections: int = 4, max_buffered_seconds: float = 1.0
+) -> StreamingServer:
+    args = get_parser().parse_args(
+        [
+            "--checkpoint=unused",
+            "--tokens=unused",
+            "--causal=1",
+            "--chunk-size=16",
+            "--left-context-frames=64",
+            "--num-encoder-layers=1,1",
+            "--downsampling-factor=1,2",
+            "--feedforward-dim=64,96",
+            "--num-heads=2,2",
+            "--encoder-dim=32,48",
+            "--encoder-unmasked-dim=32,32",
+            "--cnn-module-kernel=15,15",
+            "--query-head-dim=8",
+            "--value-head-dim=4",
+            "--pos-dim=16",
+            "--decoder-dim=16",
+            "--joiner-dim=16",
+            f"--max-connections={max_connections}",
+            f"--max-buffered-seconds={max_buffered_seconds}",
+        ]
+    )
+    params = get_params()
+    params.update(vars(args))
+    params.vocab_size = 10
+    params.blank_id = 0
+    params.unk_id = 9
+
+    torch.manual_seed(20231015)
+    model = get_model(params)
+    # Make the outputs less uniform, so that the results contain
+    # non-blank tokens
+    model.joiner.output_linear.weight.data.mul_(10.0)
+    model.eval()
+    model.device = torch.device("cpu")
+
+    token_table = {i: chr(ord("a") + i) for i in range(params.vocab_size)}
+    return StreamingServer(params=params, model=model, token_table=token_table)
+
+
+def get_audio(seconds: float, seed: int) -> torch.Tensor:
+    g = torch.Generator().manual_seed(seed)
+    return torch.rand(int(seconds * SAMPLE_RATE), generator=g) * 0.2 - 0.1
+
+
+async def split_audio(
+    audio: torch.Tensor, seconds: float, done: bool = True
+) -> AsyncIterator[Union[bytes, str]]:
+    n = int(seconds * SAMPLE_RATE)
+    for i in range(0, audio.numel(), n):
+        yield audio[i : i + n].numpy().astype("<f4").tobytes()
+        # Let the server decode, as a real client sends audio in real time
+        await asyncio.sleep(0)
+    if done:
+        yield "Done"
+
+
+class FakeSocket(object):
+    """A websocket connection whose received messages come from an async
+    iterator."""
+
+    def __init__(self, messages: AsyncIterator[Union[bytes, str]]):
+        self.messages = messages
+        self.sent: List[Dict] = []
+        self.remote_address = ("127.0.0.1", 0)
+
+    def __aiter__(self):
+        return self.messages
+
+    async def send(self, message: str) -> None:
+        self.sent.append(json.loads(message))
+
+    @property
+    def final_text(self) -> Optional[str]:
+        if self.sent and self.sent[-1]["final"]:
+            return self.sent[-1]["text"]
+        return None
+
+
+async def start(server: StreamingServer) -> asyncio.Task:
+    """Do what `StreamingServer.run` does, except listening on a port."""
+    server.slots = asyncio.Semaphore(server.params.max_connections)
+    server.new_data = asyncio.Event()
+    return asyncio.create_task(server.decode_loop())
+
+
+async def wait_all_slots_free(server: StreamingServer) -> None:
+    # The slots are freed by the decoding loop after the connections are closed
+    for _ in range(100):
+        if server.state_pool.num_free_slots == server.params.max_connections:
+            return
+        await asyncio.sleep(0.01)
+    assert False, server.state_pool.num_free_slots
+
+
+def decode(server: StreamingServer, audio: torch.Tensor, seconds: float) -> str:
+    """Return the final result of a single client sending the audio in
+    messages of the given length."""
+
+    async def run():
+        decoder = await start(server)
+        socket = FakeSocket(split_audio(audio, seconds))
+        await asyncio.wait_for(server.handle_connection(socket), timeout=60)
+        await wait_all_slots_free(server)
+        decoder.cancel()
+        return socket.final_text
+
+    return asyncio.run(run())
+
+
+@torch.no_grad()
+def test_large_message():
+    # A client sending more than --max-buffered-seconds of audio in a single
+    # message has to wait for the decoding to drain the buffer, which
+    # requires several chunks to be decoded without any new audio.
+    audio = get_audio(seconds=12, seed=1)
+    expected = decode(get_server(), audio, seconds=0.1)
+    assert expected, expected
+
+    text = decode(get_server(max_buffered_seconds=1.0), audio, seconds=12)
+    assert text == expected, (text, expected)
+
+
+@torch.no_grad()
+def test_disconnect_during_batch():
+    # Less than --max-buffered-seconds, so that client A is waiting for
+    # messages, not for the buffer to drain, when it disconnects
+    audio_a = get_audio(seconds=0.8, seed=1)
+    audio_b = get_audio(seconds=3, seed=2)
+    audio_c = get_audio(seconds=3, seed=3)
+    expected_b = decode(get_server(), audio_b, seconds=0.2)
+    expected_c = decode(get_server(), audio_c, seconds=0.2)
+    assert expected_b and expected_c, (expected_b, expected_c)
+
+    # Client A disconnects while its stream is decoded. Client C connects
+    # at that moment, when all the slots are in use.
+    server = get_server(max_connections=2)
+    disconnect_a = asyncio.Event()
+    socket_c = FakeSocket(split_audio(audio_c, seconds=0.2))
+    loop = stream_a = task_a = task_c = None
+    errors = []
+
+    async def messages_a():
+        async for message in split_audio(audio_a, seconds=0.2, done=False):
+            yield message
+        await disconnect_a.wait()
+        raise websockets.ConnectionClosedError(None, None)
+
+    socket_a = FakeSocket(messages_a())
+
+    async def on_batch_a():
+        nonlocal task_c
+        disconnect_a.set()
+        task_c = asyncio.create_task(server.handle_connection(socket_c))
+        # Let client A go away and client C try to connect
+        await asyncio.sleep(0.2)
+        if not task_a.done():
+            errors.append("Client A is not disconnected during the batch")
+
+    decode_batch = server._decode_batch
+
+    def decode_batch_and_disconnect(streams):
+        if not disconnect_a.is_set() and stream_a in streams:
+            asyncio.run_coroutine_threadsafe(on_batch_a(), loop).result()
+            # No stream outside of this batch may own a slot of this batch,
+            # as the states of the batch are written back after it
+            slots = [s.state_slot for s in streams]
+            for c in server.connections:
+                if c.stream not in streams and c.stream.state_slot in slots:
+                    errors.append(c.stream.state_slot)
+        return decode_batch(streams)
+
+    server._decode_batch = decode_batch_and_disconnect
+
+    async def run():
+        nonlocal loop, stream_a, task_a
+        loop = asyncio.get_running_loop()
+        decoder = await start(server)
+        task_a = asyncio.create_task(server.handle_connection(socket_a))
+        await asyncio.sleep(0)
+        (connection_a,) = server.connections
+        stream_a = connection_a.stream
+        socket_b = FakeSocket(split_audio(audio_b, seconds=0.2))
+        await asyncio.wait_for(
+            asyncio.gather(task_a, server.handle_connection(socket_b)), timeout=60
+        )
+        assert task_c is not None
+        await asyncio.wait_for(task_c, timeout=60)
+        await wait_all_slots_free(server)
+        decoder.cancel()
+        return socket_b
+
+    socket_b = asyncio.run(run())
+
+    assert not errors, errors
+    assert socket_a.final_text is None
+    assert socket_b.final_text == expected_b, (socket_b.final_text, expected_b)
+    assert socket_c.final_text == expected_c, (socket_c.final_text, expected_c)
+
+
+def main():
+    test_large_message()
+    test_disconnect_during_batch()
+
+
+if __name__ == "__main__":
+    main()
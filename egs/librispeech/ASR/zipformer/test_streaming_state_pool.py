@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+
+from typing import List
+
+import torch
+from streaming_state_pool import StreamingStatePool, get_state_batch_dims
+
+
+def get_init_states(num_layers: int = 2) -> List[torch.Tensor]:
+    """Random states of a single stream, shaped like those returned by
+    `get_init_states(model, batch_size=1)` in streaming_decode.py."""
+    states = []
+    for _ in range(num_layers):
+        states += [
+            torch.randn(16, 1, 8),  # cached_key
+            torch.randn(1, 1, 16, 6),  # cached_nonlin_attn
+            torch.randn(16, 1, 4),  # cached_val1
+            torch.randn(16, 1, 4),  # cached_val2
+            torch.randn(1, 8, 15),  # cached_conv1
+            torch.randn(1, 8, 15),  # cached_conv2
+        ]
+    states.append(torch.randn(1, 128, 3, 19))  # cached embed_left_pad
+    states.append(torch.randint(0, 100, (1,)))  # processed_lens
+    return states
+
+
+def get_random_states(pool: StreamingStatePool, batch_size: int) -> List[torch.Tensor]:
+    ans = []
+    for s, dim in zip(pool.init_states, pool.batch_dims):
+        shape = list(s.shape)
+        shape[dim] = batch_size
+        if s.is_floating_point():
+            ans.append(torch.randn(shape))
+        else:
+            ans.append(torch.randint(100, 200, shape))
+    return ans
+
+
+def select(states: List[torch.Tensor], dims: List[int], i: int) -> List[torch.Tensor]:
+    return [s.narrow(dim, i, 1) for s, dim in zip(states, dims)]
+
+
+def assert_equal(a: List[torch.Tensor], b: List[torch.Tensor]):
+    assert len(a) == len(b), (len(a), len(b))
+    for x, y in zip(a, b):
+        assert torch.equal(x, y), (x.shape, y.shape)
+
+
+def test_get_state_batch_dims():
+    assert get_state_batch_dims(14) == [1, 1, 1, 1, 0, 0] * 2 + [0, 0]
+
+
+def test_gather_scatter():
+    torch.manual_seed(20231015)
+    pool = StreamingStatePool(get_init_states(), num_slots=6)
+    dims = pool.batch_dims
+    slots = [pool.allocate() for _ in range(6)]
+    assert slots == list(range(6)), slots
+
+    # Contiguous and non-contiguous slots, the latter in any order
+    for batch in [[0, 1, 2], [3], [0, 2, 5], [4, 1], [5, 4, 3, 2, 1, 0]]:
+        expected = get_random_states(pool, len(batch))
+        pool.scatter(batch, expected)
+        assert_equal(pool.gather(batch), expected)
+
+        # The other slots are not touched
+        others = [s for s in slots if s not in batch]
+        if others:
+            before = [s.clone() for s in pool.gather(others)]
+            pool.scatter(batch, get_random_states(pool, len(batch)))
+            assert_equal(pool.gather(others), before)
+
+    # Gathering the slots one by one gives the same states as gathering
+    # them in a batch
+    batch = [2, 0, 3]
+    states = pool.gather(batch)
+    for i, slot in enumerate(batch):
+        assert_equal(pool.gather([slot]), select(states, dims, i))
+
+
+def test_reset():
+    torch.manual_seed(20231015)
+    init_states = get_init_states()
+    pool = StreamingStatePool(init_states, num_slots=3)
+    slots = [pool.allocate() for _ in range(3)]
+    pool.scatter(slots, get_random_states(pool, 3))
+
+    pool.reset(1)
+    assert_equal(pool.gather([1]), init_states)
+    for slot in [0, 2]:
+        for s, init in zip(pool.gather([slot]), init_states):
+            assert not torch.equal(s, init)
+
+
+def test_allocate_and_free():
+    torch.manual_seed(20231015)
+    init_states = get_init_states()
+    pool = StreamingStatePool(init_states, num_slots=2)
+    assert pool.num_free_slots == 2
+    a = pool.allocate()
+    b = pool.allocate()
+    assert (a, b) == (0, 1), (a, b)
+    assert pool.num_free_slots == 0
+
+    # The pool is exhausted and stays usable
+    try:
+        pool.allocate()
+    except RuntimeError:
+        pass
+    else:
+        assert False, "Expect a RuntimeError"
+    assert pool.num_free_slots == 0
+
+    # A freed slot is handed to a new stream with the initial states,
+    # not the states of the previous stream
+    pool.scatter([a, b], get_random_states(pool, 2))
+    b_states = [s.clone() for s in pool.gather([b])]
+    pool.free(a)
+    assert pool.num_free_slots == 1
+    c = pool.allocate()
+    assert c == a, (c, a)
+    assert_equal(pool.gather([c]), init_states)
+    assert_equal(pool.gather([b]), b_states)
+
+    # Smaller slots are allocated first
+    pool.free(b)
+    pool.free(c)
+    assert [pool.allocate(), pool.allocate()] == [0, 1]
+
+
+def main():
+    test_get_state_batch_dims()
+    test_gather_scatter()
+    test_reset()
+    test_allocate_and_free()
+
+
+if __name__ == "__main__":
+    main()
@@ -85,7 +85,11 @@ from torch.utils.tensorboard import SummaryWriter
 from zipformer import Zipformer2
 
 from icefall import diagnostics
-from icefall.checkpoint import load_checkpoint, remove_checkpoints
+from icefall.checkpoint import (
+    AsyncCheckpointSaver,
+    load_checkpoint,
+    remove_checkpoints,
+)
 from icefall.checkpoint import save_checkpoint as save_checkpoint_impl
 from icefall.checkpoint import (
     save_checkpoint_with_global_batch_idx,
@@ -501,6 +505,29 @@ def get_parser():
         """,
     )
 
+    parser.add_argument(
+        "--save-model-only",
+        type=str2bool,
+        default=False,
+        help="""If True, also save each checkpoint without the optimizer,
+        scheduler and sampler states in exp-dir/model-only. It is used
+        instead of the full checkpoint when averaging checkpoints, e.g.,
+        in ./zipformer/decode.py, which is then much faster.
+        """,
+    )
+
+    parser.add_argument(
+        "--async-checkpoint-saves",
+        type=int,
+        default=0,
+        help="""If positive, write checkpoints in a background thread, so
+        that training does not wait for them, with at most this number of
+        checkpoints being written at the same time. Each of them needs CPU
+        memory for a copy of the checkpoint. If 0, checkpoints are written
+        synchronously.
+        """,
+    )
+
     parser.add_argument(
         "--average-period",
         type=int,
@@ -785,6 +812,7 @@ def save_checkpoint(
     sampler: Optional[CutSampler] = None,
     scaler: Optional[GradScaler] = None,
     rank: int = 0,
+    saver: Optional[AsyncCheckpointSaver] = None,
 ) -> None:
     """Save model, optimizer, scheduler and training stats to file.
 
@@ -801,6 +829,8 @@ def save_checkpoint(
        The sampler for the training dataset.
       scaler:
         The scaler used for mix precision training.
+      saver:
+        If not None, write the checkpoint in the background with it.
     """
     if rank != 0:
         return
@@ -815,8 +845,17 @@ def save_checkpoint(
         sampler=sampler,
         scaler=scaler,
         rank=rank,
+        save_model_only=params.save_model_only,
+        saver=saver,
     )
 
+    if saver is not None and params.cur_epoch in (
+        params.best_train_epoch,
+        params.best_valid_epoch,
+    ):
+        # The checkpoint has to be written before it is copied
+        saver.wait()
+
     if params.best_train_epoch == params.cur_epoch:
         best_train_filename = params.exp_dir / "best-train-loss.pt"
         copyfile(src=filename, dst=best_train_filename)
@@ -968,6 +1007,7 @@ def train_one_epoch(
     tb_writer: Optional[SummaryWriter] = None,
     world_size: int = 1,
     rank: int = 0,
+    saver: Optional[AsyncCheckpointSaver] = None,
 ) -> None:
     """Train the model for one epoch.
 
@@ -999,6 +1039,8 @@ def train_one_epoch(
       rank:
         The rank of the node in DDP training. If no DDP is used, it should
         be set to 0.
+      saver:
+        If not None, write checkpoints in the background with it.
     """
     model.train()
 
@@ -1083,11 +1125,14 @@ def train_one_epoch(
                 sampler=train_dl.sampler,
                 scaler=scaler,
                 rank=rank,
+                save_model_only=params.save_model_only,
+                saver=saver,
             )
             remove_checkpoints(
                 out_dir=params.exp_dir,
                 topk=params.keep_last_k,
                 rank=rank,
+                saver=saver,
             )
 
         if batch_idx % 100 == 0 and params.use_fp16:
@@ -1344,6 +1389,11 @@ def run(rank, world_size, args):
         logging.info("Loading grad scaler state dict")
         scaler.load_state_dict(checkpoints["grad_scaler"])
 
+    if params.async_checkpoint_saves > 0 and rank == 0:
+        saver = AsyncCheckpointSaver(max_in_flight=params.async_checkpoint_saves)
+    else:
+        saver = None
+
     for epoch in range(params.start_epoch, params.num_epochs + 1):
         scheduler.step_epoch(epoch - 1)
         fix_random_seed(params.seed + epoch - 1)
@@ -1367,6 +1417,7 @@ def run(rank, world_size, args):
             tb_writer=tb_writer,
             world_size=world_size,
             rank=rank,
+            saver=saver,
         )
 
         if params.print_diagnostics:
@@ -1382,8 +1433,12 @@ def run(rank, world_size, args):
             sampler=train_dl.sampler,
             scaler=scaler,
             rank=rank,
+            saver=saver,
         )
 
+    if saver is not None:
+        saver.wait()
+
     logging.info("Done!")
 
     if world_size > 1:
@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+
+# Copyright (c)  2023  Xiaomi Corporation
+#
+# See ../../../../LICENSE for clarification regarding multiple authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+This file takes as input the filename of LM training data
+generated by ./local/sort_lm_training_data.py and converts it to
+a directory that can be memory-mapped by `MemmapLmDataset` in
+icefall/rnn_lm/dataset.py. It contains:
+
+  - tokens.npy, the tokens of all sentences, of dtype np.int32
+  - offsets.npy, the start of each sentence in tokens.npy, followed by
+    the number of tokens, of dtype np.int64
+
+Usage:
+
+./local/convert_lm_data_to_memmap.py \
+  --in-lm-data data/lm_training_bpe_500/sorted_lm_data.pt \
+  --out-dir data/lm_training_bpe_500/sorted_lm_data
+
+Then pass `--lm-data data/lm_training_bpe_500/sorted_lm_data` to
+rnn_lm/train.py or transformer_lm/train.py.
+"""
+
+import argparse
+import logging
+from pathlib import Path
+
+import numpy as np
+import torch
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--in-lm-data",
+        type=str,
+        help="Input LM training data, e.g., data/bpe_500/sorted_lm_data.pt",
+    )
+
+    parser.add_argument(
+        "--out-dir",
+        type=str,
+        help="Output directory, e.g., data/bpe_500/sorted_lm_data",
+    )
+
+    parser.add_argument(
+        "--num-sentences-per-chunk",
+        type=int,
+        default=1000000,
+        help="Number of sentences converted at a time. It limits the memory used.",
+    )
+
+    return parser.parse_args()
+
+
+def expand_words(
+    word_ids: np.ndarray, word_splits: np.ndarray, word_tokens: np.ndarray
+) -> np.ndarray:
+    """Return the concatenated tokens of the given words.
+
+    Args:
+      word_ids:
+        A 1-D array with the IDs of the words.
+      word_splits:
+        The row splits of the ragged tensor [word][token].
+      word_tokens:
+        The values of the ragged tensor [word][token].
+    """
+    starts = word_splits[word_ids]
+    lengths = word_splits[word_ids + 1] - starts
+    # Index of each token in word_tokens
+    index = np.arange(lengths.sum()) + np.repeat(
+        starts - (np.cumsum(lengths) - lengths), lengths
+    )
+    return word_tokens[index]
+
+
+def main():
+    args = get_args()
+    in_lm_data = Path(args.in_lm_data)
+    out_dir = Path(args.out_dir)
+    assert in_lm_data.is_file(), f"{in_lm_data}"
+    if (out_dir / "offsets.npy").is_file():
+        logging.warning(f"{out_dir} exists - skipping")
+        return
+    out_dir.mkdir(parents=True, exist_ok=True)
+
+    data = torch.load(in_lm_data)
+    words = data["words"]
+    sentences = data["sentences"]
+    sentence_lengths = data["sentence_lengths"].numpy().astype(np.int64)
+
+    word_splits = words.shape.row_splits(1).numpy().astype(np.int64)
+    word_tokens = words.values.numpy()
+    sentence_splits = sentences.shape.row_splits(1).numpy().astype(np.int64)
+    sentence_words = sentences.values.numpy().astype(np.int64)
+
+    num_sentences = sentence_lengths.shape[0]
+    assert num_sentences == sentence_splits.shape[0] - 1, (
+        num_sentences,
+        sentence_splits.shape[0] - 1,
+    )
+    assert np.all(sentence_lengths[:-1] >= sentence_lengths[1:]), (
+        "Sentences are not sorted by length. "
+        "Please use the output of ./local/sort_lm_training_data.py"
+    )
+
+    offsets = np.zeros(num_sentences + 1, dtype=np.int64)
+    np.cumsum(sentence_lengths, out=offsets[1:])
+
+    tokens = np.lib.format.open_memmap(
+        out_dir / "tokens.npy.tmp",
+        mode="w+",
+        dtype=np.int32,
+        shape=(int(offsets[-1]),),
+    )
+    for start in range(0, num_sentences, args.num_sentences_per_chunk):
+        end = min(start + args.num_sentences_per_chunk, num_sentences)
+        chunk = expand_words(
+            sentence_words[sentence_splits[start] : sentence_splits[end]],
+            word_splits,
+            word_tokens,
+        )
+        assert chunk.shape[0] == offsets[end] - offsets[start], (
+            chunk.shape[0],
+            offsets[end] - offsets[start],
+        )
+        tokens[offsets[start] : offsets[end]] = chunk
+        logging.info(f"Processed {end}/{num_sentences} sentences")
+    tokens.flush()
+    del tokens
+
+    # offsets.npy is written last, so that an interrupted conversion
+    # is not skipped when it is run again.
+    (out_dir / "tokens.npy.tmp").rename(out_dir / "tokens.npy")
+    np.save(out_dir / "offsets.npy", offsets)
+    logging.info(f"Saved to {out_dir}")
+
+
+if __name__ == "__main__":
+    formatter = "%(asctime)s %(levelname)s [%(filename)s:%(lineno)d] %(message)s"
+
+    logging.basicConfig(format=formatter, level=logging.INFO)
+    main()
@@ -17,7 +17,7 @@ from .checkpoint import (
     save_checkpoint_with_global_batch_idx,
 )
 
-from .context_graph import ContextGraph, ContextState
+from .context_graph import CompiledContextGraph, ContextGraph, ContextState
 
 from .decode import (
     get_lattice,
@@ -71,6 +71,6 @@ from .utils import (
     write_error_stats,
 )
 
-from .ngram_lm import NgramLm, NgramLmStateCost
+from .ngram_lm import CompiledNgramLm, NgramLm, NgramLmStateCost
 
 from .lm_wrapper import LmScorer
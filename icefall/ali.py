@@ -14,8 +14,12 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from typing import Dict, List, Tuple
+import json
+import logging
+from pathlib import Path
+from typing import Dict, List, Tuple, Union
 
+import numpy as np
 import torch
 from torch.nn.utils.rnn import pad_sequence
 
@@ -65,6 +69,182 @@ def load_alignments(filename: str) -> Tuple[int, Dict[str, List[int]]]:
     return subsampling_factor, alignments
 
 
+def save_alignment_store(
+    alignments: Dict[str, List[int]],
+    subsampling_factor: int,
+    out_dir: Union[str, Path],
+) -> None:
+    """Save alignments to a directory that can be read by
+    :class:`AlignmentStore`.
+
+    The directory contains:
+
+      - labels.npy, the alignments of all utterances concatenated, of dtype
+        np.int16 if all labels fit in it, or np.int32 otherwise
+      - offsets.npy, the start of the alignment of each utterance in
+        labels.npy, followed by the number of labels, of dtype np.int64
+      - cut_ids.npy, the sorted utterance IDs, encoded in UTF-8, of a
+        fixed-width bytes dtype
+      - info.json, containing the subsampling factor
+
+    The alignment of the i-th utterance in cut_ids.npy is
+    labels[offsets[i]:offsets[i+1]].
+
+    Args:
+      alignments:
+        A dict containing alignments. Keys of the dict are utterances and
+        values are the corresponding framewise alignments after subsampling.
+      subsampling_factor:
+        The subsampling factor of the model.
+      out_dir:
+        The directory to save the alignments.
+    Returns:
+      Return None.
+    """
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+
+    cut_ids = sorted(alignments.keys())
+    lengths = np.array([len(alignments[c]) for c in cut_ids], dtype=np.int64)
+    offsets = np.zeros(len(cut_ids) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+
+    max_label = max((max(a) for a in alignments.values() if len(a) > 0), default=0)
+    dtype = np.int16 if max_label <= np.iinfo(np.int16).max else np.int32
+
+    labels = np.lib.format.open_memmap(
+        out_dir / "labels.npy", mode="w+", dtype=dtype, shape=(int(offsets[-1]),)
+    )
+    for i, c in enumerate(cut_ids):
+        labels[offsets[i] : offsets[i + 1]] = alignments[c]
+    labels.flush()
+    del labels
+
+    np.save(out_dir / "offsets.npy", offsets)
+    np.save(
+        out_dir / "cut_ids.npy",
+        np.array([c.encode("utf-8") for c in cut_ids], dtype=bytes),
+    )
+    with open(out_dir / "info.json", "w") as f:
+        json.dump({"subsampling_factor": subsampling_factor}, f)
+
+
+def convert_alignments_to_store(
+    filename: Union[str, Path], out_dir: Union[str, Path]
+) -> None:
+    """Convert alignments saved by :func:`save_alignments` to the format of
+    :class:`AlignmentStore`.
+
+    Args:
+      filename:
+        The file saved by :func:`save_alignments`.
+      out_dir:
+        The directory to save the alignments, see
+        :func:`save_alignment_store`.
+    """
+    subsampling_factor, alignments = load_alignments(filename)
+    save_alignment_store(alignments, subsampling_factor, out_dir)
+    logging.info(f"Converted {len(alignments)} alignments to {out_dir}")
+
+
+class AlignmentStore(object):
+    """Alignments saved by :func:`save_alignment_store`.
+
+    The arrays are memory-mapped, so they are not loaded into memory and
+    they are shared by all processes using them, e.g., DDP ranks and
+    dataloader workers. Looking up a cut ID is a binary search in the
+    sorted cut IDs.
+
+    Usage::
+
+        ali = AlignmentStore("data/ali_500/train-960")
+        padded_ali, ali_lens = ali.lookup(cut_ids)
+    """
+
+    def __init__(self, store_dir: Union[str, Path]):
+        self.store_dir = Path(store_dir)
+        with open(self.store_dir / "info.json") as f:
+            self.subsampling_factor = json.load(f)["subsampling_factor"]
+        self._arrays = None
+
+    def _get_arrays(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        # Return a tuple (labels, offsets, cut_ids)
+        if self._arrays is None:
+            self._arrays = tuple(
+                np.load(self.store_dir / f"{name}.npy", mmap_mode="r")
+                for name in ["labels", "offsets", "cut_ids"]
+            )
+        return self._arrays
+
+    def __getstate__(self):
+        # Don't pickle the memory-mapped arrays, e.g., when it is sent to
+        # dataloader workers. Each process maps them again instead.
+        state = self.__dict__.copy()
+        state["_arrays"] = None
+        return state
+
+    def __len__(self) -> int:
+        return self._get_arrays()[2].shape[0]
+
+    def _find(self, cut_ids: List[str]) -> np.ndarray:
+        # Return the index of each cut ID in cut_ids.npy, or -1 if it
+        # does not exist.
+        sorted_ids = self._get_arrays()[2]
+        keys = np.array([c.encode("utf-8") for c in cut_ids], dtype=sorted_ids.dtype)
+        index = np.searchsorted(sorted_ids, keys)
+        found = index < sorted_ids.shape[0]
+        found[found] = sorted_ids[index[found]] == keys[found]
+        # Cut IDs longer than the longest saved one are truncated by
+        # the dtype, so they are not found.
+        found &= np.array([len(c.encode("utf-8")) for c in cut_ids]) <= keys.itemsize
+        return np.where(found, index, -1)
+
+    def __contains__(self, cut_id: str) -> bool:
+        return self._find([cut_id])[0] >= 0
+
+    def __getitem__(self, cut_id: str) -> torch.Tensor:
+        """Return the alignment of a cut as a 1-D torch.int64 tensor."""
+        padded_ali, _ = self.lookup([cut_id])
+        return padded_ali[0]
+
+    def lookup(
+        self, cut_ids: List[str], padding_value: int = 0
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Return the alignments of a list of cuts.
+
+        Args:
+          cut_ids:
+            A list of cut IDs. A KeyError is raised if any of them does not
+            have an alignment.
+          padding_value:
+            The value for padding the alignments.
+        Returns:
+          Return a tuple containing:
+            - A 2-D torch.int64 tensor of shape (N, T), containing the
+              padded alignments.
+            - A 1-D torch.int64 tensor of shape (N,), containing the
+              length of each alignment.
+        """
+        labels, offsets, _ = self._get_arrays()
+        index = self._find(cut_ids)
+        if np.any(index < 0):
+            raise KeyError(cut_ids[int(np.argmax(index < 0))])
+
+        starts = offsets[index]
+        lengths = offsets[index + 1] - starts
+        max_len = int(lengths.max()) if len(cut_ids) > 0 else 0
+
+        # Row and column in the padded alignments of each label
+        rows = np.repeat(np.arange(len(cut_ids)), lengths)
+        cols = np.arange(rows.shape[0]) - np.repeat(
+            np.cumsum(lengths) - lengths, lengths
+        )
+
+        padded_ali = np.full((len(cut_ids), max_len), padding_value, dtype=np.int64)
+        padded_ali[rows, cols] = labels[np.repeat(starts, lengths) + cols]
+        return torch.from_numpy(padded_ali), torch.from_numpy(lengths)
+
+
 def convert_alignments_to_tensor(
     alignments: Dict[str, List[int]], device: torch.device
 ) -> Dict[str, torch.Tensor]:
@@ -90,7 +270,7 @@ def convert_alignments_to_tensor(
 
 def lookup_alignments(
     cut_ids: List[str],
-    alignments: Dict[str, torch.Tensor],
+    alignments: Union[Dict[str, torch.Tensor], AlignmentStore],
     num_classes: int,
     log_score: float = -10,
 ) -> torch.Tensor:
@@ -122,7 +302,7 @@ def lookup_alignments(
         A list of utterance IDs.
       alignments:
         A dict containing alignments. The keys are utterance IDs and the values
-        are framewise alignments.
+        are framewise alignments. It can also be an :class:`AlignmentStore`.
       num_classes:
         The max token ID + 1 that appears in the alignments.
       log_score:
@@ -132,8 +312,11 @@ def lookup_alignments(
       Return a 3-D torch.float32 tensor of shape (N, T, C).
     """
     # We assume all utterances have their alignments.
-    ali = [alignments[cut_id] for cut_id in cut_ids]
-    padded_ali = pad_sequence(ali, batch_first=True, padding_value=0)
+    if isinstance(alignments, AlignmentStore):
+        padded_ali, _ = alignments.lookup(cut_ids, padding_value=0)
+    else:
+        ali = [alignments[cut_id] for cut_id in cut_ids]
+        padded_ali = pad_sequence(ali, batch_first=True, padding_value=0)
     padded_one_hot = torch.nn.functional.one_hot(
         padded_ali,
         num_classes=num_classes,
@@ -17,11 +17,14 @@
 
 
 import glob
+import inspect
 import logging
 import os
 import re
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
 from pathlib import Path
-from typing import Any, Dict, List, Optional, Union
+from typing import Any, Deque, Dict, List, Optional, Tuple, Union
 
 import torch
 import torch.nn as nn
@@ -46,6 +49,8 @@ def save_checkpoint(
     scaler: Optional[GradScaler] = None,
     sampler: Optional[CutSampler] = None,
     rank: int = 0,
+    save_model_only: bool = False,
+    saver: Optional["AsyncCheckpointSaver"] = None,
 ) -> None:
     """Save training information to a file.
 
@@ -66,6 +71,16 @@ def save_checkpoint(
         The GradScaler to be saved. We only save its `state_dict()`.
       rank:
         Used in DDP. We save checkpoint only for the node whose rank is 0.
+      save_model_only:
+        If True, also save the checkpoint without the optimizer, scheduler,
+        grad scaler and sampler states to :func:`model_only_filename`.
+        It is used by :func:`average_checkpoints` and
+        :func:`average_checkpoints_with_averaged_model`, which then read
+        much less data.
+      saver:
+        If not None, the checkpoint is written in the background by it,
+        see :class:`AsyncCheckpointSaver`. Otherwise, it is written before
+        this function returns.
     Returns:
       Return None.
     """
@@ -93,7 +108,197 @@ def save_checkpoint(
             assert k not in checkpoint
             checkpoint[k] = v
 
-    torch.save(checkpoint, filename)
+    if saver is not None:
+        saver.save(checkpoint, filename, save_model_only=save_model_only)
+    else:
+        _write_checkpoint(checkpoint, filename, save_model_only=save_model_only)
+
+
+def _atomic_save(obj: Any, filename: Path) -> None:
+    # Write to a temporary file first, so that there is never a partially
+    # written file with the given name, e.g., if training is killed
+    # while saving.
+    tmp_filename = filename.parent / f".{filename.name}.tmp"
+    torch.save(obj, tmp_filename)
+    os.replace(tmp_filename, filename)
+
+
+def _write_checkpoint(
+    checkpoint: Dict[str, Any], filename: Path, save_model_only: bool
+) -> None:
+    filename = Path(filename)
+    _atomic_save(checkpoint, filename)
+
+    if save_model_only:
+        model_only = model_only_filename(filename)
+        model_only.parent.mkdir(parents=True, exist_ok=True)
+        checkpoint = dict(checkpoint)
+        for k in ["optimizer", "scheduler", "grad_scaler", "sampler"]:
+            checkpoint.pop(k)
+        _atomic_save(checkpoint, model_only)
+
+
+def _snapshot(obj: Any) -> Any:
+    # Copy all tensors in obj to CPU, so that they can be written while
+    # training modifies the original ones. CUDA tensors are copied to
+    # pinned memory asynchronously, see AsyncCheckpointSaver.save().
+    if isinstance(obj, torch.Tensor):
+        if obj.is_cuda:
+            ans = torch.empty(
+                obj.shape, dtype=obj.dtype, layout=obj.layout, pin_memory=True
+            )
+            return ans.copy_(obj.detach(), non_blocking=True)
+        return obj.detach().clone()
+    elif isinstance(obj, dict):
+        return type(obj)((k, _snapshot(v)) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple)):
+        return type(obj)(_snapshot(v) for v in obj)
+    return obj
+
+
+class AsyncCheckpointSaver(object):
+    """Save checkpoints in a background thread, so that training is not
+    blocked by writing them.
+
+    The tensors of a checkpoint are first copied to CPU (pinned) memory,
+    which is fast, and the copy is then written by the background thread.
+    Each checkpoint is written to a temporary file, which is renamed once
+    it is complete.
+
+    Usage::
+
+        saver = AsyncCheckpointSaver(max_in_flight=1)
+        save_checkpoint(filename, model, ..., saver=saver)
+        # Continue training
+        ...
+        remove_checkpoints(out_dir, topk, saver=saver)
+        ...
+        saver.wait()  # Before exiting or using the checkpoint
+    """
+
+    def __init__(self, max_in_flight: int = 1):
+        """
+        Args:
+          max_in_flight:
+            The maximum number of checkpoints that are being written.
+            :meth:`save` waits until there are fewer, which limits the CPU
+            memory used by the copies of the checkpoints.
+        """
+        assert max_in_flight >= 1, max_in_flight
+        self.max_in_flight = max_in_flight
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._futures: Deque[Tuple[Path, Future]] = deque()
+
+    def save(
+        self,
+        checkpoint: Dict[str, Any],
+        filename: Path,
+        save_model_only: bool = False,
+    ) -> None:
+        """Write a checkpoint in the background.
+
+        Args:
+          checkpoint:
+            The checkpoint, see :func:`save_checkpoint`. Its tensors are
+            copied before this function returns.
+          filename:
+            The checkpoint filename.
+          save_model_only:
+            See :func:`save_checkpoint`.
+        """
+        while len(self._futures) >= self.max_in_flight:
+            self._wait_oldest()
+
+        checkpoint = _snapshot(checkpoint)
+        if torch.cuda.is_available():
+            # Wait for the copies to pinned memory
+            torch.cuda.synchronize()
+
+        future = self._executor.submit(
+            _write_checkpoint, checkpoint, filename, save_model_only
+        )
+        self._futures.append((Path(filename), future))
+
+    def in_flight(self) -> List[Path]:
+        """Return the filenames of the checkpoints that are being written."""
+        return [f for f, future in self._futures if not future.done()]
+
+    def _wait_oldest(self) -> None:
+        filename, future = self._futures.popleft()
+        # It re-raises the exception of the background thread, if any
+        future.result()
+        logging.info(f"Saved checkpoint to {filename}")
+
+    def wait(self) -> None:
+        """Wait until all checkpoints are written."""
+        while len(self._futures) > 0:
+            self._wait_oldest()
+
+
+def model_only_filename(filename: Union[str, Path]) -> Path:
+    """Return the filename of the model-only copy of a checkpoint, see
+    `save_model_only` in :func:`save_checkpoint`.
+
+    It is in a subdirectory, so that it is not found by
+    :func:`find_checkpoints`, e.g., exp/model-only/epoch-30.pt for
+    exp/epoch-30.pt.
+    """
+    filename = Path(filename)
+    return filename.parent / "model-only" / filename.name
+
+
+def load_checkpoint_lazily(filename: Union[str, Path]) -> Dict[str, Any]:
+    """Load a checkpoint saved by :func:`save_checkpoint` to CPU.
+
+    If its model-only copy exists and is not older than the checkpoint,
+    it is loaded instead. The tensors are memory-mapped if supported, so
+    only the tensors that are used are read from disk.
+
+    Args:
+      filename:
+        The checkpoint filename.
+    Returns:
+      Return the checkpoint. It may not contain the optimizer, scheduler,
+      grad scaler and sampler states.
+    """
+    filename = Path(filename)
+    model_only = model_only_filename(filename)
+    if model_only.is_file() and model_only.stat().st_mtime >= filename.stat().st_mtime:
+        filename = model_only
+
+    if "mmap" in inspect.signature(torch.load).parameters:
+        try:
+            return torch.load(str(filename), map_location="cpu", mmap=True)
+        except RuntimeError:
+            # Checkpoints saved with the legacy format cannot be
+            # memory-mapped
+            pass
+    return torch.load(filename, map_location="cpu")
+
+
+def _unique_names(state_dict: Dict[str, Tensor]) -> List[str]:
+    # Identify shared parameters. Two parameters are said to be shared
+    # if they have the same data_ptr. Return one name for each of them.
+    uniqued: Dict[int, str] = dict()
+    for k, v in state_dict.items():
+        v_data_ptr = v.data_ptr()
+        if v_data_ptr in uniqued:
+            continue
+        uniqued[v_data_ptr] = k
+    return list(uniqued.values())
+
+
+def _to_device(state_dict: Dict[str, Tensor], device: torch.device):
+    # Move a state dict to the given device. Shared parameters are still
+    # shared after moving.
+    moved: Dict[int, Tensor] = dict()
+    ans = dict()
+    for k, v in state_dict.items():
+        v_data_ptr = v.data_ptr()
+        if v_data_ptr not in moved:
+            moved[v_data_ptr] = v.to(device)
+        ans[k] = moved[v_data_ptr]
+    return ans
 
 
 def load_checkpoint(
@@ -147,48 +352,73 @@ def load_checkpoint(
 
 
 def average_checkpoints(
-    filenames: List[Path], device: torch.device = torch.device("cpu")
+    filenames: List[Path],
+    device: torch.device = torch.device("cpu"),
+    prefetch: bool = True,
 ) -> dict:
     """Average a list of checkpoints.
 
+    Only the model of each checkpoint is read, see
+    :func:`load_checkpoint_lazily`, and it is accumulated in float64
+    one tensor at a time, so only one checkpoint is in memory at a time.
+
     Args:
       filenames:
         Filenames of the checkpoints to be averaged. We assume all
         checkpoints are saved by :func:`save_checkpoint`.
       device:
         Move checkpoints to this device before averaging.
+      prefetch:
+        If True, load the next checkpoint in a background thread while
+        the current one is being accumulated.
     Returns:
       Return a dict (i.e., state_dict) which is the average of all
       model state dicts contained in the checkpoints.
     """
     n = len(filenames)
 
-    avg = torch.load(filenames[0], map_location=device)["model"]
-
-    # Identify shared parameters. Two parameters are said to be shared
-    # if they have the same data_ptr
-    uniqued: Dict[int, str] = dict()
-
-    for k, v in avg.items():
-        v_data_ptr = v.data_ptr()
-        if v_data_ptr in uniqued:
-            continue
-        uniqued[v_data_ptr] = k
-
-    uniqued_names = list(uniqued.values())
-
-    for i in range(1, n):
-        state_dict = torch.load(filenames[i], map_location=device)["model"]
-        for k in uniqued_names:
-            avg[k] += state_dict[k]
+    def load(filename):
+        return load_checkpoint_lazily(filename)["model"]
+
+    sums: Dict[str, Tensor] = dict()
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        future = executor.submit(load, filenames[0])
+        for i in range(n):
+            state_dict = future.result()
+            if prefetch and i + 1 < n:
+                future = executor.submit(load, filenames[i + 1])
+
+            if i == 0:
+                uniqued_names = _unique_names(state_dict)
+                uniqued = {state_dict[k].data_ptr(): k for k in uniqued_names}
+                # Map each name to the uniqued name of its parameter
+                shared = {k: uniqued[v.data_ptr()] for k, v in state_dict.items()}
+                dtypes = {k: state_dict[k].dtype for k in uniqued_names}
+
+            for k in uniqued_names:
+                v = state_dict[k].to(device)
+                if v.is_floating_point():
+                    v = v.to(torch.float64)
+                else:
+                    v = v.to(torch.int64)
+                if k in sums:
+                    sums[k] += v
+                else:
+                    sums[k] = v
+            del state_dict
+
+            if not prefetch and i + 1 < n:
+                future = executor.submit(load, filenames[i + 1])
 
     for k in uniqued_names:
-        if avg[k].is_floating_point():
-            avg[k] /= n
+        if sums[k].is_floating_point():
+            sums[k] /= n
         else:
-            avg[k] //= n
+            sums[k] //= n
+        sums[k] = sums[k].to(dtypes[k])
 
-    return avg
+    # Shared parameters share the averaged tensor
+    return {k: sums[u] for k, u in shared.items()}
 
 
 def save_checkpoint_with_global_batch_idx(
@@ -202,6 +432,8 @@ def save_checkpoint_with_global_batch_idx(
     scaler: Optional[GradScaler] = None,
     sampler: Optional[CutSampler] = None,
     rank: int = 0,
+    save_model_only: bool = False,
+    saver: Optional[AsyncCheckpointSaver] = None,
 ):
     """Save training info after processing given number of batches.
 
@@ -233,6 +465,10 @@ def save_checkpoint_with_global_batch_idx(
       rank:
         The rank ID used in DDP training of the current node. Set it to 0
         if DDP is not used.
+      save_model_only:
+        See :func:`save_checkpoint`.
+      saver:
+        See :func:`save_checkpoint`.
     """
     out_dir = Path(out_dir)
     out_dir.mkdir(parents=True, exist_ok=True)
@@ -247,6 +483,8 @@ def save_checkpoint_with_global_batch_idx(
         scaler=scaler,
         sampler=sampler,
         rank=rank,
+        save_model_only=save_model_only,
+        saver=saver,
     )
 
 
@@ -317,6 +555,7 @@ def remove_checkpoints(
     out_dir: Path,
     topk: int,
     rank: int = 0,
+    saver: Optional[AsyncCheckpointSaver] = None,
 ):
     """Remove checkpoints from the given directory.
 
@@ -333,6 +572,9 @@ def remove_checkpoints(
       rank:
         If using DDP for training, it is the rank of the current node.
         Use 0 if no DDP is used for training.
+      saver:
+        If not None, the checkpoints it is still writing are not removed,
+        see :class:`AsyncCheckpointSaver`.
     """
     assert topk >= 1, topk
     if rank != 0:
@@ -347,8 +589,14 @@ def remove_checkpoints(
         return
 
     to_remove = checkpoints[topk:]
+    if saver is not None:
+        in_flight = saver.in_flight()
+        to_remove = [c for c in to_remove if Path(c) not in in_flight]
     for c in to_remove:
         os.remove(c)
+        model_only = model_only_filename(c)
+        if model_only.is_file():
+            os.remove(model_only)
 
 
 def update_averaged_model(
@@ -421,8 +669,8 @@ def average_checkpoints_with_averaged_model(
       device:
         Move checkpoints to this device before averaging.
     """
-    state_dict_start = torch.load(filename_start, map_location=device)
-    state_dict_end = torch.load(filename_end, map_location=device)
+    state_dict_start = load_checkpoint_lazily(filename_start)
+    state_dict_end = load_checkpoint_lazily(filename_end)
 
     batch_idx_train_start = state_dict_start["batch_idx_train"]
     batch_idx_train_end = state_dict_end["batch_idx_train"]
@@ -431,8 +679,8 @@ def average_checkpoints_with_averaged_model(
     weight_end = batch_idx_train_end / interval
     weight_start = 1 - weight_end
 
-    model_end = state_dict_end["model_avg"]
-    model_start = state_dict_start["model_avg"]
+    model_end = _to_device(state_dict_end["model_avg"], device)
+    model_start = _to_device(state_dict_start["model_avg"], device)
     avg = model_end
 
     # scale the weight to avoid overflow
@@ -459,16 +707,7 @@ def average_state_dict(
       * scaling_factor
     It is an in-place operation on state_dict_1 itself.
     """
-    # Identify shared parameters. Two parameters are said to be shared
-    # if they have the same data_ptr
-    uniqued: Dict[int, str] = dict()
-    for k, v in state_dict_1.items():
-        v_data_ptr = v.data_ptr()
-        if v_data_ptr in uniqued:
-            continue
-        uniqued[v_data_ptr] = k
-
-    uniqued_names = list(uniqued.values())
+    uniqued_names = _unique_names(state_dict_1)
     for k in uniqued_names:
         v = state_dict_1[k]
         if torch.is_floating_point(v):
@@ -19,10 +19,29 @@ import shutil
 from collections import deque
 from typing import Dict, List, Optional, Tuple, Union
 
+import numpy as np
+
 
 class ContextState:
     """The state in ContextGraph"""
 
+    # There is one ContextState per trie node, so use __slots__ to save memory
+    # for large graphs.
+    __slots__ = (
+        "id",
+        "token",
+        "token_score",
+        "node_score",
+        "output_score",
+        "is_end",
+        "level",
+        "next",
+        "phrase",
+        "ac_threshold",
+        "fail",
+        "output",
+    )
+
     def __init__(
         self,
         id: int,
@@ -211,7 +230,6 @@ class ContextGraph:
             context_score = self.context_score if score == 0.0 else score
             threshold = self.ac_threshold if ac_threshold == 0.0 else ac_threshold
             for i, token in enumerate(tokens):
-                node_next = {}
                 if token not in node.next:
                     self.num_nodes += 1
                     is_end = i == len(tokens) - 1
@@ -322,6 +340,40 @@ class ContextGraph:
         )
         return (score + node.output_score, node, matched_node)
 
+    def forward_batch(
+        self,
+        states: List[ContextState],
+        tokens: List[int],
+        strict_mode: bool = True,
+    ) -> Tuple[List[float], List[ContextState], List[Optional[ContextState]]]:
+        """Call :meth:`forward_one_step` for each (state, token) pair.
+
+        It has the same interface as :meth:`CompiledContextGraph.forward_batch`,
+        so that decoding methods can search the graph once per frame for all
+        hypotheses no matter which kind of graph is used.
+
+        Returns:
+          Return a tuple of three lists: the boosting scores, the next states
+          and the matched states.
+        """
+        assert len(states) == len(tokens), (len(states), len(tokens))
+        scores = []
+        next_states = []
+        matched_states = []
+        for state, token in zip(states, tokens):
+            score, next_state, matched_state = self.forward_one_step(
+                state, token, strict_mode
+            )
+            scores.append(score)
+            next_states.append(next_state)
+            matched_states.append(matched_state)
+        return scores, next_states, matched_states
+
+    def compile(self) -> "CompiledContextGraph":
+        """Return an array-backed copy of this graph, see
+        :class:`CompiledContextGraph`. Call it after :meth:`build`."""
+        return CompiledContextGraph.from_context_graph(self)
+
     def is_matched(self, state: ContextState) -> Tuple[bool, ContextState]:
         """Whether current state matches any phrase (i.e. current state is the
         end state or the output of current state is not None.
@@ -480,6 +532,248 @@ class ContextGraph:
         return dot
 
 
+class CompiledContextGraph:
+    """A compact, array-backed version of :class:`ContextGraph`.
+
+    The trie is stored in flat numpy arrays indexed by node id (the root is 0):
+    the goto arcs of node `n` are `arc_tokens[arc_offsets[n]:arc_offsets[n+1]]`
+    (sorted) and the corresponding `arc_next`, while `fail`, `output` (-1 for
+    None) and the scores of each node are stored in per-node arrays.
+
+    A state of this graph is the node id, i.e., an int. It provides the same
+    search methods as :class:`ContextGraph` and a :meth:`forward_batch` to
+    search many (state, token) pairs in one vectorized call. Use
+    :meth:`ContextGraph.compile` to create it, :meth:`save` and :meth:`load`
+    to avoid building the graph again.
+    """
+
+    root = 0
+
+    def __init__(self, arrays: Dict[str, np.ndarray]):
+        """
+        Args:
+          arrays:
+            A dict containing the arrays described above. Use
+            :meth:`ContextGraph.compile` or :meth:`load` to get it.
+        """
+        self.arc_offsets = arrays["arc_offsets"]
+        self.arc_tokens = arrays["arc_tokens"]
+        self.arc_next = arrays["arc_next"]
+
+        self.fail = arrays["fail"]
+        self.output = arrays["output"]
+        self.token = arrays["token"]
+        self.token_score = arrays["token_score"]
+        self.node_score = arrays["node_score"]
+        self.output_score = arrays["output_score"]
+        self.is_end = arrays["is_end"]
+        self.level = arrays["level"]
+        self.ac_threshold = arrays["ac_threshold"]
+        self.phrase = arrays["phrase"]
+
+        self.num_nodes = self.fail.shape[0]
+
+        # Arcs are sorted by node and then by token, so arc_keys is sorted
+        # and goto arcs of many (node, token) pairs can be found with a
+        # single np.searchsorted().
+        self._token_stride = int(self.arc_tokens.max(initial=0)) + 1
+        arc_nodes = np.repeat(
+            np.arange(self.num_nodes, dtype=np.int64), np.diff(self.arc_offsets)
+        )
+        self._arc_keys = arc_nodes * self._token_stride + self.arc_tokens
+
+    @classmethod
+    def from_context_graph(cls, graph: "ContextGraph") -> "CompiledContextGraph":
+        """Flatten a built :class:`ContextGraph` into arrays."""
+        num_nodes = graph.num_nodes + 1
+        nodes: List[Optional[ContextState]] = [None] * num_nodes
+        queue = deque([graph.root])
+        while queue:
+            node = queue.popleft()
+            nodes[node.id] = node
+            queue.extend(node.next.values())
+
+        arc_offsets = np.zeros(num_nodes + 1, dtype=np.int64)
+        arc_tokens = []
+        arc_next = []
+        for node in nodes:
+            for token in sorted(node.next.keys()):
+                arc_tokens.append(token)
+                arc_next.append(node.next[token].id)
+            arc_offsets[node.id + 1] = len(arc_tokens)
+
+        arrays = {
+            "arc_offsets": arc_offsets,
+            "arc_tokens": np.array(arc_tokens, dtype=np.int64),
+            "arc_next": np.array(arc_next, dtype=np.int64),
+            "fail": np.array([n.fail.id for n in nodes], dtype=np.int64),
+            "output": np.array(
+                [-1 if n.output is None else n.output.id for n in nodes],
+                dtype=np.int64,
+            ),
+            "token": np.array([n.token for n in nodes], dtype=np.int64),
+            "token_score": np.array([n.token_score for n in nodes], dtype=np.float64),
+            "node_score": np.array([n.node_score for n in nodes], dtype=np.float64),
+            "output_score": np.array([n.output_score for n in nodes], dtype=np.float64),
+            "is_end": np.array([n.is_end for n in nodes], dtype=bool),
+            "level": np.array([n.level for n in nodes], dtype=np.int64),
+            "ac_threshold": np.array([n.ac_threshold for n in nodes], dtype=np.float64),
+            "phrase": np.array([n.phrase for n in nodes], dtype=str),
+        }
+        return cls(arrays)
+
+    def save(self, filename: str) -> None:
+        """Save the graph to a `.npz` file. Use :meth:`load` to read it back."""
+        np.savez(
+            filename,
+            arc_offsets=self.arc_offsets,
+            arc_tokens=self.arc_tokens,
+            arc_next=self.arc_next,
+            fail=self.fail,
+            output=self.output,
+            token=self.token,
+            token_score=self.token_score,
+            node_score=self.node_score,
+            output_score=self.output_score,
+            is_end=self.is_end,
+            level=self.level,
+            ac_threshold=self.ac_threshold,
+            phrase=self.phrase,
+        )
+
+    @classmethod
+    def load(cls, filename: str) -> "CompiledContextGraph":
+        """Load a graph written by :meth:`save`."""
+        with np.load(filename) as f:
+            arrays = {k: f[k] for k in f.files}
+        return cls(arrays)
+
+    def _goto(self, nodes: np.ndarray, tokens: np.ndarray) -> np.ndarray:
+        """Return the goto arc of each (node, token) pair, or -1 if it
+        does not exist."""
+        if self._arc_keys.shape[0] == 0:
+            return np.full(nodes.shape, -1, dtype=np.int64)
+        keys = nodes * self._token_stride + tokens
+        index = np.searchsorted(self._arc_keys, keys)
+        index = np.minimum(index, self._arc_keys.shape[0] - 1)
+        found = (tokens >= 0) & (tokens < self._token_stride)
+        found &= self._arc_keys[index] == keys
+        return np.where(found, self.arc_next[index], -1)
+
+    def forward_batch(
+        self,
+        states: Union[List[int], np.ndarray],
+        tokens: Union[List[int], np.ndarray],
+        strict_mode: bool = True,
+    ) -> Tuple[List[float], List[int], List[Optional[int]]]:
+        """Search the graph with many (state, token) pairs at once.
+
+        It is equivalent to calling :meth:`ContextGraph.forward_one_step` for
+        each pair, see there for the meaning of `strict_mode`. The fail arcs
+        of all pairs are followed together, so the number of numpy calls
+        is bounded by the depth of the graph.
+
+        Args:
+          states:
+            A 1-D array of states (node ids).
+          tokens:
+            A 1-D array of tokens, with the same length as `states`.
+          strict_mode:
+            See :meth:`ContextGraph.forward_one_step`.
+        Returns:
+          Return a tuple of three lists: the boosting scores, the next states
+          and the matched states (None if no phrase is matched).
+        """
+        states = np.asarray(states, dtype=np.int64)
+        tokens = np.asarray(tokens, dtype=np.int64)
+        assert states.shape == tokens.shape, (states.shape, tokens.shape)
+        if states.shape[0] == 0:
+            return [], [], []
+
+        direct = self._goto(states, tokens)
+
+        # For pairs without a direct arc, trace along the fail arcs until
+        # the token matches or the root is reached.
+        node = self.fail[states]
+        next_node = self._goto(node, tokens)
+        done = (direct >= 0) | (next_node >= 0) | (node == self.root)
+        while not done.all():
+            node = np.where(done, node, self.fail[node])
+            next_node = np.where(done, next_node, self._goto(node, tokens))
+            done |= (next_node >= 0) | (node == self.root)
+        node = np.where(next_node >= 0, next_node, node)
+
+        node = np.where(direct >= 0, direct, node)
+        score = np.where(
+            direct >= 0,
+            self.token_score[np.maximum(direct, 0)],
+            self.node_score[node] - self.node_score[states],
+        )
+
+        output = self.output[node]
+        is_end = self.is_end[node]
+        matched = np.where(is_end, node, output)
+
+        if strict_mode:
+            score = score + self.output_score[node]
+            next_state = node
+        else:
+            has_output = self.output_score[node] != 0
+            output_score = np.where(
+                is_end | (output < 0),
+                self.node_score[node],
+                self.node_score[np.maximum(output, 0)],
+            )
+            score = np.where(
+                has_output,
+                score + output_score - self.node_score[node],
+                score + self.output_score[node],
+            )
+            next_state = np.where(has_output, self.root, node)
+
+        return (
+            score.tolist(),
+            next_state.tolist(),
+            [None if m < 0 else m for m in matched.tolist()],
+        )
+
+    def forward_one_step(
+        self, state: int, token: int, strict_mode: bool = True
+    ) -> Tuple[float, int, Optional[int]]:
+        """Same as :meth:`ContextGraph.forward_one_step`, but states are
+        node ids."""
+        scores, next_states, matched = self.forward_batch([state], [token], strict_mode)
+        return scores[0], next_states[0], matched[0]
+
+    def get_state(self, state: int) -> ContextState:
+        """Return a :class:`ContextState` with the attributes of the given
+        node. Note: Its `next`, `fail` and `output` are not filled."""
+        return ContextState(
+            id=state,
+            token=int(self.token[state]),
+            token_score=float(self.token_score[state]),
+            node_score=float(self.node_score[state]),
+            output_score=float(self.output_score[state]),
+            is_end=bool(self.is_end[state]),
+            level=int(self.level[state]),
+            phrase=str(self.phrase[state]),
+            ac_threshold=float(self.ac_threshold[state]),
+        )
+
+    def is_matched(self, state: int) -> Tuple[bool, Optional[ContextState]]:
+        """Same as :meth:`ContextGraph.is_matched`. The matched state is
+        returned as a :class:`ContextState`, see :meth:`get_state`."""
+        if self.is_end[state]:
+            return True, self.get_state(state)
+        if self.output[state] >= 0:
+            return True, self.get_state(int(self.output[state]))
+        return False, None
+
+    def finalize(self, state: int) -> Tuple[float, int]:
+        """Same as :meth:`ContextGraph.finalize`."""
+        return (-float(self.node_score[state]), self.root)
+
+
 def _test(queries, score, strict_mode):
     contexts_str = [
         "S",
@@ -516,6 +810,10 @@ def _test(queries, score, strict_mode):
         symbol_table=symbol_table,
     )
 
+    compiled_graph = context_graph.compile()
+    compiled_graph.save(f"context_graph_{score}.npz")
+    compiled_graph = CompiledContextGraph.load(f"context_graph_{score}.npz")
+
     for query, expected_score in queries.items():
         total_scores = 0
         state = context_graph.root
@@ -533,6 +831,31 @@ def _test(queries, score, strict_mode):
             query,
         )
 
+    # The compiled graph searches all queries in one batch per token position
+    query_list = list(queries.keys())
+    total_scores = [0] * len(query_list)
+    states = [compiled_graph.root] * len(query_list)
+    for t in range(max(len(query) for query in query_list)):
+        indexes = [i for i, query in enumerate(query_list) if t < len(query)]
+        scores, next_states, _ = compiled_graph.forward_batch(
+            [states[i] for i in indexes],
+            [ord(query_list[i][t]) for i in indexes],
+            strict_mode,
+        )
+        for i, score, state in zip(indexes, scores, next_states):
+            total_scores[i] += score
+            states[i] = state
+
+    for query, total_score, state in zip(query_list, total_scores, states):
+        score, state = compiled_graph.finalize(state)
+        assert state == compiled_graph.root, state
+        total_score += score
+        assert round(total_score, 2) == queries[query], (
+            total_score,
+            queries[query],
+            query,
+        )
+
 
 if __name__ == "__main__":
     # test default score
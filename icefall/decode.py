@@ -15,11 +15,13 @@
 # limitations under the License.
 
 import logging
-from typing import Dict, List, Optional, Union
+from typing import Callable, Dict, List, Optional, Tuple, Union
 
 import k2
 import torch
 
+from icefall.context_graph import CompiledContextGraph, ContextGraph
+from icefall.ngram_lm import CompiledNgramLm, NgramLm, NgramLmStateCost
 from icefall.utils import add_eos, add_sos, get_texts
 
 DEFAULT_LM_SCALE = [
@@ -49,6 +51,14 @@ DEFAULT_LM_SCALE = [
     5.0,
 ]
 
+# The default memory budget of :func:`get_nbest_within_budget` and
+# :func:`rescore_with_whole_lattice`. See their documentation.
+DEFAULT_MAX_NUM_ARCS = 20000000
+
+# The default number of paths scored at a time by the attention decoder.
+# See :func:`compute_attention_scores`.
+DEFAULT_ATTENTION_BATCH_SIZE = 50
+
 
 def _intersect_device(
     a_fsas: k2.Fsa,
@@ -91,6 +101,204 @@ def _intersect_device(
     return k2.cat(ans)
 
 
+def _get_num_arcs_per_fsa(fsas: k2.Fsa) -> List[int]:
+    """Return the number of arcs of each FSA in an FsaVec."""
+    shape = fsas.arcs.shape()
+    arc_splits = shape.row_splits(2)[shape.row_splits(1).to(torch.int64)]
+    return (arc_splits[1:] - arc_splits[:-1]).tolist()
+
+
+def _split_by_cost(costs: List[int], max_cost: int) -> List[Tuple[int, int]]:
+    """Split a list into contiguous ranges [start, end) whose total cost
+    does not exceed `max_cost`. An item whose cost exceeds `max_cost` is
+    put into a range by itself.
+    """
+    ans = []
+    start = 0
+    tot_cost = 0
+    for i, cost in enumerate(costs):
+        if i > start and tot_cost + cost > max_cost:
+            ans.append((start, i))
+            start = i
+            tot_cost = 0
+        tot_cost += cost
+    if start < len(costs):
+        ans.append((start, len(costs)))
+    return ans
+
+
+def _index_fsa_range(fsas: k2.Fsa, start: int, end: int) -> k2.Fsa:
+    """Return the FSAs in the range [start, end) of an FsaVec."""
+    if start == 0 and end == fsas.shape[0]:
+        return fsas
+    indexes = torch.arange(start, end, dtype=torch.int32, device=fsas.device)
+    return k2.index_fsa(fsas, indexes)
+
+
+def compute_attention_scores(
+    nll_fn: Callable[[torch.Tensor, List[List[int]]], torch.Tensor],
+    path_to_utt_map: torch.Tensor,
+    token_ids: List[List[int]],
+    batch_size: int = DEFAULT_ATTENTION_BATCH_SIZE,
+) -> torch.Tensor:
+    """Compute the attention decoder score, i.e., the negated sum of the
+    nll, of each path, `batch_size` paths at a time.
+
+    Paths of the same utterance that have identical token IDs are scored
+    only once. The remaining paths are sorted by length so that the paths
+    in a batch have similar lengths, which reduces padding. Since
+    `nll_fn` expands the encoder output only for the paths of a batch,
+    the memory used does not grow with the total number of paths.
+
+    Args:
+      nll_fn:
+        A function that takes the utterance index of each path in a batch,
+        i.e., a 1-D torch.int64 tensor, and the token IDs of these paths.
+        It returns the nll of each token with shape (num_paths, num_tokens),
+        where padding positions are 0.
+      path_to_utt_map:
+        A 1-D tensor containing the utterance index of each path.
+      token_ids:
+        The token IDs of each path.
+      batch_size:
+        The maximum number of paths scored at a time.
+    Returns:
+      A 1-D tensor with shape (len(token_ids),) containing the score of
+      each path.
+    """
+    assert batch_size > 0, batch_size
+    assert path_to_utt_map.numel() == len(token_ids), (
+        path_to_utt_map.numel(),
+        len(token_ids),
+    )
+    utt_ids = path_to_utt_map.tolist()
+
+    # Map (utt, token_ids) to the index of its unique path
+    unique_indexes = dict()
+    path_to_unique = []
+    for utt, ids in zip(utt_ids, token_ids):
+        key = (utt, tuple(ids))
+        if key not in unique_indexes:
+            unique_indexes[key] = len(unique_indexes)
+        path_to_unique.append(unique_indexes[key])
+    unique_paths = list(unique_indexes.keys())
+
+    order = sorted(range(len(unique_paths)), key=lambda i: len(unique_paths[i][1]))
+
+    device = path_to_utt_map.device
+    scores = torch.empty(len(unique_paths), device=device)
+    for start in range(0, len(order), batch_size):
+        indexes = order[start : start + batch_size]
+        utts = torch.tensor(
+            [unique_paths[i][0] for i in indexes],
+            dtype=torch.int64,
+            device=device,
+        )
+        nll = nll_fn(utts, [list(unique_paths[i][1]) for i in indexes])
+        assert nll.ndim == 2, nll.shape
+        assert nll.shape[0] == len(indexes), (nll.shape, len(indexes))
+        scores[torch.tensor(indexes, device=device)] = -nll.sum(dim=1).to(scores.dtype)
+
+    return scores[torch.tensor(path_to_unique, dtype=torch.int64, device=device)]
+
+
+def get_best_path_indexes(
+    shape: k2.RaggedShape, tot_scores: torch.Tensor
+) -> torch.Tensor:
+    """Find the best path of each utterance for a grid of scales at once.
+
+    It is equivalent to calling `k2.RaggedTensor(shape, s).argmax()`
+    for each row `s` of `tot_scores`, but without a Python loop.
+
+    Args:
+      shape:
+        A ragged shape with axes [utt][path].
+      tot_scores:
+        A 2-D tensor of shape (num_scales, num_paths), e.g., the total
+        scores of the paths for each combination of scales.
+    Returns:
+      A torch.int32 tensor of shape (num_scales, num_utts) containing the
+      index of the best path of each utterance. It is -1 for utterances
+      that have no paths.
+    """
+    assert tot_scores.ndim == 2, tot_scores.shape
+    device = tot_scores.device
+    row_splits = shape.row_splits(1).to(device=device, dtype=torch.int64)
+    row_ids = shape.row_ids(1).to(device=device, dtype=torch.int64)
+    num_utts = row_splits.numel() - 1
+    num_paths = row_splits[1:] - row_splits[:-1]
+    max_num_paths = max(int(num_paths.max()), 1) if num_utts > 0 else 1
+
+    padded = torch.full(
+        (tot_scores.shape[0], num_utts, max_num_paths),
+        float("-inf"),
+        dtype=tot_scores.dtype,
+        device=device,
+    )
+    path_pos = torch.arange(row_ids.numel(), device=device) - row_splits[row_ids]
+    padded[:, row_ids, path_pos] = tot_scores
+
+    indexes = padded.argmax(dim=-1) + row_splits[:-1]
+    indexes = torch.where(num_paths > 0, indexes, -1)
+    return indexes.to(torch.int32)
+
+
+def _get_decoder_nll_fn(
+    model: torch.nn.Module,
+    memory: torch.Tensor,
+    memory_key_padding_mask: Optional[torch.Tensor],
+    sos_id: int,
+    eos_id: int,
+) -> Callable[[torch.Tensor, List[List[int]]], torch.Tensor]:
+    """Return the `nll_fn` of :func:`compute_attention_scores` for a
+    model with `decoder_nll()`, e.g., the class "Transformer" in
+    conformer_ctc/transformer.py.
+    """
+
+    def nll_fn(utts: torch.Tensor, token_ids: List[List[int]]) -> torch.Tensor:
+        # the shape of memory is (T, N, C), so we use axis=1 here
+        expanded_memory = memory.index_select(1, utts)
+        if memory_key_padding_mask is not None:
+            # The shape of memory_key_padding_mask is (N, T), so we
+            # use axis=0 here.
+            expanded_memory_key_padding_mask = memory_key_padding_mask.index_select(
+                0, utts
+            )
+        else:
+            expanded_memory_key_padding_mask = None
+
+        return model.decoder_nll(
+            memory=expanded_memory,
+            memory_key_padding_mask=expanded_memory_key_padding_mask,
+            token_ids=token_ids,
+            sos_id=sos_id,
+            eos_id=eos_id,
+        )
+
+    return nll_fn
+
+
+def _get_attention_decoder_nll_fn(
+    attention_decoder: torch.nn.Module,
+    encoder_out: torch.Tensor,
+    encoder_out_lens: torch.Tensor,
+) -> Callable[[torch.Tensor, List[List[int]]], torch.Tensor]:
+    """Return the `nll_fn` of :func:`compute_attention_scores` for an
+    attention decoder with `nll()`, e.g., the class "AttentionDecoderModel"
+    in zipformer/attention_decoder.py.
+    """
+
+    def nll_fn(utts: torch.Tensor, token_ids: List[List[int]]) -> torch.Tensor:
+        # the shape of encoder_out is (N, T, C), so we use axis=0 here
+        return attention_decoder.nll(
+            encoder_out=encoder_out.index_select(0, utts),
+            encoder_out_lens=encoder_out_lens.index_select(0, utts),
+            token_ids=token_ids,
+        )
+
+    return nll_fn
+
+
 def get_lattice(
     nnet_output: torch.Tensor,
     decoding_graph: k2.Fsa,
@@ -300,6 +508,32 @@ class Nbest(object):
         # `fsa` has only one extra attribute: aux_labels.
         return Nbest(fsa=fsa, shape=utt_to_path_shape)
 
+    @staticmethod
+    def cat(nbest_list: List["Nbest"]) -> "Nbest":
+        """Concatenate Nbest objects of different utterances.
+
+        Args:
+          nbest_list:
+            A list of Nbest objects. The utterances of the returned Nbest
+            are those of `nbest_list[0]`, followed by those of
+            `nbest_list[1]`, and so on.
+        Returns:
+          Return a new Nbest.
+        """
+        if len(nbest_list) == 1:
+            return nbest_list[0]
+
+        fsa = k2.cat([nbest.fsa for nbest in nbest_list])
+        row_splits = [torch.zeros(1, dtype=torch.int32)]
+        offset = 0
+        for nbest in nbest_list:
+            splits = nbest.shape.row_splits(1).cpu()
+            row_splits.append(splits[1:] + offset)
+            offset += splits[-1].item()
+        row_splits = torch.cat(row_splits).to(fsa.device)
+        shape = k2.ragged.create_ragged_shape2(row_splits, None, offset)
+        return Nbest(fsa=fsa, shape=shape)
+
     def intersect(self, lattice: k2.Fsa, use_double_scores=True) -> "Nbest":
         """Intersect this Nbest object with a lattice, get 1-best
         path from the resulting FsaVec, and return a new Nbest object.
@@ -448,6 +682,76 @@ class Nbest(object):
         return k2.levenshtein_graph(word_ids)
 
 
+def get_nbest_within_budget(
+    lattice: k2.Fsa,
+    num_paths: int,
+    max_num_arcs: int = DEFAULT_MAX_NUM_ARCS,
+    use_double_scores: bool = True,
+    nbest_scale: float = 1.0,
+) -> Nbest:
+    """Sample `num_paths` paths from each utterance of a lattice with
+    :meth:`Nbest.from_lattice` and attach scores to them with
+    :meth:`Nbest.intersect`, with memory bounded by `max_num_arcs`.
+
+    The memory used for an utterance is estimated up front as its number of
+    paths times the number of arcs of its lattice. The utterances are
+    processed in chunks whose estimates do not exceed `max_num_arcs`. If
+    the estimate of a single utterance exceeds it, fewer paths are sampled
+    for that utterance, which is logged.
+
+    Args:
+      lattice:
+        An FsaVec with axes [utt][state][arc]. See :meth:`Nbest.from_lattice`.
+      num_paths:
+        Number of paths to sample from each utterance.
+      max_num_arcs:
+        The memory budget, in number of paths times number of arcs of the
+        lattice.
+      use_double_scores:
+        See :meth:`Nbest.from_lattice`.
+      nbest_scale:
+        See :meth:`Nbest.from_lattice`.
+    Returns:
+      Return an Nbest with scores set, like :meth:`Nbest.intersect`.
+    """
+    num_arcs = _get_num_arcs_per_fsa(lattice)
+    # Number of paths to sample for each utterance
+    utt_num_paths = [
+        max(1, min(num_paths, max_num_arcs // max(n, 1))) for n in num_arcs
+    ]
+    for i, (n, p) in enumerate(zip(num_arcs, utt_num_paths)):
+        if p < num_paths:
+            logging.info(
+                f"Utterance {i} has {n} arcs. Use {p} paths instead of "
+                f"{num_paths} for it to fit max_num_arcs={max_num_arcs}"
+            )
+
+    # Utterances in a chunk share the same number of paths, since
+    # k2.random_paths() samples the same number of paths for each FSA.
+    costs = [n * p for n, p in zip(num_arcs, utt_num_paths)]
+    chunks = []
+    start = 0
+    for i in range(1, len(costs) + 1):
+        if i == len(costs) or utt_num_paths[i] != utt_num_paths[start]:
+            for s, e in _split_by_cost(costs[start:i], max_num_arcs):
+                chunks.append((start + s, start + e))
+            start = i
+
+    nbest_list = []
+    for start, end in chunks:
+        sub_lattice = _index_fsa_range(lattice, start, end)
+        nbest = Nbest.from_lattice(
+            lattice=sub_lattice,
+            num_paths=utt_num_paths[start],
+            use_double_scores=use_double_scores,
+            nbest_scale=nbest_scale,
+        )
+        # nbest.fsa.scores are all 0s at this point
+        nbest_list.append(nbest.intersect(sub_lattice))
+
+    return Nbest.cat(nbest_list)
+
+
 def one_best_decoding(
     lattice: k2.Fsa,
     use_double_scores: bool = True,
@@ -631,6 +935,7 @@ def rescore_with_n_best_list(
     lm_scale_list: List[float],
     nbest_scale: float = 1.0,
     use_double_scores: bool = True,
+    max_num_arcs: int = DEFAULT_MAX_NUM_ARCS,
 ) -> Dict[str, k2.Fsa]:
     """Rescore an n-best list with an n-gram LM.
     The path with the maximum score is used as the decoding output.
@@ -652,6 +957,9 @@ def rescore_with_n_best_list(
       use_double_scores:
         True to use double precision during computation. False to use
         single precision.
+      max_num_arcs:
+        The memory budget for extracting the paths, see
+        :func:`get_nbest_within_budget`.
     Returns:
       A dict of FsaVec, whose key is an lm_scale and the value is the
       best decoding path for each utterance in the lattice.
@@ -666,34 +974,13 @@ def rescore_with_n_best_list(
     assert G.device == device
     assert hasattr(G, "aux_labels") is False
 
-    max_loop_count = 10
-    loop_count = 0
-    while loop_count <= max_loop_count:
-        try:
-            nbest = Nbest.from_lattice(
-                lattice=lattice,
-                num_paths=num_paths,
-                use_double_scores=use_double_scores,
-                nbest_scale=nbest_scale,
-            )
-            # nbest.fsa.scores are all 0s at this point
-            nbest = nbest.intersect(lattice)
-            break
-        except RuntimeError as e:
-            logging.info(f"Caught exception:\n{e}\n")
-            logging.info(f"num_paths before decreasing: {num_paths}")
-            num_paths = int(num_paths / 2)
-            if loop_count >= max_loop_count or num_paths <= 0:
-                logging.info("Return None as the resulting lattice is too large.")
-                return None
-            logging.info(
-                "This OOM is not an error. You can ignore it. "
-                "If your model does not converge well, or --max-duration "
-                "is too large, or the input sound file is difficult to "
-                "decode, you will meet this exception."
-            )
-            logging.info(f"num_paths after decreasing: {num_paths}")
-        loop_count += 1
+    nbest = get_nbest_within_budget(
+        lattice=lattice,
+        num_paths=num_paths,
+        max_num_arcs=max_num_arcs,
+        use_double_scores=use_double_scores,
+        nbest_scale=nbest_scale,
+    )
 
     # Now nbest.fsa has its scores set
     assert hasattr(nbest.fsa, "lm_scores")
@@ -821,6 +1108,7 @@ def rescore_with_whole_lattice(
     G_with_epsilon_loops: k2.Fsa,
     lm_scale_list: Optional[List[float]] = None,
     use_double_scores: bool = True,
+    max_num_arcs: int = DEFAULT_MAX_NUM_ARCS,
 ) -> Union[k2.Fsa, Dict[str, k2.Fsa]]:
     """Intersect the lattice with an n-gram LM and use shortest path
     to decode.
@@ -847,6 +1135,11 @@ def rescore_with_whole_lattice(
       use_double_scores:
         True to use double precision in the computation.
         False to use single precision.
+      max_num_arcs:
+        The memory budget, in number of arcs of the lattice. The
+        utterances are intersected with `G_with_epsilon_loops` in chunks
+        with at most this number of arcs. If an utterance has more arcs,
+        the lattice is pruned first.
     Returns:
       If `lm_scale_list` is None, return a new lattice which is the intersection
       result of `lattice` and `G_with_epsilon_loops`.
@@ -869,45 +1162,37 @@ def rescore_with_whole_lattice(
     # inv_lattice has word IDs as labels.
     # Its `aux_labels` is token IDs
     inv_lattice = k2.invert(lattice)
-    num_seqs = lattice.shape[0]
-
-    b_to_a_map = torch.zeros(num_seqs, device=device, dtype=torch.int32)
 
-    # NOTE: The choice of the threshold list is arbitrary here to avoid OOM.
+    # NOTE: The choice of the threshold list is arbitrary here.
     # You may need to fine tune it.
     prune_th_list = [1e-10, 1e-9, 1e-8, 1e-7, 1e-6]
     prune_th_list += [1e-5, 1e-4, 1e-3, 1e-2, 1e-1]
-    max_loop_count = 10
-    loop_count = 0
-    while loop_count <= max_loop_count:
-        try:
-            rescoring_lattice = k2.intersect_device(
-                G_with_epsilon_loops,
-                inv_lattice,
-                b_to_a_map,
-                sorted_match_a=True,
-            )
-            rescoring_lattice = k2.top_sort(k2.connect(rescoring_lattice))
+    num_arcs = _get_num_arcs_per_fsa(inv_lattice)
+    for prune_th in prune_th_list:
+        if max(num_arcs) <= max_num_arcs:
             break
-        except RuntimeError as e:
-            logging.info(f"Caught exception:\n{e}\n")
-            if loop_count >= max_loop_count:
-                logging.info("Return None as the resulting lattice is too large.")
-                return None
-            logging.info(f"num_arcs before pruning: {inv_lattice.arcs.num_elements()}")
-            logging.info(
-                "This OOM is not an error. You can ignore it. "
-                "If your model does not converge well, or --max-duration "
-                "is too large, or the input sound file is difficult to "
-                "decode, you will meet this exception."
-            )
-            inv_lattice = k2.prune_on_arc_post(
-                inv_lattice,
-                prune_th_list[loop_count],
-                True,
-            )
-            logging.info(f"num_arcs after pruning: {inv_lattice.arcs.num_elements()}")
-        loop_count += 1
+        logging.info(
+            f"num_arcs before pruning: {sum(num_arcs)}, "
+            f"max num_arcs of an utterance: {max(num_arcs)}"
+        )
+        inv_lattice = k2.prune_on_arc_post(inv_lattice, prune_th, True)
+        num_arcs = _get_num_arcs_per_fsa(inv_lattice)
+        logging.info(f"num_arcs after pruning with {prune_th}: {sum(num_arcs)}")
+
+    rescoring_lattice = []
+    for start, end in _split_by_cost(num_arcs, max_num_arcs):
+        b_to_a_map = torch.zeros(end - start, device=device, dtype=torch.int32)
+        lat = k2.intersect_device(
+            G_with_epsilon_loops,
+            _index_fsa_range(inv_lattice, start, end),
+            b_to_a_map,
+            sorted_match_a=True,
+        )
+        rescoring_lattice.append(k2.top_sort(k2.connect(lat)))
+    if len(rescoring_lattice) == 1:
+        rescoring_lattice = rescoring_lattice[0]
+    else:
+        rescoring_lattice = k2.cat(rescoring_lattice)
 
     # lat has token IDs as labels
     # and word IDs as aux_labels.
@@ -940,6 +1225,8 @@ def rescore_with_attention_decoder(
     ngram_lm_scale: Optional[float] = None,
     attention_scale: Optional[float] = None,
     use_double_scores: bool = True,
+    max_num_arcs: int = DEFAULT_MAX_NUM_ARCS,
+    batch_size: int = DEFAULT_ATTENTION_BATCH_SIZE,
 ) -> Dict[str, k2.Fsa]:
     """This function extracts `num_paths` paths from the given lattice and uses
     an attention decoder to rescore them. The path with the highest score is
@@ -970,39 +1257,24 @@ def rescore_with_attention_decoder(
         Optional. It specifies the scale for n-gram LM scores.
       attention_scale:
         Optional. It specifies the scale for attention decoder scores.
+      max_num_arcs:
+        The memory budget for extracting the paths, see
+        :func:`get_nbest_within_budget`.
+      batch_size:
+        The maximum number of paths scored by the attention decoder at a
+        time, see :func:`compute_attention_scores`.
     Returns:
       A dict of FsaVec, whose key contains a string
       ngram_lm_scale_attention_scale and the value is the
       best decoding path for each utterance in the lattice.
     """
-    max_loop_count = 10
-    loop_count = 0
-    while loop_count <= max_loop_count:
-        try:
-            nbest = Nbest.from_lattice(
-                lattice=lattice,
-                num_paths=num_paths,
-                use_double_scores=use_double_scores,
-                nbest_scale=nbest_scale,
-            )
-            # nbest.fsa.scores are all 0s at this point
-            nbest = nbest.intersect(lattice)
-            break
-        except RuntimeError as e:
-            logging.info(f"Caught exception:\n{e}\n")
-            logging.info(f"num_paths before decreasing: {num_paths}")
-            num_paths = int(num_paths / 2)
-            if loop_count >= max_loop_count or num_paths <= 0:
-                logging.info("Return None as the resulting lattice is too large.")
-                return None
-            logging.info(
-                "This OOM is not an error. You can ignore it. "
-                "If your model does not converge well, or --max-duration "
-                "is too large, or the input sound file is difficult to "
-                "decode, you will meet this exception."
-            )
-            logging.info(f"num_paths after decreasing: {num_paths}")
-        loop_count += 1
+    nbest = get_nbest_within_budget(
+        lattice=lattice,
+        num_paths=num_paths,
+        max_num_arcs=max_num_arcs,
+        use_double_scores=use_double_scores,
+        nbest_scale=nbest_scale,
+    )
 
     # Now nbest.fsa has its scores set.
     # Also, nbest.fsa inherits the attributes from `lattice`.
@@ -1016,17 +1288,6 @@ def rescore_with_attention_decoder(
     assert isinstance(nbest.fsa.tokens, torch.Tensor)
 
     path_to_utt_map = nbest.shape.row_ids(1).to(torch.long)
-    # the shape of memory is (T, N, C), so we use axis=1 here
-    expanded_memory = memory.index_select(1, path_to_utt_map)
-
-    if memory_key_padding_mask is not None:
-        # The shape of memory_key_padding_mask is (N, T), so we
-        # use axis=0 here.
-        expanded_memory_key_padding_mask = memory_key_padding_mask.index_select(
-            0, path_to_utt_map
-        )
-    else:
-        expanded_memory_key_padding_mask = None
 
     # remove axis corresponding to states.
     tokens_shape = nbest.fsa.arcs.shape().remove_axis(1)
@@ -1038,17 +1299,14 @@ def rescore_with_attention_decoder(
         print("Warning: rescore_with_attention_decoder(): empty token-ids")
         return None
 
-    nll = model.decoder_nll(
-        memory=expanded_memory,
-        memory_key_padding_mask=expanded_memory_key_padding_mask,
+    attention_scores = compute_attention_scores(
+        nll_fn=_get_decoder_nll_fn(
+            model, memory, memory_key_padding_mask, sos_id, eos_id
+        ),
+        path_to_utt_map=path_to_utt_map,
         token_ids=token_ids,
-        sos_id=sos_id,
-        eos_id=eos_id,
+        batch_size=batch_size,
     )
-    assert nll.ndim == 2
-    assert nll.shape[0] == len(token_ids)
-
-    attention_scores = -nll.sum(dim=1)
 
     if ngram_lm_scale is None:
         ngram_lm_scale_list = [0.01, 0.05, 0.08]
@@ -1066,17 +1324,21 @@ def rescore_with_attention_decoder(
     else:
         attention_scale_list = [attention_scale]
 
+    # Sweep all attention scales at once for each n-gram LM scale
+    am_scores = am_scores.values
+    a_scales = torch.tensor(
+        attention_scale_list, dtype=am_scores.dtype, device=am_scores.device
+    )
+    scaled_attention_scores = a_scales[:, None] * attention_scores.to(am_scores.dtype)
+
     ans = dict()
     for n_scale in ngram_lm_scale_list:
-        for a_scale in attention_scale_list:
-            tot_scores = (
-                am_scores.values
-                + n_scale * ngram_lm_scores.values
-                + a_scale * attention_scores
-            )
-            ragged_tot_scores = k2.RaggedTensor(nbest.shape, tot_scores)
-            max_indexes = ragged_tot_scores.argmax()
-            best_path = k2.index_fsa(nbest.fsa, max_indexes)
+        tot_scores = (
+            am_scores + n_scale * ngram_lm_scores.values + scaled_attention_scores
+        )
+        max_indexes = get_best_path_indexes(nbest.shape, tot_scores)
+        for a_scale, indexes in zip(attention_scale_list, max_indexes):
+            best_path = k2.index_fsa(nbest.fsa, indexes)
 
             key = f"ngram_lm_scale_{n_scale}_attention_scale_{a_scale}"
             ans[key] = best_path
@@ -1093,6 +1355,8 @@ def rescore_with_attention_decoder_with_ngram(
     ngram_lm_scale: Optional[float] = None,
     attention_scale: Optional[float] = None,
     use_double_scores: bool = True,
+    max_num_arcs: int = DEFAULT_MAX_NUM_ARCS,
+    batch_size: int = DEFAULT_ATTENTION_BATCH_SIZE,
 ) -> Dict[str, k2.Fsa]:
     """This function extracts `num_paths` paths from the given lattice and uses
     an attention decoder to rescore them. The path with the highest score is
@@ -1119,39 +1383,24 @@ def rescore_with_attention_decoder_with_ngram(
         Optional. It specifies the scale for n-gram LM scores.
       attention_scale:
         Optional. It specifies the scale for attention decoder scores.
+      max_num_arcs:
+        The memory budget for extracting the paths, see
+        :func:`get_nbest_within_budget`.
+      batch_size:
+        The maximum number of paths scored by the attention decoder at a
+        time, see :func:`compute_attention_scores`.
     Returns:
       A dict of FsaVec, whose key contains a string
       ngram_lm_scale_attention_scale and the value is the
       best decoding path for each utterance in the lattice.
     """
-    max_loop_count = 10
-    loop_count = 0
-    while loop_count <= max_loop_count:
-        try:
-            nbest = Nbest.from_lattice(
-                lattice=lattice,
-                num_paths=num_paths,
-                use_double_scores=use_double_scores,
-                nbest_scale=nbest_scale,
-            )
-            # nbest.fsa.scores are all 0s at this point
-            nbest = nbest.intersect(lattice)
-            break
-        except RuntimeError as e:
-            logging.info(f"Caught exception:\n{e}\n")
-            logging.info(f"num_paths before decreasing: {num_paths}")
-            num_paths = int(num_paths / 2)
-            if loop_count >= max_loop_count or num_paths <= 0:
-                logging.info("Return None as the resulting lattice is too large.")
-                return None
-            logging.info(
-                "This OOM is not an error. You can ignore it. "
-                "If your model does not converge well, or --max-duration "
-                "is too large, or the input sound file is difficult to "
-                "decode, you will meet this exception."
-            )
-            logging.info(f"num_paths after decreasing: {num_paths}")
-        loop_count += 1
+    nbest = get_nbest_within_budget(
+        lattice=lattice,
+        num_paths=num_paths,
+        max_num_arcs=max_num_arcs,
+        use_double_scores=use_double_scores,
+        nbest_scale=nbest_scale,
+    )
 
     # Now nbest.fsa has its scores set.
     # Also, nbest.fsa inherits the attributes from `lattice`.
@@ -1165,9 +1414,6 @@ def rescore_with_attention_decoder_with_ngram(
     assert isinstance(nbest.fsa.tokens, torch.Tensor)
 
     path_to_utt_map = nbest.shape.row_ids(1).to(torch.long)
-    # the shape of memory is (T, N, C), so we use axis=1 here
-    expanded_encoder_out = encoder_out.index_select(0, path_to_utt_map)
-    expanded_encoder_out_lens = encoder_out_lens.index_select(0, path_to_utt_map)
 
     # remove axis corresponding to states.
     tokens_shape = nbest.fsa.arcs.shape().remove_axis(1)
@@ -1175,15 +1421,14 @@ def rescore_with_attention_decoder_with_ngram(
     tokens = tokens.remove_values_leq(0)
     token_ids = tokens.tolist()
 
-    nll = attention_decoder.nll(
-        encoder_out=expanded_encoder_out,
-        encoder_out_lens=expanded_encoder_out_lens,
+    attention_scores = compute_attention_scores(
+        nll_fn=_get_attention_decoder_nll_fn(
+            attention_decoder, encoder_out, encoder_out_lens
+        ),
+        path_to_utt_map=path_to_utt_map,
         token_ids=token_ids,
+        batch_size=batch_size,
     )
-    assert nll.ndim == 2
-    assert nll.shape[0] == len(token_ids)
-
-    attention_scores = -nll.sum(dim=1)
 
     if ngram_lm_scale is None:
         ngram_lm_scale_list = [0.01, 0.05, 0.08]
@@ -1201,17 +1446,21 @@ def rescore_with_attention_decoder_with_ngram(
     else:
         attention_scale_list = [attention_scale]
 
+    # Sweep all attention scales at once for each n-gram LM scale
+    am_scores = am_scores.values
+    a_scales = torch.tensor(
+        attention_scale_list, dtype=am_scores.dtype, device=am_scores.device
+    )
+    scaled_attention_scores = a_scales[:, None] * attention_scores.to(am_scores.dtype)
+
     ans = dict()
     for n_scale in ngram_lm_scale_list:
-        for a_scale in attention_scale_list:
-            tot_scores = (
-                am_scores.values
-                + n_scale * ngram_lm_scores.values
-                + a_scale * attention_scores
-            )
-            ragged_tot_scores = k2.RaggedTensor(nbest.shape, tot_scores)
-            max_indexes = ragged_tot_scores.argmax()
-            best_path = k2.index_fsa(nbest.fsa, max_indexes)
+        tot_scores = (
+            am_scores + n_scale * ngram_lm_scores.values + scaled_attention_scores
+        )
+        max_indexes = get_best_path_indexes(nbest.shape, tot_scores)
+        for a_scale, indexes in zip(attention_scale_list, max_indexes):
+            best_path = k2.index_fsa(nbest.fsa, indexes)
 
             key = f"ngram_lm_scale_{n_scale}_attention_scale_{a_scale}"
             ans[key] = best_path
@@ -1227,6 +1476,7 @@ def rescore_with_attention_decoder_no_ngram(
     nbest_scale: float = 1.0,
     attention_scale: Optional[float] = None,
     use_double_scores: bool = True,
+    batch_size: int = DEFAULT_ATTENTION_BATCH_SIZE,
 ) -> Dict[str, k2.Fsa]:
     """This function extracts `num_paths` paths from the given lattice and uses
     an attention decoder to rescore them. The path with the highest score is
@@ -1251,6 +1501,9 @@ def rescore_with_attention_decoder_no_ngram(
         leads to more unique paths at the risk of missing the correct path.
       attention_scale:
         Optional. It specifies the scale for attention decoder scores.
+      batch_size:
+        The maximum number of paths scored by the attention decoder at a
+        time, see :func:`compute_attention_scores`.
 
     Returns:
       A dict of FsaVec, whose key contains a string
@@ -1277,21 +1530,19 @@ def rescore_with_attention_decoder_no_ngram(
     scores = k2.RaggedTensor(utt_to_path_shape, scores.sum())
 
     path_to_utt_map = utt_to_path_shape.row_ids(1).to(torch.long)
-    # the shape of memory is (N, T, C), so we use axis=0 here
-    expanded_encoder_out = encoder_out.index_select(0, path_to_utt_map)
-    expanded_encoder_out_lens = encoder_out_lens.index_select(0, path_to_utt_map)
 
     token_ids = aux_labels.remove_values_leq(0).tolist()
 
-    nll = attention_decoder.nll(
-        encoder_out=expanded_encoder_out,
-        encoder_out_lens=expanded_encoder_out_lens,
+    # Random paths of an utterance often have the same tokens. They are
+    # scored only once.
+    attention_scores = compute_attention_scores(
+        nll_fn=_get_attention_decoder_nll_fn(
+            attention_decoder, encoder_out, encoder_out_lens
+        ),
+        path_to_utt_map=path_to_utt_map,
         token_ids=token_ids,
+        batch_size=batch_size,
     )
-    assert nll.ndim == 2
-    assert nll.shape[0] == len(token_ids)
-
-    attention_scores = -nll.sum(dim=1)
 
     if attention_scale is None:
         attention_scale_list = [0.01, 0.05, 0.08]
@@ -1302,13 +1553,18 @@ def rescore_with_attention_decoder_no_ngram(
     else:
         attention_scale_list = [attention_scale]
 
+    a_scales = torch.tensor(
+        attention_scale_list, dtype=scores.values.dtype, device=scores.device
+    )
+    tot_scores = scores.values + a_scales[:, None] * attention_scores.to(
+        scores.values.dtype
+    )
+    max_indexes = get_best_path_indexes(utt_to_path_shape, tot_scores)
+
     ans = dict()
 
-    for a_scale in attention_scale_list:
-        tot_scores = scores.values + a_scale * attention_scores
-        ragged_tot_scores = k2.RaggedTensor(utt_to_path_shape, tot_scores)
-        max_indexes = ragged_tot_scores.argmax()
-        best_path = k2.index_fsa(fsa, max_indexes)
+    for a_scale, indexes in zip(attention_scale_list, max_indexes):
+        best_path = k2.index_fsa(fsa, indexes)
 
         key = f"attention_scale_{a_scale}"
         ans[key] = best_path
@@ -1330,6 +1586,7 @@ def rescore_with_rnn_lm(
     attention_scale: Optional[float] = None,
     rnn_lm_scale: Optional[float] = None,
     use_double_scores: bool = True,
+    batch_size: int = DEFAULT_ATTENTION_BATCH_SIZE,
 ) -> Dict[str, k2.Fsa]:
     """This function extracts `num_paths` paths from the given lattice and uses
     an attention decoder to rescore them. The path with the highest score is
@@ -1364,6 +1621,9 @@ def rescore_with_rnn_lm(
         Optional. It specifies the scale for attention decoder scores.
       rnn_lm_scale:
         Optional. It specifies the scale for RNN LM scores.
+      batch_size:
+        The maximum number of paths scored by the attention decoder at a
+        time, see :func:`compute_attention_scores`.
     Returns:
       A dict of FsaVec, whose key contains a string
       ngram_lm_scale_attention_scale and the value is the
@@ -1390,17 +1650,6 @@ def rescore_with_rnn_lm(
     assert isinstance(nbest.fsa.tokens, torch.Tensor)
 
     path_to_utt_map = nbest.shape.row_ids(1).to(torch.long)
-    # the shape of memory is (T, N, C), so we use axis=1 here
-    expanded_memory = memory.index_select(1, path_to_utt_map)
-
-    if memory_key_padding_mask is not None:
-        # The shape of memory_key_padding_mask is (N, T), so we
-        # use axis=0 here.
-        expanded_memory_key_padding_mask = memory_key_padding_mask.index_select(
-            0, path_to_utt_map
-        )
-    else:
-        expanded_memory_key_padding_mask = None
 
     # remove axis corresponding to states.
     tokens_shape = nbest.fsa.arcs.shape().remove_axis(1)
@@ -1412,17 +1661,14 @@ def rescore_with_rnn_lm(
         print("Warning: rescore_with_attention_decoder(): empty token-ids")
         return None
 
-    nll = model.decoder_nll(
-        memory=expanded_memory,
-        memory_key_padding_mask=expanded_memory_key_padding_mask,
+    attention_scores = compute_attention_scores(
+        nll_fn=_get_decoder_nll_fn(
+            model, memory, memory_key_padding_mask, sos_id, eos_id
+        ),
+        path_to_utt_map=path_to_utt_map,
         token_ids=token_ids,
-        sos_id=sos_id,
-        eos_id=eos_id,
+        batch_size=batch_size,
     )
-    assert nll.ndim == 2
-    assert nll.shape[0] == len(token_ids)
-
-    attention_scores = -nll.sum(dim=1)
 
     # Now for RNN LM
     sos_tokens = add_sos(tokens, sos_id)
@@ -1456,19 +1702,30 @@ def rescore_with_rnn_lm(
     if rnn_lm_scale:
         rnn_lm_scale_list = [rnn_lm_scale]
 
+    # Sweep all attention and RNN LM scales at once for each n-gram LM scale.
+    # other_scores has shape (len(attention_scale_list), len(rnn_lm_scale_list),
+    # num_paths)
+    am_scores = am_scores.values
+    a_scales = torch.tensor(
+        attention_scale_list, dtype=am_scores.dtype, device=am_scores.device
+    )
+    r_scales = torch.tensor(
+        rnn_lm_scale_list, dtype=am_scores.dtype, device=am_scores.device
+    )
+    other_scores = (
+        a_scales[:, None, None] * attention_scores.to(am_scores.dtype)
+        + r_scales[None, :, None] * rnn_lm_scores.to(am_scores.dtype)
+    ).reshape(-1, am_scores.numel())
+
     ans = dict()
     for n_scale in ngram_lm_scale_list:
+        tot_scores = am_scores + n_scale * ngram_lm_scores.values + other_scores
+        max_indexes = get_best_path_indexes(nbest.shape, tot_scores)
+        i = 0
         for a_scale in attention_scale_list:
             for r_scale in rnn_lm_scale_list:
-                tot_scores = (
-                    am_scores.values
-                    + n_scale * ngram_lm_scores.values
-                    + a_scale * attention_scores
-                    + r_scale * rnn_lm_scores
-                )
-                ragged_tot_scores = k2.RaggedTensor(nbest.shape, tot_scores)
-                max_indexes = ragged_tot_scores.argmax()
-                best_path = k2.index_fsa(nbest.fsa, max_indexes)
+                best_path = k2.index_fsa(nbest.fsa, max_indexes[i])
+                i += 1
 
                 key = f"ngram_lm_scale_{n_scale}_attention_scale_{a_scale}_rnn_lm_scale_{r_scale}"  # noqa
                 ans[key] = best_path
@@ -1482,18 +1739,354 @@ def ctc_greedy_search(
 ) -> List[List[int]]:
     """CTC greedy search.
 
+    All utterances of the batch are processed with a few tensor operations;
+    only the final split into per-utterance lists is done in Python.
+
     Args:
          ctc_output: (batch, seq_len, vocab_size)
          encoder_out_lens: (batch,)
     Returns:
          List[List[int]]: greedy search result
     """
-    batch = ctc_output.shape[0]
     index = ctc_output.argmax(dim=-1)  # (batch, seq_len)
-    hyps = [
-        torch.unique_consecutive(index[i, : encoder_out_lens[i]]) for i in range(batch)
-    ]
+    seq_len = index.size(1)
+    mask = torch.arange(seq_len, device=index.device) < encoder_out_lens.to(
+        index.device
+    ).unsqueeze(1)
+
+    # Keep the first token of each run of identical tokens, except blanks
+    keep = torch.ones_like(mask)
+    keep[:, 1:] = index[:, 1:] != index[:, :-1]
+    keep &= mask & (index != blank_id)
+
+    tokens = index[keep].tolist()
+    hyps = []
+    start = 0
+    for num_tokens in keep.sum(dim=1).tolist():
+        hyps.append(tokens[start : start + num_tokens])
+        start += num_tokens
+
+    return hyps
+
+
+def _segment_logsumexp(
+    values: torch.Tensor, segment_ids: torch.Tensor, num_segments: int
+) -> torch.Tensor:
+    """Return the log-sum-exp of the values of each segment.
+
+    Args:
+      values:
+        A 1-D tensor.
+      segment_ids:
+        A 1-D torch.int64 tensor with the same shape as `values`, containing
+        the segment index of each value.
+      num_segments:
+        The number of segments. Empty segments get -inf.
+    """
+    max_values = torch.full(
+        (num_segments,), float("-inf"), dtype=values.dtype, device=values.device
+    ).scatter_reduce(0, segment_ids, values, reduce="amax")
+    max_values = torch.where(
+        torch.isfinite(max_values), max_values, torch.zeros_like(max_values)
+    )
+    sums = torch.zeros_like(max_values).scatter_add(
+        0, segment_ids, (values - max_values[segment_ids]).exp()
+    )
+    return sums.log() + max_values
+
+
+def ctc_prefix_beam_search(
+    ctc_output: torch.Tensor,
+    encoder_out_lens: torch.Tensor,
+    beam: int = 4,
+    blank_id: int = 0,
+    context_graph: Optional[Union[ContextGraph, CompiledContextGraph]] = None,
+    ngram_lm: Optional[Union[NgramLm, CompiledNgramLm]] = None,
+    ngram_lm_scale: float = 0.0,
+) -> List[List[int]]:
+    """CTC prefix beam search for a batch of utterances, without k2.
 
-    hyps = [h[h != blank_id].tolist() for h in hyps]
+    The blank and non-blank scores of the `beam` prefixes of all utterances
+    are kept in tensors of shape (batch, beam). At each frame, every prefix
+    either keeps its tokens (blank or a repeat of its last token) or is
+    extended with one of the `beam` best non-blank tokens of the frame.
+    Candidates that are the same prefix are merged and the best `beam` ones
+    are kept, all with tensor operations on the whole batch.
 
+    Each prefix has an integer ID. Prefix 0 is the empty prefix and the
+    other prefixes extend the prefix of their parent ID with one token. Each
+    distinct pair (parent ID, token) gets its own ID, so candidates are
+    merged by comparing integers instead of token sequences.
+
+    Args:
+      ctc_output:
+        The log-probs of the CTC output, of shape (batch, seq_len, vocab_size).
+      encoder_out_lens:
+        A 1-D tensor of shape (batch,) with the number of valid frames of each
+        utterance.
+      beam:
+        The number of prefixes kept for each utterance.
+      blank_id:
+        The ID of the blank token.
+      context_graph:
+        Optional. A ContextGraph or CompiledContextGraph for hotword biasing.
+        Its scores are added when a prefix is extended.
+      ngram_lm:
+        Optional. A token-level n-gram LM. Its scores, scaled by
+        `ngram_lm_scale`, are added when a prefix is extended.
+      ngram_lm_scale:
+        The scale of the n-gram LM scores.
+    Returns:
+      Return the token IDs of the best prefix of each utterance.
+    """
+    assert ctc_output.ndim == 3, ctc_output.shape
+    assert beam > 0, beam
+    N, T, V = ctc_output.shape
+    device = ctc_output.device
+    log_probs = ctc_output.float()
+    encoder_out_lens = encoder_out_lens.to(device)
+
+    B = beam
+    K = min(beam, V - 1)  # number of tokens used to extend each prefix
+    M = B * (1 + K)  # number of candidates of each utterance
+    neg_inf = float("-inf")
+
+    # Prefixes that are not used have -inf scores and are copies of the
+    # empty prefix.
+    pb = torch.full((N, B), neg_inf, device=device)  # ends in blank
+    pb[:, 0] = 0
+    pnb = torch.full((N, B), neg_inf, device=device)  # ends in non-blank
+    ids = torch.zeros((N, B), dtype=torch.int64, device=device)
+    # keys[n, b] is parent_id * V + last token, and -1 for the empty prefix.
+    keys = torch.full((N, B), -1, dtype=torch.int64, device=device)
+    last = torch.full((N, B), -1, dtype=torch.int64, device=device)
+    # The accumulated context graph and n-gram LM scores of each prefix
+    extra = torch.zeros((N, B), device=device)
+
+    # The parent ID and last token of each prefix
+    parents = [-1]
+    tokens = [-1]
+    # Map the key of each prefix to its ID. A prefix that leaves the beam
+    # and is created again gets the same ID, so that it can still be merged
+    # with prefixes extended from it.
+    prefix_ids = dict()
+
+    use_states = context_graph is not None or ngram_lm is not None
+    if use_states:
+        # Map prefix ID to its (context state, n-gram LM state)
+        states = {
+            0: (
+                None if context_graph is None else context_graph.root,
+                None if ngram_lm is None else NgramLmStateCost(ngram_lm),
+            )
+        }
+        # Map a key to (context state, n-gram LM state, score) of the prefix
+        cache = dict()
+
+    row_offsets = torch.arange(N, device=device).unsqueeze(1) * M
+    for t in range(T):
+        active = t < encoder_out_lens
+        if not active.any():
+            break
+        lp = log_probs[:, t]  # (N, V)
+
+        # (1) Candidates that keep the tokens of the prefix
+        lp_last = lp.gather(1, last.clamp(min=0))
+        lp_last = torch.where(last >= 0, lp_last, torch.full_like(lp_last, neg_inf))
+        p = torch.logaddexp(pb, pnb)
+        stay_pb = p + lp[:, blank_id : blank_id + 1]
+        stay_pnb = pnb + lp_last
+
+        # (2) Candidates that extend the prefix with a non-blank token.
+        # If the token is the last token of the prefix, the two must be
+        # separated by a blank.
+        lp_nonblank = lp.clone()
+        lp_nonblank[:, blank_id] = neg_inf
+        topk_lp, topk_tokens = lp_nonblank.topk(K, dim=1)  # (N, K)
+        ext_tokens = topk_tokens.unsqueeze(1).expand(N, B, K)
+        ext_pnb = torch.where(
+            ext_tokens == last.unsqueeze(2), pb.unsqueeze(2), p.unsqueeze(2)
+        ) + topk_lp.unsqueeze(1)
+        ext_keys = ids.unsqueeze(2) * V + ext_tokens
+        ext_extra = extra.unsqueeze(2).expand(N, B, K)
+
+        if use_states:
+            flat_keys = ext_keys.reshape(-1).tolist()
+            misses = dict()
+            for key, pid, token in zip(
+                flat_keys,
+                ids.unsqueeze(2).expand(N, B, K).reshape(-1).tolist(),
+                ext_tokens.reshape(-1).tolist(),
+            ):
+                if key not in cache and key not in misses:
+                    misses[key] = (pid, token)
+            if misses:
+                _extend_prefix_states(
+                    misses,
+                    states,
+                    cache,
+                    context_graph=context_graph,
+                    ngram_lm_scale=ngram_lm_scale,
+                )
+            ext_extra = ext_extra + torch.tensor(
+                [cache[key][2] for key in flat_keys], device=device
+            ).view(N, B, K)
+
+        cand_pb = torch.cat(
+            [stay_pb, torch.full((N, B * K), neg_inf, device=device)], 1
+        )
+        cand_pnb = torch.cat([stay_pnb, ext_pnb.reshape(N, -1)], 1)
+        cand_keys = torch.cat([keys, ext_keys.reshape(N, -1)], 1)
+        # -1 means the candidate may be a new prefix
+        cand_ids = torch.cat(
+            [ids, torch.full((N, B * K), -1, dtype=torch.int64, device=device)], 1
+        )
+        cand_last = torch.cat([last, ext_tokens.reshape(N, -1)], 1)
+        cand_extra = torch.cat([extra, ext_extra.reshape(N, -1)], 1)
+
+        # (3) Merge the candidates with the same key. Sort them by key such
+        # that the first candidate of each group is an existing prefix if
+        # there is one.
+        order = cand_ids.argsort(dim=1, descending=True)
+        _, order2 = cand_keys.gather(1, order).sort(dim=1, stable=True)
+        order = order.gather(1, order2)
+        cand_pb = cand_pb.gather(1, order)
+        cand_pnb = cand_pnb.gather(1, order)
+        cand_keys = cand_keys.gather(1, order)
+        cand_ids = cand_ids.gather(1, order)
+        cand_last = cand_last.gather(1, order)
+        cand_extra = cand_extra.gather(1, order)
+
+        is_first = torch.ones_like(cand_keys, dtype=torch.bool)
+        is_first[:, 1:] = cand_keys[:, 1:] != cand_keys[:, :-1]
+        # group[n, m] is the index of the merged candidate in [0, N * M)
+        group = (is_first.cumsum(dim=1) - 1 + row_offsets).reshape(-1)
+
+        merged_pb = _segment_logsumexp(cand_pb.reshape(-1), group, N * M)
+        merged_pnb = _segment_logsumexp(cand_pnb.reshape(-1), group, N * M)
+
+        # All candidates of a group are the same prefix, so they have the
+        # same key, last token and extra score. We take them from the first
+        # candidate of each group.
+        first = is_first.reshape(-1)
+        first_group = group[first]
+
+        def take_first(x: torch.Tensor, fill_value) -> torch.Tensor:
+            ans = torch.full((N * M,), fill_value, dtype=x.dtype, device=device)
+            return ans.scatter_(0, first_group, x.reshape(-1)[first])
+
+        merged_keys = take_first(cand_keys, -1).view(N, M)
+        merged_ids = take_first(cand_ids, 0).view(N, M)
+        merged_last = take_first(cand_last, -1).view(N, M)
+        merged_extra = take_first(cand_extra, 0.0).view(N, M)
+        merged_pb = merged_pb.view(N, M)
+        merged_pnb = merged_pnb.view(N, M)
+        merged_scores = torch.logaddexp(merged_pb, merged_pnb) + merged_extra
+
+        # (4) Keep the best `beam` prefixes
+        top_scores, top = merged_scores.topk(B, dim=1)
+        valid = torch.isfinite(top_scores)
+        new_pb = merged_pb.gather(1, top)
+        new_pnb = merged_pnb.gather(1, top)
+        new_keys = merged_keys.gather(1, top)
+        new_ids = merged_ids.gather(1, top)
+        new_last = merged_last.gather(1, top)
+        new_extra = merged_extra.gather(1, top)
+
+        # Assign IDs to new prefixes
+        is_new = (new_ids < 0) & valid & active.unsqueeze(1)
+        if is_new.any():
+            assigned_ids = []
+            for key in new_keys[is_new].tolist():
+                i = prefix_ids.get(key)
+                if i is None:
+                    i = len(parents)
+                    prefix_ids[key] = i
+                    parents.append(key // V)
+                    tokens.append(key % V)
+                    if use_states:
+                        states[i] = cache[key][:2]
+                assigned_ids.append(i)
+            new_ids[is_new] = torch.tensor(assigned_ids, device=device)
+
+        # Unused prefixes become copies of the empty prefix
+        new_pb = torch.where(valid, new_pb, torch.full_like(new_pb, neg_inf))
+        new_ids = torch.where(valid, new_ids, torch.zeros_like(new_ids))
+        new_keys = torch.where(valid, new_keys, torch.full_like(new_keys, -1))
+        new_last = torch.where(valid, new_last, torch.full_like(new_last, -1))
+        new_extra = torch.where(valid, new_extra, torch.zeros_like(new_extra))
+
+        # Utterances that have ended keep their prefixes
+        mask = active.unsqueeze(1)
+        pb = torch.where(mask, new_pb, pb)
+        pnb = torch.where(mask, new_pnb, pnb)
+        ids = torch.where(mask, new_ids, ids)
+        keys = torch.where(mask, new_keys, keys)
+        last = torch.where(mask, new_last, last)
+        extra = torch.where(mask, new_extra, extra)
+
+    scores = torch.logaddexp(pb, pnb) + extra
+    if context_graph is not None:
+        # Remove the bonus of partially matched hotwords
+        scores = scores + torch.tensor(
+            [context_graph.finalize(states[i][0])[0] for i in ids.reshape(-1).tolist()],
+            device=device,
+        ).view(N, B)
+
+    best_ids = ids.gather(1, scores.argmax(dim=1, keepdim=True)).squeeze(1)
+
+    hyps = []
+    for i in best_ids.tolist():
+        hyp = []
+        while i != 0:
+            hyp.append(tokens[i])
+            i = parents[i]
+        hyps.append(hyp[::-1])
     return hyps
+
+
+def _extend_prefix_states(
+    misses: Dict[int, Tuple[int, int]],
+    states: Dict[int, tuple],
+    cache: Dict[int, tuple],
+    context_graph: Optional[Union[ContextGraph, CompiledContextGraph]],
+    ngram_lm_scale: float,
+) -> None:
+    """Compute the context graph and n-gram LM states of new prefixes for
+    :func:`ctc_prefix_beam_search`.
+
+    Args:
+      misses:
+        Map the key of each new prefix to its (parent ID, token).
+      states:
+        Map a prefix ID to its (context state, n-gram LM state).
+      cache:
+        The (context state, n-gram LM state, score) of each new prefix are
+        added to it.
+      context_graph:
+        The context graph, or None.
+      ngram_lm_scale:
+        The scale of the n-gram LM scores.
+    """
+    keys = list(misses.keys())
+    parent_states = [states[misses[k][0]] for k in keys]
+    labels = [misses[k][1] for k in keys]
+
+    if context_graph is not None:
+        context_scores, context_states, _ = context_graph.forward_batch(
+            [s[0] for s in parent_states], labels
+        )
+    else:
+        context_scores = [0.0] * len(keys)
+        context_states = [None] * len(keys)
+
+    for key, (_, lm_state), label, context_score, context_state in zip(
+        keys, parent_states, labels, context_scores, context_states
+    ):
+        score = context_score
+        if lm_state is not None:
+            next_lm_state = lm_state.forward_one_step(label)
+            score += ngram_lm_scale * (next_lm_state.lm_score - lm_state.lm_score)
+        else:
+            next_lm_state = None
+        cache[key] = (context_state, next_lm_state, score)
@@ -15,7 +15,10 @@
 # limitations under the License.
 
 from collections import defaultdict
-from typing import List, Optional, Tuple
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple, Union
+
+import numpy as np
 
 from icefall.utils import is_module_available
 
@@ -53,6 +56,14 @@ class NgramLm:
         self.lm = lm
         self.backoff_id = backoff_id
 
+    @property
+    def start(self) -> int:
+        return self.lm.start
+
+    @property
+    def num_states(self) -> int:
+        return self.lm.num_states
+
     def _process_backoff_arcs(
         self,
         state: int,
@@ -139,9 +150,244 @@ class NgramLm:
         return next_states, next_costs
 
 
+class CompiledNgramLm:
+    """An array-backed version of :class:`NgramLm`.
+
+    The FST is flattened once into CSR arrays, i.e., for state `s`, its arcs
+    are at indexes `state_offsets[s]:state_offsets[s+1]` of `ilabels`,
+    `nextstates` and `weights`, sorted by ilabel. The states reachable via
+    backoff arcs (including the state itself) and their costs are precomputed
+    for every state and stored in `closure_offsets`, `closure_states`
+    and `closure_costs` in the same way.
+
+    It gives the same results as :class:`NgramLm` but avoids the Python-level
+    binary search through `kaldifst.ArcIterator` and the recursive processing
+    of backoff arcs on every call.
+    """
+
+    def __init__(
+        self,
+        arrays: Dict[str, np.ndarray],
+        backoff_id: int,
+        cache_size: int = 100000,
+    ):
+        """
+        Args:
+          arrays:
+            A dict containing the arrays described above. Use
+            :meth:`from_ngram_lm` or :meth:`load` to get it.
+          backoff_id:
+            ID of the backoff symbol.
+          cache_size:
+            Maximum number of (state, label) transitions kept in the LRU cache
+            of :meth:`get_next_state_and_cost`. 0 disables the cache.
+        """
+        self.start = int(arrays["start"])
+        self.backoff_id = backoff_id
+
+        self.state_offsets = arrays["state_offsets"]
+        self.ilabels = arrays["ilabels"]
+        self.nextstates = arrays["nextstates"]
+        self.weights = arrays["weights"]
+
+        self.closure_offsets = arrays["closure_offsets"]
+        self.closure_states = arrays["closure_states"]
+        self.closure_costs = arrays["closure_costs"]
+
+        self.num_states = self.state_offsets.shape[0] - 1
+
+        # Since arcs are sorted by state and then by ilabel, arc_keys is
+        # sorted and a (state, label) pair can be looked up with a single
+        # np.searchsorted() for any number of pairs.
+        self._label_stride = int(self.ilabels.max(initial=0)) + 1
+        arc_states = np.repeat(
+            np.arange(self.num_states, dtype=np.int64), np.diff(self.state_offsets)
+        )
+        self._arc_keys = arc_states * self._label_stride + self.ilabels
+
+        if cache_size > 0:
+            self._get_next_state_and_cost = lru_cache(maxsize=cache_size)(
+                self._get_next_state_and_cost
+            )
+
+    @classmethod
+    def from_ngram_lm(cls, ngram_lm: NgramLm, cache_size: int = 100000):
+        """Flatten an :class:`NgramLm` into arrays."""
+        import kaldifst
+
+        lm = ngram_lm.lm
+        num_states = lm.num_states
+
+        state_offsets = np.zeros(num_states + 1, dtype=np.int64)
+        ilabels = []
+        nextstates = []
+        weights = []
+        for state in range(num_states):
+            for arc in kaldifst.ArcIterator(lm, state):
+                ilabels.append(arc.ilabel)
+                nextstates.append(arc.nextstate)
+                weights.append(arc.weight.value)
+            state_offsets[state + 1] = len(ilabels)
+
+        ilabels = np.array(ilabels, dtype=np.int64)
+        nextstates = np.array(nextstates, dtype=np.int64)
+        weights = np.array(weights, dtype=np.float64)
+
+        # backoff[s] is the index of the backoff arc leaving s, or -1
+        backoff = np.full(num_states, -1, dtype=np.int64)
+        for state in range(num_states):
+            begin, end = state_offsets[state], state_offsets[state + 1]
+            i = begin + np.searchsorted(ilabels[begin:end], ngram_lm.backoff_id)
+            if i < end and ilabels[i] == ngram_lm.backoff_id:
+                backoff[state] = i
+
+        closure_offsets = np.zeros(num_states + 1, dtype=np.int64)
+        closure_states = []
+        closure_costs = []
+        for state in range(num_states):
+            # Same as NgramLm._process_backoff_arcs()
+            s = state
+            cost = 0.0
+            closure_states.append(s)
+            closure_costs.append(cost)
+            while backoff[s] != -1:
+                cost += weights[backoff[s]]
+                s = nextstates[backoff[s]]
+                closure_states.append(s)
+                closure_costs.append(cost)
+            closure_offsets[state + 1] = len(closure_states)
+
+        arrays = {
+            "start": np.array(lm.start, dtype=np.int64),
+            "state_offsets": state_offsets,
+            "ilabels": ilabels,
+            "nextstates": nextstates,
+            "weights": weights,
+            "closure_offsets": closure_offsets,
+            "closure_states": np.array(closure_states, dtype=np.int64),
+            "closure_costs": np.array(closure_costs, dtype=np.float64),
+        }
+        return cls(arrays, backoff_id=ngram_lm.backoff_id, cache_size=cache_size)
+
+    @classmethod
+    def from_file(
+        cls,
+        fst_filename: str,
+        backoff_id: int,
+        is_binary: bool = False,
+        cache_size: int = 100000,
+    ):
+        """Load an FST (see :class:`NgramLm`) and flatten it into arrays."""
+        return cls.from_ngram_lm(
+            NgramLm(fst_filename, backoff_id=backoff_id, is_binary=is_binary),
+            cache_size=cache_size,
+        )
+
+    def save(self, filename: str) -> None:
+        """Save the arrays to a `.npz` file so that the FST need not be
+        flattened again. Use :meth:`load` to read it back.
+        """
+        np.savez(
+            filename,
+            start=np.array(self.start, dtype=np.int64),
+            backoff_id=np.array(self.backoff_id, dtype=np.int64),
+            state_offsets=self.state_offsets,
+            ilabels=self.ilabels,
+            nextstates=self.nextstates,
+            weights=self.weights,
+            closure_offsets=self.closure_offsets,
+            closure_states=self.closure_states,
+            closure_costs=self.closure_costs,
+        )
+
+    @classmethod
+    def load(cls, filename: str, cache_size: int = 100000):
+        """Load a file written by :meth:`save`."""
+        with np.load(filename) as f:
+            arrays = {k: f[k] for k in f.files}
+        backoff_id = int(arrays.pop("backoff_id"))
+        return cls(arrays, backoff_id=backoff_id, cache_size=cache_size)
+
+    def forward(
+        self,
+        states: Union[List[int], np.ndarray],
+        labels: Union[List[int], np.ndarray],
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Advance many (state, label) pairs in one vectorized call.
+
+        Args:
+          states:
+            A 1-D array of states.
+          labels:
+            A 1-D array of labels, with the same length as `states`.
+        Returns:
+          Return a tuple with three arrays (row_splits, next_states, costs).
+          The next states of the i-th pair and their costs are
+          `next_states[row_splits[i]:row_splits[i+1]]` and
+          `costs[row_splits[i]:row_splits[i+1]]`, in the same order as
+          :meth:`get_next_state_and_cost` returns them.
+        """
+        states = np.asarray(states, dtype=np.int64)
+        labels = np.asarray(labels, dtype=np.int64)
+        assert states.shape == labels.shape, (states.shape, labels.shape)
+
+        # Expand each pair into the backoff closure of its state
+        begin = self.closure_offsets[states]
+        num = self.closure_offsets[states + 1] - begin
+        pair_ids = np.repeat(np.arange(states.shape[0]), num)
+        index = np.arange(pair_ids.shape[0]) - np.repeat(np.cumsum(num) - num, num)
+        index += np.repeat(begin, num)
+
+        src_states = self.closure_states[index]
+        src_costs = self.closure_costs[index]
+        src_labels = labels[pair_ids]
+
+        keys = src_states * self._label_stride + src_labels
+        arc_index = np.searchsorted(self._arc_keys, keys)
+        arc_index = np.minimum(arc_index, self._arc_keys.shape[0] - 1)
+        found = (src_labels < self._label_stride) & (self._arc_keys[arc_index] == keys)
+
+        next_states = self.nextstates[arc_index]
+        # Note: NgramLm.get_next_state_and_cost() discards arcs entering
+        # state 0, so we do the same here.
+        found &= next_states != 0
+
+        row_splits = np.zeros(states.shape[0] + 1, dtype=np.int64)
+        np.cumsum(
+            np.bincount(pair_ids[found], minlength=states.shape[0]),
+            out=row_splits[1:],
+        )
+
+        return (
+            row_splits,
+            next_states[found],
+            src_costs[found] + self.weights[arc_index[found]],
+        )
+
+    def _get_next_state_and_cost(
+        self, state: int, label: int
+    ) -> Tuple[Tuple[int, ...], Tuple[float, ...]]:
+        _, next_states, next_costs = self.forward([state], [label])
+        return tuple(next_states.tolist()), tuple(next_costs.tolist())
+
+    def get_next_state_and_cost(
+        self,
+        state: int,
+        label: int,
+    ) -> Tuple[List[int], List[float]]:
+        """Same as :meth:`NgramLm.get_next_state_and_cost`, with results
+        memoized in an LRU cache."""
+        next_states, next_costs = self._get_next_state_and_cost(state, label)
+        return list(next_states), list(next_costs)
+
+
 class NgramLmStateCost:
-    def __init__(self, ngram_lm: NgramLm, state_cost: Optional[dict] = None):
-        assert ngram_lm.lm.start == 0, ngram_lm.lm.start
+    def __init__(
+        self,
+        ngram_lm: Union[NgramLm, CompiledNgramLm],
+        state_cost: Optional[dict] = None,
+    ):
+        assert ngram_lm.start == 0, ngram_lm.start
         self.ngram_lm = ngram_lm
         if state_cost is not None:
             self.state_cost = state_cost
@@ -153,6 +399,22 @@ class NgramLmStateCost:
 
     def forward_one_step(self, label: int) -> "NgramLmStateCost":
         state_cost = defaultdict(lambda: float("inf"))
+        if isinstance(self.ngram_lm, CompiledNgramLm) and len(self.state_cost) > 1:
+            # Advance all states in one call
+            states = list(self.state_cost.keys())
+            costs = list(self.state_cost.values())
+            row_splits, next_states, next_costs = self.ngram_lm.forward(
+                states, [label] * len(states)
+            )
+            row_splits = row_splits.tolist()
+            next_states = next_states.tolist()
+            next_costs = next_costs.tolist()
+            for i, c in enumerate(costs):
+                for k in range(row_splits[i], row_splits[i + 1]):
+                    ns = next_states[k]
+                    state_cost[ns] = min(state_cost[ns], c + next_costs[k])
+            return NgramLmStateCost(ngram_lm=self.ngram_lm, state_cost=state_cost)
+
         for s, c in self.state_cost.items():
             next_states, next_costs = self.ngram_lm.get_next_state_and_cost(
                 s,
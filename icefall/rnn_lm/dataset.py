@@ -14,16 +14,56 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from typing import List, Tuple
+import logging
+from pathlib import Path
+from typing import List, Sequence, Tuple, Union
 
 import k2
+import numpy as np
 import torch
+import torch.distributed as dist
 from torch.utils.data import DataLoader
 from torch.utils.data.distributed import DistributedSampler
 
 from icefall.utils import AttributeDict, add_eos, add_sos
 
 
+def get_batch_boundaries(
+    sentence_lengths: Sequence[int], max_sent_len: int, batch_size: int
+) -> List[int]:
+    """Split sentences sorted by length into batches.
+
+    Args:
+      sentence_lengths:
+        Number of tokens of each sentence, in descending order.
+      max_sent_len:
+        See :class:`LmDataset`.
+      batch_size:
+        See :class:`LmDataset`.
+    Returns:
+      Return a list `b` such that the i-th batch contains the sentences
+      in the range [b[i], b[i+1]).
+    """
+    assert batch_size > 0, batch_size
+    assert max_sent_len > 1, max_sent_len
+    num_sentences = len(sentence_lengths)
+    boundaries = [0]
+    cur = 0
+    while cur < num_sentences:
+        sz = int(sentence_lengths[cur]) // max_sent_len + 1
+        # Assume the current sentence has 3 * max_sent_len tokens,
+        # in the worst case, the subsequent sentences also have
+        # this number of tokens, we should reduce the batch size
+        # so that this batch will not contain too many tokens
+        actual_batch_size = batch_size // sz + 1
+        actual_batch_size = min(actual_batch_size, batch_size)
+        end = cur + actual_batch_size
+        end = min(end, num_sentences)
+        boundaries.append(end)
+        cur = end
+    return boundaries
+
+
 class LmDataset(torch.utils.data.Dataset):
     def __init__(
         self,
@@ -61,25 +101,14 @@ class LmDataset(torch.utils.data.Dataset):
 
         sentence_lengths = sentence_lengths.tolist()
 
-        assert batch_size > 0, batch_size
-        assert max_sent_len > 1, max_sent_len
-        batch_indexes = []
-        num_sentences = sentences.dim0
-        cur = 0
-        while cur < num_sentences:
-            sz = sentence_lengths[cur] // max_sent_len + 1
-            # Assume the current sentence has 3 * max_sent_len tokens,
-            # in the worst case, the subsequent sentences also have
-            # this number of tokens, we should reduce the batch size
-            # so that this batch will not contain too many tokens
-            actual_batch_size = batch_size // sz + 1
-            actual_batch_size = min(actual_batch_size, batch_size)
-            end = cur + actual_batch_size
-            end = min(end, num_sentences)
-            this_batch_indexes = torch.arange(cur, end).tolist()
-            batch_indexes.append(this_batch_indexes)
-            cur = end
-        assert batch_indexes[-1][-1] == num_sentences - 1
+        boundaries = get_batch_boundaries(
+            sentence_lengths, max_sent_len=max_sent_len, batch_size=batch_size
+        )
+        batch_indexes = [
+            list(range(start, end))
+            for start, end in zip(boundaries[:-1], boundaries[1:])
+        ]
+        assert batch_indexes[-1][-1] == sentences.dim0 - 1
 
         self.batch_indexes = k2.RaggedTensor(batch_indexes)
 
@@ -162,6 +191,391 @@ class LmDatasetCollate:
         return x.to(torch.int64), y.to(torch.int64), sentence_token_lengths
 
 
+def expand_ragged(
+    row_splits: np.ndarray, rows: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Select rows of a ragged array.
+
+    Args:
+      row_splits:
+        The row splits of the ragged array, i.e., row i contains the elements
+        in the range [row_splits[i], row_splits[i+1]).
+      rows:
+        A 1-D array with the indexes of the selected rows.
+    Returns:
+      Return a tuple (index, new_row_splits). `index` contains the indexes
+      of the elements of the selected rows, in order, and `new_row_splits`
+      the row splits of the selected rows.
+    """
+    starts = row_splits[rows]
+    lengths = row_splits[rows + 1] - starts
+    new_row_splits = np.zeros(rows.shape[0] + 1, dtype=np.int64)
+    np.cumsum(lengths, out=new_row_splits[1:])
+    index = np.arange(new_row_splits[-1]) + np.repeat(
+        starts - new_row_splits[:-1], lengths
+    )
+    return index, new_row_splits
+
+
+class MemmapLmDataset(torch.utils.data.Dataset):
+    def __init__(
+        self,
+        lm_data_dir: str,
+        max_sent_len: int,
+        batch_size: int,
+    ):
+        """
+        Args:
+          lm_data_dir:
+            A directory generated by `../local/convert_lm_data_to_memmap.py`,
+            containing:
+
+              - tokens.npy, a 1-D array of dtype np.int32 with the tokens of
+                all sentences
+              - offsets.npy, a 1-D array of dtype np.int64 with
+                num_sentences + 1 entries. The tokens of the i-th sentence
+                are tokens[offsets[i]:offsets[i+1]].
+
+            The sentences are sorted by length in descending order.
+          max_sent_len:
+            See :class:`LmDataset`.
+          batch_size:
+            See :class:`LmDataset`.
+
+        The arrays are memory-mapped, so they are shared by all processes
+        reading them, e.g., DDP ranks and dataloader workers, through the
+        page cache of the OS instead of being loaded into each of them.
+        """
+        super().__init__()
+        self.lm_data_dir = Path(lm_data_dir)
+        self._tokens = None
+        self._offsets = None
+
+        self.boundaries = np.array(
+            get_batch_boundaries(
+                self.sentence_lengths(),
+                max_sent_len=max_sent_len,
+                batch_size=batch_size,
+            ),
+            dtype=np.int64,
+        )
+
+    @property
+    def tokens(self) -> np.ndarray:
+        if self._tokens is None:
+            self._tokens = np.load(self.lm_data_dir / "tokens.npy", mmap_mode="r")
+        return self._tokens
+
+    @property
+    def offsets(self) -> np.ndarray:
+        if self._offsets is None:
+            self._offsets = np.load(self.lm_data_dir / "offsets.npy", mmap_mode="r")
+        return self._offsets
+
+    def sentence_lengths(self) -> np.ndarray:
+        """Return the number of tokens of each sentence."""
+        return np.diff(self.offsets)
+
+    def __getstate__(self):
+        # Don't pickle the memory-mapped arrays, e.g., when the dataset is
+        # sent to dataloader workers, since that would copy them. Each
+        # process maps them again instead.
+        state = self.__dict__.copy()
+        state["_tokens"] = None
+        state["_offsets"] = None
+        return state
+
+    def __len__(self) -> int:
+        """Return number of batches in this dataset"""
+        return self.boundaries.shape[0] - 1
+
+    def __getitem__(
+        self, i: Union[int, Tuple[np.ndarray, np.ndarray]]
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Get a batch.
+
+        Args:
+          i:
+            Either the index of a batch of this dataset, or a batch of
+            :class:`TokenBudgetBatchSampler`, i.e., a tuple (sentences,
+            row_splits), where the sentences in the range
+            [row_splits[j], row_splits[j+1]) are packed into the j-th row
+            of the batch.
+        Returns:
+          Return a tuple (tokens, offsets, row_splits). The tokens of the
+          k-th sentence of the batch are tokens[offsets[k]:offsets[k+1]].
+          For the batches of this dataset, tokens is a view of the
+          memory-mapped array, i.e., no data is copied, and each row
+          contains one sentence.
+        """
+        if isinstance(i, tuple):
+            sentences, row_splits = i
+            index, offsets = expand_ragged(np.asarray(self.offsets), sentences)
+            return self.tokens[index], offsets, row_splits
+
+        assert 0 <= i < len(self), i
+        start, end = self.boundaries[i], self.boundaries[i + 1]
+        offsets = self.offsets[start : end + 1]
+        tokens = self.tokens[offsets[0] : offsets[-1]]
+        row_splits = np.arange(end - start + 1)
+        return tokens, offsets - offsets[0], row_splits
+
+
+class MemmapLmDatasetCollate(LmDatasetCollate):
+    def __init__(
+        self, sos_id: int, eos_id: int, blank_id: int, pack_sentences: bool = False
+    ):
+        """The same as :class:`LmDatasetCollate`, but for the batches of
+        :class:`MemmapLmDataset`.
+
+        Args:
+          sos_id:
+            Token ID of the SOS symbol.
+          eos_id:
+            Token ID of the EOS symbol.
+          blank_id:
+            Token ID of the blank symbol.
+          pack_sentences:
+            True if the batches may contain several sentences in a row, see
+            :class:`TokenBudgetBatchSampler`. If True, the sentence index of
+            each token is also returned, see :meth:`__call__`.
+        """
+        super().__init__(sos_id=sos_id, eos_id=eos_id, blank_id=blank_id)
+        self.pack_sentences = pack_sentences
+
+    def __call__(
+        self, batch: List[Tuple[np.ndarray, np.ndarray, np.ndarray]]
+    ) -> Tuple[torch.Tensor, ...]:
+        """See :meth:`LmDatasetCollate.__call__`. Each row of x (y) contains
+        the sentences packed into it, each starting with SOS (ending with
+        EOS), and lengths contains the number of tokens of each row.
+
+        If `self.pack_sentences` is True, it also returns segment_ids,
+        a 2-D tensor of dtype torch.int64 with the same shape as x, containing
+        the index of the sentence of each token in its row, or -1 for
+        padding.
+        """
+        # The batching stuff has already been done in MemmapLmDataset
+        assert len(batch) == 1
+        tokens, offsets, row_splits = batch[0]
+        num_rows = row_splits.shape[0] - 1
+        # plus 1 since we add a SOS to each sentence
+        sentence_lengths = np.diff(offsets) + 1
+        sentence_rows = np.repeat(np.arange(num_rows), np.diff(row_splits))
+
+        # Start of each sentence in its row
+        row_ends = np.cumsum(sentence_lengths)
+        row_starts = np.concatenate(([0], row_ends[:-1]))
+        sentence_starts = row_starts - np.repeat(
+            row_starts[row_splits[:-1]], np.diff(row_splits)
+        )
+        row_lengths = np.bincount(
+            sentence_rows, weights=sentence_lengths, minlength=num_rows
+        ).astype(np.int64)
+        max_len = int(row_lengths.max())
+
+        # Row and column of each token in the padded batch
+        rows = np.repeat(sentence_rows, sentence_lengths - 1)
+        cols = np.arange(tokens.shape[0]) + np.repeat(
+            sentence_starts - offsets[:-1], sentence_lengths - 1
+        )
+
+        x = np.full((num_rows, max_len), self.blank_id, dtype=np.int64)
+        x[sentence_rows, sentence_starts] = self.sos_id
+        x[rows, cols + 1] = tokens
+
+        y = np.full((num_rows, max_len), self.blank_id, dtype=np.int64)
+        y[rows, cols] = tokens
+        y[sentence_rows, sentence_starts + sentence_lengths - 1] = self.eos_id
+
+        ans = (
+            torch.from_numpy(x),
+            torch.from_numpy(y),
+            torch.from_numpy(row_lengths.astype(np.int32)),
+        )
+        if not self.pack_sentences:
+            return ans
+
+        segment_ids = np.full((num_rows, max_len), -1, dtype=np.int64)
+        sentence_in_row = np.arange(sentence_rows.shape[0]) - np.repeat(
+            row_splits[:-1], np.diff(row_splits)
+        )
+        segment_rows = np.repeat(sentence_rows, sentence_lengths)
+        segment_cols = np.arange(row_ends[-1]) - np.repeat(
+            row_starts - sentence_starts, sentence_lengths
+        )
+        segment_ids[segment_rows, segment_cols] = np.repeat(
+            sentence_in_row, sentence_lengths
+        )
+        return ans + (torch.from_numpy(segment_ids),)
+
+
+class TokenBudgetBatchSampler(torch.utils.data.Sampler):
+    def __init__(
+        self,
+        sentence_lengths: np.ndarray,
+        max_tokens: int,
+        num_buckets: int = 30,
+        shuffle: bool = True,
+        seed: int = 0,
+        world_size: int = 1,
+        rank: int = 0,
+        pack_sentences: bool = False,
+        max_row_len: int = 200,
+    ):
+        """A sampler for :class:`MemmapLmDataset`, which creates batches with
+        at most `max_tokens` tokens, including padding.
+
+        The rows of the batches, i.e., sentences or sentences packed into a
+        row, are put into `num_buckets` buckets with about the same number of
+        rows. All batches of a bucket have the same number of rows, which is
+        `max_tokens` divided by the longest row of the bucket. In each epoch,
+        the rows of each bucket and the batches are shuffled.
+
+        Args:
+          sentence_lengths:
+            Number of tokens of each sentence, without SOS/EOS.
+          max_tokens:
+            Maximum number of tokens of a batch, including padding and
+            SOS/EOS. A batch with a single row may exceed it.
+          num_buckets:
+            Number of buckets. More buckets give less padding, but batches
+            of more different sizes.
+          shuffle:
+            True to shuffle the rows and batches in each epoch.
+          seed:
+            The random seed. The seed of each epoch is `seed + epoch`, so all
+            ranks of DDP create the same batches.
+          world_size:
+            Number of DDP ranks. Each rank takes every world_size-th batch,
+            and all ranks get the same number of batches.
+          rank:
+            The DDP rank.
+          pack_sentences:
+            If True, sentences with the same length are packed into rows
+            of at most `max_row_len` tokens. The model must not attend
+            across the sentences in a row, see `segment_ids` in
+            :class:`MemmapLmDatasetCollate`.
+          max_row_len:
+            Maximum number of tokens of a row with packed sentences.
+        """
+        assert max_tokens > 0, max_tokens
+        assert num_buckets > 0, num_buckets
+        assert 0 <= rank < world_size, (rank, world_size)
+        self.sentence_lengths = np.asarray(sentence_lengths, dtype=np.int64)
+        self.max_tokens = max_tokens
+        self.num_buckets = num_buckets
+        self.shuffle = shuffle
+        self.seed = seed
+        self.world_size = world_size
+        self.rank = rank
+        self.pack_sentences = pack_sentences
+        self.max_row_len = max_row_len
+
+        self.epoch = 0
+        self._batches = None
+
+    def set_epoch(self, epoch: int) -> None:
+        self.epoch = epoch
+        self._batches = None
+
+    def _create_rows(self, rng: np.random.Generator) -> Tuple[np.ndarray, np.ndarray]:
+        # Return a tuple (sentences, row_splits), where the sentences in
+        # the range [row_splits[i], row_splits[i+1]) form the i-th row.
+        num_sentences = self.sentence_lengths.shape[0]
+        if self.shuffle:
+            sentences = rng.permutation(num_sentences)
+        else:
+            sentences = np.arange(num_sentences)
+        if not self.pack_sentences:
+            return sentences, np.arange(num_sentences + 1)
+
+        # Group the sentences by length, and put
+        # max_row_len // (length + 1) sentences of each group into a row.
+        lengths = self.sentence_lengths[sentences] + 1
+        sentences = sentences[np.argsort(lengths, kind="stable")]
+        lengths = self.sentence_lengths[sentences] + 1
+        is_first = np.ones(num_sentences, dtype=bool)
+        is_first[1:] = lengths[1:] != lengths[:-1]
+        group_starts = np.flatnonzero(is_first)
+        group_sizes = np.diff(np.append(group_starts, num_sentences))
+        per_row = np.maximum(self.max_row_len // lengths[group_starts], 1)
+
+        rank_in_group = np.arange(num_sentences) - np.repeat(group_starts, group_sizes)
+        rows_per_group = (group_sizes + per_row - 1) // per_row
+        first_row = np.cumsum(rows_per_group) - rows_per_group
+        row_ids = np.repeat(first_row, group_sizes) + rank_in_group // np.repeat(
+            per_row, group_sizes
+        )
+        row_splits = np.zeros(int(rows_per_group.sum()) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(row_ids), out=row_splits[1:])
+        return sentences, row_splits
+
+    def _create_batches(self) -> List[Tuple[np.ndarray, np.ndarray]]:
+        rng = np.random.default_rng(self.seed + self.epoch)
+        sentences, row_splits = self._create_rows(rng)
+        row_lengths = np.add.reduceat(
+            self.sentence_lengths[sentences] + 1, row_splits[:-1]
+        )
+        num_rows = row_lengths.shape[0]
+
+        # The longest row of each bucket
+        bucket_max_lengths = np.unique(
+            np.quantile(
+                row_lengths,
+                np.linspace(0, 1, self.num_buckets + 1)[1:],
+                method="higher",
+            )
+        )
+        buckets = np.searchsorted(bucket_max_lengths, row_lengths)
+        # Rows of the same bucket are consecutive, in random order
+        rows = np.argsort(buckets, kind="stable")
+
+        batches = []
+        bucket_starts = np.searchsorted(
+            buckets[rows], np.arange(len(bucket_max_lengths) + 1)
+        )
+        for b, max_len in enumerate(bucket_max_lengths.tolist()):
+            batch_size = max(self.max_tokens // max_len, 1)
+            for start in range(bucket_starts[b], bucket_starts[b + 1], batch_size):
+                end = min(start + batch_size, bucket_starts[b + 1])
+                batches.append(rows[start:end])
+
+        if self.shuffle:
+            batches = [batches[i] for i in rng.permutation(len(batches))]
+
+        num_batches = len(batches) // self.world_size
+        batches = batches[self.rank : num_batches * self.world_size : self.world_size]
+
+        num_tokens = 0
+        num_padded_tokens = 0
+        ans = []
+        for batch_rows in batches:
+            index, batch_row_splits = expand_ragged(row_splits, batch_rows)
+            ans.append((sentences[index], batch_row_splits))
+            lengths = row_lengths[batch_rows]
+            num_tokens += int(lengths.sum())
+            num_padded_tokens += int(lengths.max()) * lengths.shape[0]
+
+        self.padding_ratio = 1 - num_tokens / max(num_padded_tokens, 1)
+        logging.info(
+            f"Epoch {self.epoch}: {len(ans)} batches of {num_rows} rows, "
+            f"padding ratio {self.padding_ratio:.3f}"
+        )
+        return ans
+
+    def _get_batches(self) -> List[Tuple[np.ndarray, np.ndarray]]:
+        if self._batches is None:
+            self._batches = self._create_batches()
+        return self._batches
+
+    def __iter__(self):
+        return iter(self._get_batches())
+
+    def __len__(self) -> int:
+        return len(self._get_batches())
+
+
 def get_dataloader(
     filename: str,
     is_distributed: bool,
@@ -172,7 +586,9 @@ def get_dataloader(
     Args:
       filename:
         Path to the file containing LM data. The file is assumed to
-        be generated by `../local/sort_lm_training_data.py`.
+        be generated by `../local/sort_lm_training_data.py`. It can also
+        be a directory generated by `../local/convert_lm_data_to_memmap.py`
+        from such a file, see :class:`MemmapLmDataset`.
       is_distributed:
         True if using DDP training. False otherwise.
       params:
@@ -180,29 +596,75 @@ def get_dataloader(
     Returns:
       Return a dataloader containing the LM data.
     """
-    lm_data = torch.load(filename)
-
-    words = lm_data["words"]
-    sentences = lm_data["sentences"]
-    sentence_lengths = lm_data["sentence_lengths"]
-
-    dataset = LmDataset(
-        sentences=sentences,
-        words=words,
-        sentence_lengths=sentence_lengths,
-        max_sent_len=params.max_sent_len,
-        batch_size=params.batch_size,
-    )
-    if is_distributed:
-        sampler = DistributedSampler(dataset, shuffle=True, drop_last=True)
+    if Path(filename).is_dir():
+        dataset = MemmapLmDataset(
+            lm_data_dir=filename,
+            max_sent_len=params.max_sent_len,
+            batch_size=params.batch_size,
+        )
+        collate_fn_class = MemmapLmDatasetCollate
     else:
-        sampler = None
+        lm_data = torch.load(filename)
 
-    collate_fn = LmDatasetCollate(
-        sos_id=params.sos_id,
-        eos_id=params.eos_id,
-        blank_id=params.blank_id,
-    )
+        words = lm_data["words"]
+        sentences = lm_data["sentences"]
+        sentence_lengths = lm_data["sentence_lengths"]
+
+        dataset = LmDataset(
+            sentences=sentences,
+            words=words,
+            sentence_lengths=sentence_lengths,
+            max_sent_len=params.max_sent_len,
+            batch_size=params.batch_size,
+        )
+        collate_fn_class = LmDatasetCollate
+
+    max_tokens = params.get("max_tokens", 0)
+    pack_sentences = params.get("pack_sentences", False)
+    if max_tokens > 0 or pack_sentences:
+        if not isinstance(dataset, MemmapLmDataset):
+            raise ValueError(
+                "--max-tokens and --pack-sentences require LM data "
+                "converted by ../local/convert_lm_data_to_memmap.py"
+            )
+        if is_distributed:
+            world_size = dist.get_world_size()
+            rank = dist.get_rank()
+        else:
+            world_size = 1
+            rank = 0
+        if max_tokens <= 0:
+            # With --pack-sentences only, keep about --batch-size rows
+            # per batch
+            max_tokens = params.batch_size * params.max_sent_len
+        sampler = TokenBudgetBatchSampler(
+            sentence_lengths=dataset.sentence_lengths(),
+            max_tokens=max_tokens,
+            num_buckets=params.get("num_buckets", 30),
+            shuffle=True,
+            seed=params.get("seed", 0),
+            world_size=world_size,
+            rank=rank,
+            pack_sentences=pack_sentences,
+            max_row_len=params.max_sent_len,
+        )
+        collate_fn = MemmapLmDatasetCollate(
+            sos_id=params.sos_id,
+            eos_id=params.eos_id,
+            blank_id=params.blank_id,
+            pack_sentences=pack_sentences,
+        )
+    else:
+        if is_distributed:
+            sampler = DistributedSampler(dataset, shuffle=True, drop_last=True)
+        else:
+            sampler = None
+
+        collate_fn = collate_fn_class(
+            sos_id=params.sos_id,
+            eos_id=params.eos_id,
+            blank_id=params.blank_id,
+        )
 
     dataloader = DataLoader(
         dataset,
@@ -210,5 +672,6 @@ def get_dataloader(
         collate_fn=collate_fn,
         sampler=sampler,
         shuffle=sampler is None,
+        num_workers=params.get("num_workers", 0),
     )
     return dataloader
@@ -15,12 +15,47 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import tempfile
+from pathlib import Path
+
 import k2
+import numpy as np
 import torch
-from rnn_lm.dataset import LmDataset, LmDatasetCollate
+from rnn_lm.dataset import (
+    LmDataset,
+    LmDatasetCollate,
+    MemmapLmDataset,
+    MemmapLmDatasetCollate,
+    TokenBudgetBatchSampler,
+)
 
 
-def main():
+def _check_memmap_dataset(dataset, sentences, words):
+    # Save the sentences in the format of MemmapLmDataset
+    sentence_tokens = words.index(sentences).remove_axis(1)
+    with tempfile.TemporaryDirectory() as lm_data_dir:
+        np.save(
+            Path(lm_data_dir) / "tokens.npy",
+            sentence_tokens.values.numpy().astype(np.int32),
+        )
+        np.save(
+            Path(lm_data_dir) / "offsets.npy",
+            sentence_tokens.shape.row_splits(1).numpy().astype(np.int64),
+        )
+
+        memmap_dataset = MemmapLmDataset(lm_data_dir, max_sent_len=3, batch_size=4)
+        assert len(memmap_dataset) == len(dataset)
+
+        collate_fn = LmDatasetCollate(sos_id=1, eos_id=-1, blank_id=0)
+        memmap_collate_fn = MemmapLmDatasetCollate(sos_id=1, eos_id=-1, blank_id=0)
+        for i in range(len(dataset)):
+            expected = collate_fn([dataset[i]])
+            batch = memmap_collate_fn([memmap_dataset[i]])
+            for a, b in zip(expected, batch):
+                assert torch.equal(a, b), (a, b)
+
+
+def _get_lm_dataset():
     sentences = k2.RaggedTensor(
         [[0, 1, 2], [1, 0, 1], [0, 1], [1, 3, 0, 2, 0], [3], [0, 2, 1]]
     )
@@ -56,6 +91,56 @@ def main():
         max_sent_len=3,
         batch_size=4,
     )
+    return dataset, sentences, words
+
+
+def test_memmap_dataset():
+    dataset, sentences, words = _get_lm_dataset()
+    _check_memmap_dataset(dataset, sentences, words)
+
+
+def test_token_budget_batch_sampler():
+    np.random.seed(20231015)
+    sentence_lengths = np.sort(np.random.randint(1, 20, size=100))[::-1]
+    offsets = np.zeros(sentence_lengths.shape[0] + 1, dtype=np.int64)
+    np.cumsum(sentence_lengths, out=offsets[1:])
+    tokens = np.random.randint(2, 30, size=offsets[-1]).astype(np.int32)
+
+    with tempfile.TemporaryDirectory() as lm_data_dir:
+        np.save(Path(lm_data_dir) / "tokens.npy", tokens)
+        np.save(Path(lm_data_dir) / "offsets.npy", offsets)
+        dataset = MemmapLmDataset(lm_data_dir, max_sent_len=40, batch_size=4)
+
+        for pack_sentences in [False, True]:
+            collate_fn = MemmapLmDatasetCollate(
+                sos_id=1, eos_id=-1, blank_id=0, pack_sentences=pack_sentences
+            )
+            sampler = TokenBudgetBatchSampler(
+                dataset.sentence_lengths(),
+                max_tokens=100,
+                num_buckets=5,
+                pack_sentences=pack_sentences,
+                max_row_len=40,
+            )
+            seen = []
+            for batch in sampler:
+                x, y, lengths = collate_fn([dataset[batch]])[:3]
+                assert x.size(0) == 1 or x.numel() <= 100, x.shape
+                assert lengths.sum() == (sentence_lengths[batch[0]] + 1).sum()
+                for row, (start, end) in enumerate(zip(batch[1][:-1], batch[1][1:])):
+                    expected = [
+                        tokens[offsets[i] : offsets[i + 1]].tolist()
+                        for i in batch[0][start:end]
+                    ]
+                    n = lengths[row]
+                    assert x[row, :n].tolist() == sum([[1] + e for e in expected], [])
+                    assert y[row, :n].tolist() == sum([e + [-1] for e in expected], [])
+                seen.extend(batch[0].tolist())
+            assert sorted(seen) == list(range(len(sentence_lengths)))
+
+
+def main():
+    dataset, sentences, words = _get_lm_dataset()
 
     collate_fn = LmDatasetCollate(sos_id=1, eos_id=-1, blank_id=0)
     dataloader = torch.utils.data.DataLoader(
@@ -66,6 +151,9 @@ def main():
         print(i)
     # I've checked the output manually; the output is as expected.
 
+    _check_memmap_dataset(dataset, sentences, words)
+    test_token_budget_batch_sampler()
+
 
 if __name__ == "__main__":
     main()
@@ -145,6 +145,34 @@ def get_parser():
         help="LM validation data",
     )
 
+    parser.add_argument(
+        "--num-workers",
+        type=int,
+        default=0,
+        help="""Number of dataloader workers. If --lm-data is a directory
+        generated by ./local/convert_lm_data_to_memmap.py, the workers share
+        the memory-mapped data instead of copying it.""",
+    )
+
+    parser.add_argument(
+        "--max-tokens",
+        type=int,
+        default=0,
+        help="""If positive, create batches with at most this number of
+        tokens, including padding, instead of using --batch-size. Sentences
+        of similar lengths are put into the same batch, see --num-buckets.
+        It requires --lm-data and --lm-data-valid to be directories generated
+        by ./local/convert_lm_data_to_memmap.py.""",
+    )
+
+    parser.add_argument(
+        "--num-buckets",
+        type=int,
+        default=30,
+        help="""Number of length buckets used with --max-tokens. More buckets
+        give less padding.""",
+    )
+
     parser.add_argument(
         "--vocab-size",
         type=int,
@@ -639,7 +667,7 @@ def run(rank, world_size, args):
 
     # Note: No learning rate scheduler is used here
     for epoch in range(params.start_epoch, params.num_epochs):
-        if is_distributed:
+        if hasattr(train_dl.sampler, "set_epoch"):
             train_dl.sampler.set_epoch(epoch)
 
         params.cur_epoch = epoch
@@ -16,12 +16,17 @@
 # The smoothing algorithm is based on: http://www.speech.sri.com/projects/srilm/manpages/ngram-discount.7.html
 
 import argparse
+import hashlib
 import io
 import math
 import os
 import re
 import sys
-from collections import Counter, defaultdict
+import tempfile
+from collections import Counter, defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
 
 parser = argparse.ArgumentParser(
     description="""
@@ -43,6 +48,28 @@ parser.add_argument(
 parser.add_argument(
     "-verbose", type=int, default=0, choices=[0, 1, 2, 3, 4, 5], help="Verbose level"
 )
+parser.add_argument(
+    "-num-jobs",
+    type=int,
+    default=0,
+    help="""If positive, count n-grams with this number of processes and keep
+    the counts in numpy arrays, spilling them to disk while counting. This uses
+    much less memory than the default mode and produces the same output.
+    Use it for large corpora.""",
+)
+parser.add_argument(
+    "-lines-per-shard",
+    type=int,
+    default=100000,
+    help="Number of lines counted by a process at a time. Used if -num-jobs > 0",
+)
+parser.add_argument(
+    "-tmp-dir",
+    type=str,
+    default=None,
+    help="""Directory for the temporary count files. Defaults to the system
+    temporary directory. Used if -num-jobs > 0""",
+)
 args = parser.parse_args()
 
 # For encoding-agnostic scripts, we assume byte stream as input.
@@ -423,10 +450,440 @@ class NgramCounts:
                     print(line, file=fout)
             print("", file=fout)
         print("\\end\\", file=fout)
+        fout.flush()
+
+
+def hash_word(word):
+    # Map a word to a signed 64-bit integer. Collisions are detected when the
+    # vocabularies of the shards are merged.
+    digest = hashlib.blake2b(word.encode(default_encoding), digest_size=8).digest()
+    return int.from_bytes(digest, "little", signed=True)
+
+
+def reduce_ngrams(ngrams, counts, first_pos):
+    # Sort the n-grams, given as rows of word ids, and sum the counts of
+    # identical ones. first_pos is the position of the first occurrence.
+    if ngrams.shape[0] == 0:
+        return ngrams, counts, first_pos
+    order = np.lexsort(ngrams.T[::-1])
+    ngrams = ngrams[order]
+    counts = counts[order]
+    first_pos = first_pos[order]
+
+    is_new = np.ones(ngrams.shape[0], dtype=bool)
+    is_new[1:] = np.any(ngrams[1:] != ngrams[:-1], axis=1)
+    index = np.flatnonzero(is_new)
+    return (
+        ngrams[index],
+        np.add.reduceat(counts, index),
+        np.minimum.reduceat(first_pos, index),
+    )
+
+
+def count_shard(shard_index, lines, ngram_order, bos_symbol, eos_symbol, filename):
+    # Count the n-grams of all orders in the lines of a shard and save them,
+    # sorted, to `filename`. Words are represented by hash_word().
+    # The position of a token is shard_index << 40 plus its index in the
+    # shard, so that positions follow the order of the input.
+    # Returns a dict mapping the hashes to the words of the shard.
+    word_to_index = dict()
+    flat = []
+    line_ends = []
+    for line in lines:
+        if line == "":
+            words = [bos_symbol, eos_symbol]
+        else:
+            words = [bos_symbol] + whitespace.split(line) + [eos_symbol]
+        flat.extend(word_to_index.setdefault(w, len(word_to_index)) for w in words)
+        line_ends.append(len(flat))
+
+    hashes = np.array([hash_word(w) for w in word_to_index], dtype=np.int64)
+    ids = hashes[np.array(flat, dtype=np.int64)]
+    line_ends = np.array(line_ends, dtype=np.int64)
+    ends = np.repeat(line_ends, np.diff(line_ends, prepend=0))
+    positions = np.arange(ids.shape[0], dtype=np.int64)
+
+    arrays = dict()
+    for order in range(1, ngram_order + 1):
+        starts = positions[positions + order <= ends]
+        ngrams = np.stack([ids[starts + i] for i in range(order)], axis=1)
+        ngrams, counts, first_pos = reduce_ngrams(
+            ngrams,
+            np.ones(starts.shape[0], dtype=np.int64),
+            (shard_index << 40) + starts,
+        )
+        arrays["ngrams_{0}".format(order)] = ngrams
+        arrays["counts_{0}".format(order)] = counts
+        arrays["first_pos_{0}".format(order)] = first_pos
+
+    np.savez(filename, **arrays)
+    return dict(zip(hashes.tolist(), word_to_index.keys()))
+
+
+def merge_count_files(filenames, order, filename, remove_inputs):
+    # Merge the n-grams of the given order in the count files into one file.
+    parts = []
+    for f in filenames:
+        with np.load(f) as data:
+            parts.append(
+                tuple(
+                    data["{0}_{1}".format(name, order)]
+                    for name in ("ngrams", "counts", "first_pos")
+                )
+            )
+        if remove_inputs:
+            os.remove(f)
+
+    ngrams, counts, first_pos = reduce_ngrams(
+        *[np.concatenate(arrays) for arrays in zip(*parts)]
+    )
+    np.savez(
+        filename,
+        **{
+            "ngrams_{0}".format(order): ngrams,
+            "counts_{0}".format(order): counts,
+            "first_pos_{0}".format(order): first_pos,
+        }
+    )
+    return filename
+
+
+def sequential_segment_sums(values, starts, lengths):
+    # Return the sums of values[starts[i]:starts[i] + lengths[i]]. Elements
+    # are added from left to right, so that the results are identical to
+    # summing them in a Python loop.
+    sums = np.zeros(starts.shape[0])
+    if starts.shape[0] == 0:
+        return sums
+    order = np.argsort(-lengths, kind="stable")
+    sorted_starts = starts[order]
+    sorted_lengths = lengths[order]
+    # num_active[i] is the number of segments with more than i elements
+    num_active = np.searchsorted(
+        -sorted_lengths, -np.arange(sorted_lengths[0]), side="left"
+    )
+    acc = np.zeros(starts.shape[0])
+    for i, n in enumerate(num_active.tolist()):
+        acc[:n] += values[sorted_starts[:n] + i]
+    sums[order] = acc
+    return sums
+
+
+class ShardedNgramCounts:
+    # The same as NgramCounts, but for large corpora. The input is split into
+    # shards of lines that are counted by a pool of processes. The counts of
+    # each shard are saved to disk as sorted arrays, which are merged for
+    # each order of n-grams. The discounting is then computed with numpy.
+    #
+    # After counting, the (n+1)-grams are stored in the n-th entry of the
+    # lists below, sorted by their word ids:
+    #   self.ngrams: the word ids of the n-grams, of shape (num_ngrams, n+1)
+    #   self.counts: the raw counts
+    #   self.first_pos: position of the first occurrence in the input, used
+    #       to print the n-grams in the same order as NgramCounts
+    #   self.hist_index: index of the history (the first n words) in the
+    #       (n-1)-th entry
+    #   self.suffix_index: index of the last n words in the (n-1)-th entry
+    #   self.keys: hist_index * vocab_size + the last word, which is sorted
+    #
+    # The "modified count" n(*_z) of an n-gram _z, i.e., the number of
+    # unique words preceding it, is the number of (n+1)-grams whose last n
+    # words are _z, so the sets of context words in CountsForHistory are not
+    # needed.
+    def __init__(
+        self,
+        ngram_order,
+        num_jobs,
+        lines_per_shard=100000,
+        tmp_dir=None,
+        bos_symbol="<s>",
+        eos_symbol="</s>",
+        merge_fanin=8,
+    ):
+        assert ngram_order >= 1
+        assert num_jobs >= 1
+        assert lines_per_shard >= 1
+
+        self.ngram_order = ngram_order
+        self.num_jobs = num_jobs
+        self.lines_per_shard = lines_per_shard
+        self.tmp_dir = tmp_dir
+        self.bos_symbol = bos_symbol
+        self.eos_symbol = eos_symbol
+        self.merge_fanin = merge_fanin
+
+        self.d = []  # list of discounting factor for each order of ngram
+
+    def add_raw_counts_from_standard_input(self):
+        # byte stream as input
+        infile = io.TextIOWrapper(sys.stdin.buffer, encoding=default_encoding)
+        self.add_raw_counts_from_lines(line.strip(strip_chars) for line in infile)
+
+    def add_raw_counts_from_file(self, filename):
+        with open(filename, encoding=default_encoding) as fp:
+            lines = (line.strip(strip_chars) for line in fp)
+            if self.ngram_order == 1:
+                lines = (line.split()[0] for line in lines)
+            self.add_raw_counts_from_lines(lines)
+
+    def add_raw_counts_from_lines(self, lines):
+        # 'lines' is an iterable of stripped lines. It is read only once.
+        with tempfile.TemporaryDirectory(
+            dir=self.tmp_dir
+        ) as tmp_dir, ProcessPoolExecutor(self.num_jobs) as executor:
+            shard_files, vocab, lines_processed = self._count_shards(
+                lines, tmp_dir, executor
+            )
+            count_files = self._merge_shards(shard_files, tmp_dir, executor)
+
+            ngrams = []
+            self.counts = []
+            self.first_pos = []
+            for order in range(1, self.ngram_order + 1):
+                with np.load(count_files[order]) as data:
+                    ngrams.append(data["ngrams_{0}".format(order)])
+                    self.counts.append(data["counts_{0}".format(order)])
+                    self.first_pos.append(data["first_pos_{0}".format(order)])
+
+        if lines_processed == 0 or args.verbose > 0:
+            print(
+                "make_phone_lm.py: processed {0} lines of input".format(
+                    lines_processed
+                ),
+                file=sys.stderr,
+            )
+
+        # Every word is a unigram. Map the hashes to the index of the word
+        # in the sorted unigrams.
+        vocab_hashes = ngrams[0][:, 0]
+        self.vocab = [vocab[h] for h in vocab_hashes.tolist()]
+        self.vocab_size = len(self.vocab)
+        self.ngrams = [np.searchsorted(vocab_hashes, x) for x in ngrams]
+
+        self.keys = []
+        self.hist_index = []
+        self.suffix_index = []
+        for n in range(self.ngram_order):
+            x = self.ngrams[n]
+            if n == 0:
+                hist_index = np.zeros(x.shape[0], dtype=np.int64)
+                suffix_index = hist_index
+            else:
+                hist_index = self._find(x[:, :-1])
+                suffix_index = self._find(x[:, 1:])
+            self.hist_index.append(hist_index)
+            self.suffix_index.append(suffix_index)
+            self.keys.append(hist_index * self.vocab_size + x[:, -1])
+
+    def _count_shards(self, lines, tmp_dir, executor):
+        # Submit the shards to the pool, keeping at most 2 * num_jobs shards
+        # in memory.
+        def shards():
+            shard = []
+            for line in lines:
+                shard.append(line)
+                if len(shard) == self.lines_per_shard:
+                    yield shard
+                    shard = []
+            yield shard
+
+        shard_files = []
+        vocab = dict()
+        lines_processed = 0
+        futures = deque()
+
+        def wait_for_first():
+            for h, word in futures.popleft().result().items():
+                if vocab.setdefault(h, word) != word:
+                    raise ValueError(
+                        "Words {0} and {1} have the same hash".format(vocab[h], word)
+                    )
+
+        for shard_index, shard in enumerate(shards()):
+            if len(shard) == 0 and shard_index > 0:
+                break
+            filename = os.path.join(tmp_dir, "shard-{0}.npz".format(shard_index))
+            futures.append(
+                executor.submit(
+                    count_shard,
+                    shard_index,
+                    shard,
+                    self.ngram_order,
+                    self.bos_symbol,
+                    self.eos_symbol,
+                    filename,
+                )
+            )
+            shard_files.append(filename)
+            lines_processed += len(shard)
+            if len(futures) >= 2 * self.num_jobs:
+                wait_for_first()
+
+        while futures:
+            wait_for_first()
+
+        return shard_files, vocab, lines_processed
+
+    def _merge_shards(self, shard_files, tmp_dir, executor):
+        # Merge the count files of the shards for each order, merge_fanin
+        # files at a time. Returns a dict mapping the order to the merged file.
+        files = {o: shard_files for o in range(1, self.ngram_order + 1)}
+        merge_round = 0
+        while any(len(f) > 1 for f in files.values()):
+            futures = dict()
+            for order, filenames in files.items():
+                if len(filenames) == 1:
+                    continue
+                futures[order] = [
+                    executor.submit(
+                        merge_count_files,
+                        filenames[i : i + self.merge_fanin],
+                        order,
+                        os.path.join(
+                            tmp_dir,
+                            "merged-{0}-{1}-{2}.npz".format(order, merge_round, i),
+                        ),
+                        merge_round > 0,
+                    )
+                    for i in range(0, len(filenames), self.merge_fanin)
+                ]
+            for order, fs in futures.items():
+                files[order] = [f.result() for f in fs]
+            merge_round += 1
+        return {order: f[0] for order, f in files.items()}
+
+    def _find(self, ngrams):
+        # Return the index of each row of 'ngrams' in the table of its order.
+        index = np.searchsorted(self.keys[0], ngrams[:, 0])
+        for n in range(1, ngrams.shape[1]):
+            index = np.searchsorted(
+                self.keys[n], index * self.vocab_size + ngrams[:, n]
+            )
+        return index
+
+    def _sum_over_history(self, n, x):
+        # Return the sums of x over the n-grams of each history
+        num_hists = 1 if n == 0 else self.ngrams[n - 1].shape[0]
+        return np.bincount(self.hist_index[n], weights=x, minlength=num_hists)
+
+    def cal_discounting_constants(self):
+        # See NgramCounts.cal_discounting_constants()
+        self.d = [0]
+        for n in range(1, self.ngram_order):
+            n1 = int(np.count_nonzero(self.counts[n] == 1))
+            n2 = int(np.count_nonzero(self.counts[n] == 2))
+            assert n1 + 2 * n2 > 0
+
+            self.d.append(max(0.1, n1 * 1.0) / (n1 + 2 * n2))
+
+    def cal_f(self):
+        # See NgramCounts.cal_f()
+        self.f = [None] * self.ngram_order
+        for n in range(self.ngram_order):
+            counts = self.counts[n]
+            total_count = self._sum_over_history(n, counts)[self.hist_index[n]]
+            raw_f = np.maximum(counts - self.d[n], 0) / total_count
+
+            if n == self.ngram_order - 1:
+                self.f[n] = raw_f
+                continue
+
+            n_star_z = np.bincount(self.suffix_index[n + 1], minlength=counts.shape[0])
+            n_star_star = self._sum_over_history(n, n_star_z)[self.hist_index[n]]
+            with np.errstate(divide="ignore", invalid="ignore"):
+                modified_f = np.maximum(n_star_z - self.d[n], 0) / n_star_star
+            # patterns begin with <s>, they do not have "modified count",
+            # so use raw count instead
+            self.f[n] = np.where(n_star_star != 0, modified_f, raw_f)
+
+    def cal_bow(self):
+        # See NgramCounts.cal_bow(). A NaN means there is no back-off weight.
+        # The sums are computed over the words of each history in the same
+        # order as in NgramCounts, so the results are identical.
+        self.bow = [None] * self.ngram_order
+        n = self.ngram_order - 1
+        self.bow[n] = np.full(self.counts[n].shape[0], np.nan)
+
+        eos = self.vocab.index(self.eos_symbol) if self.ngram_order > 1 else -1
+        for n in range(0, self.ngram_order - 1):
+            # a_z are the (n+2)-grams and a_ is their history
+            hist_index = self.hist_index[n + 1]
+            order = np.lexsort((self.first_pos[n + 1], hist_index))
+            lengths = np.bincount(hist_index, minlength=self.counts[n].shape[0])
+            starts = np.cumsum(lengths) - lengths
+
+            sum_z1_f_a_z = sequential_segment_sums(
+                self.f[n + 1][order], starts, lengths
+            )
+            sum_z1_f_z = sequential_segment_sums(
+                self.f[n][self.suffix_index[n + 1][order]], starts, lengths
+            )
+
+            is_eos = self.ngrams[n][:, -1] == eos
+            assert np.all(lengths[~is_eos] > 0)
+
+            with np.errstate(divide="ignore", invalid="ignore"):
+                bow = (1.0 - sum_z1_f_a_z) / (1.0 - sum_z1_f_z)
+            self.bow[n] = np.where(~is_eos & (sum_z1_f_z < 1), bow, np.nan)
+
+    def print_as_arpa(
+        self, fout=io.TextIOWrapper(sys.stdout.buffer, encoding="latin-1")
+    ):
+        # print as ARPA format, in the same order as NgramCounts.print_as_arpa()
+
+        print("\\data\\", file=fout)
+        for hist_len in range(self.ngram_order):
+            # print the number of n-grams.
+            print(
+                "ngram {0}={1}".format(hist_len + 1, self.counts[hist_len].shape[0]),
+                file=fout,
+            )
+
+        print("", file=fout)
+
+        for hist_len in range(self.ngram_order):
+            print("\\{0}-grams:".format(hist_len + 1), file=fout)
+
+            # NgramCounts keeps the histories and the words of each history
+            # in the order of their first occurrence.
+            first_pos = self.first_pos[hist_len]
+            hist_index = self.hist_index[hist_len]
+            hist_first_pos = np.zeros(hist_index.max(initial=0) + 1, dtype=np.int64)
+            if hist_index.shape[0] > 0:
+                starts = np.flatnonzero(np.diff(hist_index, prepend=-1))
+                hist_first_pos[hist_index[starts]] = np.minimum.reduceat(
+                    first_pos, starts
+                )
+            order = np.lexsort((first_pos, hist_first_pos[hist_index]))
+
+            ngrams = self.ngrams[hist_len][order].tolist()
+            f = self.f[hist_len][order].tolist()
+            bow = self.bow[hist_len][order].tolist()
+            for ngram, prob, b in zip(ngrams, f, bow):
+                if prob == 0:  # f(<s>) is always 0
+                    prob = 1e-99
+
+                line = "{0}\t{1}".format(
+                    "%.7f" % math.log10(prob), " ".join(self.vocab[w] for w in ngram)
+                )
+                if not math.isnan(b):
+                    line += "\t{0}".format("%.7f" % math.log10(b))
+                print(line, file=fout)
+            print("", file=fout)
+        print("\\end\\", file=fout)
+        fout.flush()
 
 
 if __name__ == "__main__":
-    ngram_counts = NgramCounts(args.ngram_order)
+    if args.num_jobs > 0:
+        ngram_counts = ShardedNgramCounts(
+            args.ngram_order,
+            num_jobs=args.num_jobs,
+            lines_per_shard=args.lines_per_shard,
+            tmp_dir=args.tmp_dir,
+        )
+    else:
+        ngram_counts = NgramCounts(args.ngram_order)
 
     if args.text is None:
         ngram_counts.add_raw_counts_from_standard_input()
@@ -25,18 +25,29 @@ Usage:
 This file is from Kaldi `egs/wsj/s5/utils/lang/ngram_entropy_pruning.py`.
 This is an implementation of ``Entropy-based Pruning of Backoff Language Models''
 in the same way as SRILM.
+
+By default, the LM is kept in numpy arrays (see ArrayArpa), which gives the
+same pruned LM as the original implementation (-implementation dict) with much
+less memory and time. Use -num-jobs to compute the pruning criterion with
+several processes.
 """
 
 
 import argparse
+import functools
 import gzip
 import logging
 import math
 import re
-from collections import OrderedDict, defaultdict
+import resource
+from array import array
+from collections import OrderedDict, defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor
 from enum import Enum, unique
 from io import StringIO
 
+import numpy as np
+
 parser = argparse.ArgumentParser(
     description="""
     Prune an n-gram language model based on the relative entropy 
@@ -69,6 +80,23 @@ parser.add_argument(
     choices=[0, 1, 2, 3, 4, 5],
     help="Verbose level, where 0 is most noisy; 5 is most silent",
 )
+parser.add_argument(
+    "-implementation",
+    type=str,
+    default="array",
+    choices=["array", "dict"],
+    help="""The data structure of the LM. "array" uses ArrayArpa, which needs
+    much less memory and time than "dict" and gives the same pruned LM.
+    "dict" uses Arpa, which also logs the criterion of each ngram with
+    -verbose 1, and supports LMs in which the history of an ngram may be
+    missing.""",
+)
+parser.add_argument(
+    "-num-jobs",
+    type=int,
+    default=1,
+    help="Number of processes to prune the LM. Used only with -implementation array.",
+)
 args = parser.parse_args()
 
 default_encoding = args.encoding
@@ -581,6 +609,565 @@ def prune(lm, threshold, minorder):
     return
 
 
+def stolcke_pruned_flags(log_p, backoff_prob, lengths, log_bow, h_log_p, threshold):
+    # The Stolcke criterion of prune() for the ngrams of several contexts.
+    # The ngrams of each context are consecutive in log_p and backoff_prob,
+    # and there are lengths[i] of them for the i-th context, whose
+    # back-off weight is log_bow[i] and marginal probability is h_log_p[i].
+    # All arguments are lists of Python numbers. The computation is done with
+    # the same expressions as in prune(), since numpy's power and log may
+    # differ from the ones of the math library in the last bit, which would
+    # change the pruned LM.
+    base = Arpa.base
+    ans = []
+    start = 0
+    for length, old_log_bow, context_log_p in zip(lengths, log_bow, h_log_p):
+        end = start + length
+        numerator, denominator = sum_numerator_denominator(
+            log_p[start:end], backoff_prob[start:end]
+        )
+        context_p = base**context_log_p
+        for p, bp in zip(log_p[start:end], backoff_prob[start:end]):
+            new_log_bow = math.log(numerator + base**p, base) - math.log(
+                denominator + base**bp, base
+            )
+            delta_prob = bp + new_log_bow - p
+            delta_entropy = -context_p * (
+                (base**p) * delta_prob + numerator * (new_log_bow - old_log_bow)
+            )
+            perp_change = base**delta_entropy - 1.0
+            ans.append(threshold > 0 and perp_change < threshold)
+        start = end
+    return ans
+
+
+def backoff_weights(log_p, lower_log_p, lengths):
+    # The back-off weights of several contexts, laid out as in
+    # stolcke_pruned_flags(). See the recomputation at the end of prune().
+    base = Arpa.base
+    ans = []
+    start = 0
+    for length in lengths:
+        end = start + length
+        numerator, denominator = sum_numerator_denominator(
+            log_p[start:end], lower_log_p[start:end]
+        )
+        ans.append(math.log(numerator, base) - math.log(denominator, base))
+        start = end
+    return ans
+
+
+def sum_numerator_denominator(log_p, lower_log_p):
+    # See compute_numerator_denominator()
+    base = Arpa.base
+    log_sum_seen_h = -math.inf
+    log_sum_seen_h_lower = -math.inf
+    for p, lp in zip(log_p, lower_log_p):
+        log_sum_seen_h = add_log_p(log_sum_seen_h, p, base)
+        log_sum_seen_h_lower = add_log_p(log_sum_seen_h_lower, lp, base)
+
+    numerator = 1.0 - base**log_sum_seen_h
+    denominator = 1.0 - base**log_sum_seen_h_lower
+    return numerator, denominator
+
+
+def peak_memory_mb():
+    # ru_maxrss is in kilobytes on Linux
+    self_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children_kb = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return max(self_kb, children_kb) / 1024
+
+
+class ArrayArpa:
+    """
+    An array-backed ARPA LM for entropy pruning. It produces the same pruned
+    LM as Arpa and prune() with a fraction of the memory and time.
+
+    Words are represented by their ids in self.vocab. The k-grams are kept in
+    the order of the file; for order k (1 <= k <= self.order()):
+      self.word[k]:     the id of the last word of each k-gram
+      self.hist[k]:     the index of its history, i.e., its first k-1 words,
+                        in the (k-1)-grams, or 0 (the empty history) if k = 1
+      self.log_p[k]:    the log10 probabilities
+      self.log_bo[k]:   the log10 back-off weights, NaN if absent
+      self.sorted_keys[k], self.sorted_index[k]:
+                        the sorted keys (hist << 32 | word) of the k-grams
+                        and their indexes, to look up k-grams
+    The history of each k-gram must itself be a (k-1)-gram of the LM, which
+    is the case for LMs written by SRILM, KenLM or make_kn_lm.py.
+
+    The probabilities and back-off weights that are integers in the file
+    are flagged in self.log_p_is_int[k] and self.log_bo_is_int[k], so that
+    they are written back in the same way as Arpa.write() does.
+    """
+
+    WORD_BITS = 32
+
+    def __init__(self, path=None, encoding=None):
+        self._counts = OrderedDict()
+        self.vocab = []
+        self.word_to_id = dict()
+
+        self.word = {}
+        self.hist = {}
+        self.log_p = {}
+        self.log_bo = {}
+        self.log_p_is_int = {}
+        self.log_bo_is_int = {}
+        self.sorted_keys = {}
+        self.sorted_index = {}
+
+        # Set by prune()
+        self.exists = None
+        self.new_log_bo = {}
+
+        if path is not None:
+            self.loadf(path, encoding)
+
+    def order(self):
+        return max(self._counts.keys(), default=None)
+
+    def num_ngrams(self, order):
+        return self.word[order].shape[0]
+
+    def counts(self):
+        ans = []
+        for order, count in sorted(self._counts.items()):
+            if self.exists is not None and order in self.exists:
+                # See Arpa.update_counts()
+                new_count = int(np.count_nonzero(self.exists[order]))
+                if new_count > 0:
+                    count = new_count
+            ans.append((order, count))
+        return ans
+
+    def loadf(self, path, encoding=None):
+        """Load the first LM of an ARPA file (.arpa, .gz)."""
+        path = str(path)
+        if path.endswith(".gz"):
+            with gzip.open(path, mode="rt", encoding=encoding) as f:
+                self.load(f)
+        else:
+            with open(path, mode="rt", encoding=encoding) as f:
+                self.load(f)
+
+    def load(self, fp):
+        # The same states as ArpaParser
+        state = ArpaParser.State.DATA
+        line = None
+        for line in fp:
+            line = line.strip()
+            if state == ArpaParser.State.DATA:
+                if line == "\\data\\":
+                    state = ArpaParser.State.COUNT
+            elif state == ArpaParser.State.COUNT:
+                match = ArpaParser.re_count.match(line)
+                if match:
+                    self._counts[int(match.group(1))] = int(match.group(2))
+                elif not line:
+                    state = ArpaParser.State.HEADER
+                else:
+                    raise Exception(line)
+            elif state == ArpaParser.State.HEADER:
+                match = ArpaParser.re_header.match(line)
+                if match:
+                    order = int(match.group(1))
+                    if order != len(self.word) + 1:
+                        raise ValueError(
+                            "Expect the {}-grams, given {}".format(
+                                len(self.word) + 1, line
+                            )
+                        )
+                    self._load_entries(fp, order)
+                elif line == "\\end\\":
+                    # Like the __main__ part, only the first LM is used
+                    return
+                elif not line:
+                    pass
+                else:
+                    raise Exception(line)
+        raise Exception(line)
+
+    def _load_entries(self, fp, order):
+        # Read the entries of `order` up to the next empty line
+        words = array("i")
+        log_p = array("d")
+        log_p_is_int = bytearray()
+        log_bo = array("d")
+        log_bo_is_int = bytearray()
+
+        re_entry = ArpaParser.re_entry
+        float_or_int = ArpaParser._float_or_int
+        word_to_id = self.word_to_id
+        vocab = self.vocab
+        for line in fp:
+            line = line.strip()
+            match = re_entry.match(line)
+            if not match:
+                if not line:
+                    break
+                raise Exception(line)
+
+            ngram = match.group(4).split(" ")
+            if len(ngram) != order:
+                raise ValueError("Expect a {}-gram, given {}".format(order, line))
+            for w in ngram:
+                word_id = word_to_id.get(w)
+                if word_id is None:
+                    word_id = len(vocab)
+                    word_to_id[w] = word_id
+                    vocab.append(w)
+                words.append(word_id)
+
+            p = float_or_int(match.group(1))
+            log_p.append(p)
+            log_p_is_int.append(isinstance(p, int))
+
+            bo_match = match.group(7)
+            bo = float_or_int(bo_match) if bo_match else math.nan
+            log_bo.append(bo)
+            log_bo_is_int.append(isinstance(bo, int))
+        else:
+            raise Exception("Unexpected end of file in the {}-grams".format(order))
+
+        words = np.frombuffer(words, dtype=np.int32).reshape(-1, order)
+        self._add_order(
+            words.astype(np.int64),
+            np.frombuffer(log_p, dtype=np.float64),
+            np.frombuffer(log_p_is_int, dtype=np.bool_),
+            np.frombuffer(log_bo, dtype=np.float64),
+            np.frombuffer(log_bo_is_int, dtype=np.bool_),
+        )
+
+    def _add_order(self, words, log_p, log_p_is_int, log_bo, log_bo_is_int):
+        order = words.shape[1]
+        if order == 1:
+            hist = np.zeros(words.shape[0], dtype=np.int64)
+        else:
+            hist = self._find(words[:, :-1])
+            if np.any(hist < 0):
+                i = int(np.flatnonzero(hist < 0)[0])
+                raise ValueError(
+                    "The history of the {}-gram {} is not in the LM".format(
+                        order, " ".join(self.vocab[w] for w in words[i])
+                    )
+                )
+
+        keys = (hist << self.WORD_BITS) | words[:, -1]
+        sorted_index = np.argsort(keys, kind="stable")
+        sorted_keys = keys[sorted_index]
+        if np.any(sorted_keys[1:] == sorted_keys[:-1]):
+            raise ValueError("There are duplicate {}-grams".format(order))
+
+        self.word[order] = words[:, -1]
+        self.hist[order] = hist
+        self.log_p[order] = log_p
+        self.log_p_is_int[order] = log_p_is_int
+        self.log_bo[order] = log_bo
+        self.log_bo_is_int[order] = log_bo_is_int
+        self.sorted_keys[order] = sorted_keys
+        self.sorted_index[order] = sorted_index
+
+    def _lookup(self, order, hist, word):
+        # Return the index of the ngrams (hist, word) in the ngrams of
+        # `order`, or -1 for the ones not in the LM. hist is -1 for histories
+        # not in the LM.
+        sorted_keys = self.sorted_keys[order]
+        if sorted_keys.shape[0] == 0:
+            return np.full(word.shape[0], -1, dtype=np.int64)
+        keys = (hist << self.WORD_BITS) | word
+        pos = np.searchsorted(sorted_keys, keys)
+        pos = np.minimum(pos, sorted_keys.shape[0] - 1)
+        found = (sorted_keys[pos] == keys) & (hist >= 0)
+        return np.where(found, self.sorted_index[order][pos], -1)
+
+    def _find(self, words):
+        # Return the index of each row of `words` in the ngrams of its
+        # order, or -1 for the ones not in the LM. An empty row is the empty
+        # history, whose index is 0.
+        index = np.zeros(words.shape[0], dtype=np.int64)
+        for n in range(words.shape[1]):
+            index = self._lookup(n + 1, index, words[:, n])
+        return index
+
+    def _words(self, order, index):
+        # Return the word ids of the given ngrams of `order`
+        ans = np.empty((index.shape[0], order), dtype=np.int64)
+        for n in range(order, 0, -1):
+            ans[:, n - 1] = self.word[n][index]
+            index = self.hist[n][index]
+        return ans
+
+    def _log_p_raw_of_suffix(self, order, index, exists, log_bo):
+        # Return Arpa.log_p_raw(ngram[1:]) for the given ngrams of `order`,
+        # in the LM that contains the ngrams flagged in `exists` and with
+        # back-off weights `log_bo` (0 if absent). The sums are done in the
+        # same order as Arpa.log_p_raw().
+        words = self._words(order, index)
+        ans = None
+        for n in range(1, order):
+            # The suffix of length n and its history
+            hist = self._find(words[:, order - n : order - 1])
+            ngram = self._lookup(n, hist, words[:, -1])
+            found = ngram >= 0
+            found[found] = exists[n][ngram[found]]
+            log_p = self.log_p[n][np.maximum(ngram, 0)]
+            if n == 1:
+                if not np.all(found):
+                    raise KeyError
+                ans = log_p
+            else:
+                bo = np.where(hist >= 0, log_bo[n - 1][np.maximum(hist, 0)], 0.0)
+                ans = np.where(found, log_p, bo + ans)
+        return ans
+
+    def _log_joint_prob(self, order, index):
+        # Return Arpa.log_joint_prob() of the given ngrams of `order`
+        sos = self.word_to_id.get(Arpa.SOS, -1)
+        eos = self._find(np.array([[self.word_to_id.get(Arpa.EOS, -1)]]))
+        ans = self.log_p[order][index]
+        for n in range(order - 1, 0, -1):
+            index = self.hist[n + 1][index]
+            log_p = self.log_p[n][index]
+            if n == 1:
+                # See the comment in Arpa.log_joint_prob()
+                is_sos = self.word[1][index] == sos
+                if np.any(is_sos):
+                    if eos[0] < 0:
+                        raise KeyError
+                    log_p = np.where(is_sos, self.log_p[1][eos[0]], log_p)
+            ans = ans + log_p
+        return ans
+
+    def _group_by_history(self, order, index):
+        # Sort the ngrams of `order` given by `index` by their history,
+        # keeping their order in the file within a history. Return the
+        # sorted index, the histories and the number of ngrams of each.
+        index = index[np.argsort(self.hist[order][index], kind="stable")]
+        hist = self.hist[order][index]
+        is_first = np.ones(hist.shape[0], dtype=np.bool_)
+        is_first[1:] = hist[1:] != hist[:-1]
+        starts = np.flatnonzero(is_first)
+        lengths = np.diff(np.append(starts, hist.shape[0]))
+        return index, hist[starts], lengths
+
+    def _map_contexts(
+        self, func, ngram_args, context_args, lengths, executor, chunk_size, desc
+    ):
+        # Apply func(*ngram_args, lengths, *context_args) to chunks of the
+        # contexts, with the executor if not None, and concatenate the
+        # results. ngram_args are arrays over the ngrams of the contexts
+        # and context_args are arrays over the contexts.
+        ends = np.cumsum(lengths)
+        total = int(ends[-1]) if ends.shape[0] > 0 else 0
+        bounds = np.unique(
+            np.concatenate(
+                (
+                    [0],
+                    np.searchsorted(ends, np.arange(chunk_size, total, chunk_size)) + 1,
+                    [lengths.shape[0]],
+                )
+            )
+        ).tolist()
+
+        def chunks():
+            for begin, end in zip(bounds[:-1], bounds[1:]):
+                first = int(ends[begin - 1]) if begin > 0 else 0
+                last = int(ends[end - 1])
+                args = [a[first:last].tolist() for a in ngram_args]
+                args.append(lengths[begin:end].tolist())
+                args.extend(a[begin:end].tolist() for a in context_args)
+                yield end, args
+
+        ans = []
+
+        def add_result(end, result):
+            ans.append(np.array(result))
+            logging.info("%s: processed %d/%d contexts" % (desc, end, len(lengths)))
+
+        if executor is None:
+            for end, args in chunks():
+                add_result(end, func(*args))
+        else:
+            futures = deque()
+            for end, args in chunks():
+                futures.append((end, executor.submit(func, *args)))
+                # Keep at most 2 chunks per process in memory
+                if len(futures) >= 2 * executor._max_workers:
+                    end, f = futures.popleft()
+                    add_result(end, f.result())
+            while futures:
+                end, f = futures.popleft()
+                add_result(end, f.result())
+
+        return np.concatenate(ans) if ans else np.zeros(0)
+
+    def prune(self, threshold, minorder, num_jobs=1, chunk_size=100000):
+        """
+        Prune the LM in the same way as prune(lm, threshold, minorder).
+        The contexts of each order are processed in chunks of about
+        chunk_size ngrams, by num_jobs processes if num_jobs > 1.
+        """
+        max_order = self.order()
+        min_order = max(minorder - 1, 1) + 1  # the lowest order to prune
+
+        self.exists = {
+            n: np.ones(self.num_ngrams(n), dtype=np.bool_)
+            for n in range(1, max_order + 1)
+        }
+        # Back-off weights of the original LM, 0 if absent
+        log_bo = {n: np.nan_to_num(self.log_bo[n], nan=0.0) for n in self.log_bo}
+
+        executor = ProcessPoolExecutor(num_jobs) if num_jobs > 1 else None
+        try:
+            for i in range(max_order, min_order - 1, -1):
+                logging.info("processing %d-grams ..." % i)
+                index, hists, lengths = self._group_by_history(
+                    i, np.arange(self.num_ngrams(i))
+                )
+                # Pruning the i-grams changes neither the lower-order ngrams
+                # nor the back-off weights, so all the quantities of the
+                # criterion are computed with the original LM.
+                backoff_prob = self._log_p_raw_of_suffix(i, index, self.exists, log_bo)
+                h_log_p = self._log_joint_prob(i - 1, hists)
+
+                pruned = self._map_contexts(
+                    functools.partial(stolcke_pruned_flags, threshold=threshold),
+                    [self.log_p[i][index], backoff_prob],
+                    [log_bo[i - 1][hists], h_log_p],
+                    lengths,
+                    executor,
+                    chunk_size,
+                    "%d-grams" % i,
+                ).astype(np.bool_)
+
+                # Make sure we don't prune ngrams whose backoff nodes are needed
+                if i < max_order:
+                    num_children = np.bincount(
+                        self.hist[i + 1][self.exists[i + 1]],
+                        minlength=self.num_ngrams(i),
+                    )
+                    pruned &= num_children[index] == 0
+
+                self.exists[i][index[pruned]] = False
+                logging.info("pruned %d %d-grams" % (np.count_nonzero(pruned), i))
+                logging.info("peak memory: %.1f MB" % peak_memory_mb())
+
+            # Recompute the back-off weights of the contexts that still have
+            # ngrams, from low- to high-order. The other contexts of these
+            # orders are removed, see prune().
+            for i in range(min_order, max_order + 1):
+                logging.info("recomputing back-off weights of %d-grams ..." % (i - 1))
+                index, hists, lengths = self._group_by_history(
+                    i, np.flatnonzero(self.exists[i])
+                )
+                lower_log_p = self._log_p_raw_of_suffix(i, index, self.exists, log_bo)
+                new_log_bo = np.full(self.num_ngrams(i - 1), math.nan)
+                new_log_bo[hists] = self._map_contexts(
+                    backoff_weights,
+                    [self.log_p[i][index], lower_log_p],
+                    [],
+                    lengths,
+                    executor,
+                    chunk_size,
+                    "%d-gram contexts" % (i - 1),
+                )
+                self.new_log_bo[i - 1] = new_log_bo
+                log_bo[i - 1] = np.nan_to_num(new_log_bo, nan=0.0)
+        finally:
+            if executor is not None:
+                executor.shutdown()
+
+        logging.info("peak memory: %.1f MB" % peak_memory_mb())
+
+    def _ordered_ngrams(self, order):
+        # Return the indexes of the remaining ngrams of `order` in the order
+        # of Arpa._entries(). The contexts of Arpa are created for the ngrams
+        # with a back-off weight, in the order of the file, and then for the
+        # histories of the (order+1)-grams without one, in the order of their
+        # first ngram.
+        index = np.arange(self.num_ngrams(order))
+        if self.exists is not None:
+            index = index[self.exists[order]]
+        if order == 1:
+            return index
+        num_hists = self.num_ngrams(order - 1)
+        first_child = np.zeros(num_hists, dtype=np.int64)
+        hists, first = np.unique(self.hist[order], return_index=True)
+        first_child[hists] = first
+        context_pos = np.where(
+            np.isnan(self.log_bo[order - 1]),
+            num_hists + first_child,
+            np.arange(num_hists),
+        )
+        return index[np.lexsort((index, context_pos[self.hist[order][index]]))]
+
+    def _format(self, values, is_int):
+        # See Arpa._entry()
+        return [
+            str(int(v)) if i else str(round(v, Arpa.FLOAT_NDIGITS))
+            for v, i in zip(values.tolist(), is_int.tolist())
+        ]
+
+    def write(self, fp, block_size=1000000):
+        """Write the LM in the same way as Arpa.write()."""
+        fp.write("\n\\data\\\n")
+        for order, count in self.counts():
+            fp.write("ngram {}={}\n".format(order, count))
+        fp.write("\n")
+        for order, _ in self.counts():
+            fp.write("\\{}-grams:\n".format(order))
+            index = self._ordered_ngrams(order)
+            if order in self.new_log_bo:
+                log_bo = self.new_log_bo[order]
+                log_bo_is_int = np.zeros(log_bo.shape[0], dtype=np.bool_)
+            elif order < self.order():
+                log_bo = self.log_bo[order]
+                log_bo_is_int = self.log_bo_is_int[order]
+            else:
+                log_bo = None
+
+            for start in range(0, index.shape[0], block_size):
+                block = index[start : start + block_size]
+                probs = self._format(
+                    self.log_p[order][block], self.log_p_is_int[order][block]
+                )
+                ngrams = [
+                    " ".join([self.vocab[w] for w in words])
+                    for words in self._words(order, block).tolist()
+                ]
+                if log_bo is None:
+                    for prob, ngram in zip(probs, ngrams):
+                        fp.write("{}\t{}\n".format(prob, ngram))
+                    continue
+                backoffs = self._format(log_bo[block], log_bo_is_int[block])
+                has_bo = ~np.isnan(log_bo[block])
+                for prob, ngram, backoff, b in zip(
+                    probs, ngrams, backoffs, has_bo.tolist()
+                ):
+                    if b:
+                        fp.write("{}\t{}\t{}\n".format(prob, ngram, backoff))
+                    else:
+                        fp.write("{}\t{}\n".format(prob, ngram))
+            fp.write("\n")
+        fp.write("\\end\\\n")
+
+    def writef(self, path, encoding=None):
+        """Write the LM to path (.arpa, .gz)."""
+        path = str(path)
+        if path.endswith(".gz"):
+            with gzip.open(path, mode="wt", encoding=encoding) as f:
+                self.write(f)
+        else:
+            with open(path, mode="wt", encoding=encoding) as f:
+                self.write(f)
+
+
+def _star_call(func_and_args):
+    func, args = func_and_args
+    return func(*args)
+
+
 def check_h_is_valid(lm, h):
     sum_under_h = sum(
         [lm.base ** lm.log_p_raw(h + (w,)) for w in lm.vocabulary(sort=False)]
@@ -608,16 +1195,22 @@ def compare_two_apras(path1, path2):
 if __name__ == "__main__":
     # load an arpa file
     logging.info("Loading the arpa file from %s" % args.lm)
-    parser = ArpaParser()
-    models = parser.loadf(args.lm, encoding=default_encoding)
-    lm = models[0]  # ARPA files may contain several models.
+    if args.implementation == "array":
+        lm = ArrayArpa(args.lm, encoding=default_encoding)
+    else:
+        parser = ArpaParser()
+        models = parser.loadf(args.lm, encoding=default_encoding)
+        lm = models[0]  # ARPA files may contain several models.
     logging.info("Stats before pruning:")
     for i, cnt in lm.counts():
         logging.info("ngram %d=%d" % (i, cnt))
 
     # prune it, the language model will be modified in-place
     logging.info("Start pruning the model with threshold=%.3E..." % args.threshold)
-    prune(lm, args.threshold, args.minorder)
+    if args.implementation == "array":
+        lm.prune(args.threshold, args.minorder, num_jobs=args.num_jobs)
+    else:
+        prune(lm, args.threshold, args.minorder)
 
     # validate_lm(lm)
 
@@ -626,5 +1219,9 @@ if __name__ == "__main__":
     for i, cnt in lm.counts():
         logging.info("ngram %d=%d" % (i, cnt))
     logging.info("Saving the pruned arpa file to %s" % args.write_lm)
-    parser.dumpf(lm, args.write_lm, encoding=default_encoding)
+    if args.implementation == "array":
+        lm.writef(args.write_lm, encoding=default_encoding)
+    else:
+        parser.dumpf(lm, args.write_lm, encoding=default_encoding)
+    logging.info("Peak memory: %.1f MB" % peak_memory_mb())
     logging.info("Done.")
@@ -161,6 +161,97 @@ class RelPositionMultiheadAttention(nn.Module):
             left_context=left_context,
         )
 
+    def streaming_forward(
+        self,
+        x: Tensor,
+        pos_emb: Tensor,
+        cached_key: Tensor,
+        cached_val: Tensor,
+        key_padding_mask: Optional[Tensor] = None,
+    ) -> Tuple[Tensor, Tensor, Tensor]:
+        r"""Causal self-attention of new frames over the cached keys and
+        values of the previous frames and the new frames themselves.
+
+        Args:
+            x: the new frames, of shape :math:`(L, N, E)`.
+            pos_emb: Positional embedding tensor, of shape :math:`(1, P+2*L-1, E)`.
+            cached_key: the projected keys of the previous frames,
+                of shape :math:`(P, N, E)`. P may be 0.
+            cached_val: the projected values of the previous frames,
+                of shape :math:`(P, N, E)`.
+            key_padding_mask: :math:`(N, P+L)`. True for positions that are
+                ignored, e.g., the left padding of the cache.
+
+        Returns:
+            A tuple of 3 tensors:
+            - attn_output: :math:`(L, N, E)`.
+            - cached_key: the keys of the previous and the new frames,
+              of shape :math:`(P+L, N, E)`.
+            - cached_val: the values of the previous and the new frames,
+              of shape :math:`(P+L, N, E)`.
+        """
+        tgt_len, bsz, embed_dim = x.size()
+        num_heads = self.num_heads
+        head_dim = self.head_dim
+        left_context = cached_key.size(0)
+        src_len = left_context + tgt_len
+
+        q, k, v = nn.functional.linear(
+            x, self.in_proj.get_weight(), self.in_proj.get_bias()
+        ).chunk(3, dim=-1)
+
+        cached_key = torch.cat([cached_key, k], dim=0)
+        cached_val = torch.cat([cached_val, v], dim=0)
+
+        scaling = float(head_dim) ** -0.5
+        q = (q * scaling).contiguous().view(tgt_len, bsz, num_heads, head_dim)
+        k = cached_key.contiguous().view(src_len, bsz, num_heads, head_dim)
+        v = (
+            cached_val.contiguous()
+            .view(src_len, bsz * num_heads, head_dim)
+            .transpose(0, 1)
+        )
+
+        q = q.transpose(0, 1)  # (batch, time1, head, d_k)
+
+        p = self.linear_pos(pos_emb).view(pos_emb.size(0), -1, num_heads, head_dim)
+        p = p.permute(0, 2, 3, 1)  # (batch, head, d_k, left_context+2*time1-1)
+
+        q_with_bias_u = (q + self._pos_bias_u()).transpose(1, 2)
+        q_with_bias_v = (q + self._pos_bias_v()).transpose(1, 2)
+
+        k = k.permute(1, 2, 3, 0)  # (batch, head, d_k, time2)
+        matrix_ac = torch.matmul(q_with_bias_u, k)  # (batch, head, time1, time2)
+
+        matrix_bd = torch.matmul(q_with_bias_v, p)
+        matrix_bd = self.rel_shift(matrix_bd, left_context)
+
+        attn_output_weights = matrix_ac + matrix_bd  # (batch, head, time1, time2)
+
+        # The i-th new frame can attend to the cache and new frames 0..i
+        mask = torch.ones(tgt_len, src_len, device=x.device, dtype=torch.bool)
+        mask = torch.triu(mask, diagonal=left_context + 1)
+        if key_padding_mask is not None:
+            mask = mask | key_padding_mask.unsqueeze(1).unsqueeze(2)
+
+        attn_output_weights = attn_output_weights.masked_fill(mask, float("-inf"))
+        attn_output_weights = nn.functional.softmax(attn_output_weights, dim=-1)
+        # Frames in the left padding can see nothing and get `nan` above.
+        attn_output_weights = attn_output_weights.masked_fill(mask, 0.0)
+
+        attn_output_weights = attn_output_weights.view(
+            bsz * num_heads, tgt_len, src_len
+        )
+        attn_output = torch.bmm(attn_output_weights, v)
+        attn_output = (
+            attn_output.transpose(0, 1).contiguous().view(tgt_len, bsz, embed_dim)
+        )
+        attn_output = nn.functional.linear(
+            attn_output, self.out_proj.get_weight(), self.out_proj.get_bias()
+        )
+
+        return attn_output, cached_key, cached_val
+
     def rel_shift(self, x: Tensor, left_context: int = 0) -> Tensor:
         """Compute relative positional encoding.
 
@@ -60,6 +60,7 @@ class Transformer(torch.nn.Module):
 
         self.encoder_layers = num_layers
         self.d_model = d_model
+        self.nhead = nhead
 
         self.embed = ScaledLinear(input_dim, d_model)
         self.norm_before = BasicNorm(d_model, learn_eps=False)
@@ -75,21 +76,38 @@ class Transformer(torch.nn.Module):
 
         self.encoder = TransformerEncoder(encoder_layer, num_layers)
 
-    def _create_attention_mask(self, x_lens: torch.Tensor):
+    def _create_attention_mask(
+        self, x_lens: torch.Tensor, segment_ids: Optional[torch.Tensor] = None
+    ):
         # create a 2D attention mask to mask out
         # the upper right half of the attention matrix
         max_len = max(x_lens)
         ones = torch.ones(max_len, max_len, device=x_lens.device, dtype=torch.bool)
-        return torch.triu(ones, diagonal=1)
+        mask = torch.triu(ones, diagonal=1)
+        if segment_ids is None:
+            return mask
+
+        # If several sentences are packed into a row, a token can attend
+        # only to the tokens of its own sentence. This gives a 3D mask
+        # (B*nhead, T, T).
+        segment_mask = segment_ids.unsqueeze(2) != segment_ids.unsqueeze(1)
+        mask = mask | segment_mask
+        return mask.repeat_interleave(self.nhead, dim=0)
 
     def forward(
-        self, x: torch.Tensor, x_lens: torch.Tensor
+        self,
+        x: torch.Tensor,
+        x_lens: torch.Tensor,
+        segment_ids: Optional[torch.Tensor] = None,
     ) -> Tuple[torch.Tensor, torch.Tensor]:
         """Transformer forward
 
         Args:
             x (torch.Tensor): Input tensor (B,T,input_dim)
             x_lens (torch.Tensor): The length of input tensors before padding (B,)
+            segment_ids (torch.Tensor, optional): The index of the sentence of
+                each frame (B,T) if several sentences are packed into a row.
+                Frames attend only to frames with the same index.
 
         Returns:
             Return a tuple of 2 tensors:
@@ -97,7 +115,7 @@ class Transformer(torch.nn.Module):
             - x_lens: output feature lens of the transformer
         """
 
-        attention_mask = self._create_attention_mask(x_lens)
+        attention_mask = self._create_attention_mask(x_lens, segment_ids)
         src_key_padding_mask = make_pad_mask(x_lens)
 
         x = self.norm_before(self.embed(x))
@@ -115,6 +133,47 @@ class Transformer(torch.nn.Module):
         x = x.permute(1, 0, 2)  # (T, N, C) ->(N, T, C)
         return x, x_lens
 
+    def streaming_forward(
+        self,
+        x: torch.Tensor,
+        cached_key: torch.Tensor,
+        cached_val: torch.Tensor,
+        key_padding_mask: Optional[torch.Tensor] = None,
+    ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        """Forward new frames given the cached keys and values of the
+        previous frames of each layer.
+
+        Args:
+            x (torch.Tensor): The new frames (B,U,input_dim)
+            cached_key (torch.Tensor): The keys of the previous frames
+                (num_layers,P,B,d_model). P may be 0.
+            cached_val (torch.Tensor): The values of the previous frames
+                (num_layers,P,B,d_model)
+            key_padding_mask (torch.Tensor, optional): (B,P+U). True for
+                the positions to ignore, e.g., the left padding.
+
+        Returns:
+            Return a tuple of 3 tensors:
+            - x: output feature of the transformer (B,U,d_model)
+            - cached_key: updated keys (num_layers,P+U,B,d_model)
+            - cached_val: updated values (num_layers,P+U,B,d_model)
+        """
+        x = self.norm_before(self.embed(x))
+
+        x, pos_emb = self.encoder_pos(x, left_context=cached_key.size(1))
+        x = x.permute(1, 0, 2)
+
+        x, cached_key, cached_val = self.encoder.streaming_forward(
+            x,
+            pos_emb,
+            cached_key=cached_key,
+            cached_val=cached_val,
+            key_padding_mask=key_padding_mask,
+        )  # (U, B, C)
+
+        x = x.permute(1, 0, 2)  # (U, B, C) ->(B, U, C)
+        return x, cached_key, cached_val
+
 
 class TransformerEncoder(torch.nn.Module):
     def __init__(self, encoder_layer: torch.nn.Module, num_layers: int) -> None:
@@ -160,6 +219,43 @@ class TransformerEncoder(torch.nn.Module):
 
         return output
 
+    def streaming_forward(
+        self,
+        src: torch.Tensor,
+        pos_emb: torch.Tensor,
+        cached_key: torch.Tensor,
+        cached_val: torch.Tensor,
+        key_padding_mask: Optional[torch.Tensor] = None,
+    ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        """
+        Args:
+            src: the new frames (U, B, C).
+            pos_emb: Positional embedding tensor.
+            cached_key: keys of the previous frames (num_layers, P, B, C).
+            cached_val: values of the previous frames (num_layers, P, B, C).
+            key_padding_mask: the mask for the keys per batch (B, P+U) (optional).
+
+        Returns:
+            A tuple of the output (U, B, C) and the updated keys and values
+            (num_layers, P+U, B, C).
+        """
+        output = src
+
+        new_cached_key = []
+        new_cached_val = []
+        for layer_index, mod in enumerate(self.layers):
+            output, layer_key, layer_val = mod.streaming_forward(
+                output,
+                pos_emb,
+                cached_key=cached_key[layer_index],
+                cached_val=cached_val[layer_index],
+                key_padding_mask=key_padding_mask,
+            )
+            new_cached_key.append(layer_key)
+            new_cached_val.append(layer_val)
+
+        return output, torch.stack(new_cached_key), torch.stack(new_cached_val)
+
 
 class TransformerEncoderLayer(torch.nn.Module):
     def __init__(
@@ -235,6 +331,46 @@ class TransformerEncoderLayer(torch.nn.Module):
 
         return src
 
+    def streaming_forward(
+        self,
+        src: torch.Tensor,
+        pos_emb: torch.Tensor,
+        cached_key: torch.Tensor,
+        cached_val: torch.Tensor,
+        key_padding_mask: Optional[torch.Tensor] = None,
+    ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        """
+        Pass new frames through the encoder layer, attending to the cached
+        keys and values of the previous frames.
+
+        Args:
+            src: the new frames (U, B, C).
+            pos_emb: Positional embedding tensor.
+            cached_key: keys of the previous frames (P, B, C).
+            cached_val: values of the previous frames (P, B, C).
+            key_padding_mask: the mask for the keys per batch (B, P+U) (optional).
+
+        Returns:
+            A tuple of the output (U, B, C) and the updated keys and values
+            (P+U, B, C).
+        """
+        src_att, cached_key, cached_val = self.self_attn.streaming_forward(
+            src,
+            pos_emb=pos_emb,
+            cached_key=cached_key,
+            cached_val=cached_val,
+            key_padding_mask=key_padding_mask,
+        )
+
+        src = src + self.dropout(src_att)
+
+        # feed forward module
+        src = src + self.dropout(self.feed_forward(src))
+
+        src = self.norm_final(self.balancer(src))
+
+        return src, cached_key, cached_val
+
 
 class RelPositionalEncoding(torch.nn.Module):
     """Relative positional encoding module.
@@ -15,7 +15,7 @@
 # limitations under the License.
 
 import logging
-from typing import Optional, Tuple
+from typing import List, Optional, Tuple
 
 import torch
 import torch.nn.functional as F
@@ -73,6 +73,7 @@ class TransformerLM(torch.nn.Module):
         y: torch.Tensor,
         x_lens: torch.Tensor,
         return_logits: bool = False,
+        segment_ids: Optional[torch.Tensor] = None,
     ):
         """Forward transformer language model
 
@@ -81,12 +82,15 @@ class TransformerLM(torch.nn.Module):
             y (torch.Tensor): Output tokens (with EOS appended) (B,L)
             x_lens (torch.Tensor): Length of input tokens before padding (B,)
             return_logits (bool, optional): Return logits instead of NLL
+            segment_ids (torch.Tensor, optional): The index of the sentence
+                of each token (B,L) if several sentences are packed into
+                a row, see `MemmapLmDatasetCollate` in icefall/rnn_lm/dataset.py
 
         """
 
         x = self.input_embedding(x)
 
-        x, x_lens = self.encoder(x, x_lens)
+        x, x_lens = self.encoder(x, x_lens, segment_ids=segment_ids)
 
         logits = self.output_linear(x)
 
@@ -102,13 +106,127 @@ class TransformerLM(torch.nn.Module):
 
         return nll_loss
 
-    def score_token(self, x: torch.Tensor, x_lens: torch.Tensor, state=None):
-        bs = x.size(0)
+    def score_token(
+        self,
+        x: torch.Tensor,
+        x_lens: torch.Tensor,
+        state: Optional[Tuple[torch.Tensor, torch.Tensor, torch.Tensor]] = None,
+    ) -> Tuple[torch.Tensor, Tuple[torch.Tensor, torch.Tensor, torch.Tensor]]:
+        """Score the next token of each sequence in the batch.
 
-        state = None
-        logits = self.forward(x, x, x_lens, return_logits=True)
-        index = torch.arange(bs)
+        The keys and values of the self-attention of the scored tokens are
+        returned as the state, so that a sequence can be extended by new
+        tokens without running the transformer over its prefix again.
 
-        last_logits = logits[index, x_lens - 1, :]
+        Args:
+            x (torch.Tensor):
+                The tokens to score (B,U), padded on the right.
+            x_lens (torch.Tensor):
+                The number of tokens in each row of `x` (B,). If `state` is
+                not None, all rows must have U tokens, e.g., U is 1 when
+                each sequence is extended by one token.
+            state (optional):
+                None, or the state of the previous tokens returned by this
+                function or by :meth:`stack_states`. It is a tuple of 3
+                tensors (cached_key, cached_val, cached_len). cached_key and
+                cached_val have the shape (num_layers,P,B,d_model) and
+                are padded on the left; cached_len (B,) contains the number
+                of previous tokens of each sequence.
+
+        Returns:
+            Return a tuple containing:
+            - the log-probs of the next token (B,vocab_size)
+            - the state after seeing the tokens in `x`
+        """
+        bs, U = x.shape
+        device = x.device
+
+        if state is None:
+            # Move the padding to the left, so that the last tokens of all
+            # the sequences are aligned.
+            shift = U - x_lens
+            index = (torch.arange(U, device=device) - shift.unsqueeze(1)) % U
+            x = torch.gather(x, dim=1, index=index)
+            key_padding_mask = torch.arange(U, device=device) < shift.unsqueeze(1)
+
+            num_layers = self.encoder.encoder_layers
+            d_model = self.encoder.d_model
+            dtype = self.input_embedding.weight.dtype
+            cached_key = torch.zeros(
+                num_layers, 0, bs, d_model, dtype=dtype, device=device
+            )
+            cached_val = torch.zeros(
+                num_layers, 0, bs, d_model, dtype=dtype, device=device
+            )
+            cached_len = torch.zeros(bs, dtype=torch.int64, device=device)
+        else:
+            assert torch.all(x_lens == U), (x_lens, U)
+            cached_key, cached_val, cached_len = state
+            P = cached_key.size(1)
+            key_padding_mask = torch.cat(
+                [
+                    torch.arange(P, device=device) < (P - cached_len).unsqueeze(1),
+                    torch.zeros(bs, U, dtype=torch.bool, device=device),
+                ],
+                dim=1,
+            )
+
+        x = self.input_embedding(x)
+        x, cached_key, cached_val = self.encoder.streaming_forward(
+            x,
+            cached_key=cached_key,
+            cached_val=cached_val,
+            key_padding_mask=key_padding_mask,
+        )
+        last_logits = self.output_linear(x[:, -1])
+
+        state = (cached_key, cached_val, cached_len + x_lens)
 
         return last_logits.log_softmax(-1), state
+
+    @staticmethod
+    def stack_states(
+        state_list: List[Tuple[torch.Tensor, torch.Tensor, torch.Tensor]]
+    ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        """Stack the states of a list of sequences into a batch, padding
+        the caches on the left. It is the inverse of :meth:`unstack_states`.
+
+        Args:
+          state_list:
+            A list of states of :meth:`score_token`, each of which
+            has batch size 1, e.g., the ones returned by :meth:`unstack_states`.
+        Returns:
+          The batched state.
+        """
+        P = max(s[0].size(1) for s in state_list)
+        cached_key = torch.cat(
+            [F.pad(s[0], (0, 0, 0, 0, P - s[0].size(1), 0)) for s in state_list],
+            dim=2,
+        )
+        cached_val = torch.cat(
+            [F.pad(s[1], (0, 0, 0, 0, P - s[1].size(1), 0)) for s in state_list],
+            dim=2,
+        )
+        cached_len = torch.cat([s[2] for s in state_list])
+        return cached_key, cached_val, cached_len
+
+    @staticmethod
+    def unstack_states(
+        state: Tuple[torch.Tensor, torch.Tensor, torch.Tensor]
+    ) -> List[Tuple[torch.Tensor, torch.Tensor, torch.Tensor]]:
+        """Split a batched state of :meth:`score_token` into the states of
+        each sequence, removing the left padding. The returned caches are
+        views of the batched ones.
+        """
+        cached_key, cached_val, cached_len = state
+        P = cached_key.size(1)
+        ans = []
+        for i, n in enumerate(cached_len.tolist()):
+            ans.append(
+                (
+                    cached_key[:, P - n :, i : i + 1],
+                    cached_val[:, P - n :, i : i + 1],
+                    cached_len[i : i + 1],
+                )
+            )
+        return ans
@@ -133,6 +133,45 @@ def get_parser():
         help="LM validation data",
     )
 
+    parser.add_argument(
+        "--num-workers",
+        type=int,
+        default=0,
+        help="""Number of dataloader workers. If --lm-data is a directory
+        generated by ./local/convert_lm_data_to_memmap.py, the workers share
+        the memory-mapped data instead of copying it.""",
+    )
+
+    parser.add_argument(
+        "--max-tokens",
+        type=int,
+        default=0,
+        help="""If positive, create batches with at most this number of
+        tokens, including padding, instead of using --batch-size. Sentences
+        of similar lengths are put into the same batch, see --num-buckets.
+        It requires --lm-data and --lm-data-valid to be directories generated
+        by ./local/convert_lm_data_to_memmap.py.""",
+    )
+
+    parser.add_argument(
+        "--num-buckets",
+        type=int,
+        default=30,
+        help="""Number of length buckets used with --max-tokens. More buckets
+        give less padding.""",
+    )
+
+    parser.add_argument(
+        "--pack-sentences",
+        type=str2bool,
+        default=False,
+        help="""If True, pack short sentences of the same length into a row
+        of at most `max_sent_len` tokens, see get_params(). Tokens attend
+        only to the tokens of their own sentence. If --max-tokens is not
+        positive, a batch has at most --batch-size * `max_sent_len` tokens.
+        It requires the same LM data as --max-tokens.""",
+    )
+
     parser.add_argument(
         "--vocab-size",
         type=int,
@@ -290,6 +329,7 @@ def compute_loss(
     y: torch.Tensor,
     sentence_lengths: torch.Tensor,
     is_training: bool,
+    segment_ids: Optional[torch.Tensor] = None,
 ) -> Tuple[torch.Tensor, MetricsTracker]:
     """Compute the negative log-likelihood loss given a model and its input.
     Args:
@@ -306,14 +346,20 @@ def compute_loss(
        before padding.
      is_training:
        True for training. False for validation.
+     segment_ids:
+       None, or a 2-D tensor with the same shape as `x` containing the index
+       of the sentence of each token if several sentences are packed into
+       a row. See --pack-sentences.
     """
     with torch.set_grad_enabled(is_training):
         device = model.device
         x = x.to(device)
         y = y.to(device)
         sentence_lengths = sentence_lengths.to(device)
+        if segment_ids is not None:
+            segment_ids = segment_ids.to(device)
 
-        nll = model(x, y, sentence_lengths)
+        nll = model(x, y, sentence_lengths, segment_ids=segment_ids)
         loss = nll.sum()
 
         num_tokens = sentence_lengths.sum().item()
@@ -340,13 +386,15 @@ def compute_validation_loss(
     tot_loss = MetricsTracker()
 
     for batch_idx, batch in enumerate(valid_dl):
-        x, y, sentence_lengths = batch
+        x, y, sentence_lengths = batch[:3]
+        segment_ids = batch[3] if len(batch) > 3 else None
         with torch.cuda.amp.autocast(enabled=params.use_fp16):
             loss, loss_info = compute_loss(
                 model=model,
                 x=x,
                 y=y,
                 sentence_lengths=sentence_lengths,
+                segment_ids=segment_ids,
                 is_training=False,
             )
 
@@ -401,7 +449,8 @@ def train_one_epoch(
 
     for batch_idx, batch in enumerate(train_dl):
         params.batch_idx_train += 1
-        x, y, sentence_lengths = batch
+        x, y, sentence_lengths = batch[:3]
+        segment_ids = batch[3] if len(batch) > 3 else None
         batch_size = x.size(0)
         with torch.cuda.amp.autocast(enabled=params.use_fp16):
             loss, loss_info = compute_loss(
@@ -409,6 +458,7 @@ def train_one_epoch(
                 x=x,
                 y=y,
                 sentence_lengths=sentence_lengths,
+                segment_ids=segment_ids,
                 is_training=True,
             )
 
@@ -560,7 +610,7 @@ def run(rank, world_size, args):
 
     # Note: No learning rate scheduler is used here
     for epoch in range(params.start_epoch, params.num_epochs):
-        if is_distributed:
+        if hasattr(train_dl.sampler, "set_epoch"):
             train_dl.sampler.set_epoch(epoch)
 
         params.cur_epoch = epoch
@@ -19,14 +19,17 @@
 
 import argparse
 import collections
+import json
 import logging
 import os
 import re
 import subprocess
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
 from contextlib import contextmanager
 from dataclasses import dataclass
 from datetime import datetime
+from functools import partial
 from pathlib import Path
 from shutil import copyfile
 from typing import Dict, Iterable, List, Optional, TextIO, Tuple, Union
@@ -571,6 +574,160 @@ def store_transcripts_and_timestamps(
                 print(f"{cut_id}:\ttimestamp_hyp={s}", file=f)
 
 
+def _align_chunk(
+    chunk: List[Tuple[List[str], List[str]]], sclite_mode: bool
+) -> List[List[Tuple[str, str]]]:
+    return [
+        kaldialign.align(ref, hyp, "*", sclite_mode=sclite_mode) for ref, hyp in chunk
+    ]
+
+
+def align_results(
+    results: List[Tuple[str, List[str], List[str]]],
+    sclite_mode: bool = False,
+    num_jobs: int = 1,
+    chunk_size: int = 1000,
+) -> List[List[Tuple[str, str]]]:
+    """Align the reference and predicted transcripts of each utterance.
+
+    Args:
+      results:
+        A list of tuples (cut_id, ref, hyp), see :func:`write_error_stats`.
+      sclite_mode:
+        Passed to `kaldialign.align()`.
+      num_jobs:
+        If larger than 1, align the utterances with this number of
+        processes.
+      chunk_size:
+        Number of utterances aligned by a process at a time.
+    Returns:
+      Return the alignment of each utterance, i.e., a list of pairs
+      (ref_word, hyp_word), where "*" is used for insertions and deletions.
+    """
+    pairs = [(ref, hyp) for _, ref, hyp in results]
+    chunks = [pairs[i : i + chunk_size] for i in range(0, len(pairs), chunk_size)]
+    align = partial(_align_chunk, sclite_mode=sclite_mode)
+    if num_jobs > 1 and len(chunks) > 1:
+        with ProcessPoolExecutor(max_workers=num_jobs) as executor:
+            alignments = list(executor.map(align, chunks))
+    else:
+        alignments = [align(c) for c in chunks]
+    return [ali for c in alignments for ali in c]
+
+
+def align_results_dict(
+    results_dict: Dict[str, List[Tuple[str, List[str], List[str]]]],
+    compute_CER: bool = False,
+    sclite_mode: bool = False,
+    num_jobs: int = 1,
+    chunk_size: int = 1000,
+) -> Dict[str, List[List[Tuple[str, str]]]]:
+    """Align the results of several decoding methods at a time, e.g., the
+    `results_dict` of `save_results()` in decode.py, which share the work
+    of :func:`align_results` among the processes.
+
+    The results are sorted in place, so that they can be passed to
+    :func:`write_error_stats` with the returned alignments.
+
+    Args:
+      results_dict:
+        A dict mapping a key, e.g., the decoding method, to the results of
+        it. See :func:`write_error_stats` for the format.
+      compute_CER:
+        True to align characters instead of words, which must also be
+        passed to :func:`write_error_stats`.
+      sclite_mode:
+        See :func:`align_results`.
+      num_jobs:
+        See :func:`align_results`.
+      chunk_size:
+        See :func:`align_results`.
+    Returns:
+      Return a dict mapping each key to the alignments of its results.
+    """
+    all_results = []
+    for key, results in results_dict.items():
+        results.sort()
+        if compute_CER:
+            results = _to_char_results(results)
+        all_results.extend(results)
+
+    alignments = align_results(
+        all_results,
+        sclite_mode=sclite_mode,
+        num_jobs=num_jobs,
+        chunk_size=chunk_size,
+    )
+
+    ans = dict()
+    start = 0
+    for key, results in results_dict.items():
+        ans[key] = alignments[start : start + len(results)]
+        start += len(results)
+    return ans
+
+
+def _to_char_results(
+    results: List[Tuple[str, List[str], List[str]]]
+) -> List[Tuple[str, List[str], List[str]]]:
+    return [
+        (cut_id, list("".join(ref)), list("".join(hyp))) for cut_id, ref, hyp in results
+    ]
+
+
+def _combine_successive_errors(ali: List[Tuple[str, str]]) -> List[List[str]]:
+    ERR = "*"
+    ali = [[[x], [y]] for x, y in ali]
+    for i in range(len(ali) - 1):
+        if ali[i][0] != ali[i][1] and ali[i + 1][0] != ali[i + 1][1]:
+            ali[i + 1][0] = ali[i][0] + ali[i + 1][0]
+            ali[i + 1][1] = ali[i][1] + ali[i + 1][1]
+            ali[i] = [[], []]
+    ali = [
+        [
+            list(filter(lambda a: a != ERR, x)),
+            list(filter(lambda a: a != ERR, y)),
+        ]
+        for x, y in ali
+    ]
+    ali = list(filter(lambda x: x != [[], []], ali))
+    ali = [
+        [
+            ERR if x == [] else " ".join(x),
+            ERR if y == [] else " ".join(y),
+        ]
+        for x, y in ali
+    ]
+    return ali
+
+
+def write_alignments_jsonl(
+    filename: Union[str, Path],
+    results: List[Tuple[str, List[str], List[str]]],
+    alignments: List[List[Tuple[str, str]]],
+) -> None:
+    """Write the alignment and the number of errors of each utterance to a
+    file, one JSON object per line. See `jsonl_filename` in
+    :func:`write_error_stats`.
+    """
+    ERR = "*"
+    with open(filename, "w", encoding="utf-8") as f:
+        for (cut_id, _, _), ali in zip(results, alignments):
+            num_ins = sum(1 for r, _ in ali if r == ERR)
+            num_del = sum(1 for _, h in ali if h == ERR)
+            num_corr = sum(1 for r, h in ali if r == h)
+            num_sub = len(ali) - num_ins - num_del - num_corr
+            d = {
+                "cut_id": cut_id,
+                "corr": num_corr,
+                "sub": num_sub,
+                "ins": num_ins,
+                "del": num_del,
+                "ali": ali,
+            }
+            print(json.dumps(d, ensure_ascii=False), file=f)
+
+
 def write_error_stats(
     f: TextIO,
     test_set_name: str,
@@ -578,6 +735,9 @@ def write_error_stats(
     enable_log: bool = True,
     compute_CER: bool = False,
     sclite_mode: bool = False,
+    num_jobs: int = 1,
+    alignments: Optional[List[List[Tuple[str, str]]]] = None,
+    jsonl_filename: Optional[Union[str, Path]] = None,
 ) -> float:
     """Write statistics based on predicted results and reference transcripts.
 
@@ -610,6 +770,20 @@ def write_error_stats(
       enable_log:
         If True, also print detailed WER to the console.
         Otherwise, it is written only to the given file.
+      num_jobs:
+        Number of processes used to align the results, see
+        :func:`align_results`.
+      alignments:
+        If not None, the alignments of the results returned by
+        :func:`align_results_dict` or :func:`align_results`. They are
+        used instead of aligning the results again.
+      jsonl_filename:
+        If not None, also write the alignment and the number of errors of
+        each utterance to this file, one JSON object per line, e.g.::
+
+          {"cut_id": "1089-134686-0001", "corr": 4, "sub": 1, "ins": 0,
+           "del": 0, "ali": [["THE", "THE"], ["EDISON", "ADDISON"], ...]}
+
     Returns:
       Return None.
     """
@@ -624,28 +798,31 @@ def write_error_stats(
     ERR = "*"
 
     if compute_CER:
-        for i, res in enumerate(results):
-            cut_id, ref, hyp = res
-            ref = list("".join(ref))
-            hyp = list("".join(hyp))
-            results[i] = (cut_id, ref, hyp)
-
-    for cut_id, ref, hyp in results:
-        ali = kaldialign.align(ref, hyp, ERR, sclite_mode=sclite_mode)
-        for ref_word, hyp_word in ali:
-            if ref_word == ERR:
-                ins[hyp_word] += 1
-                words[hyp_word][3] += 1
-            elif hyp_word == ERR:
-                dels[ref_word] += 1
-                words[ref_word][4] += 1
-            elif hyp_word != ref_word:
-                subs[(ref_word, hyp_word)] += 1
-                words[ref_word][1] += 1
-                words[hyp_word][2] += 1
-            else:
-                words[ref_word][0] += 1
-                num_corr += 1
+        results[:] = _to_char_results(results)
+
+    if alignments is None:
+        alignments = align_results(results, sclite_mode=sclite_mode, num_jobs=num_jobs)
+    assert len(alignments) == len(results), (len(alignments), len(results))
+
+    # Count each distinct (ref_word, hyp_word) pair only once
+    pair_counts = collections.Counter()
+    for ali in alignments:
+        pair_counts.update(ali)
+
+    for (ref_word, hyp_word), count in pair_counts.items():
+        if ref_word == ERR:
+            ins[hyp_word] += count
+            words[hyp_word][3] += count
+        elif hyp_word == ERR:
+            dels[ref_word] += count
+            words[ref_word][4] += count
+        elif hyp_word != ref_word:
+            subs[(ref_word, hyp_word)] += count
+            words[ref_word][1] += count
+            words[hyp_word][2] += count
+        else:
+            words[ref_word][0] += count
+            num_corr += count
     ref_len = sum([len(r) for _, r, _ in results])
     sub_errs = sum(subs.values())
     ins_errs = sum(ins.values())
@@ -675,31 +852,10 @@ def write_error_stats(
 
     print("", file=f)
     print("PER-UTT DETAILS: corr or (ref->hyp)  ", file=f)
-    for cut_id, ref, hyp in results:
-        ali = kaldialign.align(ref, hyp, ERR)
+    for (cut_id, ref, hyp), ali in zip(results, alignments):
         combine_successive_errors = True
         if combine_successive_errors:
-            ali = [[[x], [y]] for x, y in ali]
-            for i in range(len(ali) - 1):
-                if ali[i][0] != ali[i][1] and ali[i + 1][0] != ali[i + 1][1]:
-                    ali[i + 1][0] = ali[i][0] + ali[i + 1][0]
-                    ali[i + 1][1] = ali[i][1] + ali[i + 1][1]
-                    ali[i] = [[], []]
-            ali = [
-                [
-                    list(filter(lambda a: a != ERR, x)),
-                    list(filter(lambda a: a != ERR, y)),
-                ]
-                for x, y in ali
-            ]
-            ali = list(filter(lambda x: x != [[], []], ali))
-            ali = [
-                [
-                    ERR if x == [] else " ".join(x),
-                    ERR if y == [] else " ".join(y),
-                ]
-                for x, y in ali
-            ]
+            ali = _combine_successive_errors(ali)
 
         print(
             f"{cut_id}:\t"
@@ -712,6 +868,9 @@ def write_error_stats(
             file=f,
         )
 
+    if jsonl_filename is not None:
+        write_alignments_jsonl(jsonl_filename, results, alignments)
+
     print("", file=f)
     print("SUBSTITUTIONS: count ref -> hyp", file=f)
 
@@ -25,11 +25,20 @@
 
 from pathlib import Path
 
+import torch
 from lhotse import CutSet, load_manifest
 from lhotse.dataset import K2SpeechRecognitionDataset, SimpleCutSampler
 from lhotse.dataset.collation import collate_custom_field
 from torch.utils.data import DataLoader
 
+from icefall.ali import (
+    AlignmentStore,
+    convert_alignments_to_store,
+    convert_alignments_to_tensor,
+    lookup_alignments,
+    save_alignments,
+)
+
 ICEFALL_DIR = Path(__file__).resolve().parent.parent
 egs_dir = ICEFALL_DIR / "egs/librispeech/ASR"
 lang_dir = egs_dir / "data/lang_bpe_500"
@@ -85,5 +94,33 @@ def test():
         break
 
 
+def test_alignment_store(tmp_path):
+    alignments = {
+        "cut-2": [1, 3, 2],
+        "cut-1": [1, 0, 4, 2],
+        "cut-3": [],
+    }
+    save_alignments(alignments, subsampling_factor=4, filename=tmp_path / "a.pt")
+    convert_alignments_to_store(tmp_path / "a.pt", tmp_path / "a")
+
+    store = AlignmentStore(tmp_path / "a")
+    assert store.subsampling_factor == 4
+    assert len(store) == 3
+    assert "cut-1" in store and "cut-4" not in store
+    assert store["cut-2"].tolist() == [1, 3, 2]
+
+    padded_ali, ali_lens = store.lookup(["cut-2", "cut-3", "cut-1"])
+    assert padded_ali.tolist() == [[1, 3, 2, 0], [0, 0, 0, 0], [1, 0, 4, 2]]
+    assert ali_lens.tolist() == [3, 0, 4]
+
+    cut_ids = ["cut-1", "cut-2"]
+    expected = lookup_alignments(
+        cut_ids,
+        convert_alignments_to_tensor(alignments, device=torch.device("cpu")),
+        num_classes=5,
+    )
+    assert torch.equal(lookup_alignments(cut_ids, store, num_classes=5), expected)
+
+
 if __name__ == "__main__":
     test()
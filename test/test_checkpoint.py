@@ -20,7 +20,16 @@ import pytest
 import torch
 import torch.nn as nn
 
-from icefall.checkpoint import average_checkpoints, load_checkpoint, save_checkpoint
+from icefall.checkpoint import (
+    AsyncCheckpointSaver,
+    average_checkpoints,
+    load_checkpoint,
+    load_checkpoint_lazily,
+    model_only_filename,
+    remove_checkpoints,
+    save_checkpoint,
+    save_checkpoint_with_global_batch_idx,
+)
 
 
 @pytest.fixture
@@ -61,3 +70,50 @@ def test_average_checkpoints(checkpoints1, checkpoints2):
     state_dict = average_checkpoints([checkpoints1, checkpoints2])
     assert torch.allclose(state_dict["p1"], torch.Tensor([30, 25.0]))
     assert torch.allclose(state_dict["p2"], torch.tensor([5, 51]))
+
+
+def test_average_checkpoints_model_only(tmp_path):
+    filenames = []
+    for i in range(3):
+        m = nn.Module()
+        m.p1 = nn.Parameter(torch.tensor([1.0, 2.0]) * (i + 1))
+        # p3 is shared with p1
+        m.p3 = m.p1
+        m.register_buffer("p2", torch.tensor([1, 5]) * (i + 1))
+        optimizer = torch.optim.SGD(m.parameters(), lr=0.1)
+        f = tmp_path / f"epoch-{i}.pt"
+        save_checkpoint(f, m, optimizer=optimizer, save_model_only=i > 0)
+        filenames.append(f)
+
+    assert model_only_filename(filenames[1]).is_file()
+    assert "optimizer" not in load_checkpoint_lazily(filenames[1])
+
+    for prefetch in [True, False]:
+        state_dict = average_checkpoints(filenames, prefetch=prefetch)
+        assert torch.allclose(state_dict["p1"], torch.tensor([2.0, 4.0]))
+        assert state_dict["p1"].data_ptr() == state_dict["p3"].data_ptr()
+        assert torch.equal(state_dict["p2"], torch.tensor([2, 10]))
+
+
+def test_async_checkpoint_saver(tmp_path):
+    m = nn.Module()
+    m.p1 = nn.Parameter(torch.tensor([1.0, 2.0]))
+    optimizer = torch.optim.SGD(m.parameters(), lr=0.1, momentum=0.9)
+
+    saver = AsyncCheckpointSaver(max_in_flight=2)
+    for i in range(1, 5):
+        save_checkpoint_with_global_batch_idx(
+            tmp_path, i, m, optimizer=optimizer, saver=saver
+        )
+        # Training continues while the checkpoint is being written
+        with torch.no_grad():
+            m.p1 += 1
+        remove_checkpoints(tmp_path, topk=2, saver=saver)
+    saver.wait()
+
+    assert sorted(p.name for p in tmp_path.iterdir()) == [
+        "checkpoint-3.pt",
+        "checkpoint-4.pt",
+    ]
+    checkpoint = torch.load(tmp_path / "checkpoint-4.pt")
+    assert torch.allclose(checkpoint["model"]["p1"], torch.tensor([4.0, 5.0]))
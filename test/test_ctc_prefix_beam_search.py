@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+
+import itertools
+
+import torch
+
+from icefall.context_graph import ContextGraph
+from icefall.decode import ctc_greedy_search, ctc_prefix_beam_search
+
+
+def best_sequence(log_probs: torch.Tensor) -> list:
+    """Find the most probable token sequence by summing the probabilities of
+    all alignments."""
+    T, V = log_probs.shape
+    scores = dict()
+    for alignment in itertools.product(range(V), repeat=T):
+        tokens = [k for k, _ in itertools.groupby(alignment) if k != 0]
+        score = log_probs[torch.arange(T), torch.tensor(alignment)].sum()
+        key = tuple(tokens)
+        scores[key] = torch.logaddexp(scores.get(key, score - score - 1e9), score)
+    return list(max(scores, key=lambda k: scores[k]))
+
+
+def test_ctc_prefix_beam_search():
+    torch.manual_seed(20231015)
+    log_probs = torch.randn(3, 5, 3).mul(2).log_softmax(dim=-1)
+    log_probs_length = torch.tensor([5, 4, 2])
+
+    # With a large beam, it finds the most probable sequence
+    hyps = ctc_prefix_beam_search(log_probs, log_probs_length, beam=30)
+    for i in range(3):
+        expected = best_sequence(log_probs[i, : log_probs_length[i]])
+        assert hyps[i] == expected, (i, hyps[i], expected)
+
+
+def test_ctc_prefix_beam_search_vs_greedy_search():
+    # The best path is all blanks, but the sum of the paths of [1] is larger
+    log_probs = torch.tensor(
+        [
+            [
+                [0.4, 0.3, 0.3],
+                [0.4, 0.3, 0.3],
+            ]
+        ]
+    ).log()
+    log_probs_length = torch.tensor([2])
+
+    assert ctc_greedy_search(log_probs, log_probs_length) == [[]]
+    assert ctc_prefix_beam_search(log_probs, log_probs_length, beam=4) == [[1]]
+
+
+def test_ctc_prefix_beam_search_with_context_graph():
+    log_probs = torch.tensor(
+        [
+            [
+                [0.1, 0.6, 0.3],
+                [0.9, 0.05, 0.05],
+                [0.1, 0.6, 0.3],
+            ]
+        ]
+    ).log()
+    log_probs_length = torch.tensor([3])
+
+    assert ctc_prefix_beam_search(log_probs, log_probs_length) == [[1, 1]]
+
+    context_graph = ContextGraph(context_score=1.0)
+    context_graph.build([[2, 2]])
+    for graph in [context_graph, context_graph.compile()]:
+        hyps = ctc_prefix_beam_search(log_probs, log_probs_length, context_graph=graph)
+        assert hyps == [[2, 2]], hyps
+
+
+if __name__ == "__main__":
+    test_ctc_prefix_beam_search()
+    test_ctc_prefix_beam_search_vs_greedy_search()
+    test_ctc_prefix_beam_search_with_context_graph()
@@ -23,8 +23,14 @@ You can run this file in one of the two ways:
 """
 
 import k2
+import torch
 
-from icefall.decode import Nbest
+from icefall.decode import (
+    Nbest,
+    compute_attention_scores,
+    get_best_path_indexes,
+    get_nbest_within_budget,
+)
 
 
 def test_nbest_from_lattice():
@@ -61,3 +67,62 @@ def test_nbest_from_lattice():
     argmax = tot_scores.argmax()
     best_path = k2.index_fsa(nbest2.fsa, argmax)
     print(best_path[0])
+
+
+def test_get_nbest_within_budget():
+    s = """
+        0 1 1 10 0.1
+        0 1 5 10 0.11
+        0 1 2 20 0.2
+        1 2 3 30 0.3
+        1 2 4 40 0.4
+        2 3 -1 -1 0.5
+        3
+    """
+    lattice = k2.Fsa.from_str(s, acceptor=False)
+    lattice = k2.Fsa.from_fsas([lattice, lattice, lattice])
+
+    # Each utterance has 6 arcs, so each chunk contains a single utterance
+    nbest = get_nbest_within_budget(lattice, num_paths=10, max_num_arcs=60)
+    assert nbest.shape.row_splits(1).tolist() == [0, 4, 8, 12]
+    assert nbest.fsa.shape[0] == 12
+    assert nbest.tot_scores().values.shape == (12,)
+
+    # Only 1 path can be sampled from each utterance
+    nbest = get_nbest_within_budget(lattice, num_paths=10, max_num_arcs=6)
+    assert nbest.shape.row_splits(1).tolist() == [0, 1, 2, 3]
+
+
+def test_compute_attention_scores():
+    num_calls = []
+
+    def nll_fn(utts, token_ids):
+        num_calls.append(len(token_ids))
+        assert len(token_ids) <= 2
+        nll = torch.zeros(len(token_ids), max(len(t) for t in token_ids))
+        for i, (u, t) in enumerate(zip(utts.tolist(), token_ids)):
+            nll[i, : len(t)] = torch.tensor(t, dtype=torch.float32) + u
+        return nll
+
+    path_to_utt_map = torch.tensor([0, 0, 0, 1, 1])
+    token_ids = [[1, 2], [3], [1, 2], [1, 2], [4, 5, 6]]
+    scores = compute_attention_scores(nll_fn, path_to_utt_map, token_ids, batch_size=2)
+    assert scores.tolist() == [-3, -3, -3, -5, -18]
+    # The duplicate path of utterance 0 is scored only once
+    assert sum(num_calls) == 4, num_calls
+
+
+def test_get_best_path_indexes():
+    shape = k2.ragged.create_ragged_shape2(
+        row_splits=torch.tensor([0, 3, 3, 5], dtype=torch.int32)
+    )
+    tot_scores = torch.tensor(
+        [
+            [1.0, 3.0, 2.0, 0.0, -1.0],
+            [3.0, 1.0, 2.0, -1.0, 0.0],
+        ]
+    )
+    indexes = get_best_path_indexes(shape, tot_scores)
+    assert indexes.tolist() == [[1, -1, 3], [0, -1, 4]]
+    for scores, expected in zip(tot_scores, indexes):
+        assert k2.RaggedTensor(shape, scores).argmax().tolist() == expected.tolist()
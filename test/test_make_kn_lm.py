@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+# Copyright      2023  Xiaomi Corp.
+#
+# See ../LICENSE for clarification regarding multiple authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import random
+import subprocess
+import sys
+from pathlib import Path
+
+MAKE_KN_LM = Path(__file__).resolve().parent.parent / "icefall/shared/make_kn_lm.py"
+
+
+def generate_corpus(filename: Path, num_lines: int = 300):
+    random.seed(20231015)
+    words = [f"W{i}" for i in range(30)]
+    lines = []
+    for _ in range(num_lines):
+        if lines and random.random() < 0.3:
+            # Repeat a previous sentence
+            lines.append(random.choice(lines))
+        else:
+            # A small vocabulary, so that many n-grams occur several times
+            n = random.randint(1, 12)
+            lines.append(" ".join(random.choices(words[: random.randint(3, 30)], k=n)))
+    filename.write_text("\n".join(lines) + "\n")
+
+
+def make_kn_lm(*args):
+    subprocess.run([sys.executable, str(MAKE_KN_LM), *args], check=True)
+
+
+def test_sharded_counts(tmp_path: Path):
+    corpus = tmp_path / "corpus.txt"
+    generate_corpus(corpus)
+
+    for order in [3, 4]:
+        expected = tmp_path / f"{order}.arpa"
+        make_kn_lm(
+            "-ngram-order", str(order), "-text", str(corpus), "-lm", str(expected)
+        )
+        assert expected.stat().st_size > 0
+
+        # 300 lines in 18 shards
+        arpa = tmp_path / f"{order}-sharded.arpa"
+        make_kn_lm(
+            "-ngram-order",
+            str(order),
+            "-text",
+            str(corpus),
+            "-lm",
+            str(arpa),
+            "-num-jobs",
+            "2",
+            "-lines-per-shard",
+            "17",
+            "-tmp-dir",
+            str(tmp_path),
+        )
+        assert arpa.read_bytes() == expected.read_bytes(), order
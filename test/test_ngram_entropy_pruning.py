@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+# Copyright      2023  Xiaomi Corp.
+#
+# See ../LICENSE for clarification regarding multiple authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import subprocess
+import sys
+from pathlib import Path
+
+from test_make_kn_lm import generate_corpus, make_kn_lm
+
+NGRAM_ENTROPY_PRUNING = (
+    Path(__file__).resolve().parent.parent / "icefall/shared/ngram_entropy_pruning.py"
+)
+
+
+def prune(lm: Path, pruned_lm: Path, threshold: float, *args):
+    subprocess.run(
+        [
+            sys.executable,
+            str(NGRAM_ENTROPY_PRUNING),
+            "-lm",
+            str(lm),
+            "-write-lm",
+            str(pruned_lm),
+            "-threshold",
+            str(threshold),
+            "-verbose",
+            "3",
+            *args,
+        ],
+        check=True,
+    )
+
+
+def count_ngrams(arpa: Path) -> int:
+    return sum(
+        int(line.split("=")[1])
+        for line in arpa.read_text().splitlines()
+        if line.startswith("ngram ")
+    )
+
+
+def test_array_arpa(tmp_path: Path):
+    corpus = tmp_path / "corpus.txt"
+    generate_corpus(corpus)
+    lm = tmp_path / "lm.arpa"
+    make_kn_lm("-ngram-order", "3", "-text", str(corpus), "-lm", str(lm))
+
+    for threshold in [1e-4, 1e-3]:
+        expected = tmp_path / f"dict-{threshold}.arpa"
+        prune(lm, expected, threshold, "-implementation", "dict")
+        assert 0 < count_ngrams(expected) < count_ngrams(lm), threshold
+
+        for num_jobs in [1, 2]:
+            pruned_lm = tmp_path / f"array-{threshold}-{num_jobs}.arpa"
+            prune(
+                lm,
+                pruned_lm,
+                threshold,
+                "-implementation",
+                "array",
+                "-num-jobs",
+                str(num_jobs),
+            )
+            assert pruned_lm.read_bytes() == expected.read_bytes(), (
+                threshold,
+                num_jobs,
+            )
@@ -15,7 +15,8 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import graphviz
+import tempfile
+from pathlib import Path
 
 from icefall import is_module_available
 
@@ -24,10 +25,10 @@ if not is_module_available("kaldifst"):
 
 import kaldifst
 
-from icefall import NgramLm, NgramLmStateCost
+from icefall import CompiledNgramLm, NgramLm, NgramLmStateCost
 
 
-def generate_fst(filename: str):
+def generate_fst(filename: str, draw: bool = True):
     s = """
 3	5	1	1	3.00464
 3	0	3	0	5.75646
@@ -44,6 +45,12 @@ def generate_fst(filename: str):
 """
     fst = kaldifst.compile(s=s, acceptor=False)
     fst.write(filename)
+    if not draw:
+        return
+
+    # It requires the dot binary of graphviz
+    import graphviz
+
     fst_dot = kaldifst.draw(fst, acceptor=False, portrait=True)
     source = graphviz.Source(fst_dot)
     source.render(outfile=f"{filename}.svg")
@@ -69,6 +76,32 @@ def main():
     s2 = s1.forward_one_step(2)
     print(s2.state_cost)
 
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        test_compiled_ngram_lm(Path(tmp_dir))
+
+
+def test_compiled_ngram_lm(tmp_path: Path):
+    filename = str(tmp_path / "test.fst")
+    generate_fst(filename, draw=False)
+    ngram_lm = NgramLm(filename, backoff_id=3, is_binary=True)
+    compiled = CompiledNgramLm.from_ngram_lm(ngram_lm)
+
+    compiled.save(f"{filename}.npz")
+    loaded = CompiledNgramLm.load(f"{filename}.npz", cache_size=0)
+
+    for state in range(ngram_lm.num_states):
+        for label in [1, 2, 3, 4, 5]:
+            expected = ngram_lm.get_next_state_and_cost(state=state, label=label)
+            assert compiled.get_next_state_and_cost(state, label) == expected
+            assert loaded.get_next_state_and_cost(state, label) == expected
+
+    state_cost = NgramLmStateCost(ngram_lm)
+    compiled_state_cost = NgramLmStateCost(loaded)
+    for label in [1, 2, 2, 1, 1, 2]:
+        state_cost = state_cost.forward_one_step(label)
+        compiled_state_cost = compiled_state_cost.forward_one_step(label)
+        assert dict(state_cost.state_cost) == dict(compiled_state_cost.state_cost)
+
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+# Copyright      2023  Xiaomi Corp.
+#
+# See ../LICENSE for clarification regarding multiple authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import torch
+
+from icefall.transformer_lm.model import TransformerLM
+
+
+def get_model():
+    torch.manual_seed(20231015)
+    model = TransformerLM(
+        vocab_size=30,
+        embedding_dim=32,
+        d_model=32,
+        dim_feedforward=64,
+        nhead=4,
+        num_layers=3,
+    )
+    return model.eval()
+
+
+def reference_scores(model, seqs):
+    x = torch.nn.utils.rnn.pad_sequence(seqs, batch_first=True)
+    x_lens = torch.tensor([len(s) for s in seqs])
+    logits = model(x, x, x_lens, return_logits=True)
+    return logits[torch.arange(len(seqs)), x_lens - 1].log_softmax(-1)
+
+
+@torch.no_grad()
+def test_score_token():
+    model = get_model()
+    seqs = [torch.randint(1, 30, (n,)) for n in [1, 5, 3, 8]]
+    expected = reference_scores(model, seqs)
+
+    x = torch.nn.utils.rnn.pad_sequence(seqs, batch_first=True)
+    x_lens = torch.tensor([len(s) for s in seqs])
+    scores, state = model.score_token(x, x_lens)
+    assert torch.allclose(scores, expected, atol=1e-5)
+    assert state[2].tolist() == x_lens.tolist()
+
+
+@torch.no_grad()
+def test_score_token_with_cache():
+    model = get_model()
+    seqs = [torch.randint(1, 30, (n,)) for n in [1, 5, 3, 8]]
+    expected = reference_scores(model, seqs)
+
+    scores = [None] * len(seqs)
+    states = [None] * len(seqs)
+    for i, s in enumerate(seqs):
+        score, states[i] = model.score_token(s[:1].unsqueeze(0), torch.tensor([1]))
+        scores[i] = score[0]
+
+    # Extend the sequences by one token at a time, each time with a
+    # different batch of sequences
+    for t in range(1, max(len(s) for s in seqs)):
+        indexes = [i for i, s in enumerate(seqs) if len(s) > t]
+        state = TransformerLM.stack_states([states[i] for i in indexes])
+        x = torch.tensor([[seqs[i][t]] for i in indexes])
+        x_lens = torch.ones(len(indexes), dtype=torch.int64)
+        score, state = model.score_token(x, x_lens, state)
+        for k, (i, s) in enumerate(zip(indexes, TransformerLM.unstack_states(state))):
+            assert s[0].size(1) == t + 1
+            states[i] = s
+            scores[i] = score[k]
+
+    assert torch.allclose(torch.stack(scores), expected, atol=1e-5)
+
+
+def main():
+    test_score_token()
+    test_score_token_with_cache()
+
+
+if __name__ == "__main__":
+    main()
@@ -16,6 +16,9 @@
 # limitations under the License.
 
 
+import io
+import json
+
 import k2
 import pytest
 import torch
@@ -25,9 +28,11 @@ from icefall.utils import (
     AttributeDict,
     add_eos,
     add_sos,
+    align_results_dict,
     encode_supervisions,
     get_texts,
     make_pad_mask,
+    write_error_stats,
 )
 
 
@@ -163,3 +168,28 @@ def test_add_eos():
         [[1, 2, eos_id], [3, eos_id], [eos_id], [5, 8, 9, eos_id]]
     )
     assert str(ragged_eos) == str(expected)
+
+
+def test_write_error_stats(tmp_path):
+    results = [
+        ("a", "THE CAT SAT".split(), "THE BAT SAT DOWN".split()),
+        ("b", "HELLO WORLD".split(), "HELLO".split()),
+    ]
+    f = io.StringIO()
+    wer = write_error_stats(
+        f, "test", results, enable_log=False, jsonl_filename=tmp_path / "a.jsonl"
+    )
+    assert wer == 60.0
+    assert "a:\tTHE (CAT->BAT) SAT (*->DOWN)" in f.getvalue()
+
+    lines = [json.loads(line) for line in open(tmp_path / "a.jsonl")]
+    assert lines[0]["cut_id"] == "a"
+    assert (lines[0]["sub"], lines[0]["ins"], lines[0]["corr"]) == (1, 1, 2)
+    assert lines[1]["del"] == 1
+
+    # The same results with alignments computed in other processes, one
+    # utterance per process
+    alignments = align_results_dict({"x": list(results)}, num_jobs=2, chunk_size=1)["x"]
+    f2 = io.StringIO()
+    write_error_stats(f2, "test", results, enable_log=False, alignments=alignments)
+    assert f2.getvalue() == f.getvalue()